@@ -1,9 +1,53 @@
 from amaranth import *
 from amaranth.build import *
 
-class SingleCRC(Elaboratable):
+__all__ = ["crc_matrix", "ParallelCRC", "SingleCRC", "CRC", "LCRC"]
+
+def crc_matrix(polynomial, crc_size, data_bits):
 	"""
-	CRC generator for a variable number of data bits, calculates CRC of inputted data bits combinatorially
+	Calculates the next-state matrix of a CRC over GF(2) by running the serial CRC symbolically.
+
+	Every CRC bit is represented as a pair of bit masks (state_mask, data_mask), the next CRC bit is the XOR of all
+	current CRC bits in state_mask and all data bits in data_mask. Data bits are processed starting at bit 0.
+
+	Parameters
+	----------
+	polynomial : int
+		CRC polynomial
+	crc_size : int
+		CRC size, for example 16 for CRC16.
+	data_bits : int
+		Number of data bits processed in one step
+	"""
+	state = [(1 << i, 0) for i in range(crc_size)]
+	for i in range(data_bits):
+		# The input value is the input data XORed with the last bit of the CRC
+		feedback = (state[crc_size - 1][0], state[crc_size - 1][1] ^ (1 << i))
+
+		# Shift the last CRC value and XOR all bits of it which are 1 in the polynomial with the input value
+		next_state = []
+		for j in range(crc_size):
+			shifted = state[j - 1] if j > 0 else (0, 0)
+			if polynomial & (1 << j):
+				next_state.append((shifted[0] ^ feedback[0], shifted[1] ^ feedback[1]))
+			else:
+				next_state.append(shifted)
+		state = next_state
+
+	return state
+
+def _xor_bits(value, mask):
+	"""
+	XORs all bits of value which are set in mask, returns a constant 0 if no bit is set.
+	"""
+	bits = [value[i] for i in range(len(value)) if mask & (1 << i)]
+	if len(bits) == 0:
+		return C(0, 1)
+	return Cat(*bits).xor()
+
+class ParallelCRC(Elaboratable):
+	"""
+	Parallel CRC generator for any data width, the next-state matrix is calculated at elaboration time and results in a flat XOR network per CRC bit
 
 	Parameters
 	----------
@@ -19,44 +63,98 @@ class SingleCRC(Elaboratable):
 		CRC size, for example 16 for CRC16.
 	reset : Signal()
 		Reset CRC Generator
+	byte_enable : Signal(len(input) // 8) or None
+		Byte enables, only the enabled bytes are processed and the CRC holds its value if none is enabled.
+		If None, all input bits are processed every cycle.
+	pipeline : bool
+		Registers the data part of the XOR network before it is added to the CRC, which adds one cycle of latency.
+		reset, start and byte_enable are delayed accordingly.
+	start : Signal() or None
+		Process the data starting from the initial value instead of the current CRC value, for starting a new CRC
+		in the cycle after the last data of the previous one.
+	patterns : [int] or None
+		Byte enable values which can occur, each one needs to be contiguous. Defaults to the lowest n bytes for any n.
 	"""
-	def __init__(self, input, init, polynomial, crc_size):
-		self.input	  = input
-		self.output	 = Signal(crc_size, reset = init)
-		self.init	   = init
-		self.polynomial = polynomial
-		self.crc_size   = crc_size
-	
+	def __init__(self, input, init, polynomial, crc_size, reset, byte_enable = None, pipeline = False, start = None, patterns = None):
+		self.input       = input
+		self.output      = Signal(crc_size, reset = init)
+		self.init        = init
+		self.polynomial  = polynomial
+		self.crc_size    = crc_size
+		self.reset       = reset
+		self.byte_enable = byte_enable
+		self.pipeline    = pipeline
+		self.start       = start
+		self.patterns    = patterns
+
+		if byte_enable is not None:
+			assert len(input) % 8 == 0
+			assert len(byte_enable) == len(input) // 8
+
 	def elaborate(self, platform):
 		m = Module()
 
-		last = Const(self.init)
-		for i in range(len(self.input)):
-			# The input value is the input data XORed with the last bit of the CRC
-			in_val = self.input[i] ^ last[self.crc_size - 1]
-
-			# All values to XOR
-			in_vals = [None] * self.crc_size
-			for j in range(self.crc_size):
-				# If the polynomial is 1 at a bit, XOR it with that bit in the input value
-				if (self.polynomial & (1 << j)) == 0:
-					in_vals[j] = 0
-				else:
-					in_vals[j] = in_val
-
-			# Current CRC value
-			current = Signal(self.crc_size) # This needs to be a signal, otherwise the simulation doesn't work
-			# Shift the last CRC value and XOR all bits of it which are 1 in the polynomial with the input value
-			m.d.comb += current.eq((Cat(last) << 1)[0:self.crc_size] ^ Cat(in_vals))
-			last = current
-	
-		m.d.comb += self.output.eq(last)
+		# First bit and number of bits processed for every valid byte enable pattern
+		if self.byte_enable is None:
+			widths = {0: (0, len(self.input))}
+			select = C(0, 1)
+		else:
+			patterns = self.patterns if self.patterns is not None else [(1 << i) - 1 for i in range(1, len(self.byte_enable) + 1)]
+			widths = {}
+			for pattern in patterns:
+				first = (pattern & -pattern).bit_length() - 1
+				count = bin(pattern).count("1")
+				assert pattern >> first == (1 << count) - 1 # Byte enables need to be contiguous
+				widths[pattern] = (8 * first, 8 * count)
+			select = self.byte_enable
+
+		matrices = {pattern: crc_matrix(self.polynomial, self.crc_size, bits) for pattern, (_, bits) in widths.items()}
+
+		def data_term(pattern):
+			first = widths[pattern][0]
+			return Cat(_xor_bits(self.input[first:], matrices[pattern][i][1]) for i in range(self.crc_size))
+
+		start = C(0, 1) if self.start is None else self.start
+
+		if self.pipeline:
+			data = Signal(self.crc_size)
+			data_select = Signal.like(select)
+			reset = Signal()
+			data_start = Signal()
+			m.d.sync += data_select.eq(select)
+			m.d.sync += reset.eq(self.reset)
+			m.d.sync += data_start.eq(start)
+			m.d.sync += data.eq(0)
+			with m.Switch(select):
+				for pattern in widths:
+					with m.Case(pattern):
+						m.d.sync += data.eq(data_term(pattern))
+
+		else:
+			data_select = select
+			reset = self.reset
+			data_start = start
+			data = None
+
+		state = Mux(data_start, self.init, self.output)
+
+		def state_term(pattern):
+			return Cat(_xor_bits(state, matrices[pattern][i][0]) for i in range(self.crc_size))
+
+		# Setting the output to the initial value resets it
+		with m.If(reset):
+			m.d.sync += self.output.eq(self.init)
+		with m.Else():
+			with m.Switch(data_select):
+				for pattern in widths:
+					with m.Case(pattern):
+						m.d.sync += self.output.eq(state_term(pattern) ^ (data if self.pipeline else data_term(pattern)))
 
 		return m
 
-class CRC(Elaboratable):
+class SingleCRC(Elaboratable):
 	"""
-	CRC generator for a variable number of data bits
+	CRC generator for a variable number of data bits, calculates CRC of inputted data bits combinatorially
 
 	Parameters
 	----------
@@ -70,51 +168,28 @@ class CRC(Elaboratable):
 		CRC polynomial
 	crc_size : int
 		CRC size, for example 16 for CRC16.
-	reset : Signal()
-		Reset CRC Generator
 	"""
-	def __init__(self, input, init, polynomial, crc_size, reset):
+	def __init__(self, input, init, polynomial, crc_size):
 		self.input	  = input
 		self.output	 = Signal(crc_size, reset = init)
 		self.init	   = init
 		self.polynomial = polynomial
 		self.crc_size   = crc_size
-		self.reset	  = reset
-	
-	def elaborate(self, platform): # TODO: Apparently this generates 512 wires, look at new amaranth CRC gen when it is upstream
+
+	def elaborate(self, platform):
 		m = Module()
 
-		last = self.output
-		for i in range(len(self.input)):
-			# The input value is the input data XORed with the last bit of the CRC
-			in_val = self.input[i] ^ last[self.crc_size - 1]
-
-			# All values to XOR
-			in_vals = [None] * self.crc_size
-			for j in range(self.crc_size):
-				# If the polynomial is 1 at a bit, XOR it with that bit in the input value
-				if (self.polynomial & (1 << j)) == 0:
-					in_vals[j] = 0
-				else:
-					in_vals[j] = in_val
-
-			# Current CRC value
-			current = Signal(self.crc_size) # This needs to be a signal, otherwise the simulation doesn't work
-			# Shift the last CRC value and XOR all bits of it which are 1 in the polynomial with the input value
-			m.d.comb += current.eq((Cat(last) << 1)[0:self.crc_size] ^ Cat(in_vals))
-			last = current
-		
-		# Setting the output to the initial value resets it
-		with m.If(self.reset):
-			m.d.sync += self.output.eq(self.init)
-		with m.Else():
-			m.d.sync += self.output.eq(last)
+		# The initial value is constant, so its part of the matrix is folded into an inversion of the output bits
+		matrix = crc_matrix(self.polynomial, self.crc_size, len(self.input))
+		for i, (state_mask, data_mask) in enumerate(matrix):
+			invert = bin(state_mask & self.init).count("1") & 1
+			m.d.comb += self.output[i].eq(_xor_bits(self.input, data_mask) ^ invert)
 
 		return m
 
-class LCRC(Elaboratable):
+class CRC(ParallelCRC):
 	"""
-	LCRC generator for a variable number of data bits, currently 16 and 32 while 32 is best supported
+	CRC generator for a variable number of data bits
 
 	Parameters
 	----------
@@ -122,118 +197,74 @@ class LCRC(Elaboratable):
 		Data input
 	output : Signal()
 		Data output
+	init : int
+		Initial CRC value
+	polynomial : int
+		CRC polynomial
 	crc_size : int
 		CRC size, for example 16 for CRC16.
 	reset : Signal()
 		Reset CRC Generator
 	"""
-	def __init__(self, input, reset):
-		self.input      = input
-		self.init       = 0xFFFFFFFF
-		self.polynomial = 0x04C11DB7
-		self.crc_size   = 32
-		self.reset      = reset
-		self.output     = Signal(self.crc_size, reset = self.init)
-	
-	def elaborate(self, platform): # TODO: Apparently this generates 512 wires
+	def __init__(self, input, init, polynomial, crc_size, reset):
+		super().__init__(input, init, polynomial, crc_size, reset)
+
+class LCRC(Elaboratable):
+	"""
+	LCRC generator for a variable number of data bits, the output is inverted and byte-swapped to be sent in transmission order.
+
+	When no byte enables are given and the input is 32 bits wide, only the lower 16 bits are processed in the first cycle after reset is deasserted, which is where the sequence number is.
+
+	Parameters
+	----------
+	input : Signal()
+		Data input
+	output : Signal()
+		Data output
+	reset : Signal()
+		Reset CRC Generator
+	byte_enable : Signal(len(input) // 8) or None
+		Byte enables, see ParallelCRC
+	pipeline : bool
+		Adds a pipeline register, see ParallelCRC
+	start : Signal() or None
+		Start a new CRC with the current data, see ParallelCRC
+	patterns : [int] or None
+		Byte enable values which can occur, see ParallelCRC
+	"""
+	def __init__(self, input, reset, byte_enable = None, pipeline = False, start = None, patterns = None):
+		self.input       = input
+		self.init        = 0xFFFFFFFF
+		self.polynomial  = 0x04C11DB7
+		self.crc_size    = 32
+		self.reset       = reset
+		self.byte_enable = byte_enable
+		self.pipeline    = pipeline
+		self.start       = start
+		self.patterns    = patterns
+		self.output      = Signal(self.crc_size, reset = self.init)
+
+	def elaborate(self, platform):
 		m = Module()
 
-		last_reset = Signal()
-		m.d.sync += last_reset.eq(self.reset)
-
-		self.intermediate = Signal(self.crc_size, reset = self.init)
-
-		if len(self.input) == 32:
-			with m.If(last_reset & ~self.reset):
-				last = self.intermediate
-				for i in range(16):
-					# The input value is the input data XORed with the last bit of the CRC
-					in_val = self.input[i] ^ last[self.crc_size - 1]
-
-					# All values to XOR
-					in_vals = [None] * self.crc_size
-					for j in range(self.crc_size):
-						# If the polynomial is 1 at a bit, XOR it with that bit in the input value
-						if (self.polynomial & (1 << j)) == 0:
-							in_vals[j] = 0
-						else:
-							in_vals[j] = in_val
-
-					# Current CRC value
-					current = Signal(self.crc_size) # This needs to be a signal, otherwise the simulation doesn't work
-					# Shift the last CRC value and XOR all bits of it which are 1 in the polynomial with the input value
-					#m.d.comb += current[:16].eq(0xFFFF)
-					#m.d.comb += current[16:].eq((Cat(last) << 1)[0 : self.crc_size] ^ Cat(in_vals))
-					m.d.comb += current.eq((Cat(last) << 1)[0 : self.crc_size] ^ Cat(in_vals))
-					last = current
-
-				# Setting the output to the initial value resets it
-				# TODO: Redundant
-				with m.If(self.reset):
-					m.d.sync += self.intermediate.eq(self.init)
-				with m.Else():
-					m.d.sync += self.intermediate.eq(last)
-			
-			with m.Else():
-				last = self.intermediate
-				for i in range(len(self.input)):
-					# The input value is the input data XORed with the last bit of the CRC
-					in_val = self.input[i] ^ last[self.crc_size - 1]
-
-					# All values to XOR
-					in_vals = [None] * self.crc_size
-					for j in range(self.crc_size):
-						# If the polynomial is 1 at a bit, XOR it with that bit in the input value
-						if (self.polynomial & (1 << j)) == 0:
-							in_vals[j] = 0
-						else:
-							in_vals[j] = in_val
-
-					# Current CRC value
-					current = Signal(self.crc_size) # This needs to be a signal, otherwise the simulation doesn't work
-					# Shift the last CRC value and XOR all bits of it which are 1 in the polynomial with the input value
-					m.d.comb += current.eq((Cat(last) << 1)[0 : self.crc_size] ^ Cat(in_vals))
-					last = current
-
-				# Setting the output to the initial value resets it
-				with m.If(self.reset):
-					m.d.sync += self.intermediate.eq(self.init)
-				with m.Else():
-					m.d.sync += self.intermediate.eq(last)
-		
-		else:
-			last = self.intermediate
-			for i in range(len(self.input)):
-				# The input value is the input data XORed with the last bit of the CRC
-				in_val = self.input[i] ^ last[self.crc_size - 1]
-
-				# All values to XOR
-				in_vals = [None] * self.crc_size
-				for j in range(self.crc_size):
-					# If the polynomial is 1 at a bit, XOR it with that bit in the input value
-					if (self.polynomial & (1 << j)) == 0:
-						in_vals[j] = 0
-					else:
-						in_vals[j] = in_val
-
-				# Current CRC value
-				current = Signal(self.crc_size) # This needs to be a signal, otherwise the simulation doesn't work
-				# Shift the last CRC value and XOR all bits of it which are 1 in the polynomial with the input value
-				m.d.comb += current.eq((Cat(last) << 1)[0 : self.crc_size] ^ Cat(in_vals))
-				last = current
-			
-			# Setting the output to the initial value resets it
-			with m.If(self.reset):
-				m.d.sync += self.intermediate.eq(self.init)
-			with m.Else():
-				m.d.sync += self.intermediate.eq(last)
-		
-		if len(self.input) == 32:
-			for i in [0, 8, 16, 24]:
-				m.d.comb += self.output[24 - i : 24 - i + 8].eq(~self.intermediate[i : i + 8][::-1])
+		byte_enable = self.byte_enable
 
-		else:
+		if byte_enable is None and len(self.input) == 32:
+			last_reset = Signal()
+			m.d.sync += last_reset.eq(self.reset)
+
+			byte_enable = Signal(4)
+			m.d.comb += byte_enable.eq(Mux(last_reset & ~self.reset, 0b0011, 0b1111))
+
+		m.submodules.crc = crc = ParallelCRC(self.input, self.init, self.polynomial, self.crc_size, self.reset, byte_enable, self.pipeline, self.start, self.patterns)
+		self.intermediate = crc.output
+
+		if len(self.input) == 16:
 			for i in [0, 8]:
 				m.d.comb += self.output[8 - i : 8 - i + 8].eq(~self.intermediate[i : i + 8][::-1])
 
+		else:
+			for i in [0, 8, 16, 24]:
+				m.d.comb += self.output[24 - i : 24 - i + 8].eq(~self.intermediate[i : i + 8][::-1])
+
 		return m
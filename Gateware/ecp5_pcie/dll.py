@@ -18,6 +18,12 @@ class FCType(IntEnum):
 	FC2 = 3
 	UpdateFC = 2
 
+class PMType(IntEnum):
+	Enter_L1 = 0
+	Enter_L23 = 1
+	Active_State_Request_L1 = 3
+	Request_Ack = 4
+
 #
 # This implements the PCIe Data Link Layer
 #
@@ -33,11 +39,22 @@ class PCIeDLL(Elaboratable): # Based on Yumewatary phy.py
 	up : Signal()
 		Whether the DLL is active
 	credits_tx : Record(dll_layout)
-		Credits to transmit
+		Credits to transmit, CREDITS_ALLOCATED of the receiver
 	credits_rx : Record(dll_layout)
 		Received credits
 	speed : Signal()
 		Speed, from LinkSpeed enum from serdes.py
+
+	DLLPs are scheduled by priority, see section 3.5.2.1 on page 144 in PCIe 1.1: Nak or Ack, Flow Control and then PM DLLPs.
+	They are only started between TLPs, sending_tlp is driven by the TLP transmitter, which in turn doesn't start a TLP while
+	sending_dllp is set. Neither TLPs nor DLLPs are started while the PHY has SKP ordered sets pending (skp_pending), so the
+	SKP ordered sets are sent once the packet in progress is done instead of waiting for a gap in back to back TLPs.
+
+	Active State Power Management L1 is negotiated when it is enabled in ltssm.aspm_control, see section 5.4.1.3 on page 347
+	in PCIe 1.1. An upstream port requests it with PM_Active_State_Request_L1 DLLPs after l1_idle_time without traffic and
+	once all of its TLPs have been acknowledged, a downstream port acknowledges the request with PM_Request_Ack DLLPs until
+	it receives an EIOS. New TLPs wait while L1 is negotiated (block_tlps), a TLP which is waiting wakes the link (exit_l1).
+	L1 is over once the LTSSM has left it (ltssm.status.l1), the link stays up while it goes through Recovery.
 	"""
 	def __init__(self, ltssm : PCIeLTSSM, tx : PCIeDLLPTransmitter, rx : PCIeDLLPReceiver, clk_freq : int, use_speed : bool):
 		self.up = Signal()
@@ -66,6 +83,32 @@ class PCIeDLL(Elaboratable): # Based on Yumewatary phy.py
 		self.received_ack_nak_id = Signal(12)
 		"""ID of Ack or Nak DLLP which was received"""
 
+		self.update_fc = Signal()
+		"""Set to 1 for 1 cycle to send UpdateFC DLLPs, for example when receive buffer space has been freed"""
+
+		self.schedule_pm = Signal()
+		"""Schedule a PM DLLP, configured with scheduled_pm"""
+		self.scheduled_pm = Signal(3)
+		"""Type of the PM DLLP, for example 0 for PM_Enter_L1"""
+
+		self.sending_tlp = Signal()
+		"""Whether a TLP is being transmitted, DLLPs wait until it is done"""
+		self.sending_dllp = Signal()
+		"""Whether a DLLP is pending or being transmitted, new TLPs must wait"""
+		self.skp_pending = Signal(4)
+		"""Number of SKP ordered sets the PHY is waiting to send, each takes the slot of one word, new packets must wait"""
+
+		self.tlp_pending = Signal()
+		"""Whether a TLP is waiting to be sent, driven by the TLP transmitter"""
+		self.block_tlps = Signal()
+		"""Whether L1 is being negotiated or the link is in L1, new TLPs must wait"""
+		self.enter_l1 = Signal()
+		"""L1 has been negotiated, the LTSSM goes to L1"""
+		self.exit_l1 = Signal()
+		"""A TLP is waiting in L1, the LTSSM leaves L1"""
+		self.l1_idle_time = 10E-6
+		"""Time without traffic in seconds after which an upstream port requests L1"""
+
 		self.debug_state = Signal(8, decoder=State)
 
 		self.state = [
@@ -85,38 +128,27 @@ class PCIeDLL(Elaboratable): # Based on Yumewatary phy.py
 		got_np = Signal()
 		got_cpl = Signal()
 
-		# One credit equals 4 DW / 16 byte
-		m.d.comb += [ # Fix this maybe
-			#self.credits_tx.PH.eq(32),
-			#self.credits_tx.PD.eq(0xE0),
-			#self.credits_tx.NPH.eq(32),
-			#self.credits_tx.NPD.eq(0x20),
-			#self.credits_tx.CPLH.eq(0), # Must advertise infinite as root complex or endpoint
-			#self.credits_tx.CPLD.eq(0), #
-			#self.credits_tx.PH.eq(32),
-			#self.credits_tx.PD.eq(0xE0),
-			#self.credits_tx.NPH.eq(32),
-			#self.credits_tx.NPD.eq(0xE0),
-			#self.credits_tx.CPLH.eq(0), # Must advertise infinite as root complex or endpoint
-			#self.credits_tx.CPLD.eq(0), #
-			self.credits_tx.PH.eq(2),
-			self.credits_tx.PD.eq(0x20),
-			self.credits_tx.NPH.eq(2),
-			self.credits_tx.NPD.eq(0x02),
-			self.credits_tx.CPLH.eq(0), # Must advertise infinite as root complex or endpoint
-			self.credits_tx.CPLD.eq(0), #
-		]
+		# One credit equals 4 DW / 16 byte, credits_tx is driven by the TLP receiver since it depends on its buffer
+
+		# Pending DLLPs, Flow Control DLLPs are in the order P, NP, CPL
+		ack_nak_pending = Signal()
+		fc_pending = Signal(3)
+		pm_pending = Signal()
+		pm_type = Signal(3)
 
-		# Which DLLPs to transmit, only concerning Flow Control Initialization
+		# Type of Flow Control DLLPs, a round of InitFC DLLPs is done once the CPL DLLP has started
 		fc_type = Signal(2)
-		transmit_dllps = Signal()
 		done_dllp_transmission = Signal()
-
-		# For later use
-		sending_tlp = Signal() # TODO: Connect this wire for proper operation
+		sending_fc_cpl = Signal()
+		started_fc_cpl = Signal()
+		m.d.comb += started_fc_cpl.eq(self.tx.started_sending & sending_fc_cpl)
 
 		m.d.rx += self.received_ack_nak.eq(0)
 
+		# Received PM DLLPs
+		received_pm_request = Signal()
+		received_pm_ack = Signal()
+
 		# Get update DLLPs
 		with m.If(~self.ltssm.status.link.up):
 			pass
@@ -145,6 +177,10 @@ class PCIeDLL(Elaboratable): # Based on Yumewatary phy.py
 			m.d.rx += self.received_ack.eq(0)
 			m.d.rx += self.received_ack_nak_id.eq(self.rx.dllp.data)
 
+		with m.Elif(self.rx.dllp.valid & (self.rx.dllp.type == DLLPType.PM)):
+			m.d.comb += received_pm_request.eq(self.rx.dllp.type_meta == PMType.Active_State_Request_L1)
+			m.d.comb += received_pm_ack.eq(self.rx.dllp.type_meta == PMType.Request_Ack)
+
 		# Data Link Layer State Machine, Page 129 in PCIe 1.1
 		with m.FSM(domain="rx") as x:
 			with m.State(State.DL_Inactive):
@@ -155,7 +191,9 @@ class PCIeDLL(Elaboratable): # Based on Yumewatary phy.py
 					got_np.eq(0),
 					got_cpl.eq(0),
 					done_dllp_transmission.eq(0),
-					transmit_dllps.eq(0),
+					ack_nak_pending.eq(0),
+					fc_pending.eq(0),
+					pm_pending.eq(0),
 					self.received_ack_nak.eq(0),
 				]
 
@@ -180,20 +218,28 @@ class PCIeDLL(Elaboratable): # Based on Yumewatary phy.py
 					m.d.rx += self.credits_rx.CPLD.eq(self.rx.dllp.data)
 					m.d.rx += got_cpl.eq(1)
 				
+				# InitFC DLLPs are sent continuously
 				m.d.rx += fc_type.eq(FCType.FC1)
-				m.d.rx += transmit_dllps.eq(1)
+				with m.If(fc_pending == 0):
+					m.d.rx += fc_pending.eq(0b111)
+
+				with m.If(started_fc_cpl & (self.tx.dllp.type[2:4] == FCType.FC1)):
+					m.d.rx += done_dllp_transmission.eq(1)
 				
 				with m.If(got_p & got_np & got_cpl & done_dllp_transmission):
 					m.d.rx += done_dllp_transmission.eq(0)
-					m.d.rx += transmit_dllps.eq(0)
 					m.next = State.DL_Init_FC2
 
 			with m.State(State.DL_Init_FC2):
 				m.d.rx += self.debug_state.eq(State.DL_Init_FC2)
 				m.d.rx += fc_type.eq(FCType.FC2)
-				m.d.rx += transmit_dllps.eq(1)
+				with m.If(fc_pending == 0):
+					m.d.rx += fc_pending.eq(0b111)
+
+				with m.If(started_fc_cpl & (self.tx.dllp.type[2:4] == FCType.FC2)):
+					m.d.rx += done_dllp_transmission.eq(1)
+
 				with m.If(done_dllp_transmission & (self.rx.dllp.type[2:4] == FCType.FC2)):
-					m.d.rx += transmit_dllps.eq(0)
 					m.next = State.DL_Active
 
 			with m.State(State.DL_Active):
@@ -201,132 +247,164 @@ class PCIeDLL(Elaboratable): # Based on Yumewatary phy.py
 				# This is supposed to be in the above state, but does it matter?
 				m.d.rx += self.up.eq(1)
 
-				# Send DLLP UpdateFC packets often enough, assumes 62.5 MHz clock, transmits every 20 µs if there is no other ongoing transmission
-				clk = 62500000
+				# Send DLLP UpdateFC packets when the receiver has freed credits and every 20 µs.
+				# clk_freq is the clock frequency at 5 GT/s, at 2.5 GT/s the timer is shifted to count twice as fast.
+				clk = self.clk_freq
 				min_delay = 20E-6
 				update_timer = Signal(range(int(min_delay * clk + 1)))
 
 				m.d.rx += update_timer.eq(update_timer + 1)
-				m.d.rx += transmit_dllps.eq(0)
 
-				with m.If(((update_timer << (self.speed if self.use_speed else 0)) >= int(min_delay * clk)) & ~sending_tlp):
+				# UpdateFC DLLPs aren't needed for infinite credits, which completions usually are
+				cpl_finite = (self.credits_tx.CPLH != 0) | (self.credits_tx.CPLD != 0)
+
+				with m.If(((update_timer << (self.speed if self.use_speed else 0)) >= int(min_delay * clk)) | self.update_fc):
 					m.d.rx += fc_type.eq(FCType.UpdateFC)
-					m.d.rx += transmit_dllps.eq(1)
-					m.d.rx += done_dllp_transmission.eq(0)
+					m.d.rx += fc_pending.eq(fc_pending | Cat(1, 1, cpl_finite))
 					m.d.rx += update_timer.eq(0)
-				#with m.Elif(done_dllp_transmission):
-				#    m.d.rx += transmit_dllps.eq(0)
 					
 				with m.If(~self.ltssm.status.link.up): # TODO: Why does it cause u-boot on the RP64 to reboot?
 					m.next = State.DL_Inactive
 		
 
-		# DLLP sending FSM
-		# TODO: It transmits the first packet twice. This doesn't break it but it unnecessarily takes up bandwidth.
-		send_ack_nak = Signal()
-		with m.If(self.schedule_ack_nak):
-			m.d.rx += send_ack_nak.eq(1)
-
-		timer = Signal(6)
+		# DLLP scheduler, the highest priority pending DLLP is selected once the previous one has started and no TLP is being sent.
+		# Pending DLLPs hold off new TLPs, so they are sent once the current TLP is done even if TLPs follow back to back.
+		# At ratios above 4 a DLLP takes one word, so the next one can be selected in the cycle the current one starts.
+		select = Signal()
+		next_dllp = ~self.tx.send | (self.tx.started_sending if self.tx.ratio > 4 else 0)
+		m.d.comb += select.eq((ack_nak_pending | (fc_pending != 0) | pm_pending) & next_dllp & ~self.sending_tlp & (self.skp_pending == 0))
+		m.d.comb += self.sending_dllp.eq(ack_nak_pending | (fc_pending != 0) | pm_pending | self.tx.send)
 
-		with m.FSM(domain="rx"):
-			with m.State("Idle"):
-				m.d.rx += self.tx.send.eq(0)
+		with m.If(self.tx.started_sending):
+			m.d.rx += self.tx.send.eq(0)
 
-				with m.If(transmit_dllps):
-					m.next = "Pre-1"
+		with m.If(select):
+			m.d.rx += self.tx.send.eq(1)
+			m.d.rx += self.tx.dllp.valid.eq(1)
+			m.d.rx += self.tx.dllp.type_meta.eq(0)
+			m.d.rx += sending_fc_cpl.eq(0)
 
-				with m.Elif(send_ack_nak & ~sending_tlp): # TODO: This might be a problem
-					m.next = "Ack_Nak"
-			
-			with m.State("Pre-1"):
-				m.d.rx += timer.eq(0)
-				m.d.rx += self.tx.send.eq(0)
-				m.next = "Pre-2"
-			
-			with m.State("Pre-2"):
-				m.d.rx += timer.eq(timer + 1)
-
-				with m.If(timer == 10):
-					m.next = "P"
-
-			# Const(n, 2) means n = 0: P, n = 1: NP, n = 2: CPL
-			with m.State("P"):
-				#with m.If(~transmit_dllps):
-				#    m.d.rx += done_dllp_transmission.eq(0)
-				#    m.next = "Idle"
-
-				m.d.rx += [
-					self.tx.dllp.type.eq(Cat(Const(0, 2), fc_type)),
-					self.tx.dllp.header.eq(self.credits_tx.PH),
-					self.tx.dllp.data.eq(self.credits_tx.PD),
-					self.tx.dllp.valid.eq(1),
-					self.tx.send.eq(1),
-				]
-
-				with m.If(self.tx.started_sending):
-					m.d.rx += self.tx.send.eq(0)
-					m.next = "NP"
-
-			with m.State("NP"):
-				#with m.If(~transmit_dllps):
-				#    m.d.rx += done_dllp_transmission.eq(0)
-				#    m.next = "Idle"
-					
-				m.d.rx += [
-					self.tx.dllp.type.eq(Cat(Const(1, 2), fc_type)),
-					self.tx.dllp.header.eq(self.credits_tx.NPH),
-					self.tx.dllp.data.eq(self.credits_tx.NPD),
-					self.tx.dllp.valid.eq(1),
-					self.tx.send.eq(1),
-				]
-
-				with m.If(self.tx.started_sending):
-					m.d.rx += self.tx.send.eq(0)
-					with m.If(fc_type == FCType.UpdateFC): # Other devices don't seem to transmit CPL in UpdateFC (TODO)
-						# This is kind of a hack to ensure that it doesn't toggle to 1 when it isn't supposed to transmit (but still finishing a transmission)
-						m.d.rx += done_dllp_transmission.eq(transmit_dllps)
-						with m.If(transmit_dllps):
-							m.next = "Pre-1"
-						with m.Else():
-							m.next = "Idle"
-					
-					with m.Else():
-						m.next = "CPL"
-
-			with m.State("CPL"):
-				#with m.If(~transmit_dllps):
-				#    m.d.rx += done_dllp_transmission.eq(0)
-				#    m.next = "Idle"
-					
+			with m.If(ack_nak_pending):
 				m.d.rx += [
-					self.tx.dllp.type.eq(Cat(Const(2, 2), fc_type)),
-					self.tx.dllp.header.eq(self.credits_tx.CPLH),
-					self.tx.dllp.data.eq(self.credits_tx.CPLD),
-					self.tx.dllp.valid.eq(1),
-					self.tx.send.eq(1),
+					ack_nak_pending.eq(0),
+					self.tx.dllp.type.eq(Mux(self.scheduled_ack, DLLPType.Ack, DLLPType.Nak)),
+					self.tx.dllp.header.eq(0),
+					self.tx.dllp.data.eq(self.scheduled_ack_nak_id),
 				]
 
-				with m.If(self.tx.started_sending):
-					m.d.rx += self.tx.send.eq(0)
-					# This is kind of a hack to ensure that it doesn't toggle to 1 when it isn't supposed to transmit (but still finishing a transmission)
-					m.d.rx += done_dllp_transmission.eq(transmit_dllps)
-					with m.If(transmit_dllps):
-						m.next = "Pre-1"
-					with m.Else():
-						m.next = "Idle"
-			
-			with m.State("Ack_Nak"):
+			# Const(n, 2) means n = 0: P, n = 1: NP, n = 2: CPL
+			for i, (header, data) in enumerate([("PH", "PD"), ("NPH", "NPD"), ("CPLH", "CPLD")]):
+				with m.Elif(fc_pending[i]):
+					m.d.rx += [
+						fc_pending[i].eq(0),
+						self.tx.dllp.type.eq(Cat(Const(i, 2), fc_type)),
+						self.tx.dllp.header.eq(self.credits_tx[header]),
+						self.tx.dllp.data.eq(self.credits_tx[data]),
+						sending_fc_cpl.eq(i == 2),
+					]
+
+			with m.Else():
 				m.d.rx += [
-					self.tx.dllp.type.eq(Mux(self.scheduled_ack, DLLPType.Ack, DLLPType.Nak)),
+					pm_pending.eq(0),
+					self.tx.dllp.type.eq(DLLPType.PM),
+					self.tx.dllp.type_meta.eq(pm_type),
 					self.tx.dllp.header.eq(0),
-					self.tx.dllp.data.eq(self.scheduled_ack_nak_id),
-					self.tx.dllp.valid.eq(1),
-					self.tx.send.eq(1),
-					send_ack_nak.eq(0),
+					self.tx.dllp.data.eq(0),
 				]
 
-				with m.If(self.tx.started_sending):
-					m.next = "Idle"
+		# New requests are kept even if the same type of DLLP has been selected in this cycle
+		with m.If(self.schedule_ack_nak):
+			m.d.rx += ack_nak_pending.eq(1)
+
+		with m.If(self.schedule_pm):
+			m.d.rx += pm_pending.eq(1)
+			m.d.rx += pm_type.eq(self.scheduled_pm)
+
+		# Active State Power Management L1 negotiation. The timer counts the time without traffic in L0 and the time the
+		# other side takes to answer while L1 is negotiated.
+		l1_enabled = self.ltssm.aspm_control[1]
+		pm_time = int(self.l1_idle_time * self.clk_freq)
+		pm_timer = Signal(range(pm_time + 1))
+		retry_buffer_empty = self.status.retry_buffer_occupation == 0
+		pm_timeout = (pm_timer << (self.speed if self.use_speed else 0)) >= pm_time
+
+		with m.If(~pm_timeout):
+			m.d.rx += pm_timer.eq(pm_timer + 1)
+
+		with m.FSM(domain="rx", name="ASPM_L1"):
+			with m.State("L0"):
+				with m.If(self.tlp_pending | self.sending_tlp | self.sending_dllp | ~retry_buffer_empty):
+					m.d.rx += pm_timer.eq(0)
+
+				if self.ltssm.upstream:
+					with m.If(self.up & l1_enabled & pm_timeout):
+						m.d.rx += pm_timer.eq(0)
+						m.next = "Request"
+
+				else:
+					with m.If(self.up & l1_enabled & received_pm_request):
+						m.d.rx += pm_timer.eq(0)
+						m.next = "Accept"
+
+			# Send PM_Active_State_Request_L1 until PM_Request_Ack arrives, give up if it doesn't
+			with m.State("Request"):
+				m.d.comb += self.block_tlps.eq(1)
+
+				with m.If(~pm_pending):
+					m.d.rx += pm_pending.eq(1)
+					m.d.rx += pm_type.eq(PMType.Active_State_Request_L1)
+
+				with m.If(received_pm_ack):
+					m.d.rx += pm_pending.eq(0)
+					m.next = "L1"
+
+				with m.Elif(pm_timeout | ~self.up):
+					m.next = "L0"
+
+			# All TLPs need to be acknowledged before accepting the request
+			with m.State("Accept"):
+				m.d.comb += self.block_tlps.eq(1)
+
+				with m.If(retry_buffer_empty & ~self.sending_tlp):
+					m.d.rx += pm_timer.eq(0)
+					m.next = "Ack"
+
+				with m.If(~self.up):
+					m.next = "L0"
+
+			# Send PM_Request_Ack until the other side sends an EIOS, which makes the receiver go to L0s
+			with m.State("Ack"):
+				m.d.comb += self.block_tlps.eq(1)
+
+				with m.If(~pm_pending):
+					m.d.rx += pm_pending.eq(1)
+					m.d.rx += pm_type.eq(PMType.Request_Ack)
+
+				with m.If(self.ltssm.status.rx_l0s):
+					m.d.rx += pm_pending.eq(0)
+					m.next = "L1"
+
+				with m.Elif(pm_timeout | ~self.up):
+					m.next = "L0"
+
+			# The LTSSM goes to L1 once the packet in progress has been sent
+			with m.State("L1"):
+				m.d.comb += self.block_tlps.eq(1)
+				m.d.comb += self.enter_l1.eq(1)
+
+				with m.If(self.ltssm.status.l1):
+					m.next = "L1-Idle"
+
+				with m.Elif(~self.up):
+					m.next = "L0"
+
+			# A waiting TLP wakes the link, L1 is left through Recovery, where TLPs wait in the PHY until the link is in L0
+			with m.State("L1-Idle"):
+				m.d.comb += self.block_tlps.eq(1)
+				m.d.comb += self.exit_l1.eq(self.tlp_pending)
+
+				with m.If(~self.ltssm.status.l1 | ~self.up):
+					m.d.rx += pm_timer.eq(0)
+					m.next = "L0"
 
 		return m
\ No newline at end of file
@@ -1,30 +1,79 @@
 from amaranth import *
 from amaranth.build import *
-from amaranth.lib.fifo import SyncFIFOBuffered
+from amaranth.lib.fifo import SyncFIFO, SyncFIFOBuffered
+import math
 
 from .layouts import dllp_layout
 from .serdes import K, D, Ctrl
 from .crc import LCRC
 from .stream import StreamInterface
 from .dll import PCIeDLL
-from .memory import TLPBuffer
+from .memory import TLPBuffer, InterleavedFIFO
+from .flow_control import PCIeFlowControl, FCClass, tlp_fc_class, tlp_data_credits
+
+def ack_nak_latency(max_payload_size: int, lanes: int) -> int:
+	"""
+	Unadjusted Ack transmission latency in symbol times, see Table 3-6 on page 150 in PCIe 1.1
+
+	Parameters
+	----------
+	max_payload_size : int
+		Max_Payload_Size in bytes
+	lanes : int
+		Link width
+	"""
+	widths = [1, 2, 4, 8, 12, 16, 32]
+	assert lanes in widths
+	# The AckFactor depends on the Max_Payload_Size and the link width
+	if max_payload_size <= 256:
+		ack_factor = [1.4, 1.4, 1.4, 2.5, 3.0, 3.0, 3.0][widths.index(lanes)]
+	else:
+		ack_factor = [1.0, 1.0, 1.0, 1.0, 2.0, 2.0, 2.0][widths.index(lanes)]
+	tlp_overhead = 28
+	internal_delay = 19
+	return int((max_payload_size + tlp_overhead) * ack_factor / lanes + internal_delay)
+
+def max_tlp_bytes(max_payload_size: int) -> int:
+	"""
+	Length of the longest TLP in bytes, a header of 4 DW, the payload and a TLP digest. The buffers only hold the TLP,
+	the sequence number and LCRC are added when it is sent and removed when it is received.
+
+	Parameters
+	----------
+	max_payload_size : int
+		Max_Payload_Size in bytes
+	"""
+	assert max_payload_size in [128, 256, 512, 1024, 2048, 4096]
+	return 16 + max_payload_size + 4
 
 class PCIeDLLTLPTransmitter(Elaboratable):
 	"""
+	PCIe Data Link Layer TLP transmitter, adds the sequence number and LCRC to TLPs and frames them
+
+	TLPs need to be a multiple of 4 bytes long and are delimited by first and last in the sink, the ratio needs to be a multiple of 4.
+	TLPs can follow each other without a gap, the STP of the next TLP is put into the word following the END.
+	A new TLP is only taken from the sink if the other side has advertised enough flow control credits for it.
+	TLPs aren't started while the DLL is sending a DLLP or the PHY has SKP ordered sets pending, dll.sending_tlp is set until
+	the TLP has left the framing pipeline.
+
+	The retry buffer holds TLPs of up to max_payload_size bytes of payload, the transaction layer mustn't send longer ones.
 	"""
-	def __init__(self, dll: PCIeDLL, ratio: int = 4):
+	def __init__(self, dll: PCIeDLL, ratio: int = 4, max_payload_size: int = 128):
 		self.tlp_sink = StreamInterface(8, ratio, name="TLP_Sink")
 		self.dllp_source = StreamInterface(9, ratio, name="DLLP_Source") # TODO: Maybe connect these in elaborate instead of where this class is instantiated
 
 		self.dll = dll
+		self.flow_control = PCIeFlowControl(dll.credits_rx)
+		"""Credits of the other side, the transaction layer can check credits of queued TLPs with it"""
 
 		self.send = Signal()
 		self.started_sending = Signal()
 		self.accepts_tlps = Signal()
 		self.nullify = Signal() # if this is 1 towards the end of the TLP, the TLP will be nullified (set to 1 in rx domain, will be set to 0 by this module)
-		assert len(self.dllp_source.symbol) == 4
-		assert len(self.tlp_sink.symbol) == 4
-		self.ratio = len(self.dllp_source.symbol)
+		assert ratio % 4 == 0
+		self.ratio = ratio
+		self.max_payload_size = max_payload_size
+		self.tlp_bytes = max_tlp_bytes(max_payload_size)
 
 		self.clocks_per_ms = 62500
 
@@ -32,6 +81,7 @@ class PCIeDLLTLPTransmitter(Elaboratable):
 		self.next_transmit_seq = Signal(12, reset=0x000) # TLP sequence number
 		self.ackd_seq = Signal(12, reset=0xFFF) # Last acknowledged TLP
 		self.replay_num = Signal(2, reset=0b00) # Number of times the retry buffer has been re-transmitted
+		self.retrain = Signal() # Is 1 for 1 cycle after REPLAY_NUM has rolled over, the link needs to be retrained
 		self.replay_timeout = 462 # TODO: is 462 right number? See page 148 Table 3-4 PCIe 1.1
 		self.replay_timer = Signal(range(self.replay_timeout), reset=0)  # Time since last TLP has finished transmitting, hold if LTSSM in recovery
 		self.replay_timer_running = Signal()
@@ -51,28 +101,49 @@ class PCIeDLLTLPTransmitter(Elaboratable):
 		m = Module()
 
 		ratio = self.ratio
-		assert ratio == 4
 
 		# Maybe these should be moved into PCIeDLLTLP class since it also involves RX a bit
-		m.submodules.buffer = buffer = TLPBuffer(ratio = ratio, max_tlps = 2 ** len(self.replay_num))
-		m.submodules.unacknowledged_tlp_fifo = unacknowledged_tlp_fifo = SyncFIFOBuffered(width = 12, depth = buffer.max_tlps)
+		# The ring holds 4 TLPs of the maximum length
+		ring_words = 1 << math.ceil(math.log2(4 * self.tlp_bytes // ratio))
+		m.submodules.buffer = buffer = TLPBuffer(ratio = ratio, max_tlps = 16, tlp_bytes = self.tlp_bytes, ring_words = ring_words)
 
 		m.d.comb += self.dll.status.retry_buffer_occupation.eq(buffer.slots_occupied)
 		m.d.comb += self.dll.status.tx_seq_num.eq(self.next_transmit_seq)
 
+		# Whether a TLP is being framed, the source is only switched between TLPs
+		transmitting = Signal()
+		# Set to block new TLPs from the sink, for starting a replay
+		block_sink = Signal()
+
+		# Flow control credits are checked and consumed at the start of a new TLP from the sink
+		m.submodules.flow_control = flow_control = self.flow_control
+		m.d.comb += Cat(flow_control.header).eq(Cat(self.tlp_sink.symbol[0:4]))
+
+		# TLPs from the sink are only accepted while the retry buffer can store them, new TLPs wait for DLLPs and SKP ordered sets
+		# to be sent and while L1 is negotiated
+		hold = self.dll.sending_dllp | (self.dll.skp_pending != 0) | self.dll.block_tlps
+		m.d.comb += self.dll.tlp_pending.eq(self.tlp_sink.all_valid)
 		source_from_buffer = Signal()
 		sink_ready = Signal()
 		m.d.comb += buffer.tlp_source.ready.eq(sink_ready & source_from_buffer)
-		m.d.comb += self.tlp_sink.ready.eq(sink_ready & ~source_from_buffer & ~buffer.slots_full)
-		sink_valid = Mux(source_from_buffer, buffer.tlp_source.all_valid, self.tlp_sink.all_valid)
+		m.d.comb += self.tlp_sink.ready.eq(sink_ready & ~source_from_buffer & buffer.tlp_sink.ready &
+			(transmitting | (~block_sink & ~hold & (flow_control.available | ~self.tlp_sink.valid[0]))))
+		sink_valid = [Mux(source_from_buffer, buffer.tlp_source.valid[i], self.tlp_sink.valid[i]) for i in range(ratio)]
 		sink_symbol = [Mux(source_from_buffer, buffer.tlp_source.symbol[i], self.tlp_sink.symbol[i]) for i in range(ratio)]
+		sink_first = Mux(source_from_buffer, buffer.tlp_source.first, self.tlp_sink.first)
+		sink_last = Mux(source_from_buffer, buffer.tlp_source.last, self.tlp_sink.last)
 
-		self.tlp_sink.connect(buffer.tlp_sink, m.d.comb)
+		# Only words which are taken are stored
+		for i in range(ratio):
+			m.d.comb += buffer.tlp_sink.symbol[i].eq(self.tlp_sink.symbol[i])
+			m.d.comb += buffer.tlp_sink.valid[i].eq(self.tlp_sink.valid[i] & self.tlp_sink.ready)
+		m.d.comb += buffer.tlp_sink.first.eq(self.tlp_sink.first)
+		m.d.comb += buffer.tlp_sink.last.eq(self.tlp_sink.last)
 
+		# The next TLP can be taken right after the last one, so the sequence number is passed on combinatorially
 		with m.If(self.dll.up):
 			m.d.comb += buffer.store_tlp.eq(1) # TODO: Is this a good idea?
-			m.d.rx += buffer.store_tlp_id.eq(self.next_transmit_seq)
-			m.d.rx += buffer.send_tlp_id.eq(unacknowledged_tlp_fifo.r_data)
+			m.d.comb += buffer.store_tlp_id.eq(self.next_transmit_seq)
 		
 		with m.Else():
 			m.d.rx += self.next_transmit_seq.eq(self.next_transmit_seq.reset)
@@ -81,266 +152,429 @@ class PCIeDLLTLPTransmitter(Elaboratable):
 		
 		m.d.rx += self.accepts_tlps.eq((self.next_transmit_seq - self.ackd_seq) >= 2048) # mod 4096 is already applied since the signal is 12 bits long
 
-		with m.If(self.replay_timer_running):
+		# The TLPs from ackd_seq + 1 to next_transmit_seq - 1 are unacknowledged
+		unacknowledged = Signal()
+		m.d.comb += unacknowledged.eq((self.next_transmit_seq - 1)[:12] != self.ackd_seq)
+
+		# The timer holds while the link is retrained, see page 148 in PCIe 1.1. Acknowledgements are delayed while the other side
+		# leaves L0s, so the timer holds while the receiver is in L0s as well.
+		with m.If(self.replay_timer_running & ~self.dll.ltssm.status.link.training & ~self.dll.ltssm.status.rx_l0s):
 			m.d.rx += self.replay_timer.eq(self.replay_timer + 1)
 
-		with m.If(unacknowledged_tlp_fifo.r_level == 0):
+		with m.If(~unacknowledged):
 			m.d.rx += self.replay_timer_running.eq(0)
 			m.d.rx += self.replay_timer.eq(0)
 
+		# Acks and Naks are cumulative, they acknowledge all TLPs up to AckNak_Seq_Num.
+		# An AckNak_Seq_Num of a TLP which hasn't been sent or which is older than ackd_seq is ignored.
+		ack_nak_id = self.dll.received_ack_nak_id
+		ack_nak_valid = Signal()
+		m.d.comb += ack_nak_valid.eq(self.dll.received_ack_nak &
+			((self.next_transmit_seq - 1 - ack_nak_id)[:12] < 2048) & ((ack_nak_id - self.ackd_seq)[:12] < 2048))
+
+		with m.If(ack_nak_valid & (ack_nak_id != self.ackd_seq)):
+			m.d.comb += buffer.delete_range.eq(1)
+			m.d.comb += buffer.delete_range_first.eq(self.ackd_seq + 1)
+			m.d.comb += buffer.delete_range_last.eq(ack_nak_id)
+			m.d.rx += self.ackd_seq.eq(ack_nak_id)
+			m.d.rx += self.replay_timer.eq(0)
+			m.d.rx += self.replay_num.eq(0)
+
+		# Sequence number of the TLP being replayed
+		replay_seq = Signal(12)
+
+		# On a Nak, the TLPs after AckNak_Seq_Num are replayed, on a timeout all unacknowledged TLPs are replayed.
+		# When REPLAY_NUM rolls over, the link is retrained once the TLP in progress has been sent and the replay starts once
+		# the link is back in L0.
+		training = self.dll.ltssm.status.link.training
+
 		with m.FSM(name="Replay_FSM", domain = "rx"):
 			with m.State("Idle"):
 				m.d.rx += source_from_buffer.eq(0)
 
-				with m.If(self.replay_timer >= self.replay_timeout):
-					m.next = "Replay"
-				
-				with m.If(self.dll.received_ack_nak & ~self.dll.received_ack):
+				with m.If((ack_nak_valid & ~self.dll.received_ack) | (self.replay_timer >= self.replay_timeout)):
+					m.d.rx += replay_seq.eq(Mux(ack_nak_valid, ack_nak_id, self.ackd_seq) + 1)
+					m.d.rx += self.replay_num.eq(self.replay_num + 1)
+					m.d.rx += self.replay_timer_running.eq(0)
+					m.d.rx += self.replay_timer.eq(0)
+
+					with m.If(self.replay_num == 3):
+						m.next = "Retrain"
+					with m.Else():
+						m.next = "Replay-Wait"
+
+			with m.State("Retrain"):
+				m.d.comb += block_sink.eq(1)
+
+				with m.If(~self.dll.sending_tlp):
+					m.d.comb += self.retrain.eq(1)
+					m.next = "Retrain-Start"
+
+			with m.State("Retrain-Start"):
+				m.d.comb += block_sink.eq(1)
+
+				with m.If(training):
+					m.next = "Retrain-End"
+
+			with m.State("Retrain-End"):
+				m.d.comb += block_sink.eq(1)
+
+				with m.If(~training):
+					m.next = "Replay-Wait"
+
+			with m.State("Replay-Wait"):
+				m.d.comb += block_sink.eq(1)
+
+				with m.If(~transmitting):
+					m.d.rx += source_from_buffer.eq(1)
 					m.next = "Replay"
 
 			with m.State("Replay"):
-				m.d.rx += source_from_buffer.eq(1)
-				m.d.rx += self.replay_timer.eq(0) # TODO: This should be after the TLP is sent
+				with m.If(~transmitting):
+					with m.If(replay_seq == self.next_transmit_seq):
+						m.d.rx += source_from_buffer.eq(0)
+						m.d.rx += self.replay_timer_running.eq(unacknowledged)
+						m.next = "Idle"
+
+					# Replayed TLPs wait for DLLPs and SKP ordered sets as well, the buffer streams the TLP once it has started
+					with m.Elif(~hold):
+						m.d.comb += buffer.send_tlp.eq(1)
+						m.d.rx += buffer.send_tlp_id.eq(replay_seq)
+						m.next = "Replay-TLP"
+
+			with m.State("Replay-TLP"):
+				# TLPs which have been acknowledged during the replay are skipped
+				with m.If(~buffer.sending_tlp):
+					m.d.rx += replay_seq.eq(replay_seq + 1)
+					m.next = "Replay"
+
+		# TLPs are sent as STP, sequence number, TLP, LCRC and END, framed at multiples of 4 symbols.
+		# The sequence number and the TLP (SQ) are 2 symbols ahead of the TLP words, so each SQ chunk consists of 2 symbols left over from
+		# the previous word (or the sequence number) and the first ratio - 2 symbols of the current word.
+		# In the next cycle STP or the last symbol of the previous chunk is put in front of the chunk and the LCRC and END are appended.
+		# If they don't fit, they are sent in the next word, which blocks the sink for one cycle.
+		# If the last word is full, its remaining 2 symbols form the last chunk, which blocks the sink for one cycle as well.
+		# The latency from the sink to the source is 2 cycles.
+		advance = Signal()
+		m.d.comb += advance.eq(self.dllp_source.ready)
+
+		# Remaining 2 symbols of the last word, tail_last is set if they are the end of the TLP
+		tail = [Signal(8, name=f"tail_{i}") for i in range(2)]
+		tail_valid = Signal()
+		tail_last = Signal()
+
+		take = advance & Mux(source_from_buffer, buffer.tlp_source.ready, self.tlp_sink.ready)
+		first = take & sink_valid[0] & sink_first
+
+		tx_seq = Mux(source_from_buffer, replay_seq, self.next_transmit_seq)
+		chunk = [
+			Mux(tail_valid, tail[0], Cat(tx_seq[8 : 12], Const(0, shape = 4))),
+			Mux(tail_valid, tail[1], tx_seq[0 : 8]),
+		] + sink_symbol[:ratio - 2]
+		chunk_valid = Signal(ratio)
+		m.d.comb += chunk_valid.eq(Cat(first | tail_valid, first | tail_valid, *[take & sink_valid[i] for i in range(ratio - 2)]))
+		last = (take & sink_valid[0] & sink_last & ~sink_valid[ratio - 1]) | tail_last
 
-				with m.If(buffer.slots_empty):
-					m.d.rx += source_from_buffer.eq(0)
-					m.next = "Idle"
-		
-		m.d.rx += self.ackd_seq.eq(self.dll.received_ack_nak_id)
-
-		# If ACK received:
-		# Delete entry from retry buffer and advance unacknowledged_tlp_fifo
-		# TODO: This doesn't check whether the ID stored in the FIFO was the one which was acknowledged. Maybe it can be replaced with a counter or that can be checked.
-		with m.If(self.dll.received_ack_nak & self.dll.received_ack):
-			m.d.comb += buffer.delete_tlp.eq(1)
-			m.d.comb += buffer.delete_tlp_id.eq(self.dll.received_ack_nak_id)
-			m.d.comb += unacknowledged_tlp_fifo.r_en.eq(1)
-
-			m.d.comb += buffer.in_buffer_id.eq(self.dll.received_ack_nak_id)
-			with m.If(buffer.in_buffer):
-				m.d.rx += self.replay_timer.eq(0)
-		
-		reset_crc = Signal(reset = 1)
 		# TODO Warning: Endianness
-		crc_input = Signal(32)
-		m.submodules.lcrc = lcrc = DomainRenamer("rx")(LCRC(crc_input, reset_crc))
+		crc_input = Signal(8 * ratio)
+		m.d.comb += crc_input.eq(Cat(chunk))
+		m.submodules.lcrc = lcrc = DomainRenamer("rx")(LCRC(crc_input, Const(0), byte_enable = Mux(advance, chunk_valid, 0), start = first))
 		m.d.rx += self.debug_crc_output.eq(lcrc.output)
 		m.d.rx += self.debug_crc_input.eq(crc_input)
 
-		last_valid = Signal()
-		m.d.rx += last_valid.eq(sink_valid)
-		last_last_valid = Signal() # TODO: Maybe there is a better way
-		m.d.rx += last_last_valid.eq(last_valid)
-		last_last_last_valid = Signal() # TODO: Maybe there is a better way 😿 like a longer signal which gets shifted for example
-		m.d.rx += last_last_last_valid.eq(last_last_valid)
+		chunk_symbols = [Signal(8, name=f"chunk_{i}") for i in range(ratio)]
+		chunk_symbols_valid = Signal(ratio)
+		chunk_first = Signal()
+		chunk_last = Signal()
+		chunk_nullify = Signal()
+		previous_symbol = Signal(8)
+		previous_symbol_valid = Signal()
 
+		with m.If(advance):
+			m.d.rx += [
+				tail[0].eq(sink_symbol[ratio - 2]),
+				tail[1].eq(sink_symbol[ratio - 1]),
+				tail_valid.eq(take & sink_valid[ratio - 1]),
+				tail_last.eq(take & sink_last & sink_valid[ratio - 1]),
+				Cat(chunk_symbols).eq(Cat(chunk)),
+				chunk_symbols_valid.eq(chunk_valid),
+				chunk_first.eq(first),
+				chunk_last.eq(last),
+				chunk_nullify.eq(self.nullify),
+				previous_symbol.eq(chunk_symbols[-1]),
+				previous_symbol_valid.eq(chunk_symbols_valid[-1]),
+			]
 
-		tlp_bytes = Signal(8 * self.ratio)
-		tlp_bytes_before = Signal(8 * self.ratio)
+			with m.If(first):
+				m.d.rx += transmitting.eq(1)
+				m.d.comb += flow_control.consume.eq(~source_from_buffer)
 
-		with m.If(sink_valid):
-			m.d.comb += Cat(tlp_bytes[0 : 8 * ratio]).eq(Cat(sink_symbol)) # TODO: Endianness correct?
-			m.d.rx += Cat(tlp_bytes_before[0 : 8 * ratio]).eq(Cat(sink_symbol)) # TODO: Endianness correct?
+			with m.If(last):
+				m.d.rx += transmitting.eq(0)
 
-		with m.Else():
-			with m.If(self.nullify):
-				m.d.comb += Cat(tlp_bytes[0 : 8 * ratio]).eq(~lcrc.output) # ~~x = x
-				m.d.rx += Cat(tlp_bytes_before[0 : 8 * ratio]).eq(~lcrc.output)
-				m.d.comb += buffer.delete_tlp.eq(1)
-				m.d.comb += buffer.delete_tlp_id.eq(self.next_transmit_seq)
-
-			with m.Else():
-				m.d.comb += Cat(tlp_bytes[0 : 8 * ratio]).eq(lcrc.output) # TODO: Endianness correct?
-				m.d.rx += Cat(tlp_bytes_before[0 : 8 * ratio]).eq(lcrc.output) # TODO: Endianness correct?
-
-
-		#m.d.rx += Cat(tlp_bytes[8 * ratio : 2 * 8 * ratio]).eq(Cat(tlp_bytes[0 : 8 * ratio]))
-
-		even_more_delay = [Signal(9) for i in range(4)]
-
-		m.d.rx += unacknowledged_tlp_fifo.w_en.eq(0)
-
-		m.d.comb += sink_ready.eq(0) # TODO: maybe move to rx?
-
-		delayed_symbol = Signal(32)
-		m.d.rx += delayed_symbol.eq(Cat(sink_symbol))
-		m.d.comb += crc_input.eq(delayed_symbol)
-
-		for i in range(4):
-			m.d.rx += self.dllp_source.valid[i].eq(0)
-
-
-		with m.If(self.dllp_source.ready & unacknowledged_tlp_fifo.w_rdy):
-			m.d.comb += sink_ready.eq(1) # TODO: maybe move to rx?
-			with m.FSM(name = "DLL_TLP_tx_FSM", domain = "rx") as fsm:
-				m.d.comb += Cat(self.debug[0:4]).eq(fsm.state)
-				m.d.comb += self.debug_state.eq(fsm.state)
-				m.d.comb += self.debug[4].eq(reset_crc)
-
-				with m.State("Idle"):
-					with m.If(~last_valid & sink_valid):
-						m.d.comb += reset_crc.eq(0)
-						m.d.comb += crc_input.eq(Cat(self.next_transmit_seq[8 : 12], Const(0, shape = 4), self.next_transmit_seq[0 : 8]))
-						m.d.rx += even_more_delay[0].eq(Ctrl.STP)
-						m.d.rx += even_more_delay[1].eq(self.next_transmit_seq[8 : 12])
-						m.d.rx += even_more_delay[2].eq(self.next_transmit_seq[0 : 8])
-						m.d.rx += even_more_delay[3].eq(tlp_bytes[8 * 0 : 8 * 1])
-						m.next = "Transmit"
-
-				with m.State("Transmit"):
-					with m.If(last_valid & sink_valid):
-						m.d.comb += reset_crc.eq(0)
-						m.d.rx += even_more_delay[0].eq(tlp_bytes_before[8 * 1 : 8 * 2])
-						m.d.rx += even_more_delay[1].eq(tlp_bytes_before[8 * 2 : 8 * 3])
-						m.d.rx += even_more_delay[2].eq(tlp_bytes_before[8 * 3 : 8 * 4])
-						m.d.rx += even_more_delay[3].eq(tlp_bytes[8 * 0 : 8 * 1])
-						for i in range(4):
-							m.d.rx += self.dllp_source.symbol[i].eq(even_more_delay[i])
-						for i in range(4):
-							m.d.rx += self.dllp_source.valid[i].eq(1)
-
-					with m.Elif(~sink_valid):
-						m.d.comb += reset_crc.eq(0)
-						m.d.comb += sink_ready.eq(0) # TODO: maybe move to rx?
-						m.d.rx += even_more_delay[0].eq(tlp_bytes_before[8 * 1 : 8 * 2])
-						m.d.rx += even_more_delay[1].eq(tlp_bytes_before[8 * 2 : 8 * 3])
-						m.d.rx += even_more_delay[2].eq(tlp_bytes_before[8 * 3 : 8 * 4])
-						for i in range(4):
-							m.d.rx += self.dllp_source.symbol[i].eq(even_more_delay[i])
-						for i in range(4):
-							m.d.rx += self.dllp_source.valid[i].eq(1)
-						m.next = "Post-1"
-
-				with m.State("Post-1"):
-					m.d.rx += self.dllp_source.symbol[3].eq(tlp_bytes[8 * 0 : 8 * 1])
-
-					for i in range(3):
-						m.d.rx += self.dllp_source.symbol[i].eq(even_more_delay[i])
-
-					for i in range(4):
-						m.d.rx += self.dllp_source.valid[i].eq(1)
-
-					m.next = "Post-2"
-				
-				with m.State("Post-2"):
-					m.d.comb += sink_ready.eq(0) # TODO: maybe move to rx?
-					m.d.rx += self.dllp_source.symbol[0].eq(tlp_bytes_before[8 * 1 : 8 * 2])
-					m.d.rx += self.dllp_source.symbol[1].eq(tlp_bytes_before[8 * 2 : 8 * 3])
-					m.d.rx += self.dllp_source.symbol[2].eq(tlp_bytes_before[8 * 3 : 8 * 4])
-
-					with m.If(self.nullify):
-						m.d.rx += self.dllp_source.symbol[3].eq(Ctrl.EDB)
-						m.d.rx += self.nullify.eq(0)
+			# Replayed TLPs already have a sequence number
+			with m.If(last & ~source_from_buffer):
+				with m.If(self.nullify):
+					m.d.comb += buffer.delete_tlp.eq(1)
+					m.d.comb += buffer.delete_tlp_id.eq(self.next_transmit_seq)
+					m.d.rx += self.nullify.eq(0)
 
-					with m.Else():
-						m.d.rx += self.dllp_source.symbol[3].eq(Ctrl.END)
-						m.d.rx += unacknowledged_tlp_fifo.w_data.eq(self.next_transmit_seq)
-						m.d.rx += unacknowledged_tlp_fifo.w_en.eq(1)
-						m.d.rx += self.next_transmit_seq.eq(self.next_transmit_seq + 1)
-					
-					m.d.rx += self.replay_timer_running.eq(1) # TODO: Maybe this should be in the Else block above
-
-					for i in range(4):
-						m.d.rx += self.dllp_source.valid[i].eq(1)
-
-					m.next = "Idle"
-
-
-
-
-		# TODO: This could be a FSM
-		#with m.If(self.dllp_source.ready & unacknowledged_tlp_fifo.w_rdy):
-		#	m.d.comb += sink_ready.eq(1) # TODO: maybe move to rx?
-#
-		#	with m.If(~last_valid & sink_valid):
-		#		m.d.comb += reset_crc.eq(0)
-		#		m.d.comb += crc_input.eq(Cat(self.next_transmit_seq[8 : 12], Const(0, shape = 4), self.next_transmit_seq[0 : 8]))
-		#		m.d.rx += even_more_delay[0].eq(Ctrl.STP)
-		#		m.d.rx += even_more_delay[1].eq(self.next_transmit_seq[8 : 12])
-		#		m.d.rx += even_more_delay[2].eq(self.next_transmit_seq[0 : 8])
-		#		m.d.rx += even_more_delay[3].eq(tlp_bytes[8 * 0 : 8 * 1])
-		#		#for i in range(4):
-		#		#	m.d.rx += self.dllp_source.symbol[i].eq(even_more_delay[i])
-#
-		#	with m.Elif(last_valid & sink_valid):
-		#		m.d.comb += reset_crc.eq(0)
-		#		m.d.rx += even_more_delay[0].eq(tlp_bytes_before[8 * 1 : 8 * 2])
-		#		m.d.rx += even_more_delay[1].eq(tlp_bytes_before[8 * 2 : 8 * 3])
-		#		m.d.rx += even_more_delay[2].eq(tlp_bytes_before[8 * 3 : 8 * 4])
-		#		m.d.rx += even_more_delay[3].eq(tlp_bytes[8 * 0 : 8 * 1])
-		#		for i in range(4):
-		#			m.d.rx += self.dllp_source.symbol[i].eq(even_more_delay[i])
-		#		for i in range(4):
-		#			m.d.rx += self.dllp_source.valid[i].eq(1)
-#
-		#	with m.Elif(last_valid & ~sink_valid): # Maybe this can be done better and replaced by the two if blocks above
-		#		m.d.comb += reset_crc.eq(0)
-		#		m.d.comb += sink_ready.eq(0) # TODO: maybe move to rx?
-		#		m.d.rx += even_more_delay[0].eq(tlp_bytes_before[8 * 1 : 8 * 2])
-		#		m.d.rx += even_more_delay[1].eq(tlp_bytes_before[8 * 2 : 8 * 3])
-		#		m.d.rx += even_more_delay[2].eq(tlp_bytes_before[8 * 3 : 8 * 4])
-		#		for i in range(4):
-		#			m.d.rx += self.dllp_source.symbol[i].eq(even_more_delay[i])
-		#		for i in range(4):
-		#			m.d.rx += self.dllp_source.valid[i].eq(1)
-#
-		#	with m.Elif(last_last_valid & ~sink_valid):
-		#		m.d.rx += self.dllp_source.symbol[3].eq(tlp_bytes[8 * 0 : 8 * 1])
-#
-		#		for i in range(3):
-		#			m.d.rx += self.dllp_source.symbol[i].eq(even_more_delay[i])
-#
-		#		for i in range(4):
-		#			m.d.rx += self.dllp_source.valid[i].eq(1)
-#
-		#	with m.Elif(last_last_last_valid & ~sink_valid):
-		#		m.d.comb += sink_ready.eq(0) # TODO: maybe move to rx?
-		#		m.d.rx += self.dllp_source.symbol[0].eq(tlp_bytes_before[8 * 1 : 8 * 2])
-		#		m.d.rx += self.dllp_source.symbol[1].eq(tlp_bytes_before[8 * 2 : 8 * 3])
-		#		m.d.rx += self.dllp_source.symbol[2].eq(tlp_bytes_before[8 * 3 : 8 * 4])
-#
-		#		with m.If(self.nullify):
-		#			m.d.rx += self.dllp_source.symbol[3].eq(Ctrl.EDB)
-		#			m.d.rx += self.nullify.eq(0)
-#
-		#		with m.Else():
-		#			m.d.rx += self.dllp_source.symbol[3].eq(Ctrl.END)
-		#			m.d.rx += unacknowledged_tlp_fifo.w_data.eq(self.next_transmit_seq)
-		#			m.d.rx += unacknowledged_tlp_fifo.w_en.eq(1)
-		#			m.d.rx += self.next_transmit_seq.eq(self.next_transmit_seq + 1)
-		#		
-		#		m.d.rx += self.replay_timer_running.eq(1) # TODO: Maybe this should be in the Else block above
-#
-		#		for i in range(4):
-		#			m.d.rx += self.dllp_source.valid[i].eq(1)
+				with m.Else():
+					m.d.rx += self.next_transmit_seq.eq(self.next_transmit_seq + 1)
+					m.d.rx += self.replay_timer_running.eq(1)
+
+		# A nullified TLP has an inverted LCRC and ends with EDB
+		lcrc_symbols = [Mux(chunk_nullify, ~lcrc.output, lcrc.output).word_select(i, 8) for i in range(4)]
+		end_symbol = Mux(chunk_nullify, Ctrl.EDB, Ctrl.END)
+
+		# LCRC symbols and END which didn't fit in the last word
+		overflow = [Signal(9, name=f"overflow_{i}") for i in range(4)]
+		overflow_valid = Signal()
+
+		out_symbols = [Signal(9, name=f"out_symbol_{i}") for i in range(ratio)]
+		out_valid = Signal(ratio)
+
+		m.d.comb += out_symbols[0].eq(Mux(chunk_first, Ctrl.STP, previous_symbol))
+		m.d.comb += out_valid[0].eq(chunk_first | previous_symbol_valid)
+		for i in range(1, ratio):
+			m.d.comb += out_symbols[i].eq(chunk_symbols[i - 1])
+			m.d.comb += out_valid[i].eq(chunk_symbols_valid[i - 1])
+
+		with m.If(overflow_valid):
+			for i in range(4):
+				m.d.comb += out_symbols[i].eq(overflow[i])
+				m.d.comb += out_valid[i].eq(1)
+
+		# The last chunk has 4n + 2 symbols, the first LCRC symbol goes at the end of the quad and the rest in the next quad
+		m.d.comb += sink_ready.eq(advance & ~tail_last)
+		for i in range(2, ratio, 4):
+			with m.If(chunk_last & chunk_symbols_valid[i - 1] & ~chunk_symbols_valid[i]):
+				rest = lcrc_symbols[1:] + [end_symbol]
+				m.d.comb += out_symbols[i + 1].eq(lcrc_symbols[0])
+				m.d.comb += out_valid[i + 1].eq(1)
+				if i + 5 < ratio:
+					for j in range(4):
+						m.d.comb += out_symbols[i + 2 + j].eq(rest[j])
+						m.d.comb += out_valid[i + 2 + j].eq(1)
+				else:
+					with m.If(advance):
+						m.d.rx += [overflow[j].eq(rest[j]) for j in range(4)]
+					m.d.comb += sink_ready.eq(0)
+
+		with m.If(advance):
+			m.d.rx += overflow_valid.eq(chunk_last & chunk_symbols_valid[ratio - 3] & ~chunk_symbols_valid[ratio - 2])
+			m.d.rx += Cat(self.dllp_source.symbol).eq(Cat(out_symbols))
+			m.d.rx += Cat(self.dllp_source.valid).eq(out_valid)
+
+		# A TLP is being sent until its last chunk, including LCRC symbols which didn't fit, has been put into the source
+		m.d.comb += self.dll.sending_tlp.eq(transmitting | (chunk_symbols_valid != 0) | overflow_valid | (source_from_buffer & buffer.sending_tlp))
+
+		m.d.comb += self.debug_state.eq(Cat(tail_valid, chunk_first, chunk_last, overflow_valid))
+		m.d.comb += self.debug[0:4].eq(self.debug_state)
+
+		return m
 
+class PCIeDLLTLPSplitter(Elaboratable):
+	"""
+	Splits the received words such that every word holds the symbols of at most one TLP, used by PCIeDLLTLPReceiver at ratios above 8
+
+	At ratios above 8 a TLP can start in the word in which the previous one ends, and at ratios above 16 several TLPs can start in
+	a word. The quads of every TLP in a word are put into a word of their own, the other quads of it are 0, words without TLP
+	quads are dropped. The words are queued in an InterleavedFIFO since up to segments words come out of one word, the source
+	puts out words of 0 while the queue is empty. A TLP which starts while the queue is nearly full is dropped as a whole, the
+	receiver Naks the next TLP for the gap in the sequence numbers or the TLP is replayed after the replay timeout.
+	Since the receiver takes one word per cycle, this happens for long bursts of short TLPs sharing words.
+
+	Parameters
+	----------
+	ratio : int
+		Gearbox ratio, the number of symbols per clock cycle of all lanes
+	depth : int
+		Depth of every FIFO of the queue
+	"""
+	def __init__(self, ratio: int, depth: int = 16):
+		assert ratio % 4 == 0
+		self.ratio = ratio
+
+		self.sink = StreamInterface(9, ratio, name="Splitter_Sink")
+		self.source = StreamInterface(9, ratio, name="Splitter_Source")
+
+		# A TLP takes at least 5 quads: STP and the sequence number, a header of 3 DW and the LCRC with END
+		quads = ratio // 4
+		self.segments = 1 + (quads - 1 + 4) // 5
+		"""Maximum number of TLPs in a word"""
+		self.depth = depth
+		self.queue = InterleavedFIFO(9 * ratio, depth, self.segments)
+
+	def elaborate(self, platform: Platform) -> Module:
+		m = Module()
+
+		ratio = self.ratio
+		quads = ratio // 4
+		segments = self.segments
+		symbols = self.sink.symbol
+
+		m.submodules.queue = queue = DomainRenamer("rx")(self.queue)
+
+		# Find the TLP quads like the receiver and number the TLPs in the word, a TLP continuing from the last word is the first
+		in_tlp = Signal()
+		tlp_quads = Signal(quads)
+		segment_quads = [Signal(range(segments), name=f"segment_quad_{q}") for q in range(quads)]
+		segment_count = Signal(range(segments + 1))
+
+		in_tlp_statement = in_tlp
+		any_tlp_statement = in_tlp
+		segment_statement = Const(0, range(segments))
+		for q in range(quads):
+			start = ~in_tlp_statement & (symbols[4 * q] == Ctrl.STP)
+			segment_statement = Mux(start & any_tlp_statement, segment_statement + 1, segment_statement)
+			in_tlp_statement = in_tlp_statement | start
+			any_tlp_statement = any_tlp_statement | start
+			m.d.comb += tlp_quads[q].eq(in_tlp_statement)
+			m.d.comb += segment_quads[q].eq(segment_statement)
+			in_tlp_statement = in_tlp_statement & ~((symbols[4 * q + 3] == Ctrl.END) | (symbols[4 * q + 3] == Ctrl.EDB))
+
+		m.d.rx += in_tlp.eq(in_tlp_statement)
+		m.d.comb += segment_count.eq(Mux(any_tlp_statement, segment_statement + 1, 0))
+
+		segment_words = []
+		for j in range(segments):
+			segment_words.append(Cat(Mux(tlp_quads[q] & (segment_quads[q] == j), Cat(symbols[4 * q : 4 * q + 4]), 0) for q in range(quads)))
+
+		# The queue only grows with the TLPs started in a word, a continuing TLP takes a word per cycle like the receiver.
+		# Every FIFO holds at most level / segments words rounded up, a TLP is only started while there is space for the words
+		# of the TLPs started in this word and a margin for the latency of the FIFOs.
+		room = Signal()
+		m.d.comb += room.eq(queue.level <= segments * (self.depth - 4))
+
+		# Whether the TLP continuing from the last word is being dropped
+		dropping = Signal()
+		first_kept = Mux(in_tlp, ~dropping, room) & (segment_count != 0)
+		last_kept = Mux(segment_count == 1, first_kept, room)
+
+		# The kept words are written first to last, only the first one can be dropped while the others are kept
+		for i in range(segments):
+			if i + 1 < segments:
+				m.d.comb += queue.w_data[i].eq(Mux(first_kept, segment_words[i], segment_words[i + 1]))
+			else:
+				m.d.comb += queue.w_data[i].eq(segment_words[i])
+		with m.If(segment_count != 0):
+			m.d.comb += queue.w_count.eq(first_kept + Mux(room, segment_count - 1, 0))
+			m.d.rx += dropping.eq(in_tlp_statement & ~last_kept)
+
+		# The receiver takes a word every cycle
+		m.d.comb += queue.r_en.eq(1)
+		with m.If(queue.r_rdy):
+			m.d.comb += Cat(self.source.symbol).eq(queue.r_data)
+		m.d.comb += Cat(self.source.valid).eq(Repl(queue.r_rdy, ratio))
 
 		return m
 
 class PCIeDLLTLPReceiver(Elaboratable):
 	"""
+	PCIe Data Link Layer TLP receiver, checks the sequence number and LCRC of received TLPs and stores them
+
+	TLPs can start at any multiple of 4 symbols, the ratio needs to be a multiple of 4. At ratios above 8 the received words
+	are split first, so that every TLP starting in the word in which the previous one ends is received in words of its own.
+
+	Only TLPs which passed the checks are stored, they are passed on in the order of their sequence numbers.
+
+	Acks are coalesced, one Ack acknowledging all received TLPs is sent when the AckNak latency timer expires or
+	when ack_coalesce_count TLPs are waiting to be acknowledged. The latency follows Table 3-6 in PCIe 1.1.
+
+	Parameters
+	----------
+	dll : PCIeDLL
+		Data Link Layer
+	ratio : int
+		Gearbox ratio, the number of symbols per clock cycle of all lanes
+	lanes : int
+		Link width
+	max_payload_size : int
+		Max_Payload_Size in bytes, used for the size of the buffer and the AckNak latency
+	ack_coalesce_count : int
+		Number of received TLPs after which an Ack is sent without waiting for the latency timer
+	update_fc_threshold : int
+		Number of freed header credits after which UpdateFC DLLPs are requested
+	update_fc_interval : int
+		Minimum number of clock cycles between UpdateFC requests
+	cut_through : bool
+		Pass TLPs on while they are being received instead of storing them until their LCRC and sequence number are checked
+	completion_blocks : int
+		Completion data in blocks of 64 bytes which the buffer keeps room for, every block can come in a TLP of its own
+	tlp_good : Signal()
+		Valid with the last word of a TLP, whether the TLP passed the checks. Always 1 unless cut_through is set.
+
+	In cut-through mode the transaction layer sees the header a few cycles after it was received, TLPs which failed the
+	checks (LCRC, sequence number, EDB) have to be discarded by the transaction layer when tlp_good is 0 on their last word.
+	The TLPs are passed on through a FIFO of the size of the buffer, so tlp_source can stall like in buffered mode. A TLP is
+	only written into the FIFO if there is space for a TLP of the maximum length when it starts.
+
+	The advertised credits (dll.credits_tx) are derived from the buffer size and returned once a good TLP has been passed on.
+	UpdateFC DLLPs are requested when update_fc_threshold header credits have been freed or when the buffer has run empty.
+	Completions are advertised as infinite as required for endpoints, so the buffer keeps slots and room for completion_blocks
+	blocks of completion data besides the posted and non-posted credits. A completer splits a read at most at every 64 byte
+	Read Completion Boundary, the requester has to keep the blocks touched by its outstanding reads within completion_blocks.
+	A TLP which arrives while the buffer is full isn't stored, it is Nak'd so it gets replayed. A TLP with more than
+	max_payload_size bytes of payload is malformed, it is acknowledged but dropped by the buffer.
 	"""
-	def __init__(self, dll: PCIeDLL, ratio: int = 4):
-		#self.tlp_source = StreamInterface(8, ratio, name="TLP_Source")
+	def __init__(self, dll: PCIeDLL, ratio: int = 4, lanes: int = 1, max_payload_size: int = 128, ack_coalesce_count: int = 4,
+		update_fc_threshold: int = 4, update_fc_interval: int = 64, cut_through: bool = False, completion_blocks: int = 0):
 		self.dllp_sink = StreamInterface(9, ratio, name="DLLP_Sink") # TODO: Maybe connect these in elaborate instead of where this class is instantiated
-
-		# Buffer
-		self.buffer = TLPBuffer(ratio = ratio, max_tlps = 4)
-		self.tlp_source = self.buffer.tlp_source
+		self.cut_through = cut_through
+		self.tlp_good = Signal(reset = 1)
 
 		self.dll = dll
 		
-		assert len(self.dllp_sink.symbol) == 4
-		assert len(self.tlp_source.symbol) == 4
-		self.ratio = len(self.dllp_sink.symbol)
+		assert ratio % 4 == 0
+		self.ratio = ratio
+		self.splitter = PCIeDLLTLPSplitter(ratio) if ratio > 8 else None
+
+		# Every TLP takes a slot and a header of up to 4 DW, which can end in a partially used word
+		header_bytes = 16 + ratio
+		completion_bytes = completion_blocks * (64 + header_bytes)
+		self.tlp_bytes = max_tlp_bytes(max_payload_size)
+		ring_words = 1 << math.ceil(math.log2((4 * self.tlp_bytes + completion_bytes) // ratio))
+
+		if cut_through:
+			self.buffer = None
+			self.fifo = DomainRenamer("rx")(SyncFIFOBuffered(width = ratio * 9 + 3, depth = ring_words))
+			self.tlp_source = StreamInterface(8, ratio, name="TLP_Source")
+			self.depth = ring_words
+			self.tlp_depth = (self.tlp_bytes + ratio - 1) // ratio
+			self.max_tlps = ring_words # Every TLP takes at least a word
+
+		else:
+			max_tlps = 1 << math.ceil(math.log2(12 + completion_blocks))
+			self.buffer = TLPBuffer(ratio = ratio, max_tlps = max_tlps, tlp_bytes = self.tlp_bytes, delete_on_send = True, ring_words = ring_words)
+			self.tlp_source = self.buffer.tlp_source
+			self.depth = self.buffer.depth
+			self.tlp_depth = self.buffer.tlp_depth
+			self.max_tlps = self.buffer.max_tlps
+
+		# Storing a TLP only starts if there is space for a TLP of the maximum length, so that space can't be advertised
+		space = (self.depth - self.tlp_depth) * ratio - completion_bytes
+		self.credits = {
+			"PH": 8,
+			"NPH": 4,
+		}
+		self.credits["NPD"] = self.credits["NPH"] # Non-posted requests carry at most 1 DW
+		self.credits["PD"] = (space - (self.credits["PH"] + self.credits["NPH"]) * header_bytes - self.credits["NPD"] * 16) // 16
+		assert self.credits["PH"] + self.credits["NPH"] + completion_blocks <= self.max_tlps
+		assert self.credits["PD"] >= max_payload_size // 16
+		"""Initially advertised credits"""
+
+		self.update_fc_threshold = update_fc_threshold
+		self.update_fc_interval = update_fc_interval
 
 		self.clocks_per_ms = 62500
 
 		# See page 142 in PCIe 1.1
 		self.next_receive_seq = Signal(12, reset=0x000) # Expected TLP sequence number
 		self.nak_scheduled = Signal(reset = 0)
-		self.ack_nak_latency_limit = 154
-		self.ack_nak_latency_timer = Signal(range(self.ack_nak_latency_limit), reset=0) # Time since an Ack or Nak DLLP was scheduled for transmission
+		self.ack_nak_latency_limit = ack_nak_latency(max_payload_size, lanes) // (ratio // lanes) # In clock cycles
+		self.ack_coalesce_count = ack_coalesce_count
+		self.ack_nak_latency_timer = Signal(range(self.ack_nak_latency_limit + 1), reset=0) # Time since the oldest unacknowledged TLP was received
 
 		self.actual_receive_seq = Signal(12, reset=0x000) # Received TLP sequence number
 
@@ -360,15 +594,70 @@ class PCIeDLLTLPReceiver(Elaboratable):
 		m = Module()
 
 		ratio = self.ratio
-		assert ratio == 4
 
-		# TODO: Send NAK if buffer is full
-		m.submodules.buffer = buffer = self.buffer
-		m.submodules.received_tlp_fifo = received_tlp_fifo = SyncFIFOBuffered(width = 12, depth = buffer.max_tlps)
-
-		m.d.comb += self.dll.status.receive_buffer_occupation.eq(buffer.slots_occupied)
 		m.d.comb += self.dll.status.rx_seq_num.eq(self.actual_receive_seq)
 
+		if self.cut_through:
+			# TLPs are passed on through the FIFO as they are received, the result of the checks is queued with the last word
+			m.submodules.fifo = fifo = self.fifo
+			received = StreamInterface(8, ratio, name="Received")
+
+			source = self.tlp_source
+			m.d.comb += Cat(*source.symbol, *source.valid, source.first, source.last, self.tlp_good).eq(fifo.r_data)
+			with m.If(~fifo.r_rdy):
+				m.d.comb += [valid.eq(0) for valid in source.valid]
+				m.d.comb += source.first.eq(0)
+				m.d.comb += source.last.eq(0)
+			m.d.comb += fifo.r_en.eq(source.ready)
+
+		else:
+			m.submodules.buffer = buffer = self.buffer
+			m.submodules.received_tlp_fifo = received_tlp_fifo = DomainRenamer("rx")(SyncFIFOBuffered(width = 12, depth = buffer.max_tlps))
+
+			m.d.comb += self.dll.status.receive_buffer_occupation.eq(buffer.slots_occupied)
+
+			# Every received TLP is stored, store_tlp_id is set at STP before the first word reaches the buffer
+			m.d.comb += buffer.store_tlp.eq(1)
+			received = buffer.tlp_sink
+
+		# CREDITS_ALLOCATED, they are reset to the initial credits while the DLL is down
+		credits_allocated = Record([(name, len(self.dll.credits_tx[name])) for name in self.credits])
+		for name, credits in self.credits.items():
+			credits_allocated[name].reset = credits
+			m.d.comb += self.dll.credits_tx[name].eq(credits_allocated[name])
+		m.d.comb += self.dll.credits_tx.CPLH.eq(0)
+		m.d.comb += self.dll.credits_tx.CPLD.eq(0)
+
+		# Credits of a TLP which has been passed on, they are returned
+		return_credits = Signal()
+		returned_header = [Signal(8, name=f"returned_header_{i}") for i in range(4)]
+		returned_class = Signal(2)
+		returned_data_credits = Signal(9)
+		m.d.comb += returned_class.eq(tlp_fc_class(returned_header[0]))
+		m.d.comb += returned_data_credits.eq(tlp_data_credits(returned_header[0], Cat(returned_header[3], returned_header[2][0:2])))
+
+		with m.If(return_credits):
+			for fc_class, (header_name, data_name) in [(FCClass.Posted, ("PH", "PD")), (FCClass.NonPosted, ("NPH", "NPD"))]:
+				with m.If(returned_class == fc_class):
+					m.d.rx += credits_allocated[header_name].eq(credits_allocated[header_name] + 1)
+					m.d.rx += credits_allocated[data_name].eq(credits_allocated[data_name] + returned_data_credits)
+
+		# Request UpdateFC DLLPs once enough credits have been freed or if the buffer ran empty, but not more often than every update_fc_interval cycles
+		freed_credits = Signal(range(self.max_tlps + 1))
+		update_fc_timer = Signal(range(self.update_fc_interval + 1))
+		empty = (fifo.level == 0) if self.cut_through else buffer.slots_empty
+
+		with m.If(update_fc_timer != 0):
+			m.d.rx += update_fc_timer.eq(update_fc_timer - 1)
+
+		with m.If((update_fc_timer == 0) & (freed_credits != 0) & ((freed_credits >= self.update_fc_threshold) | empty)):
+			m.d.comb += self.dll.update_fc.eq(1)
+			m.d.rx += update_fc_timer.eq(self.update_fc_interval)
+			m.d.rx += freed_credits.eq(return_credits)
+
+		with m.Elif(return_credits):
+			m.d.rx += freed_credits.eq(freed_credits + 1)
+
 		with m.If(~self.dll.up):
 			m.d.rx += self.ack_nak_latency_timer.eq(self.ack_nak_latency_timer.reset)
 		
@@ -377,34 +666,143 @@ class PCIeDLLTLPReceiver(Elaboratable):
 		#with m.If(self.timer_running):
 		#	m.d.rx += self.replay_timer.eq(self.replay_timer + 1)
 
-		source_3_delayed = Signal(8)
-		m.d.rx += source_3_delayed.eq(self.dllp_sink.symbol[3][0:8])
-
-		# Aligned as received by TLP layer from other end of the link
-		source_symbols = [source_3_delayed, self.dllp_sink.symbol[0][0:8], self.dllp_sink.symbol[1][0:8], self.dllp_sink.symbol[2][0:8]]
-		last_symbols = Signal(32)
-		m.d.rx += last_symbols.eq(Cat(source_symbols))
+		if self.splitter is not None:
+			m.submodules.splitter = splitter = self.splitter
+			m.d.comb += Cat(splitter.sink.symbol).eq(Cat(self.dllp_sink.symbol))
+			symbols = splitter.source.symbol
+		else:
+			symbols = self.dllp_sink.symbol
+		quads = ratio // 4
+
+		# Find the quads which belong to a TLP, a TLP starts with a quad beginning with STP and ends with a quad ending with END or EDB
+		in_tlp = Signal()
+		tlp_quads = Signal(quads)
+		start_quads = Signal(quads)
+		end_quads = Signal(quads)
+
+		in_tlp_statement = in_tlp
+		for q in range(quads):
+			m.d.comb += start_quads[q].eq(~in_tlp_statement & (symbols[4 * q] == Ctrl.STP))
+			in_tlp_statement = in_tlp_statement | start_quads[q]
+			m.d.comb += tlp_quads[q].eq(in_tlp_statement)
+			m.d.comb += end_quads[q].eq(in_tlp_statement & ((symbols[4 * q + 3] == Ctrl.END) | (symbols[4 * q + 3] == Ctrl.EDB)))
+			in_tlp_statement = in_tlp_statement & ~end_quads[q]
+
+		m.d.rx += in_tlp.eq(in_tlp_statement)
+
+		# The last word is processed, the LCRC can end up to 5 symbols before the END in the current word
+		last_symbols = [Signal(9, name=f"last_symbol_{i}") for i in range(ratio)]
+		last_tlp_quads = Signal(quads)
+		last_start_quads = Signal(quads)
+		last_end_quads = Signal(quads)
+		m.d.rx += [
+			Cat(last_symbols).eq(Cat(symbols)),
+			last_tlp_quads.eq(tlp_quads),
+			last_start_quads.eq(start_quads),
+			last_end_quads.eq(end_quads),
+		]
 
+		# The quad before the END quad, it ends with the first LCRC symbol
+		lcrc_quads = Signal(quads)
+		m.d.comb += lcrc_quads.eq(last_tlp_quads & ~last_end_quads & Cat(last_end_quads[1:], end_quads[0]))
+
+		# Sequence number and TLP (SQ) symbols and TLP symbols of the last word
+		sq_symbols = Signal(ratio)
+		tlp_symbols = Signal(ratio)
+		for i in range(ratio):
+			q = i // 4
+			sq = last_tlp_quads[q] & ~last_end_quads[q]
+			if i % 4 == 0:
+				sq = sq & ~last_start_quads[q]
+			if i % 4 == 3:
+				sq = sq & ~lcrc_quads[q]
+			m.d.comb += sq_symbols[i].eq(sq)
+			m.d.comb += tlp_symbols[i].eq(sq & ~last_start_quads[q] if i % 4 in [1, 2] else sq)
+
+		# SQ symbols start after STP or at the start of the word and end before an LCRC symbol or at the end of the word
+		patterns = []
+		for start in [0] + list(range(1, ratio, 4)):
+			for end in list(range(3, ratio, 4)) + [ratio]:
+				if start < end:
+					patterns.append(((1 << end) - 1) & ~((1 << start) - 1))
 
-		reset_crc = Signal(reset = 1)
 		# TODO Warning: Endianness
-		crc_input = Signal(32)
-		m.submodules.lcrc = lcrc = DomainRenamer("rx")(LCRC(crc_input, reset_crc))
-
-		m.d.rx += crc_input.eq(Cat(source_symbols))
+		crc_input = Signal(8 * ratio)
+		m.d.comb += crc_input.eq(Cat(symbol[0:8] for symbol in last_symbols))
+		m.submodules.lcrc = lcrc = DomainRenamer("rx")(LCRC(crc_input, Const(0), byte_enable = sq_symbols, start = last_start_quads.any(), patterns = patterns))
 
-		for i in range(4):
-			m.d.rx += buffer.tlp_sink.symbol[i].eq(Cat(source_symbols[i]))
-		
+		window = last_symbols + symbols
+		lcrc_received = Signal(32)
 		end_good = Signal()
-
-		def ack():
-			m.d.comb += self.dll.schedule_ack_nak.eq(1)
-			m.d.rx += [
-				self.dll.scheduled_ack.eq(1),
-				self.dll.scheduled_ack_nak_id.eq(self.actual_receive_seq),
-				self.ack_nak_latency_timer.eq(self.ack_nak_latency_timer.reset),
-			]
+		check_lcrc = Signal()
+
+		# The sequence number of the TLP starting in the last word, it is passed on to the buffer with the first word
+		start_id = Signal(12)
+
+		m.d.rx += check_lcrc.eq(0)
+		for q in range(quads):
+			with m.If(last_start_quads[q]):
+				tlp_id = Cat(last_symbols[4 * q + 2][0:8], last_symbols[4 * q + 1][0:4])
+				m.d.comb += start_id.eq(tlp_id)
+				m.d.rx += self.actual_receive_seq.eq(tlp_id)
+
+			# A TLP without any TLP symbols isn't checked, it has no first word to go with the result
+			with m.If(lcrc_quads[q] & ~last_start_quads[q]):
+				m.d.rx += check_lcrc.eq(1)
+				m.d.rx += lcrc_received.eq(Cat(symbol[0:8] for symbol in window[4 * q + 3 : 4 * q + 7]))
+				m.d.rx += end_good.eq(window[4 * q + 7] == Ctrl.END)
+
+		# The TLP symbols are realigned such that the TLP starts at the start of the word, 3 symbols after STP.
+		# Since the TLP symbols are known a cycle later, the last two words are delayed once more.
+		delayed_symbols = [[Signal(8, name=f"delayed_symbol_{j}_{i}") for i in range(ratio)] for j in range(2)]
+		delayed_valid = [Signal(ratio, name=f"delayed_valid_{j}") for j in range(2)]
+		delayed_start_quads = [Signal(quads, name=f"delayed_start_quads_{j}") for j in range(2)]
+		delayed_start_id = [Signal(12, name=f"delayed_start_id_{j}") for j in range(2)]
+		m.d.rx += [
+			Cat(delayed_symbols[1]).eq(crc_input),
+			delayed_valid[1].eq(tlp_symbols),
+			delayed_start_quads[1].eq(last_start_quads),
+			delayed_start_id[1].eq(start_id),
+			Cat(delayed_symbols[0]).eq(Cat(delayed_symbols[1])),
+			delayed_valid[0].eq(delayed_valid[1]),
+			delayed_start_quads[0].eq(delayed_start_quads[1]),
+			delayed_start_id[0].eq(delayed_start_id[1]),
+		]
+		if not self.cut_through:
+			with m.If(delayed_start_quads[0].any()):
+				m.d.rx += buffer.store_tlp_id.eq(delayed_start_id[0])
+
+		# The symbols of a word in which a TLP starts belong to that TLP, they don't end the window of the previous TLP
+		delayed_window = delayed_symbols[0] + delayed_symbols[1]
+		delayed_window_valid = Cat(delayed_valid[0], Mux(delayed_start_quads[1].any(), 0, delayed_valid[1]))
+
+		tlp_offset = Signal(range(ratio))
+		tlp_offset_statement = tlp_offset
+		for q in range(quads):
+			tlp_offset_statement = Mux(delayed_start_quads[0][q], 4 * q + 3, tlp_offset_statement)
+		m.d.rx += tlp_offset.eq(tlp_offset_statement)
+
+		# The first word is the one starting after STP, the last word is followed by a word without TLP symbols.
+		# Since TLP symbols are contiguous, the first symbol of the following word tells whether there is one.
+		with m.Switch(tlp_offset_statement):
+			for q in range(quads):
+				with m.Case(4 * q + 3):
+					for i in range(ratio):
+						m.d.rx += received.symbol[i].eq(delayed_window[4 * q + 3 + i])
+						m.d.rx += received.valid[i].eq(delayed_window_valid[4 * q + 3 + i])
+					m.d.rx += received.first.eq(delayed_start_quads[0][q])
+					m.d.rx += received.last.eq(delayed_window_valid[4 * q + 3] & ~delayed_window_valid[4 * q + 3 + ratio])
+
+		# Whether TLPs are waiting to be acknowledged and how many
+		ack_pending = Signal()
+		ack_pending_count = Signal(range(self.ack_coalesce_count + 1))
+		# A TLP has been received and is to be acknowledged
+		ack_received = Signal()
+		# Send an Ack right away
+		ack_flush = Signal()
+
+		def ack(immediately = False):
+			m.d.comb += (ack_flush if immediately else ack_received).eq(1)
 		
 		def nak():
 			with m.If(~self.nak_scheduled):
@@ -414,12 +812,98 @@ class PCIeDLLTLPReceiver(Elaboratable):
 					self.dll.scheduled_ack_nak_id.eq(self.next_receive_seq - 1),
 					self.nak_scheduled.eq(1),
 					self.ack_nak_latency_timer.eq(self.ack_nak_latency_timer.reset),
+					ack_pending.eq(0),
+					ack_pending_count.eq(0),
 				]
 
-		with m.If(self.ack_nak_latency_timer < self.ack_nak_latency_limit):
-			m.d.rx += self.ack_nak_latency_timer.eq(self.ack_nak_latency_timer + 1)
+		# The Ack acknowledges all TLPs up to NEXT_RCV_SEQ - 1, a TLP received in the same cycle waits for the next Ack
+		with m.If(ack_flush | (ack_pending & ((self.ack_nak_latency_timer >= self.ack_nak_latency_limit) | (ack_pending_count == self.ack_coalesce_count)))):
+			m.d.comb += self.dll.schedule_ack_nak.eq(1)
+			m.d.rx += [
+				self.dll.scheduled_ack.eq(1),
+				self.dll.scheduled_ack_nak_id.eq(self.next_receive_seq - 1),
+				self.ack_nak_latency_timer.eq(self.ack_nak_latency_timer.reset),
+				ack_pending.eq(ack_received),
+				ack_pending_count.eq(ack_received),
+			]
 
-		m.d.rx += buffer.delete_tlp.eq(0)
+		with m.Else():
+			with m.If(ack_received):
+				m.d.rx += ack_pending.eq(1)
+				m.d.rx += ack_pending_count.eq(ack_pending_count + 1)
+
+			# The timer runs while TLPs are waiting to be acknowledged
+			with m.If(~ack_pending):
+				m.d.rx += self.ack_nak_latency_timer.eq(self.ack_nak_latency_timer.reset)
+			with m.Elif(self.ack_nak_latency_timer < self.ack_nak_latency_limit):
+				m.d.rx += self.ack_nak_latency_timer.eq(self.ack_nak_latency_timer + 1)
+
+		# From a ratio of 8 the checks of a short TLP can be done up to two cycles before its first word is passed on, and the
+		# checks of the next TLP can follow before that. The results wait in a queue for the first word, since the decision needs
+		# to know whether the first word was stored. The decision is made by the time the last word is passed on.
+		m.submodules.checks = checks = DomainRenamer("rx")(SyncFIFO(width = 3 + 12, depth = 4))
+		m.d.comb += checks.w_en.eq(check_lcrc)
+		m.d.comb += checks.w_data.eq(Cat(lcrc.output == lcrc_received, ~lcrc.output == lcrc_received, end_good, self.actual_receive_seq))
+		lcrc_good = checks.r_data[0]
+		lcrc_inverted = checks.r_data[1]
+		checked_end_good = checks.r_data[2]
+		checked_seq = checks.r_data[3:15]
+
+		first_received = received.first & received.valid[0]
+		first_waiting = Signal()
+		decide = Signal()
+		m.d.comb += decide.eq(checks.r_rdy & (first_received | first_waiting))
+		m.d.comb += checks.r_en.eq(decide)
+		with m.If(decide):
+			m.d.rx += first_waiting.eq(0)
+		with m.Elif(first_received):
+			m.d.rx += first_waiting.eq(1)
+
+		# The result of the checks is known when the last word of the TLP is passed on. In cut-through mode it is queued for the
+		# transaction layer, otherwise the buffer drops TLPs which failed the checks, so only good TLPs take a slot.
+		decided_good = Signal()
+		last_good = Signal()
+		good = Mux(decide, decided_good, last_good)
+		with m.If(decide):
+			m.d.rx += last_good.eq(decided_good)
+		if not self.cut_through:
+			m.d.comb += buffer.store_tlp_good.eq(good)
+
+		def discard():
+			m.d.comb += decided_good.eq(0)
+
+		# The TLP passed the checks, its sequence number is queued to pass the TLPs on in order
+		def accept():
+			m.d.comb += decided_good.eq(1)
+			if not self.cut_through:
+				m.d.comb += received_tlp_fifo.w_en.eq(1)
+				m.d.comb += received_tlp_fifo.w_data.eq(checked_seq)
+
+		# Whether the receiver has space for another TLP
+		if self.cut_through:
+			space_left = Signal()
+			m.d.comb += space_left.eq(fifo.level <= self.depth - self.tlp_depth)
+
+			# The words of a TLP are written if there was space when it started, the FIFO can't overflow since that space was kept
+			writing = Signal()
+			write = Mux(received.first, space_left, writing)
+			m.d.comb += fifo.w_data.eq(Cat(*received.symbol, *received.valid, received.first, received.last, good))
+			m.d.comb += fifo.w_en.eq(received.valid[0] & write)
+			with m.If(received.valid[0]):
+				m.d.rx += writing.eq(write & ~received.last)
+
+			first_accepted = space_left
+
+		else:
+			space_left = ~buffer.slots_full
+			first_accepted = buffer.tlp_sink.ready
+
+		# Whether the buffer took the first word of the TLP and stores it. It doesn't if it was full when the TLP started, such a
+		# TLP is Nak'd even if space has been freed since.
+		first_stored = Signal()
+		with m.If(first_received):
+			m.d.rx += first_stored.eq(first_accepted)
+		stored = Mux(first_received, first_accepted, first_stored)
 
 		m.d.comb += self.debug2.eq(lcrc.output)
 		m.d.comb += self.debug3.eq(crc_input)
@@ -428,103 +912,71 @@ class PCIeDLLTLPReceiver(Elaboratable):
 			m.d.comb += Cat(self.debug[0:4]).eq(fsm.state)
 			m.d.comb += Cat(self.debug_state[0:4]).eq(fsm.state)
 
-			with m.State("Idle"):
-				with m.If(self.dllp_sink.symbol[0] == Ctrl.STP):
-					tlp_id = Cat(source_symbols[3], source_symbols[2][0:4])
-
-					m.d.comb += buffer.store_tlp.eq(1)
-					m.d.rx += buffer.store_tlp_id.eq(tlp_id)
-
-					m.d.rx += reset_crc.eq(0)
-					m.d.rx += crc_input.eq(Cat(source_symbols[2], source_symbols[3]))
-					m.d.rx += self.actual_receive_seq.eq(tlp_id)
-					m.next = "Receive"
-
-					m.d.comb += Cat(self.debug[4:8]).eq(0)
-				
-				#with m.If(self.dll.up  & (self.ack_nak_latency_timer == self.ack_nak_latency_limit) & ~ self.nak_scheduled)
-			
 			with m.State("Receive"):
-				with m.If((self.dllp_sink.symbol[3] == Ctrl.END) | (self.dllp_sink.symbol[3] == Ctrl.EDB)):
-					for i in range(4):
-						m.d.rx += buffer.tlp_sink.valid[i].eq(0)
-
-					m.d.rx += end_good.eq(self.dllp_sink.symbol[3] == Ctrl.END)
-
-					m.next = "LCRC"
-
-				with m.Else():
-					for i in range(4):
-						m.d.rx += buffer.tlp_sink.valid[i].eq(1)
-			
-			with m.State("LCRC"):
-				#ack()	
-				m.d.rx += reset_crc.eq(1)
-				m.d.comb += Cat(self.debug[4:8]).eq(7)
-
-				with m.If((lcrc.output == last_symbols) & end_good):
-					with m.If(self.actual_receive_seq == self.next_receive_seq):
-						m.d.comb += received_tlp_fifo.w_en.eq(1)
-						m.d.comb += received_tlp_fifo.w_data.eq(self.actual_receive_seq)
-						m.d.rx += self.next_receive_seq.eq(self.next_receive_seq + 1)
-						m.d.rx += self.nak_scheduled.eq(0)
-						with m.If(~buffer.slots_full):
-							ack() # This should be fine, really, see PCIe Base 1.1 Page 157 Point 2
-							m.d.comb += Cat(self.debug[4:8]).eq(1)
+				with m.If(decide):
+					m.d.comb += Cat(self.debug[4:8]).eq(7)
+
+					with m.If(lcrc_good & checked_end_good):
+						with m.If((checked_seq == self.next_receive_seq) & stored):
+							accept()
+							m.d.rx += self.next_receive_seq.eq(self.next_receive_seq + 1)
+							m.d.rx += self.nak_scheduled.eq(0)
+							with m.If(space_left):
+								ack() # This should be fine, really, see PCIe Base 1.1 Page 157 Point 2
+								m.d.comb += Cat(self.debug[4:8]).eq(1)
+
+							with m.Else():
+								m.next = "Wait"
+								m.d.comb += Cat(self.debug[4:8]).eq(2)
+
+						with m.Elif(checked_seq == self.next_receive_seq): # Not stored, it is replayed after the Nak
+							discard()
+							nak()
+
+						with m.Elif((self.next_receive_seq - checked_seq) <= 2048): # Duplicate received
+							discard()
+							ack(immediately = True)
+							m.d.comb += Cat(self.debug[4:8]).eq(3)
 
 						with m.Else():
-							m.next = "Wait"
-							m.d.comb += Cat(self.debug[4:8]).eq(2)
-
-					with m.Elif((self.next_receive_seq - self.actual_receive_seq) <= 2048): # Duplicate received
-						ack()
-						m.d.comb += Cat(self.debug[4:8]).eq(3)
-
+							discard()
+							nak()
+							m.d.comb += Cat(self.debug[4:8]).eq(4)
+					
 					with m.Else():
-						m.d.rx += buffer.delete_tlp.eq(1)
-						m.d.rx += buffer.delete_tlp_id.eq(self.actual_receive_seq)
-						nak()
-						m.d.comb += Cat(self.debug[4:8]).eq(4)
-				
-				with m.Else():
-					with m.If((~lcrc.output == last_symbols) & ~end_good):
-						m.d.rx += buffer.delete_tlp.eq(1)
-						m.d.rx += buffer.delete_tlp_id.eq(self.actual_receive_seq)
-						m.d.comb += Cat(self.debug[4:8]).eq(5)
-
-					with m.Else(): # TODO: Delete TLP here too?
-						m.d.rx += buffer.delete_tlp.eq(1)
-						m.d.rx += buffer.delete_tlp_id.eq(self.actual_receive_seq)
-						nak()
-						m.d.comb += Cat(self.debug[4:8]).eq(6)
-
-				m.next = "Idle"
+						with m.If(lcrc_inverted & ~checked_end_good):
+							discard()
+							m.d.comb += Cat(self.debug[4:8]).eq(5)
+
+						with m.Else():
+							discard()
+							nak()
+							m.d.comb += Cat(self.debug[4:8]).eq(6)
 			
 			with m.State("Wait"): # It goes in this state if there is no free space, after space has been freed it is acknowledged such that the next TLP can be received.
-				with m.If(~buffer.slots_full):
-					ack()
-					m.next = "Idle"
+				with m.If(decide):
+					discard()
 
-		with m.FSM(name = "DLL_TLP_to_TLP_rx_FSM", domain = "rx") as fsm:
-			m.d.comb += Cat(self.debug_state[4:8]).eq(fsm.state)
+				with m.If(space_left):
+					ack()
+					m.next = "Receive"
 
-			with m.State("Wait"):
-				with m.If(~self.buffer.slots_empty):
-					tx_id = 0
-					for i in range(len(self.buffer.slots)):
-						tx_id = Mux(self.buffer.slots[i][0], self.buffer.slots[i][1], tx_id)
-					
-					m.d.rx += self.buffer.send_tlp_id.eq(tx_id)
-					m.d.comb += self.buffer.send_tlp.eq(1)
-					m.next = "Send"
-			
-			with m.State("Send"):
-				with m.If(~self.buffer.sending_tlp):
-					m.d.rx += buffer.delete_tlp.eq(1) # TODO: This might clash with the code further up if two deletes are issued at the same time
-					m.d.rx += buffer.delete_tlp_id.eq(self.buffer.send_tlp_id)
-					m.next = "Wait-Delete"
-
-			with m.State("Wait-Delete"):
-				m.next = "Wait"
+		if not self.cut_through:
+			# TLPs are passed on in the order they have been received. The next TLP is requested while the current one is being sent
+			# and the buffer deletes a TLP once it has been read, so consecutive TLPs are passed on without idle cycles.
+			with m.If(received_tlp_fifo.r_rdy & buffer.send_ready):
+				m.d.comb += received_tlp_fifo.r_en.eq(1)
+				m.d.comb += buffer.send_tlp.eq(1)
+				m.d.rx += buffer.send_tlp_id.eq(received_tlp_fifo.r_data)
+
+		# The credits are returned once the last word has been taken, the header fields needed for this are in the first word.
+		# TLPs which failed the checks in cut-through mode don't return credits, they are replayed.
+		take = self.tlp_source.ready & self.tlp_source.valid[0]
+		first_header = Signal(32)
+		with m.If(take & self.tlp_source.first):
+			m.d.rx += first_header.eq(Cat(self.tlp_source.symbol[0:4]))
+
+		m.d.comb += Cat(returned_header).eq(Mux(self.tlp_source.first, Cat(self.tlp_source.symbol[0:4]), first_header))
+		m.d.comb += return_credits.eq(take & self.tlp_source.last & self.tlp_good)
 
 		return m
\ No newline at end of file
@@ -7,6 +7,7 @@ from .layouts import dllp_layout
 from .serdes import K, D, Ctrl
 from .crc import SingleCRC
 from .stream import StreamInterface
+from .memory import InterleavedFIFO
 
 # Page 137 in PCIe 1.1
 class DLLPType(IntEnum):
@@ -30,7 +31,7 @@ class DLLPType(IntEnum):
 
 class PCIeDLLPTransmitter(Elaboratable):
 	"""
-	PCIe Data Link Layer Packet transmitter for x4 width
+	PCIe Data Link Layer Packet transmitter, a DLLP takes two clock cycles at a ratio of 4 and one clock cycle at wider ratios
 
 	Parameters
 	----------
@@ -40,14 +41,13 @@ class PCIeDLLPTransmitter(Elaboratable):
 		True when sending DLLPs
 	"""
 	def __init__(self, ratio = 4):
+		assert ratio % 4 == 0
 		self.dllp = Record(dllp_layout)
 		self.phy_source = StreamInterface(9, ratio, name="PHY_Source")
 		self.dllp_sink = StreamInterface(9, ratio, name="DLLP_Sink")
 		self.send = Signal()
 		self.started_sending = Signal()
-		assert len(self.phy_source.symbol) == 4
-		assert len(self.dllp_sink.symbol) == 4
-		self.ratio = len(self.phy_source.symbol)
+		self.ratio = ratio
 
 		self.dllp_data = Signal(4 * 8)
 
@@ -59,6 +59,7 @@ class PCIeDLLPTransmitter(Elaboratable):
 		m = Module()
 
 		dllp = self.dllp
+		ratio = self.ratio
 
 		# The first 4 bytes
 		dllp_data = self.dllp_data# = Signal(4 * 8)
@@ -75,43 +76,41 @@ class PCIeDLLPTransmitter(Elaboratable):
 
 		dllp_bytes = Cat(dllp_data, ~Cat(crc.output[::-1]))
 
-		# First or second half of DLLP
-		which_half = Signal()
+		# SDP, 6 bytes and END, split into words
+		dllp_symbols = [Ctrl.SDP] + [dllp_bytes[8 * i : 8 * i + 8] for i in range(6)] + [Ctrl.END]
+		beats = (len(dllp_symbols) + ratio - 1) // ratio
+
+		# Which part of the DLLP is being sent
+		beat = Signal(range(beats))
 
 		m.d.comb += self.dllp_sink.ready.eq(0)
 
 		with m.If(self.phy_source.ready):
 			m.d.comb += self.dllp_sink.ready.eq(1)
 			with m.If(self.dllp_sink.all_valid):
-				for i in range(self.ratio):
+				for i in range(ratio):
 					m.d.rx += self.phy_source.symbol[i].eq(self.dllp_sink.symbol[i])
 					m.d.rx += self.phy_source.valid[i].eq(self.dllp_sink.valid[i]) # TODO: Fix this
 
-			with m.Elif(dllp.valid & (self.send | which_half)):
+			with m.Elif(dllp.valid & (self.send | (beat != 0))):
 				#m.d.comb += self.dllp_sink.ready.eq(0)
-				for i in range(4):
-					m.d.rx += self.phy_source.valid[i].eq(1)
-
-				with m.If(~which_half):
-					m.d.rx += which_half.eq(1)
-					m.d.rx += self.phy_source.symbol[0].eq(Ctrl.SDP)
-					m.d.comb += self.started_sending.eq(1)
-
-					for i in range(self.ratio - 1):
-						m.d.rx += self.phy_source.symbol[i + 1].eq(dllp_bytes[8 * i : 8 * i + 8])
-
-				with m.Else():
-					m.d.rx += which_half.eq(0)
-					m.d.comb += self.started_sending.eq(0)
-					for i in range(self.ratio - 1):
-						m.d.rx += self.phy_source.symbol[i].eq(dllp_bytes[8 * i + (self.ratio - 1) * 8 : 8 * i + 8 + (self.ratio - 1) * 8])
-
-					m.d.rx += self.phy_source.symbol[3].eq(Ctrl.END)
+				with m.Switch(beat):
+					for i in range(beats):
+						with m.Case(i):
+							m.d.rx += beat.eq(i + 1 if i + 1 < beats else 0)
+							m.d.comb += self.started_sending.eq(i == 0)
+
+							for j in range(ratio):
+								if i * ratio + j < len(dllp_symbols):
+									m.d.rx += self.phy_source.symbol[j].eq(dllp_symbols[i * ratio + j])
+									m.d.rx += self.phy_source.valid[j].eq(1)
+								else:
+									m.d.rx += self.phy_source.valid[j].eq(0)
 
 			with m.Else():
-				m.d.rx += which_half.eq(0)
+				m.d.rx += beat.eq(0)
 				m.d.comb += self.started_sending.eq(0)
-				for i in range(4):
+				for i in range(ratio):
 					m.d.rx += self.phy_source.valid[i].eq(0)
 
 		return m
@@ -119,15 +118,31 @@ class PCIeDLLPTransmitter(Elaboratable):
 class PCIeDLLPReceiver(Elaboratable):
 	"""
 	PCIe Data Link Layer Packet receiver
+
+	DLLPs start at a multiple of 4 symbols, they are detected in a window of the last two words. At ratios above 8 several DLLPs
+	can end in the same word, all of them are checked and the good ones are queued, one DLLP is put out per clock cycle. A DLLP
+	arriving while the queue is full is dropped like a DLLP with a bad CRC, the queue holds a burst of queue_depth words of DLLPs.
+
+	Parameters
+	----------
+	ratio : int
+		Gearbox ratio, the number of symbols per clock cycle of all lanes
+	queue_depth : int
+		Depth of every FIFO of the queue at ratios above 8
 	"""
-	def __init__(self, ratio = 4):
-		assert ratio == 4
+	def __init__(self, ratio = 4, queue_depth = 8):
+		assert ratio % 4 == 0
 
 		self.dllp = Record(dllp_layout)
 		self.phy_sink = StreamInterface(9, ratio, name="PHY_Sink")
 		self.dllp_source = StreamInterface(9, ratio, name="DLLP_Source")
 		self.ratio = ratio
 
+		# A DLLP takes 8 symbols, SDP, 6 bytes and END
+		self.max_dllps = max(1, ratio // 8)
+		"""Maximum number of DLLPs ending in a word"""
+		self.queue = InterleavedFIFO(4 * 8, queue_depth, self.max_dllps) if self.max_dllps > 1 else None
+
 		self.state = [
 			self.dllp
 		]
@@ -136,38 +151,61 @@ class PCIeDLLPReceiver(Elaboratable):
 		m = Module()
 
 		dllp = self.dllp
-
-		dllp_bytes = Signal(6 * 8)
-
-		received = Signal()
-
-		valid = Signal()
-
-		m.submodules.crc = crc = SingleCRC(dllp_bytes[:4 * 8], 0xFFFF, 0x100B, 16)
-
-		with m.If(self.phy_sink.symbol[0] == Ctrl.SDP):
-			for i in range(self.ratio - 1):
-				m.d.rx += Cat(dllp_bytes[8 * i : 8 * i + 8]).eq(self.phy_sink.symbol[i + 1])
-			#m.d.rx += valid.eq(0)
-
-		with m.Elif(self.phy_sink.symbol[3] == Ctrl.END):
-			for i in range(self.ratio - 1):
-				m.d.rx += Cat(dllp_bytes[8 * i + (self.ratio - 1) * 8: 8 * i + 8 + (self.ratio - 1) * 8]).eq(self.phy_sink.symbol[i])
-			m.d.rx += received.eq(1)
-		
-		m.d.comb += valid.eq(~Cat(crc.output[::-1]) == dllp_bytes[8 * 4:])
-
-		with m.If(valid & received):
-			m.d.rx += dllp.valid.eq(1)
-			m.d.rx += dllp.type.eq(dllp_bytes[4:8])
-			m.d.rx += dllp.type_meta.eq(dllp_bytes[0:3])
-			m.d.rx += dllp.header.eq(Cat(dllp_bytes[22:24], dllp_bytes[8:14]))
-			m.d.rx += dllp.data.eq(Cat(dllp_bytes[24:32], dllp_bytes[16:20]))
-			m.d.rx += received.eq(0)
-		
-
-		for i in range(4):
+		ratio = self.ratio
+
+		# Symbols of the last word and the current word
+		last_symbols = [Signal(9, name=f"last_symbol_{i}") for i in range(ratio)]
+		m.d.rx += Cat(last_symbols).eq(Cat(self.phy_sink.symbol))
+		window = last_symbols + self.phy_sink.symbol
+
+		# DLLPs ending at every quad of the current word, each one is checked
+		ends = list(range(ratio + 3, 2 * ratio, 4))
+		dllp_bytes = [Signal(6 * 8, name=f"dllp_bytes_{i}") for i in range(len(ends))]
+		received = Signal(len(ends))
+		valid = Signal(len(ends))
+
+		for i, end in enumerate(ends):
+			m.d.rx += dllp_bytes[i].eq(Cat(symbol[:8] for symbol in window[end - 6 : end]))
+			m.d.rx += received[i].eq((window[end - 7] == Ctrl.SDP) & (window[end] == Ctrl.END))
+
+			m.submodules[f"crc_{i}"] = crc = SingleCRC(dllp_bytes[i][:4 * 8], 0xFFFF, 0x100B, 16)
+			m.d.comb += valid[i].eq(received[i] & (~Cat(crc.output[::-1]) == dllp_bytes[i][8 * 4:]))
+
+		def decode(data):
+			return [
+				dllp.type.eq(data[4:8]),
+				dllp.type_meta.eq(data[0:3]),
+				dllp.header.eq(Cat(data[22:24], data[8:14])),
+				dllp.data.eq(Cat(data[24:32], data[16:20])),
+			]
+
+		m.d.rx += dllp.valid.eq(0)
+		if self.queue is None:
+			# Two DLLPs can't end in the same word
+			for i in reversed(range(len(ends))):
+				with m.If(valid[i]):
+					m.d.rx += dllp.valid.eq(1)
+					m.d.rx += decode(dllp_bytes[i][:4 * 8])
+
+		else:
+			m.submodules.queue = queue = DomainRenamer("rx")(self.queue)
+
+			# The good DLLPs are written in the order they were received, the n-th one is written with w_data[n]
+			count = 0
+			for i in range(len(ends)):
+				for n in range(self.max_dllps):
+					with m.If(valid[i] & (count == n)):
+						m.d.comb += queue.w_data[n].eq(dllp_bytes[i][:4 * 8])
+				count = count + valid[i]
+			m.d.comb += queue.w_count.eq(count)
+
+			m.d.comb += queue.r_en.eq(1)
+			with m.If(queue.r_rdy):
+				m.d.rx += dllp.valid.eq(1)
+				m.d.rx += decode(queue.r_data)
+
+		for i in range(ratio):
 			m.d.rx += self.dllp_source.symbol[i].eq(self.phy_sink.symbol[i])
 			m.d.rx += self.dllp_source.valid[i].eq(1) # Maybe toggle this with STP / END, EDB
 
-		return m
\ No newline at end of file
+		return m
@@ -0,0 +1,506 @@
+from amaranth import *
+from amaranth.build import *
+from amaranth.lib.fifo import SyncFIFOBuffered
+import math
+
+from .stream import StreamInterface
+from .serdes import LinkSpeed
+from .tlp import TLPType, DWSplitter, DWPacker
+
+def big_endian(value: Value) -> Value:
+	"""
+	DW with its bytes in the order they are sent in, for addresses in TLP headers
+	"""
+	return Cat(value[24:32], value[16:24], value[8:16], value[0:8])
+
+class DMAEngine(Elaboratable):
+	"""
+	Bus master DMA engine, copies data between host memory and the card memory ports.
+
+	Descriptors are queued per direction. Descriptors from the host are split into memory read requests of at most
+	Max_Read_Request_Size, which are sent as long as there are free tags. The completions can arrive in any order, their
+	data is put into a reorder buffer with room for one request per tag, requests are written to the card in the order
+	they were sent and a descriptor is reported done once its last request has been written.
+	Descriptors to the host are split into memory writes of at most Max_Payload_Size and reported done once the last one
+	has been queued.
+
+	Requests don't cross a boundary of their maximum size and so never cross a 4 KB boundary. Host addresses and lengths
+	are in DWs and all bytes are enabled.
+
+	Completions are advertised as infinite, so the receive buffer has to hold the completions of all outstanding reads.
+	A completer can split a read at every 64 byte Read Completion Boundary, a read is only sent while the 64 byte blocks
+	touched by the outstanding reads fit into the completion_blocks the receiver keeps room for, see PCIeDLLTLPReceiver.
+
+	Every outstanding read has a completion timer, see 2.8 in PCIe 1.1. If the read isn't completed within completion_timeout,
+	its tag is retired like one which got a completion with an error status and the descriptor is reported with an error.
+	The timers count ticks of completion_timeout / 64, so a timer expires up to 1/64 of completion_timeout late.
+	Completions arriving after the timeout are dropped while the tag is still waiting to be retired.
+
+	Parameters
+	----------
+	ratio : int
+		Gearbox ratio
+	card_address_width : int
+		Width of the DW addresses of the card memory
+	tags : int
+		Number of read requests which can be outstanding, at most 32
+	max_read_request_size : int
+		Largest read request in bytes, the size set in the Device Control register is limited to it
+	max_payload_size : int
+		Largest payload in bytes, the size set in the Device Control register is limited to it
+	descriptors : int
+		Number of descriptors which can be queued per direction
+	completion_blocks : int
+		Number of 64 byte blocks of completion data the receive buffer has room for, at least max_read_request_size // 64
+	frequency : float
+		Maximum clock frequency of the rx domain in Hz, the frequency at 5 GT/s
+	use_speed : bool
+		Whether the clock runs at half the frequency at 2.5 GT/s, see speed
+	completion_timeout : float
+		Completion timeout in seconds, from 50 us to 50 ms
+
+	descriptor_valid : Signal()
+		Queue a descriptor
+	descriptor_ready : Signal()
+		The descriptor is queued
+	descriptor_to_host : Signal()
+		Copy from the card to the host instead of from the host to the card
+	descriptor_host_address : Signal(64)
+		Host byte address, DW aligned
+	descriptor_card_address : Signal(card_address_width)
+		Card DW address
+	descriptor_length : Signal(16)
+		Number of DWs to copy, at least 1
+	descriptor_id : Signal(8)
+		Reported with the descriptor when it is done
+
+	from_host_done : Signal()
+		A descriptor from the host is done, valid for 1 cycle
+	from_host_done_id : Signal(8)
+		Its ID
+	from_host_done_error : Signal()
+		A completion for it had an error status or a request timed out, the data of that request hasn't been written
+	to_host_done : Signal()
+		A descriptor to the host is done, valid for 1 cycle
+	to_host_done_id : Signal(8)
+		Its ID
+
+	requester_id : Signal(16)
+		Bus, device and function number of this function, Cat(function, device, bus)
+	bus_master_enable : Signal()
+		Bus Master Enable bit of the Command register, no requests are sent if 0
+	payload_size : Signal(3)
+		Max_Payload_Size field of the Device Control register
+	read_request_size : Signal(3)
+		Max_Read_Request_Size field of the Device Control register
+	speed : Signal(1)
+		Link speed, only used with use_speed
+
+	read_source : StreamInterface
+		Memory read requests
+	write_source : StreamInterface
+		Memory write requests
+	completion_sink : StreamInterface
+		Completions
+	completion_sink_good : Signal()
+		Valid with the last word, the completion is dropped if 0
+
+	write_address : Signal(card_address_width)
+		Card DW address to write to
+	write_data : Signal(32)
+		Data to write, little endian
+	write_enable : Signal(4)
+		Byte enables, nothing is written if 0
+	read_address : Signal(card_address_width)
+		Card DW address to read from
+	read_enable : Signal()
+		Read read_address
+	read_data : Signal(32)
+		Data read, needs to be valid in the cycle after read_enable
+	"""
+	def __init__(self, ratio: int, card_address_width: int = 16, tags: int = 8, max_read_request_size: int = 512, max_payload_size: int = 128, descriptors: int = 4,
+		completion_blocks: int = 16, frequency: float = 125e6, use_speed: bool = False, completion_timeout: float = 10e-3):
+		assert tags <= 32 and tags & (tags - 1) == 0
+		assert 50e-6 <= completion_timeout and completion_timeout * (1 + 1 / 64) <= 50e-3
+		assert completion_blocks >= max_read_request_size // 64
+		assert max_read_request_size in [128, 256, 512, 1024, 2048, 4096]
+		assert max_payload_size in [128, 256, 512, 1024, 2048, 4096]
+		self.ratio = ratio
+		self.card_address_width = card_address_width
+		self.tags = tags
+		self.max_read_request_size = max_read_request_size
+		self.max_payload_size = max_payload_size
+		self.descriptors = descriptors
+		self.completion_blocks = completion_blocks
+		self.frequency = frequency
+		self.use_speed = use_speed
+		self.completion_timeout = completion_timeout
+
+		self.descriptor_valid = Signal()
+		self.descriptor_ready = Signal()
+		self.descriptor_to_host = Signal()
+		self.descriptor_host_address = Signal(64)
+		self.descriptor_card_address = Signal(card_address_width)
+		self.descriptor_length = Signal(16)
+		self.descriptor_id = Signal(8)
+
+		self.from_host_done = Signal()
+		self.from_host_done_id = Signal(8)
+		self.from_host_done_error = Signal()
+		self.to_host_done = Signal()
+		self.to_host_done_id = Signal(8)
+
+		self.requester_id = Signal(16)
+		self.bus_master_enable = Signal()
+		self.payload_size = Signal(3)
+		self.read_request_size = Signal(3)
+		self.speed = Signal(reset = LinkSpeed.S2_5)
+
+		self.read_source = StreamInterface(8, ratio, name="DMA_Read_Source")
+		self.write_source = StreamInterface(8, ratio, name="DMA_Write_Source")
+		self.completion_sink = StreamInterface(8, ratio, name="DMA_Completion_Sink")
+		self.completion_sink_good = Signal(reset = 1)
+
+		self.write_address = Signal(card_address_width)
+		self.write_data = Signal(32)
+		self.write_enable = Signal(4)
+		self.read_address = Signal(card_address_width)
+		self.read_enable = Signal()
+		self.read_data = Signal(32)
+
+	def elaborate(self, platform: Platform) -> Module:
+		m = Module()
+
+		ratio = self.ratio
+		tags = self.tags
+		requester_id = self.requester_id
+
+		def size_dws(field, maximum):
+			"""Size field of the Device Control register in DWs, limited to maximum bytes"""
+			limit = int(math.log2(maximum // 128))
+			size = Signal(11)
+			m.d.comb += size.eq(Const(32, 6) << Mux(field > limit, limit, field))
+			return size
+
+		read_request_dws = size_dws(self.read_request_size, self.max_read_request_size)
+		payload_dws = size_dws(self.payload_size, self.max_payload_size)
+
+		# Descriptor queues
+		def descriptor_fields(host_address, card_address, length, id):
+			return Cat(host_address, card_address, length, id)
+
+		descriptor_width = len(descriptor_fields(self.descriptor_host_address, self.descriptor_card_address, self.descriptor_length, self.descriptor_id))
+		m.submodules.from_host_queue = from_host_queue = SyncFIFOBuffered(width = descriptor_width, depth = self.descriptors)
+		m.submodules.to_host_queue = to_host_queue = SyncFIFOBuffered(width = descriptor_width, depth = self.descriptors)
+
+		for queue, to_host in [(from_host_queue, 0), (to_host_queue, 1)]:
+			m.d.comb += queue.w_data.eq(descriptor_fields(self.descriptor_host_address, self.descriptor_card_address, self.descriptor_length, self.descriptor_id))
+			m.d.comb += queue.w_en.eq(self.descriptor_valid & (self.descriptor_to_host == to_host))
+		m.d.comb += self.descriptor_ready.eq(Mux(self.descriptor_to_host, to_host_queue.w_rdy, from_host_queue.w_rdy))
+
+		def request_header(fmt_type_32, fmt_type_64, host_address, length, tag):
+			"""Header DWs of a memory request and whether it has 4 DWs"""
+			is_64 = host_address[32:64] != 0
+			fmt_type = Mux(is_64, Const(fmt_type_64, 7), Const(fmt_type_32, 7))
+			first_dw_be = Const(0b1111, 4)
+			last_dw_be = Mux(length == 1, Const(0b0000, 4), Const(0b1111, 4))
+			length_field = Signal(10) # 1024 DWs is 0
+			m.d.comb += length_field.eq(length)
+			return [
+				Cat(fmt_type, Const(0, 1), Const(0, 8), length_field[8:10], Const(0, 6), length_field[0:8]),
+				Cat(requester_id[8:16], requester_id[0:8], tag, first_dw_be, last_dw_be),
+				Mux(is_64, big_endian(host_address[32:64]), big_endian(host_address[0:32])),
+				big_endian(host_address[0:32]),
+			], is_64
+
+		# Completion timeout ticks, a timer expires after more than timeout_ticks ticks
+		timeout_ticks = 64
+		tick_cycles = max(2, math.ceil(self.completion_timeout * self.frequency / timeout_ticks))
+		# The clock runs at half the frequency at 2.5 GT/s
+		last_cycle = Mux(self.speed == LinkSpeed.S2_5, tick_cycles // 2 - 1, tick_cycles - 1) if self.use_speed else tick_cycles - 1
+		prescaler = Signal(range(tick_cycles))
+		tick = Signal()
+		m.d.comb += tick.eq(prescaler == last_cycle)
+		m.d.rx += prescaler.eq(Mux(tick, 0, prescaler + 1))
+
+		# Tag table, tags are allocated and retired in order
+		tag_bits = max(1, int(math.log2(tags)))
+		request_bits = int(math.log2(self.max_read_request_size // 4))
+		tag_head = Signal(tag_bits)
+		tag_tail = Signal(tag_bits)
+		tags_used = Signal(range(tags + 1))
+		tag_allocate = Signal()
+		tag_retire = Signal()
+		m.d.rx += tags_used.eq(tags_used + tag_allocate - tag_retire)
+
+		tag_pending = Array(Signal(name = f"Tag_{i}_pending") for i in range(tags))
+		tag_complete = Array(Signal(name = f"Tag_{i}_complete") for i in range(tags))
+		tag_error = Array(Signal(name = f"Tag_{i}_error") for i in range(tags))
+		tag_last = Array(Signal(name = f"Tag_{i}_last") for i in range(tags))
+		tag_id = Array(Signal(8, name = f"Tag_{i}_id") for i in range(tags))
+		tag_card_address = Array(Signal(self.card_address_width, name = f"Tag_{i}_card_address") for i in range(tags))
+		tag_length = Array(Signal(request_bits + 1, name = f"Tag_{i}_length") for i in range(tags))
+		tag_received = Array(Signal(request_bits + 1, name = f"Tag_{i}_received") for i in range(tags))
+		tag_blocks = Array(Signal(range(self.completion_blocks + 1), name = f"Tag_{i}_blocks") for i in range(tags))
+		tag_timer = Array(Signal(range(timeout_ticks + 2), name = f"Tag_{i}_timer") for i in range(tags))
+
+		# 64 byte blocks of completion data of the outstanding reads, they are released when the tag is retired
+		blocks_used = Signal(range(self.completion_blocks + 1))
+		read_blocks = Signal(range(self.completion_blocks + 1))
+		m.d.rx += blocks_used.eq(blocks_used + Mux(tag_allocate, read_blocks, 0) - Mux(tag_retire, tag_blocks[tag_tail], 0))
+
+		# Reorder buffer, every tag has room for one request
+		reorder_buffer = Memory(width = 32, depth = tags << request_bits, name = "Reorder_Buffer")
+		m.submodules.reorder_write = reorder_write = reorder_buffer.write_port(domain = "rx")
+		m.submodules.reorder_read = reorder_read = reorder_buffer.read_port(domain = "rx", transparent = False)
+
+		# Memory read requests
+		m.submodules.read_packer = read_packer = DWPacker(ratio)
+		read_packer.tlp_source.connect(self.read_source, m.d.comb)
+
+		read_host_address = Signal(64)
+		read_card_address = Signal(self.card_address_width)
+		read_remaining = Signal(17)
+		read_id = Signal(8)
+		read_length = Signal(request_bits + 1)
+
+		read_boundary = read_request_dws - (read_host_address[2:] & (read_request_dws - 1))
+		read_header, read_is_64 = request_header(TLPType.MRd32, TLPType.MRd64, read_host_address, read_length, Cat(tag_head, Const(0, 8 - tag_bits)))
+
+		with m.FSM(name = "Read_FSM", domain = "rx"):
+			with m.State("Idle"):
+				with m.If(from_host_queue.r_rdy):
+					m.d.comb += from_host_queue.r_en.eq(1)
+					m.d.rx += Cat(read_host_address, read_card_address, read_remaining[0:16], read_id).eq(from_host_queue.r_data)
+					m.d.rx += read_remaining[16].eq(0)
+					m.next = "Request"
+
+			with m.State("Request"):
+				length = Mux(read_remaining <= read_boundary, read_remaining, read_boundary)
+				blocks = (read_host_address[2:6] + length + 15) >> 4
+				with m.If(self.bus_master_enable & (tags_used < tags) & (blocks_used + blocks <= self.completion_blocks)):
+					m.d.rx += read_length.eq(length)
+					m.d.rx += read_blocks.eq(blocks)
+					m.next = "Header0"
+
+			for i in range(4):
+				with m.State(f"Header{i}"):
+					with m.If(read_packer.room):
+						m.d.comb += read_packer.w_en.eq(1)
+						m.d.comb += read_packer.w_data.eq(read_header[i])
+						m.d.comb += read_packer.w_first.eq(i == 0)
+						m.d.comb += read_packer.w_last.eq((i == 3) | ((i == 2) & ~read_is_64))
+
+						if i < 2:
+							m.next = f"Header{i + 1}"
+
+						else:
+							with m.If((i == 3) | ~read_is_64):
+								m.d.comb += tag_allocate.eq(1)
+								m.d.rx += [
+									tag_pending[tag_head].eq(1),
+									tag_complete[tag_head].eq(0),
+									tag_error[tag_head].eq(0),
+									tag_last[tag_head].eq(read_remaining == read_length),
+									tag_id[tag_head].eq(read_id),
+									tag_card_address[tag_head].eq(read_card_address),
+									tag_length[tag_head].eq(read_length),
+									tag_received[tag_head].eq(0),
+									tag_blocks[tag_head].eq(read_blocks),
+									tag_timer[tag_head].eq(0),
+									tag_head.eq(tag_head + 1),
+
+									read_host_address.eq(read_host_address + (read_length << 2)),
+									read_card_address.eq(read_card_address + read_length),
+									read_remaining.eq(read_remaining - read_length),
+								]
+								m.next = "Request"
+								with m.If(read_remaining == read_length):
+									m.next = "Idle"
+
+							if i == 2:
+								with m.If(read_is_64):
+									m.next = "Header3"
+
+		# Completions, their data is put into the reorder buffer
+		m.submodules.splitter = splitter = DWSplitter(ratio)
+		self.completion_sink.connect(splitter.tlp_sink, m.d.comb)
+		m.d.comb += splitter.ready.eq(1)
+		take = splitter.valid
+
+		completion_header = [Signal(32, name = f"Completion_DW{i}") for i in range(3)]
+		completion_dw = Signal(range(4))
+		completion_data = Signal(request_bits + 1)
+		with m.If(take):
+			m.d.rx += completion_dw.eq(Mux(splitter.last, 0, Mux(completion_dw == 3, 3, completion_dw + 1)))
+			m.d.rx += completion_data.eq(Mux(completion_dw == 3, completion_data + 1, 0))
+			with m.Switch(completion_dw):
+				for i in range(3):
+					with m.Case(i):
+						m.d.rx += completion_header[i].eq(splitter.dw)
+
+		completion_length = Mux(Cat(completion_header[0][24:32], completion_header[0][16:18]) == 0, 1024, Cat(completion_header[0][24:32], completion_header[0][16:18]))
+		completion_has_data = completion_header[0][6]
+		completion_status = completion_header[1][21:24]
+		# The last header DW is used while it is taken, since it is the last DW of a completion without data
+		completion_header_2 = Mux(completion_dw == 2, splitter.dw, completion_header[2])
+		completion_requester_id = Cat(completion_header_2[8:16], completion_header_2[0:8])
+		completion_tag = completion_header_2[16:24]
+		completion_tag_index = completion_tag[0:tag_bits]
+		completion_ours = (completion_requester_id == requester_id) & (completion_tag < tags) & tag_pending[completion_tag_index] & ~tag_complete[completion_tag_index]
+
+		with m.If(take & (completion_dw == 3) & completion_ours & (completion_status == 0)):
+			m.d.comb += reorder_write.en.eq(1)
+			m.d.comb += reorder_write.addr.eq(Cat((tag_received[completion_tag_index] + completion_data)[0:request_bits], completion_tag_index))
+			m.d.comb += reorder_write.data.eq(splitter.dw)
+
+		with m.If(take & splitter.last & (completion_dw >= 2) & self.completion_sink_good):
+			with m.If(completion_ours):
+				with m.If(completion_status != 0):
+					m.d.rx += tag_error[completion_tag_index].eq(1)
+					m.d.rx += tag_complete[completion_tag_index].eq(1)
+
+				with m.Elif(completion_has_data & (completion_dw == 3)):
+					m.d.rx += tag_received[completion_tag_index].eq(tag_received[completion_tag_index] + completion_length)
+					with m.If(tag_received[completion_tag_index] + completion_length == tag_length[completion_tag_index]):
+						m.d.rx += tag_complete[completion_tag_index].eq(1)
+
+		# A read which timed out is retired with an error, late completions for it aren't ours anymore
+		for i in range(tags):
+			with m.If(tag_pending[i] & ~tag_complete[i]):
+				with m.If(tag_timer[i] == timeout_ticks + 1):
+					m.d.rx += tag_error[i].eq(1)
+					m.d.rx += tag_complete[i].eq(1)
+
+				with m.Elif(tick):
+					m.d.rx += tag_timer[i].eq(tag_timer[i] + 1)
+
+		# Requests are written to the card in order
+		drain_count = Signal(request_bits + 1)
+		drain_write = Signal()
+		drain_address = Signal(self.card_address_width)
+		descriptor_error = Signal()
+
+		m.d.rx += drain_write.eq(0)
+		m.d.rx += self.from_host_done.eq(0)
+		with m.If(drain_write):
+			m.d.comb += self.write_address.eq(drain_address)
+			m.d.comb += self.write_data.eq(reorder_read.data)
+			m.d.comb += self.write_enable.eq(0b1111)
+
+		with m.FSM(name = "Retire_FSM", domain = "rx"):
+			with m.State("Idle"):
+				with m.If(tag_pending[tag_tail] & tag_complete[tag_tail]):
+					m.d.rx += drain_count.eq(0)
+					m.next = "Drain"
+					with m.If(tag_error[tag_tail]):
+						m.next = "Retire"
+
+			with m.State("Drain"):
+				m.d.comb += reorder_read.en.eq(1)
+				m.d.comb += reorder_read.addr.eq(Cat(drain_count[0:request_bits], tag_tail))
+				m.d.rx += drain_write.eq(1)
+				m.d.rx += drain_address.eq(tag_card_address[tag_tail] + drain_count)
+				m.d.rx += drain_count.eq(drain_count + 1)
+				with m.If(drain_count == tag_length[tag_tail] - 1):
+					m.next = "Retire"
+
+			with m.State("Retire"):
+				m.d.comb += tag_retire.eq(1)
+				m.d.rx += tag_pending[tag_tail].eq(0)
+				m.d.rx += tag_tail.eq(tag_tail + 1)
+				m.d.rx += descriptor_error.eq(descriptor_error | tag_error[tag_tail])
+				with m.If(tag_last[tag_tail]):
+					m.d.rx += self.from_host_done.eq(1)
+					m.d.rx += self.from_host_done_id.eq(tag_id[tag_tail])
+					m.d.rx += self.from_host_done_error.eq(descriptor_error | tag_error[tag_tail])
+					m.d.rx += descriptor_error.eq(0)
+				m.next = "Idle"
+
+		# Memory write requests, memory reads take 1 cycle
+		m.submodules.write_packer = write_packer = DWPacker(ratio)
+		write_packer.tlp_source.connect(self.write_source, m.d.comb)
+
+		push = Signal()
+		push_read = Signal()
+		push_dw = Signal(32)
+		push_first = Signal()
+		push_last = Signal()
+		m.d.rx += push.eq(0)
+		m.d.comb += write_packer.w_en.eq(push)
+		m.d.comb += write_packer.w_data.eq(Mux(push_read, self.read_data, push_dw))
+		m.d.comb += write_packer.w_first.eq(push_first)
+		m.d.comb += write_packer.w_last.eq(push_last)
+
+		write_host_address = Signal(64)
+		write_card_address = Signal(self.card_address_width)
+		write_remaining = Signal(17)
+		write_id = Signal(8)
+		write_length = Signal(11)
+		write_left = Signal(11)
+
+		write_boundary = payload_dws - (write_host_address[2:] & (payload_dws - 1))
+		write_header, write_is_64 = request_header(TLPType.MWr32, TLPType.MWr64, write_host_address, write_length, Const(0, 8))
+
+		m.d.rx += self.to_host_done.eq(0)
+
+		with m.FSM(name = "Write_FSM", domain = "rx"):
+			with m.State("Idle"):
+				with m.If(to_host_queue.r_rdy):
+					m.d.comb += to_host_queue.r_en.eq(1)
+					m.d.rx += Cat(write_host_address, write_card_address, write_remaining[0:16], write_id).eq(to_host_queue.r_data)
+					m.d.rx += write_remaining[16].eq(0)
+					m.next = "Request"
+
+			with m.State("Request"):
+				with m.If(self.bus_master_enable):
+					m.d.rx += write_length.eq(Mux(write_remaining <= write_boundary, write_remaining, write_boundary))
+					m.d.rx += write_left.eq(Mux(write_remaining <= write_boundary, write_remaining, write_boundary))
+					m.next = "Header0"
+
+			for i in range(4):
+				with m.State(f"Header{i}"):
+					with m.If(write_packer.room):
+						m.d.rx += [
+							push.eq(1),
+							push_read.eq(0),
+							push_dw.eq(write_header[i]),
+							push_first.eq(i == 0),
+							push_last.eq(0),
+						]
+
+						if i < 2:
+							m.next = f"Header{i + 1}"
+
+						elif i == 2:
+							m.next = "Data"
+							with m.If(write_is_64):
+								m.next = "Header3"
+
+						else:
+							m.next = "Data"
+
+			with m.State("Data"):
+				with m.If(write_packer.room):
+					m.d.comb += self.read_enable.eq(1)
+					m.d.comb += self.read_address.eq(write_card_address)
+					m.d.rx += [
+						push.eq(1),
+						push_read.eq(1),
+						push_first.eq(0),
+						push_last.eq(write_left == 1),
+						write_card_address.eq(write_card_address + 1),
+						write_left.eq(write_left - 1),
+					]
+
+					with m.If(write_left == 1):
+						m.d.rx += write_host_address.eq(write_host_address + (write_length << 2))
+						m.d.rx += write_remaining.eq(write_remaining - write_length)
+						m.next = "Request"
+
+						with m.If(write_remaining == write_length):
+							m.d.rx += self.to_host_done.eq(1)
+							m.d.rx += self.to_host_done_id.eq(write_id)
+							m.next = "Idle"
+
+		return m
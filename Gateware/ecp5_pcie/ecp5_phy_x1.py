@@ -1,20 +1,48 @@
 from amaranth import *
 from amaranth.build import *
 from .ecp5_serdes_geared_x4 import LatticeECP5PCIeSERDESx4
-from .ecp5_serdes import LatticeECP5PCIeSERDES
-from .serdes import PCIeSERDESAligner, LinkSpeed, Ctrl
+from .ecp5_serdes import LatticeECP5PCIeSERDES, LatticeECP5DCU
+from .serdes import PCIeSERDESAligner, PCIeSERDESDeskew, LinkSpeed, Ctrl
 from .phy import PCIePhy
 from .ltssm import State
 
 class LatticeECP5PCIePhy(Elaboratable):
 	"""
-	A PCIe Phy for the ECP5 for PCIe x1
+	A PCIe Phy for the ECP5 for PCIe x1, x2 or x4
+
+	Parameters
+	----------
+	support_5GTps : bool
+		Whether 5 GT/s is supported
+	lanes : int
+		Number of lanes, lane i uses channel i % 2 of DCU i // 2. The rx and tx clocks are taken from lane 0.
+	gearing : int
+		Symbols per clock cycle and lane, 4 or 8
+	cdc : str
+		Clock domain crossing of the transmitted data, see PCIeSERDESAligner. Use "elastic" with a reference clock which
+		isn't shared with the link partner.
 	"""
-	def __init__(self, support_5GTps = True):
+	def __init__(self, support_5GTps = True, lanes = 1, gearing = 4, cdc = "fifo"):
+		assert lanes in [1, 2, 4]
+		self.lanes = lanes
+
+		self.dcus = [LatticeECP5DCU(i) for i in range((lanes + 1) // 2)] if lanes > 1 else []
+
 		#self.__serdes = LatticeECP5PCIeSERDESx2() # Declare SERDES module with 1:2 gearing
-		self.serdes = LatticeECP5PCIeSERDESx4(speed_5GTps=support_5GTps, clkfreq=100e6, fabric_clk=True) # Declare SERDES module with 1:4 gearing
-		self.aligner = DomainRenamer("rx")(PCIeSERDESAligner(self.serdes.lane)) # Aligner for aligning COM symbols
-		self.phy = PCIePhy(self.aligner, support_5GTps=support_5GTps)
+		# Declare SERDES modules with 1:4 or 1:8 gearing, all lanes but the first are crossed into the clock domains of the first lane
+		self.all_serdes = [LatticeECP5PCIeSERDESx4(speed_5GTps=support_5GTps, DCU=i // 2, CH=i % 2, clkfreq=100e6, fabric_clk=True,
+			dcu=self.dcus[i // 2] if lanes > 1 else None, cdc=i > 0, gearing=gearing) for i in range(lanes)]
+		self.serdes = self.all_serdes[0]
+		self.aligners = [] # Aligner for aligning COM symbols, the other lanes follow the elastic buffer of lane 0
+		for serdes in self.all_serdes:
+			leader = self.aligners[0] if self.aligners else None
+			self.aligners.append(DomainRenamer("rx")(PCIeSERDESAligner(serdes.lane, cdc=cdc, leader=leader)))
+		self.aligner = self.aligners[0]
+		if lanes > 1:
+			self.deskew = DomainRenamer("rx")(PCIeSERDESDeskew(self.aligners))
+			self.phy = PCIePhy(self.deskew, support_5GTps=support_5GTps, scrambler_pipeline=gearing >= 8)
+		else:
+			self.phy = PCIePhy(self.aligner, support_5GTps=support_5GTps, scrambler_pipeline=gearing >= 8)
 		#self.serdes.lane.speed = 1
 		self.submodules = [
 			self.serdes.lane,
@@ -54,10 +82,17 @@ class LatticeECP5PCIePhy(Elaboratable):
 	def elaborate(self, platform: Platform) -> Module:
 		m = Module()
 
-		m.submodules.serdes = serdes = self.serdes
-		m.submodules.aligner = self.aligner
+		for i in range(self.lanes):
+			m.submodules[f"serdes_{i}" if i else "serdes"] = self.all_serdes[i]
+			m.submodules[f"aligner_{i}" if i else "aligner"] = self.aligners[i]
+		for i, dcu in enumerate(self.dcus):
+			m.submodules[f"dcu_{i}"] = dcu
+		if self.lanes > 1:
+			m.submodules.deskew = self.deskew
 		m.submodules.phy = self.phy
 
+		serdes = self.serdes
+
 		with m.If(self.phy.ltssm.debug_state > 2):
 			with m.If(~serdes.lane.rx_locked):
 				m.d.rx += self.err_cnt_1.eq(self.err_cnt_1 + 1)
@@ -65,7 +100,9 @@ class LatticeECP5PCIePhy(Elaboratable):
 			with m.If((serdes.lane.rx_symbol[0:9] == Ctrl.Error) | (serdes.lane.rx_symbol[9:18] == Ctrl.Error) | (serdes.lane.rx_symbol[18:27] == Ctrl.Error) | (serdes.lane.rx_symbol[27:36] == Ctrl.Error)):
 				m.d.rx += self.err_cnt_2.eq(self.err_cnt_2 + 1)
 
-		m.d.comb += self.serdes.lane.speed.eq(LinkSpeed.S2_5)
+		# The speed is changed by the LTSSM in Recovery.Speed
+		for lane_serdes in self.all_serdes:
+			m.d.comb += lane_serdes.lane.speed.eq(Mux(self.phy.ltssm.status.link.speed, LinkSpeed.S5_0, LinkSpeed.S2_5))
 		
 		m.domains.rx = ClockDomain()
 		m.domains.tx = ClockDomain()
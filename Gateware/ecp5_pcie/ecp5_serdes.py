@@ -7,7 +7,7 @@ from .serdes import PCIeSERDESInterface, K, Ctrl
 from .sci import *
 
 
-__all__ = ["LatticeECP5PCIeSERDES", "ECP5SerDesConfigInterface"]
+__all__ = ["LatticeECP5PCIeSERDES", "LatticeECP5DCU", "ECP5SerDesConfigInterface"]
 
 
 
@@ -31,6 +31,8 @@ class LatticeECP5PCIeSERDES(Elaboratable): # Based on Yumewatari
 		Which channel within the DCU to use
 	clkfreq : int
 		DCU reference clock frequency in Hz
+	dcu : LatticeECP5DCU or None
+		Shared DCU for using both channels of a DCU, if None the DCU is only used by this channel
 	
 	Attributes
 	----------
@@ -47,8 +49,9 @@ class LatticeECP5PCIeSERDES(Elaboratable): # Based on Yumewatari
 	divide_clk : Signal
 		Divide clock by 2 when true, used for 5 GT/s mode. When enabled with 200 MHz REFCLK the transfer rate is 2.5 GT/s.
 	"""
-	def __init__(self, gearing, speed_5GTps = False, DCU=0, CH=0, clkfreq = 200e6, fabric_clk = False):
+	def __init__(self, gearing, speed_5GTps = False, DCU=0, CH=0, clkfreq = 200e6, fabric_clk = False, dcu = None):
 		assert gearing == 1 or gearing == 2
+		assert dcu is None or dcu.DCU == DCU
 
 		self.ref_clk = Signal() # reference clock
 
@@ -95,6 +98,8 @@ class LatticeECP5PCIeSERDES(Elaboratable): # Based on Yumewatari
 
 		self.fabric_clk = fabric_clk
 
+		self.dcu = dcu
+
 		class DebugSignals:
 			dco_status = Signal(8)
 
@@ -214,6 +219,13 @@ class LatticeECP5PCIeSERDES(Elaboratable): # Based on Yumewatari
 		pcs_reset       = Signal()
 		cnt = Signal(8)
 
+		# The rate is changed with the RATE_MODE inputs, after a change the PLL and CDR need to lock again
+		speed_changed = Signal()
+		if self.speed_5GTps:
+			last_speed = Signal.like(self.lane.speed)
+			m.d.rx += last_speed.eq(self.lane.speed)
+			m.d.comb += speed_changed.eq(last_speed != self.lane.speed)
+
 		with m.FSM(domain="rx"): # Inspirations taken from LUNA
 			with m.State("init"):
 				m.d.comb += [
@@ -263,6 +275,10 @@ class LatticeECP5PCIeSERDES(Elaboratable): # Based on Yumewatari
 				with m.If(self.lane.reset):
 					m.next = "init"
 
+				with m.Elif(speed_changed):
+					m.d.rx += cnt.eq(0)
+					m.next = "start-tx"
+
 
 		# Clock domain crossing for status signals and tx data
 		m.submodules += [
@@ -674,6 +690,11 @@ class LatticeECP5PCIeSERDES(Elaboratable): # Based on Yumewatari
 		for key in ch_config:
 			modified_ch_config[key.replace("CHx", "CH0" if self.CH == 0 else "CH1")] = ch_config[key]
 
+		# The DCUA primitive is created by the shared DCU
+		if self.dcu is not None:
+			self.dcu.add_channel(self.CH, dcu_config, modified_ch_config)
+			return m
+
 		m.submodules.dcu0 = Instance("DCUA", **dcu_config, **modified_ch_config)
 
 		m.submodules.dcu0.attrs["LOC"] = "DCU0" if self.DCU == 0 else "DCU1"
@@ -682,4 +703,50 @@ class LatticeECP5PCIeSERDES(Elaboratable): # Based on Yumewatari
 		m.submodules.dcu0.attrs["CHAN"] = "CH0" if self.CH == 0 else "CH1"
 		m.submodules.dcu0.attrs["BEL"] = "X42/Y71/DCU"
 
-		return m
\ No newline at end of file
+		return m
+
+
+class LatticeECP5DCU(Elaboratable):
+	"""
+	Lattice ECP5 DCU shared by two LatticeECP5PCIeSERDES channels, since both channels of a DCU are configured by a
+	single DCUA primitive. DCU wide settings, the reference clock and the SCI are taken from the first channel added.
+
+	Needs to be added as a submodule after the SERDES modules using it, such that they are elaborated first.
+
+	Parameters
+	----------
+	DCU : int
+		Which DCU to use
+	"""
+	def __init__(self, DCU=0):
+		assert DCU == 0 or DCU == 1
+		self.DCU = DCU
+
+		self.__dcu_config = None
+		self.__ch_config = {}
+
+	def add_channel(self, CH, dcu_config, ch_config):
+		"""
+		Adds the configuration of a channel, called when the channel is elaborated
+		"""
+		assert CH not in self.__ch_config
+
+		if self.__dcu_config is None:
+			self.__dcu_config = dcu_config
+
+		self.__ch_config[CH] = ch_config
+
+	def elaborate(self, platform: Platform) -> Module:
+		m = Module()
+
+		assert self.__dcu_config is not None, "SERDES channels need to be elaborated before their DCU"
+
+		config = dict(self.__dcu_config)
+		for CH in self.__ch_config:
+			config.update(self.__ch_config[CH])
+
+		m.submodules.dcu = Instance("DCUA", **config)
+
+		m.submodules.dcu.attrs["LOC"] = "DCU0" if self.DCU == 0 else "DCU1"
+
+		return m
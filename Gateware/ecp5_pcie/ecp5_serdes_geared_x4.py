@@ -10,9 +10,9 @@ __all__ = ["LatticeECP5PCIeSERDESx4"]
 class LatticeECP5PCIeSERDESx4(Elaboratable): # Based on Yumewatari
 	"""
 	Lattice ECP5 DCU configured in PCIe mode, 2.5 or 5 GT/s. Assumes 100 MHz reference clock on SERDES clock input pair. Only provides a single lane.
-	Uses 1:4 gearing.
+	Uses 1:4 or 1:8 gearing, the DCU uses 1:2 gearing and the rest is done in the fabric.
 
-	Clock frequencies are 125 MHz for 5 GT/s and 62.5 MHz for 2.5 GT/s.
+	Clock frequencies are 125 MHz for 5 GT/s and 62.5 MHz for 2.5 GT/s at 1:4 gearing and half of that at 1:8 gearing.
 
 	Parameters
 	----------
@@ -22,6 +22,12 @@ class LatticeECP5PCIeSERDESx4(Elaboratable): # Based on Yumewatari
 		Which DCU to use
 	CH : int
 		Which channel within the DCU to use
+	dcu : LatticeECP5DCU or None
+		Shared DCU, see LatticeECP5PCIeSERDES
+	cdc : bool
+		Cross the symbols into the rx and tx domains with asynchronous FIFOs, for lanes which do not provide the rx and tx clocks
+	gearing : int
+		Symbols per clock cycle, 4 or 8
 
 	Attributes
 	----------
@@ -36,15 +42,17 @@ class LatticeECP5PCIeSERDESx4(Elaboratable): # Based on Yumewatari
 	tx_clk_i : Signal
 		Clock for the transmit FIFO.
 	"""
-	def __init__(self, speed_5GTps=True, DCU=0, CH=0, clkfreq = 200e6, fabric_clk = False):
+	def __init__(self, speed_5GTps=True, DCU=0, CH=0, clkfreq = 200e6, fabric_clk = False, dcu = None, cdc = False, gearing = 4):
+		assert gearing in [4, 8]
+
 		self.rx_clk = Signal(name="pcie_clk")  # recovered word clock
 
 		self.tx_clk = Signal(name="tx_slow_clk")  # generated word clock
 
 		# The PCIe lane with all signals necessary to control it
-		self.lane = PCIeSERDESInterface(4)
+		self.lane = PCIeSERDESInterface(gearing)
 
-		self.gearing = 4
+		self.gearing = gearing
 
 		assert DCU == 0 or DCU == 1
 		assert CH == 0 or CH == 1
@@ -57,11 +65,13 @@ class LatticeECP5PCIeSERDESx4(Elaboratable): # Based on Yumewatari
 
 		self.speed_5GTps = speed_5GTps
 
+		self.cdc = cdc
+
 		#self.__serdes = LatticeECP5PCIeSERDES(2, speed_5GTps = self.speed_5GTps, DCU=self.DCU, CH=self.CH)
-		self.__serdes = DomainRenamer({"tx": "txf"})(LatticeECP5PCIeSERDES(2, speed_5GTps = self.speed_5GTps, DCU=self.DCU, CH=self.CH, clkfreq=clkfreq, fabric_clk=fabric_clk))
+		self.__serdes = DomainRenamer({"tx": "txf"})(LatticeECP5PCIeSERDES(2, speed_5GTps = self.speed_5GTps, DCU=self.DCU, CH=self.CH, clkfreq=clkfreq, fabric_clk=fabric_clk, dcu=dcu))
 		self.serdes = self.__serdes # For testing
 
-		self.lane.frequency     = int(self.__serdes.lane.frequency / 2)
+		self.lane.frequency     = int(self.__serdes.lane.frequency * 2 / gearing)
 		self.lane.speed         = self.__serdes.lane.speed
 		self.lane.use_speed     = self.__serdes.lane.use_speed
 
@@ -97,56 +107,69 @@ class LatticeECP5PCIeSERDESx4(Elaboratable): # Based on Yumewatari
 
 		data_width = len(serdes.lane.rx_symbol)
 
-		m.domains.rxf = ClockDomain()
-		m.domains.txf = ClockDomain()
+		# Number of SERDES words per fabric word
+		words = self.gearing // serdes.gearing
+
+		# Local, so multiple lanes can be instantiated
+		m.domains.rxf = ClockDomain(local=True)
+		m.domains.txf = ClockDomain(local=True)
 		m.d.comb += [
 			#ClockSignal("sync").eq(serdes.refclk),
 			ClockSignal("rxf").eq(serdes.rx_clk),
 			ClockSignal("txf").eq(serdes.tx_clk),
 		]
 
-		platform.add_clock_constraint(self.rx_clk, 125e6 if self.speed_5GTps else 625e5) # For NextPNR, set the maximum clock frequency such that errors are given
-		platform.add_clock_constraint(self.tx_clk, 125e6 if self.speed_5GTps else 625e5)
+		platform.add_clock_constraint(self.rx_clk, (250e6 if self.speed_5GTps else 125e6) / words) # For NextPNR, set the maximum clock frequency such that errors are given
+		platform.add_clock_constraint(self.tx_clk, (250e6 if self.speed_5GTps else 125e6) / words)
 
-		m.submodules.lane = lane = PCIeSERDESInterface(4) # TODO: Uhh is this supposed to be here? // I think it might be the fast lane
+		m.submodules.lane = lane = PCIeSERDESInterface(self.gearing) # TODO: Uhh is this supposed to be here? // I think it might be the fast lane
 
 		# IF SOMETHING IS BROKE: Check if the TX actually transmits good data and not order-swapped data
 		# TODO: Maybe use hardware divider? Though this seems to be fine
-		m.d.rxf += self.rx_clk.eq(~self.rx_clk)
-
-		with m.If(~self.rx_clk):
-			m.d.rxf += lane.rx_symbol   [data_width     :data_width     * 2 ].eq(serdes.lane.rx_symbol)
-			m.d.rxf += lane.rx_valid    [serdes.gearing :serdes.gearing * 2 ].eq(serdes.lane.rx_valid)
-		with m.Else():
-			m.d.rxf += lane.rx_symbol   [0:data_width       ].eq(serdes.lane.rx_symbol)
-			m.d.rxf += lane.rx_valid    [0:serdes.gearing   ].eq(serdes.lane.rx_valid)
+		# The clocks are the highest bit of the phase counters, which count the SERDES words in a fabric word
+		rx_phase = Signal(range(words))
+		m.d.rxf += rx_phase.eq(rx_phase + 1)
+		m.d.comb += self.rx_clk.eq(rx_phase[-1])
+
+		# SERDES word k is stored in the phase before k, the word is complete when it is written into the FIFO
+		with m.Switch(rx_phase):
+			for k in range(words):
+				with m.Case((k - 1) % words):
+					m.d.rxf += lane.rx_symbol   [data_width     * k :data_width     * (k + 1)].eq(serdes.lane.rx_symbol)
+					m.d.rxf += lane.rx_valid    [serdes.gearing * k :serdes.gearing * (k + 1)].eq(serdes.lane.rx_valid)
 
 			# To ensure that it outputs consistent data
 			# m.d.rxf += self.lane.rx_symbol.eq(lane.rx_symbol)
 			# m.d.rxf += self.lane.rx_valid.eq(lane.rx_valid)
 
-		m.d.txf += self.tx_clk.eq(~self.tx_clk)
+		tx_phase = Signal(range(words))
+		m.d.txf += tx_phase.eq(tx_phase + 1)
+		m.d.comb += self.tx_clk.eq(tx_phase[-1])
 
-		m.d.txf += serdes.lane.tx_symbol    .eq(Mux(self.tx_clk, lane.tx_symbol     [data_width    :data_width * 2      ],  lane.tx_symbol  [0:data_width]))
-		m.d.txf += serdes.lane.tx_disp      .eq(Mux(self.tx_clk, lane.tx_disp       [serdes.gearing:serdes.gearing * 2  ],  lane.tx_disp    [0:serdes.gearing]))
-		m.d.txf += serdes.lane.tx_set_disp  .eq(Mux(self.tx_clk, lane.tx_set_disp   [serdes.gearing:serdes.gearing * 2  ],  lane.tx_set_disp[0:serdes.gearing]))
-		m.d.txf += serdes.lane.tx_e_idle    .eq(Mux(self.tx_clk, lane.tx_e_idle     [serdes.gearing:serdes.gearing * 2  ],  lane.tx_e_idle  [0:serdes.gearing]))
+		m.d.txf += serdes.lane.tx_symbol    .eq(lane.tx_symbol  .word_select(tx_phase, data_width))
+		m.d.txf += serdes.lane.tx_disp      .eq(lane.tx_disp    .word_select(tx_phase, serdes.gearing))
+		m.d.txf += serdes.lane.tx_set_disp  .eq(lane.tx_set_disp.word_select(tx_phase, serdes.gearing))
+		m.d.txf += serdes.lane.tx_e_idle    .eq(lane.tx_e_idle  .word_select(tx_phase, serdes.gearing))
 
 
 		# CDC
 		# TODO: Keep the SyncFIFO? Its faster but is it reliable?
-		#rx_fifo = m.submodules.rx_fifo = AsyncFIFOBuffered(width=(data_width + serdes.gearing) * 2, depth=4, r_domain="rx", w_domain="rxf")
-		rx_fifo = m.submodules.rx_fifo = DomainRenamer("rxf")(SyncFIFOBuffered(width=(data_width + serdes.gearing) * 2, depth=4))
+		if self.cdc:
+			rx_fifo = m.submodules.rx_fifo = AsyncFIFOBuffered(width=(data_width + serdes.gearing) * words, depth=4, r_domain="rx", w_domain="rxf")
+		else:
+			rx_fifo = m.submodules.rx_fifo = DomainRenamer("rxf")(SyncFIFOBuffered(width=(data_width + serdes.gearing) * words, depth=4))
 		m.d.rxf += rx_fifo.w_data.eq(Cat(lane.rx_symbol, lane.rx_valid))
 		m.d.comb += Cat(self.lane.rx_symbol, self.lane.rx_valid).eq(rx_fifo.r_data)
 		m.d.comb += rx_fifo.r_en.eq(1)
-		m.d.rxf += rx_fifo.w_en.eq(self.rx_clk)
+		m.d.rxf += rx_fifo.w_en.eq(rx_phase == words - 1)
 
-		#tx_fifo = m.submodules.tx_fifo = AsyncFIFOBuffered(width=(data_width + serdes.gearing * 3) * 2, depth=4, r_domain="txf", w_domain="tx")
-		tx_fifo = m.submodules.tx_fifo = DomainRenamer("txf")(SyncFIFOBuffered(width=(data_width + serdes.gearing * 3) * 2, depth=4))
+		if self.cdc:
+			tx_fifo = m.submodules.tx_fifo = AsyncFIFOBuffered(width=(data_width + serdes.gearing * 3) * words, depth=4, r_domain="txf", w_domain="tx")
+		else:
+			tx_fifo = m.submodules.tx_fifo = DomainRenamer("txf")(SyncFIFOBuffered(width=(data_width + serdes.gearing * 3) * words, depth=4))
 		m.d.comb += tx_fifo.w_data.eq(Cat(self.lane.tx_symbol, self.lane.tx_set_disp, self.lane.tx_disp, self.lane.tx_e_idle))
 		m.d.txf  += Cat(lane.tx_symbol, lane.tx_set_disp, lane.tx_disp, lane.tx_e_idle).eq(tx_fifo.r_data)
-		m.d.txf  += tx_fifo.r_en.eq(self.tx_clk)
+		m.d.txf  += tx_fifo.r_en.eq(tx_phase == (words - 3) % words) # Such that the next word arrives in phase 0
 		m.d.comb += tx_fifo.w_en.eq(1)
 		#m.d.txf  += Cat(lane.tx_symbol, lane.tx_set_disp, lane.tx_disp, lane.tx_e_idle).eq(Cat(self.lane.tx_symbol, self.lane.tx_set_disp, self.lane.tx_disp, self.lane.tx_e_idle))
 
@@ -0,0 +1,123 @@
+from amaranth import *
+from amaranth.build import *
+from enum import IntEnum
+
+from .layouts import dll_layout
+
+class FCClass(IntEnum):
+	Posted     = 0
+	NonPosted  = 1
+	Completion = 2
+
+def tlp_fc_class(fmt_type: Value) -> Value:
+	"""
+	Flow control class of a TLP, see Table 2-2 on page 49 and section 2.6.1 in PCIe 1.1
+
+	Parameters
+	----------
+	fmt_type : Value
+		First byte of the TLP header, Cat(type, fmt)
+	"""
+	type = fmt_type[0:5]
+	has_data = fmt_type[6]
+	posted = (type[3:5] == 0b10) | ((type == 0b00000) & has_data) # Messages and memory writes
+	completion = (type == 0b01010) | (type == 0b01011)
+	return Mux(posted, FCClass.Posted, Mux(completion, FCClass.Completion, FCClass.NonPosted))
+
+def tlp_data_credits(fmt_type: Value, length: Value) -> Value:
+	"""
+	Number of data credits a TLP needs, one credit is 4 DW. A length of 0 means 1024 DW.
+
+	Parameters
+	----------
+	fmt_type : Value
+		First byte of the TLP header, Cat(type, fmt)
+	length : Value
+		Length field of the TLP header in DW
+	"""
+	return Mux(fmt_type[6], Mux(length == 0, 256, (length + 3) >> 2), 0)
+
+class PCIeFlowControl(Elaboratable):
+	"""
+	Transmitter flow control credit tracking, see section 2.6.1.2 on page 106 in PCIe 1.1
+
+	For every credit type CREDITS_CONSUMED is counted and compared with the CREDIT_LIMIT received from the other side.
+	Credit types which are advertised as 0 in InitFC are infinite. The limits need to be valid in the first cycle this module is
+	not in reset, so it should be reset while the Data Link Layer isn't up.
+
+	Parameters
+	----------
+	credits_rx : Record(dll_layout)
+		CREDIT_LIMIT of all credit types, from InitFC and UpdateFC DLLPs
+	header : [Signal(8)] * 4
+		First DW of the header of the next TLP
+	available : Signal()
+		Whether there are enough credits to transmit the TLP in header, comb domain
+	consume : Signal()
+		Set to 1 for 1 cycle to consume the credits of the TLP in header
+	credits_consumed : Record(dll_layout)
+		CREDITS_CONSUMED of all credit types
+	"""
+	def __init__(self, credits_rx: Record):
+		self.credits_rx = credits_rx
+		self.header = [Signal(8, name=f"header_{i}") for i in range(4)]
+		self.available = Signal()
+		self.consume = Signal()
+		self.credits_consumed = Record(dll_layout)
+		self.infinite = Record([(name, 1) for name, _ in dll_layout])
+		"""Whether the credit type is infinite"""
+		self.initialized = Signal()
+		"""Whether the limits have been taken over from InitFC, no credits are available before"""
+
+	def credits_available(self, header: list) -> Value:
+		"""
+		Whether there are enough credits to transmit a TLP, for checking TLPs other than the one in header
+
+		Parameters
+		----------
+		header : [Value(8)] * 4
+			First DW of the header of the TLP
+		"""
+		fmt_type = header[0]
+		fc_class = tlp_fc_class(fmt_type)
+		header_credits = 1
+		data_credits = tlp_data_credits(fmt_type, Cat(header[3], header[2][0:2]))
+
+		def sufficient(name, credits):
+			"""CREDIT_LIMIT - (CREDITS_CONSUMED + credits) mod 2^n <= 2^(n - 1) with n being the field size"""
+			limit = self.credits_rx[name]
+			consumed = self.credits_consumed[name]
+			return self.infinite[name] | ((limit - consumed - credits)[:len(limit)] <= 2 ** (len(limit) - 1))
+
+		available = [
+			sufficient("PH", header_credits) & sufficient("PD", data_credits),
+			sufficient("NPH", header_credits) & sufficient("NPD", data_credits),
+			sufficient("CPLH", header_credits) & sufficient("CPLD", data_credits),
+		]
+		return self.initialized & Array(available)[fc_class]
+
+	def elaborate(self, platform: Platform) -> Module:
+		m = Module()
+
+		fmt_type = self.header[0]
+		fc_class = Signal(2)
+		m.d.comb += fc_class.eq(tlp_fc_class(fmt_type))
+		header_credits = 1
+		data_credits = Signal(9)
+		m.d.comb += data_credits.eq(tlp_data_credits(fmt_type, Cat(self.header[3], self.header[2][0:2])))
+
+		# Infinite credits are advertised once with InitFC
+		with m.If(~self.initialized):
+			m.d.rx += self.initialized.eq(1)
+			for name, _ in dll_layout:
+				m.d.rx += self.infinite[name].eq(self.credits_rx[name] == 0)
+
+		m.d.comb += self.available.eq(self.credits_available(self.header))
+
+		with m.If(self.consume):
+			for fc_class_value, (header_name, data_name) in zip(FCClass, [("PH", "PD"), ("NPH", "NPD"), ("CPLH", "CPLD")]):
+				with m.If(fc_class == fc_class_value):
+					m.d.rx += self.credits_consumed[header_name].eq(self.credits_consumed[header_name] + header_credits)
+					m.d.rx += self.credits_consumed[data_name].eq(self.credits_consumed[data_name] + data_credits)
+
+		return m
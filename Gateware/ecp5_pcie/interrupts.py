@@ -0,0 +1,232 @@
+from amaranth import *
+from amaranth.build import *
+import math
+
+from .stream import StreamInterface
+from .tlp import TLPType, DWPacker
+from .dma import big_endian
+
+class InterruptController(Elaboratable):
+	"""
+	MSI and MSI-X interrupts, sent as memory writes.
+
+	An event sets the pending bit of its vector, a vector which is pending, not masked and whose coalescing timer has
+	expired is sent and its pending bit is cleared. The timer is started by the first event of a vector which isn't pending
+	and by an event in the cycle its message is sent, so a burst of events shorter than holdoff cycles produces one
+	interrupt. Vectors are sent lowest first, events are ignored while neither MSI nor MSI-X is enabled.
+
+	MSI-X is used if it is enabled, with a table entry per vector. With MSI vector v uses message number v modulo the number
+	of allocated vectors, see section 6.8.1.6 on page 262 in PCIe 1.1.
+
+	Parameters
+	----------
+	ratio : int
+		Gearbox ratio
+	vectors : int
+		Number of vectors, at most 32
+	holdoff : int
+		Reset value of the holdoff register
+	msix : bool
+		Whether there is an MSI-X capability and table
+
+	table_size : int
+		Size of the MSI-X table BAR in bytes, the table is at offset 0 and the Pending Bit Array follows it
+
+	interrupts : Signal(vectors)
+		Events, a bit is set for 1 cycle per event
+	holdoff : Signal(16)
+		Coalescing time in cycles
+	pending : Signal(vectors)
+		Pending bits
+
+	requester_id : Signal(16)
+		Bus, device and function number of this function, Cat(function, device, bus)
+	bus_master_enable : Signal()
+		Bus Master Enable bit of the Command register, no messages are sent if 0
+	msi_control : Signal(16)
+		MSI Message Control register
+	msi_address : Signal(64)
+		MSI Message Address and Message Upper Address registers
+	msi_data : Signal(16)
+		MSI Message Data register
+	msi_mask : Signal(32)
+		MSI Mask Bits register
+	msi_pending : Signal(32)
+		MSI Pending Bits register, by message number
+	msix_control : Signal(16)
+		MSI-X Message Control register
+
+	table_write_address : Signal(range(table_size // 4))
+		DW address in the table BAR to write to
+	table_write_data : Signal(32)
+		Data to write, little endian
+	table_write_enable : Signal(4)
+		Byte enables, nothing is written if 0
+	table_read_address : Signal(range(table_size // 4))
+		DW address in the table BAR to read from
+	table_read_enable : Signal()
+		Read table_read_address
+	table_read_data : Signal(32)
+		Data read, valid in the cycle after table_read_enable
+
+	tlp_source : StreamInterface
+		Memory writes
+	"""
+	# Writable bits of the DWs of an MSI-X table entry: Message Address, Message Upper Address, Message Data and Vector Control
+	TABLE_WRITE_MASKS = [0xFFFFFFFC, 0xFFFFFFFF, 0xFFFFFFFF, 0x00000001]
+
+	def __init__(self, ratio: int, vectors: int = 1, holdoff: int = 0, msix: bool = True):
+		assert 1 <= vectors <= 32
+		self.ratio = ratio
+		self.vectors = vectors
+		self.msix = msix
+
+		# MSI vectors are allocated in powers of 2
+		self.msi_vectors = 1 << math.ceil(math.log2(vectors))
+
+		# 16 bytes per table entry and 8 bytes of Pending Bit Array, BARs are a power of 2 and at least 128 bytes
+		self.table_size = max(128, 1 << (vectors * 16 + 8 - 1).bit_length()) if msix else 0
+
+		self.interrupts = Signal(vectors)
+		self.holdoff = Signal(16, reset = holdoff)
+		self.pending = Signal(vectors)
+
+		self.requester_id = Signal(16)
+		self.bus_master_enable = Signal()
+		self.msi_control = Signal(16)
+		self.msi_address = Signal(64)
+		self.msi_data = Signal(16)
+		self.msi_mask = Signal(32)
+		self.msi_pending = Signal(32)
+		self.msix_control = Signal(16)
+
+		self.table_write_address = Signal(range(max(self.table_size // 4, 2)))
+		self.table_write_data = Signal(32)
+		self.table_write_enable = Signal(4)
+		self.table_read_address = Signal(range(max(self.table_size // 4, 2)))
+		self.table_read_enable = Signal()
+		self.table_read_data = Signal(32)
+
+		self.tlp_source = StreamInterface(8, ratio, name="Interrupt_Source")
+
+	def elaborate(self, platform: Platform) -> Module:
+		m = Module()
+
+		vectors = self.vectors
+
+		msi_enable = self.msi_control[0]
+		msix_enable = self.msix_control[15] if self.msix else Const(0)
+		function_mask = self.msix_control[14]
+
+		# MSI message number of every vector, the Multiple Message Enable field is the log2 of the allocated vectors
+		number_mask = Signal(5)
+		m.d.comb += number_mask.eq(Array(Const(min((1 << i) - 1, 31), 5) for i in range(8))[self.msi_control[4:7]])
+		numbers = [Const(v, 5) & number_mask for v in range(vectors)]
+
+		for n in range(self.msi_vectors):
+			m.d.comb += self.msi_pending[n].eq(Cat(self.pending[v] & (numbers[v] == n) for v in range(vectors)).any())
+
+		# MSI-X table, every entry has an address, data and a mask bit which is set after reset
+		table = [[Signal(32, name = f"MSIX_{v}_{i}", reset = 1 if i == 3 else 0) for i in range(4)] for v in range(vectors)] if self.msix else []
+
+		for v, entry in enumerate(table):
+			for i, (register, mask) in enumerate(zip(entry, self.TABLE_WRITE_MASKS)):
+				with m.If(self.table_write_address == 4 * v + i):
+					for j in range(4):
+						with m.If(self.table_write_enable[j]):
+							m.d.rx += register.word_select(j, 8).eq(((register & (~mask & 0xFFFFFFFF)) | (self.table_write_data & mask)).word_select(j, 8))
+
+		with m.If(self.table_read_enable):
+			with m.Switch(self.table_read_address):
+				for v, entry in enumerate(table):
+					for i, register in enumerate(entry):
+						with m.Case(4 * v + i):
+							m.d.rx += self.table_read_data.eq(register)
+				if self.msix:
+					with m.Case(4 * vectors):
+						m.d.rx += self.table_read_data.eq(self.pending)
+				with m.Default():
+					m.d.rx += self.table_read_data.eq(0)
+
+		# Message of the vector being sent
+		vector = Signal(range(max(vectors, 2)))
+		address = Signal(64)
+		data = Signal(32)
+		send = Signal() # The pending bit of vector is cleared
+
+		# Pending bits and coalescing timers
+		ready = Signal(vectors)
+		for v in range(vectors):
+			timer = Signal(16, name = f"Vector_{v}_timer")
+			with m.If(timer != 0):
+				m.d.rx += timer.eq(timer - 1)
+
+			with m.If(self.interrupts[v] & (msi_enable | msix_enable)):
+				m.d.rx += self.pending[v].eq(1)
+				with m.If(~self.pending[v] | (send & (vector == v))):
+					m.d.rx += timer.eq(self.holdoff)
+			with m.Elif(send & (vector == v)):
+				m.d.rx += self.pending[v].eq(0)
+
+			if self.msix:
+				masked = Mux(msix_enable, function_mask | table[v][3][0], self.msi_mask.bit_select(numbers[v], 1))
+			else:
+				masked = self.msi_mask.bit_select(numbers[v], 1)
+			m.d.comb += ready[v].eq(self.pending[v] & ~masked & (timer == 0))
+
+		# The lowest vector which is ready is sent
+		selected = Signal.like(vector)
+		for v in reversed(range(vectors)):
+			with m.If(ready[v]):
+				m.d.comb += selected.eq(v)
+
+		# Memory writes of 1 DW
+		m.submodules.packer = packer = DWPacker(self.ratio)
+		packer.tlp_source.connect(self.tlp_source, m.d.comb)
+
+		requester_id = self.requester_id
+		is_64 = address[32:64] != 0
+		fmt_type = Mux(is_64, Const(TLPType.MWr64, 7), Const(TLPType.MWr32, 7))
+		header = [
+			Cat(fmt_type, Const(0, 1), Const(0, 8), Const(0, 2), Const(0, 6), Const(1, 8)),
+			Cat(requester_id[8:16], requester_id[0:8], Const(0, 8), Const(0b1111, 4), Const(0b0000, 4)),
+			Mux(is_64, big_endian(address[32:64]), big_endian(address[0:32])),
+			Mux(is_64, big_endian(address[0:32]), data),
+			data,
+		]
+
+		with m.FSM(name = "Interrupt_FSM", domain = "rx"):
+			with m.State("Idle"):
+				with m.If(ready.any() & self.bus_master_enable):
+					m.d.comb += send.eq(1)
+					m.d.comb += vector.eq(selected)
+
+					# The message number replaces the lower bits of the MSI data
+					m.d.rx += address.eq(self.msi_address)
+					m.d.rx += data.eq((self.msi_data & ~Cat(number_mask, Const(0, 11))) | Array(numbers)[selected])
+
+					if self.msix:
+						with m.If(msix_enable):
+							m.d.rx += address.eq(Cat(Array(entry[0] for entry in table)[selected], Array(entry[1] for entry in table)[selected]))
+							m.d.rx += data.eq(Array(entry[2] for entry in table)[selected])
+
+					m.next = "DW0"
+
+			for i in range(5):
+				with m.State(f"DW{i}"):
+					with m.If(packer.room):
+						m.d.comb += packer.w_en.eq(1)
+						m.d.comb += packer.w_data.eq(header[i])
+						m.d.comb += packer.w_first.eq(i == 0)
+						m.d.comb += packer.w_last.eq((i == 4) | ((i == 3) & ~is_64))
+
+						if i < 3:
+							m.next = f"DW{i + 1}"
+
+						else:
+							with m.If((i == 4) | ~is_64):
+								m.next = "Idle"
+							with m.Else():
+								m.next = "DW4"
+
+		return m
@@ -34,7 +34,7 @@ ltssm_layout = [
     ("link", [
         ("speed", 1), # 0: 2.5, 1: 5
         ("up", 1), # Currently the only thing that is implemented
-        ("training", 1),
+        ("training", 1), # LTSSM is in neither L0 nor L1
         ("scrambling", 1), # And this too
         ("n_fts", 8),
         ("rate",  [ # Data rate identifier
@@ -48,12 +48,19 @@ ltssm_layout = [
         ("changed_speed_recovery", 1),
         ("upconfigure_capable", 1),
         ("successful_speed_negotiation", 1),
+        ("width", 6), # Number of configured lanes
+        ("lane_reversal", 1), # Lane numbers are reversed
 
     ]),
     ("recv_err", 2),
     ("presence", 1),
     ("idle_to_rlock_transitioned", 8),
     ("directed_speed_change", 1),
+    ("tx_l0s", 1), # Transmitter is in L0s, from sending EIOS until the FTSs have been sent
+    ("rx_l0s", 1), # Receiver is in L0s, from receiving EIOS until the SKP ordered set after the FTSs
+    ("l1", 1), # Link is in L1
+    ("l0s_exit_latency", 16), # Longest time the receiver took from the first FTS to L0, in clock cycles
+    ("l1_exit_latency", 16), # Longest time from leaving L1 until L0, in clock cycles
 ]
 
 dllp_layout = [
@@ -1,29 +1,72 @@
 from amaranth import *
 from amaranth.build import *
 
+from .crc import _xor_bits
 
-__all__ = ["PCIeLFSR"]
+
+__all__ = ["lfsr_matrix", "PCIeLFSR"]
+
+
+def lfsr_matrix(steps):
+	"""
+	Calculates the matrix over GF(2) which advances the scrambling LFSR by steps bytes, by running the LFSR symbolically.
+
+	Bit i of the advanced state is the XOR of all bits of the current state which are set in mask i of the result.
+	The state holds the LFSR bits in the order used by PCIeLFSR, one step is a byte swap with the high byte XORed in
+	at bits 3, 4 and 5.
+
+	Parameters
+	----------
+	steps : int
+		Number of bytes to advance by
+	"""
+	state = [1 << i for i in range(16)]
+	for _ in range(steps):
+		high = state[8:16]
+		next_state = state[8:16] + state[0:8]
+		for shift in [3, 4, 5]:
+			for i in range(8):
+				if i + shift < 16:
+					next_state[i + shift] ^= high[i]
+		state = next_state
+
+	return state
+
+def _apply_matrix(matrix, value):
+	"""
+	Applies a matrix from lfsr_matrix to an int.
+	"""
+	return sum(bin(value & mask).count("1") % 2 << i for i, mask in enumerate(matrix))
 
 
 class PCIeLFSR(Elaboratable):
 	"""
-	PCIe Linear Feedback Shift Register for scrambling
+	PCIe Linear Feedback Shift Register for scrambling, produces scrambling data for a word of symbols per clock cycle
+
+	The state for every symbol is calculated directly instead of going through the symbols one by one. It is the state
+	at the start of the word or the reset value advanced by the number of advancing symbols before it, since the last
+	reset if there is one. The matrices for every number of advancing symbols are calculated at elaboration time, so
+	COM and SKP can be anywhere in the word.
 
 	Parameters
 	----------
 	bytes : int
 		Number of bytes of scrambling data to produce
-	reset : Signal
-		Reset LFSR, should be 'symbol == Ctrl.COM'
-	advance : Signal
-		Advance LFSR, should be 'symbol != Ctrl.SKP'
-	
+	reset : Signal(bytes)
+		Per symbol, reset LFSR after this symbol, should be 'symbol == Ctrl.COM'
+	advance : Signal(bytes)
+		Per symbol, advance LFSR after this symbol, should be 'symbol != Ctrl.SKP'
+	pipeline : bool
+		Registers the number of advancing symbols before every symbol, so output is one cycle after reset and advance
+
 	output : Signal(9 * bytes)
 		output data for scrambling. XOR symbols with this to scramble. 9th bit is 0
 	"""
-	def __init__(self, bytes, reset, advance):
+	def __init__(self, bytes, reset, advance, pipeline = False):
+		assert len(reset) == bytes and len(advance) == bytes
 		self.reset = reset
 		self.advance = advance
+		self.pipeline = pipeline
 		self.output = Signal(9 * bytes)
 		#self.count = Signal(32)
 		self.__bytes = bytes
@@ -31,49 +74,42 @@ class PCIeLFSR(Elaboratable):
 	def elaborate(self, platform: Platform) -> Module:
 		m = Module()
 
-		def calculate_lfsr(advances):
-			state = 0xFFFF
-			for _ in range(advances):
-				state = ((state >> 8) | ((state & 0xFF) << 8)) ^ ((state & 0xFF00) >> 5) ^ ((state & 0xFF00) >> 4) ^ ((state & 0xFF00) >> 3)
-				
-			return state
-
-		def apply_lfsr(in_state):
-			return Cat(in_state[8:16], in_state[0:8]) ^ Cat(Const(0, 3), in_state[8:16]) ^ Cat(Const(0, 4), in_state[8:16]) ^ Cat(Const(0, 5), in_state[8:16])
-
-		#states = [Signal(16, reset=calculate_lfsr(i)) for i in range(self.__bytes)]
-		states = [Signal(16, reset=0xFFFF) for i in range(self.__bytes)]# * self.__bytes
-
-
-		for i in range(0, self.__bytes - 1):
-			m.d.comb += states[i + 1].eq(apply_lfsr(states[i]))
-
-
-		with m.If(self.reset):
-			with m.If(self.advance):
-				m.d.rx += states[0].eq([0, 0xFFFF, 0xE817, 0x0328, 0x284B, 0x4DE8, 0xE755, 0x404F, 0x4140][self.__bytes]) # TODO: This is a hack. Please fix. It is the next state after 0xFFFF. It happens when there is 'COM x' where x is not SKP.
-			with m.Else():
-				m.d.rx += states[0].eq(0xFFFF) # When x is SKP, it can go straight to 0xFFFF.
-				# Because when its not SKP, it already needs to advance by 1 cycle. With COM SKP, the number of LFSR advances look like this, symbol 1 besides symbol 2:
-				# 0 1
-				# 2 3
-				# 4 5
-				# and so on. But for example with COM D0.0 it goes like
-				# 1 2
-				# 3 4
-				# 5 6
-				# afterwards, where it is shifted by ½ clock cycle. In the PCIeScrambler, before the beginning of the thing above, the second symbol gets scrambled with 0xFF.
-			#for i in range(1, self.__bytes - 1):
-			#    m.d.comb += states[i + 1].eq(apply_lfsr(states[i]))
-		with m.Elif(self.advance):
-			m.d.rx += states[0].eq(apply_lfsr(states[self.__bytes - 1]))
-			#for i in range(self.__bytes):
-			#    if i == self.__bytes - 1:
-			#        m.d.rx += states[0].eq(apply_lfsr(states[i]))
-			#    else:
-			#        m.d.comb += states[i + 1].eq(apply_lfsr(states[i]))
-		
-		for i in range(self.__bytes):
+		n = self.__bytes
+		matrices = [lfsr_matrix(k) for k in range(n + 1)]
+
+		# Number of advancing symbols before symbol i, counted from the last reset in the word if there is one
+		counts = [Signal(range(n + 1), name=f"count_{i}") for i in range(n + 1)]
+		restarts = [Signal(name=f"restart_{i}") for i in range(n + 1)]
+		domain = m.d.rx if self.pipeline else m.d.comb
+
+		for i in range(n + 1):
+			count = Signal(range(n + 1), name=f"count_now_{i}")
+			restart = Signal(name=f"restart_now_{i}")
+			m.d.comb += count.eq(sum(self.advance[j] for j in range(i)))
+			for r in range(i):
+				with m.If(self.reset[r]):
+					m.d.comb += restart.eq(1)
+					m.d.comb += count.eq(sum(self.advance[j] for j in range(r + 1, i)))
+
+			domain += counts[i].eq(count)
+			domain += restarts[i].eq(restart)
+
+		# State at the start of the word and advanced by every possible number of symbols. COM resets the LFSR to
+		# 0xFFFF, so the advanced reset values are constants.
+		state = Signal(16, reset=0xFFFF)
+		advanced = [Signal(16, name=f"advanced_{k}") for k in range(n + 1)]
+		for k in range(n + 1):
+			m.d.comb += advanced[k].eq(Cat(_xor_bits(state, mask) for mask in matrices[k]))
+
+		# State used for symbol i, the state after the last symbol is stored for the next word
+		states = [Signal(16, name=f"state_{i}") for i in range(n + 1)]
+		for i in range(n + 1):
+			reset_values = Array(Const(_apply_matrix(matrices[k], 0xFFFF), 16) for k in range(i + 1))
+			m.d.comb += states[i].eq(Mux(restarts[i], reset_values[counts[i]], Array(advanced[:i + 1])[counts[i]]))
+
+		m.d.rx += state.eq(states[n])
+
+		for i in range(n):
 			m.d.comb += self.output.word_select(i, 9).eq(states[i][15:7:-1])
 
-		return m
\ No newline at end of file
+		return m
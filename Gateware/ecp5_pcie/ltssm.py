@@ -32,10 +32,28 @@ class State(IntEnum):
 	Recovery_Idle = 16
 	L0 = 17
 	Disabled = 18
+	L1_Entry = 19
+	L1_Idle = 20
 
 class PCIeLTSSM(Elaboratable): # Based on Yumewatary phy.py
 	"""
-	PCIe Link Training and Status State Machine for 1:4 gearing and one lane
+	PCIe Link Training and Status State Machine for 1:4 gearing per lane
+
+	If 5 GT/s is supported by both sides, a speed change is directed once after reaching L0 at 2.5 GT/s.
+	The link speed is in status.link.speed and needs to be forwarded to the SERDES.
+
+	Multiple lanes are always configured with their full width, either with lane 0 being lane 0 or with reversed
+	lane numbers if the other side numbers the lanes in reverse.
+
+	status.link.up is set in L0 and only cleared in Detect and Disabled, it stays set while the link is retrained in
+	Recovery, so the Data Link Layer keeps its state. status.link.training is set while the link is being trained.
+
+	In L0 the transmitter and the receiver go to L0s on their own, see section 4.2.6.5 on page 219 in PCIe 1.1. The
+	transmitter sends an EIOS after l0s_entry_clocks without packets if L0s is enabled in aspm_control and leaves L0s by
+	sending the number of FTSs the other side requested in its TSs. The receiver goes to L0s when it receives an EIOS, which
+	is always supported, and back to L0 at the SKP ordered set after the FTSs. L1 is negotiated by the Data Link Layer, the
+	link leaves it through Recovery. The longest exit latencies are measured in status.l0s_exit_latency and
+	status.l1_exit_latency, they should be below the advertised ones from l0s_exit_latency() and l1_exit_latency().
 
 	Parameters
 	----------
@@ -49,9 +67,19 @@ class PCIeLTSSM(Elaboratable): # Based on Yumewatary phy.py
 		Whether it is an upstream port. True by default.
 		An upstream port is the port type on a PCIe card which connects to a root hub or a switch.
 		Within a device it is the port closest to the root complex, others are downstream ports (if it has only one connection towards the root complex)
+	retrain : Signal()
+		Set to 1 for 1 cycle to retrain the link from L0 through Recovery
+	n_fts : int
+		Number of FTSs requested from the other side for leaving L0s, which the receiver needs to lock
+	aspm_control : Signal(2)
+		ASPM Control field of the Link Control register, bit 0 enables L0s of the transmitter and bit 1 enables L1
+	enter_l1 : Signal()
+		Asserted by the Data Link Layer to go from L0 to L1 once L1 has been negotiated
+	exit_l1 : Signal()
+		Asserted by the Data Link Layer to leave L1, for example to send a TLP
 	"""
-	def __init__(self, lane : PCIeSERDESInterface, tx : PCIePhyTX, rx : PCIePhyRX, upstream = True, support_5GTps = True, disable_scrambling = False):
-		assert lane.ratio == 4
+	def __init__(self, lane : PCIeSERDESInterface, tx : PCIePhyTX, rx : PCIePhyRX, upstream = True, support_5GTps = True, disable_scrambling = False, n_fts = 0xFF):
+		assert lane.ratio % (4 * lane.lanes) == 0
 		self.lane = lane
 		self.status = Record(ltssm_layout)
 		self.tx = tx
@@ -63,14 +91,23 @@ class PCIeLTSSM(Elaboratable): # Based on Yumewatary phy.py
 		self.rx_ts_count = Signal(range(16 + 1))
 		self.tx_ts_count = Signal(range(1024 + 1))
 		self.extra_signals = Signal(8) # Extra signals, assigned in each state
-		self.clocks_per_ms = Mux(self.lane.speed == LinkSpeed.S2_5, 62500, 125000)
-		self.clocks_per_ms_max = 125000 # Equals the maximum frequency multiplied by 1 ms
-		self.ui_per_clock = 40 # 10 UI per symbol, 4 wide gearing
+		self.clocks_per_ms_max = int(lane.frequency // 1000) # Equals the maximum frequency multiplied by 1 ms
+		# At 2.5 GT/s the clock frequency is halved if the lane supports both speeds
+		self.clocks_per_ms = Mux(self.lane.speed == LinkSpeed.S2_5, self.clocks_per_ms_max // 2, self.clocks_per_ms_max) if lane.use_speed else self.clocks_per_ms_max
+		self.ui_per_clock = 10 * (lane.ratio // lane.lanes) # 10 UI per symbol, per lane gearing
 		self.simulate = False # Set to true to make it go faster, for example only count to 64 instead of 1024 TS in Polling.Active
 		self.timer = Signal(range(64 * self.clocks_per_ms_max + 1))
 
 		self.support_5GTps = support_5GTps
 		self.disable_scrambling = disable_scrambling
+		self.retrain = Signal()
+
+		assert 0 < n_fts <= 0xFF
+		self.n_fts = n_fts
+		self.aspm_control = Signal(2)
+		self.enter_l1 = Signal()
+		self.exit_l1 = Signal()
+		self.l0s_entry_clocks = int(lane.frequency * 7E-6) # Idle time before the transmitter goes to L0s at the maximum frequency, 7 µs
 
 		self.state = [
 			self.debug_state,
@@ -80,6 +117,20 @@ class PCIeLTSSM(Elaboratable): # Based on Yumewatary phy.py
 			self.status
 		]
 
+	def l0s_exit_latency(self):
+		"""
+		L0s exit latency of the receiver in ns at 2.5 GT/s, the time n_fts FTSs and the SKP ordered set after them take
+		"""
+		return (self.n_fts + 1) * 4 * 4
+
+	def l1_exit_latency(self):
+		"""
+		L1 exit latency in ns at 2.5 GT/s. Leaving L1 goes through Recovery, which takes 8 received TS1s, 8 received and
+		16 sent TS2s and a few idle words, the TSs are 16 symbols long. 48 TSs leave enough time for the other side to
+		notice the exit and for the idle words.
+		"""
+		return 48 * 16 * 4
+
 	def elaborate(self, platform: Platform) -> Module: # TODO: Think about clock domains! (assuming RX, TX pll lock, the discrepancy is 0 on average)
 		m = Module()
 
@@ -95,6 +146,9 @@ class PCIeLTSSM(Elaboratable): # Based on Yumewatary phy.py
 
 		link_num = 0
 
+		# Highest lane number of the link
+		last_lane = lane.lanes - 1
+
 		# Number of Training Sequences received, usage depends on FSM state
 		rx_ts_count = self.rx_ts_count
 		tx_ts_count = self.tx_ts_count
@@ -124,6 +178,9 @@ class PCIeLTSSM(Elaboratable): # Based on Yumewatary phy.py
 		# Is set when transitioning to Detect.Active and reset in Detect.Quiet
 		ready_reset = Signal()
 
+		# Whether a speed change to 5 GT/s has been directed since the link was trained, only one attempt is made
+		speed_change_attempted = Signal()
+
 		m.d.rx += self.tx.ltssm_L0.eq(0)
 
 		
@@ -183,11 +240,18 @@ class PCIeLTSSM(Elaboratable): # Based on Yumewatary phy.py
 
 			return timer
 
-		m.d.rx += tx.ts.n_fts.eq(0xFF)
+		m.d.rx += tx.ts.n_fts.eq(self.n_fts)
+
+		# Set by the receiver L0s state machine below if it doesn't get back to L0 in time
+		rx_l0s_timeout = Signal()
+
+		# Whether the link is leaving L1, the time until L0 is measured
+		l1_exiting = Signal()
+		l1_exit_timer = Signal(16)
 
 
 		# Link Training and Status State Machine, Page 177 in PCIe 1.1, Page 244 in PCIe 3.0
-		with m.FSM(domain="rx"): # Page 249 onwards
+		with m.FSM(domain="rx") as fsm: # Page 249 onwards
 			# Detect.Active after 12 ms or Electrical Idle broken (detected by rx_locked)
 			with m.State(State.Detect_Quiet): # Change to 2.5 GT/s
 				m.d.rx += debug_state.eq(State.Detect_Quiet) # Debug State is there to find out which state the FSM is in
@@ -195,11 +259,22 @@ class PCIeLTSSM(Elaboratable): # Based on Yumewatary phy.py
 				# The Link is now down and the TX SERDES is put into electrical idle
 				m.d.rx += status.link.up.eq(0)
 				#m.d.rx += tx.eidle.eq(0b11)
-				m.d.rx += lane.tx_e_idle.eq(0b1111)
+				m.d.rx += lane.tx_e_idle.eq(Repl(1, len(lane.tx_e_idle)))
 				m.d.rx += rx.ready.eq(0)
 				m.d.rx += tx.ready.eq(0)
 				m.d.rx += tx.idle.eq(0)
 				m.d.rx += lane.det_enable.eq(0)
+				m.d.rx += status.l1.eq(0)
+				m.d.rx += l1_exiting.eq(0)
+
+				# Go back to 2.5 GT/s
+				m.d.rx += [
+					status.link.speed.eq(0),
+					status.link.changed_speed_recovery.eq(0),
+					status.link.successful_speed_negotiation.eq(0),
+					status.directed_speed_change.eq(0),
+					speed_change_attempted.eq(0),
+				]
 
 				# Enable scrambling
 				m.d.rx += scrambling.eq(1)
@@ -231,7 +306,7 @@ class PCIeLTSSM(Elaboratable): # Based on Yumewatary phy.py
 				# reset_ts_count_and_jump(State.Polling)
 
 				with m.If(timer > 20):
-					m.d.rx += lane.tx_e_idle.eq(0b0000)
+					m.d.rx += lane.tx_e_idle.eq(0)
 
 				with m.If(lane.det_valid):
 					# Wait until the detection result is there and disable lane detection again as soon as it is.
@@ -356,7 +431,7 @@ class PCIeLTSSM(Elaboratable): # Based on Yumewatary phy.py
 					# and set the link number of the TSs being sent to the received link number
 					# and go to Configuration.Linkwidth.Accept
 					with m.If(rx.consecutive & rx.ts.valid & (rx.ts.ts_id == 0)
-					& rx.ts.link.valid & ~rx.ts.lane.valid):
+					& rx.ts.link.valid & ~rx.ts.lane.valid & rx.lane_link_valid.all()):
 						m.d.rx += tx.ts.link.valid.eq(1)
 						m.d.rx += tx.ts.link.number.eq(rx.ts.link.number)
 						reset_ts_count_and_jump(State.Configuration_Linkwidth_Accept)
@@ -380,8 +455,8 @@ class PCIeLTSSM(Elaboratable): # Based on Yumewatary phy.py
 					with m.If(rx.ts.valid & (rx.ts.ts_id == 0) & ~rx.ts.link.valid & ~rx.ts.lane.valid):
 						m.d.rx += received_padpad.eq(1)
 
-					# Accept TS1s with Link=Link_num Lane=PAD
-					with m.If(received_padpad & rx.ts.valid & (rx.ts.ts_id == 0) & rx.ts.link.valid & (rx.ts.link.number == link_num) & ~rx.ts.lane.valid):
+					# Accept TS1s with Link=Link_num Lane=PAD on all lanes
+					with m.If(received_padpad & rx.ts.valid & (rx.ts.ts_id == 0) & rx.ts.link.valid & (rx.ts.link.number == link_num) & ~rx.ts.lane.valid & rx.lane_link_valid.all()):
 						with m.If(tx_ts_count >= 2):
 							reset_ts_count_and_jump(State.Configuration_Linkwidth_Accept)
 
@@ -397,13 +472,20 @@ class PCIeLTSSM(Elaboratable): # Based on Yumewatary phy.py
 
 				if upstream:
 					# Accept TS1 Link=Upstream-Link Lane=Upstream-Lane
-					# with the lane number 0, in a x4 implementation it should be lane-dependent.
+					# with the lane number 0 on lane 0, or the highest lane number if the lanes are reversed.
+					# All other lanes need to be numbered consecutively.
 					# Report back that the received lane is valid.
 					#with m.If(rx.ts_received):
+					reversed_lanes = rx.ts.lane.number == last_lane
+					lanes_numbered = rx.lane_lane_valid.all()
+					for i in range(lane.lanes):
+						lanes_numbered &= rx.lane_numbers[i] == Mux(reversed_lanes, last_lane - i, i)
+
 					with m.If(rx.ts.valid & (rx.ts.ts_id == 0) & rx.ts.link.valid & rx.ts.lane.valid & rx.consecutive):
-						with m.If(rx.ts.lane.number == 0):
+						with m.If(((rx.ts.lane.number == 0) | reversed_lanes) & lanes_numbered):
 							m.d.rx += tx.ts.lane.valid.eq(1)
 							m.d.rx += tx.ts.lane.number.eq(rx.ts.lane.number)
+							m.d.rx += tx.lane_reversal.eq(rx.ts.lane.number != 0)
 							reset_ts_count_and_jump(State.Configuration_Lanenum_Wait)
 					
 				
@@ -471,6 +553,7 @@ class PCIeLTSSM(Elaboratable): # Based on Yumewatary phy.py
 							
 							with m.Elif((rx.ts.link.number == tx.ts.link.number) & (rx.ts.lane.number != tx.ts.lane.number)): # TODO: Correct?
 								m.d.rx += tx.ts.lane.number.eq(rx.ts.lane.number)
+								m.d.rx += tx.lane_reversal.eq(rx.ts.lane.number != 0)
 								reset_ts_count_and_jump(State.Configuration_Lanenum_Wait)
 
 					# But no two consecutive TS1s with invalid link and lane.
@@ -479,8 +562,8 @@ class PCIeLTSSM(Elaboratable): # Based on Yumewatary phy.py
 							reset_ts_count_and_jump(State.Detect)
 				
 				else:
-					# Accept consecutive TS1 Link=Upstream-Link Lane=Upstream-Lane
-					with m.If(rx.ts.valid & (rx.ts.ts_id == 0) & rx.ts.link.valid & rx.ts.lane.valid):
+					# Accept consecutive TS1 Link=Upstream-Link Lane=Upstream-Lane on all lanes
+					with m.If(rx.ts.valid & (rx.ts.ts_id == 0) & rx.ts.link.valid & rx.ts.lane.valid & rx.lane_lane_valid.all()):
 						with m.If((rx.ts.link.number == tx.ts.link.number) & (rx.ts.lane.number == tx.ts.lane.number)):
 							with m.If(rx.consecutive):
 								reset_ts_count_and_jump(State.Configuration_Complete)
@@ -493,7 +576,7 @@ class PCIeLTSSM(Elaboratable): # Based on Yumewatary phy.py
 				# And reset the TS counts.
 				m.d.rx += [
 					tx.ts.ts_id.eq(1),
-					tx.ts.n_fts.eq(0xFF),
+					tx.ts.n_fts.eq(self.n_fts),
 					tx_ts_count.eq(0),
 					rx_ts_count.eq(0),
 				]
@@ -533,6 +616,8 @@ class PCIeLTSSM(Elaboratable): # Based on Yumewatary phy.py
 						m.d.rx += status.link.rate.eq(rx.ts.rate)
 						m.d.rx += status.link.changed_speed_recovery.eq(0)
 						m.d.rx += status.link.upconfigure_capable.eq(rx.ts.rate.autonomous_change & tx.ts.rate.autonomous_change)
+						m.d.rx += status.link.width.eq(lane.lanes)
+						m.d.rx += status.link.lane_reversal.eq(tx.lane_reversal)
 						m.d.rx += tx.idle.eq(1)
 						m.d.rx += tx.idle_symbol.eq(0)
 						reset_ts_count_and_jump(State.Configuration_Idle)
@@ -609,12 +694,16 @@ class PCIeLTSSM(Elaboratable): # Based on Yumewatary phy.py
 				m.d.rx += [
 					tx.ts.valid.eq(1),
 					tx.ts.ts_id.eq(0),
-					status.link.up.eq(0), # Not sure if this is right
 					rx.ready.eq(0),
 					tx.ready.eq(0),
-					tx.ts.rate.speed_change.eq(tx.ts.rate.speed_change | status.directed_speed_change),
+					tx.ts.rate.speed_change.eq(status.directed_speed_change),
 				]
 
+				# The other side requests a speed change, follow it if 5 GT/s is supported by both sides
+				if self.support_5GTps:
+					with m.If(rx.ts_received & rx.ts.valid & rx.ts.rate.speed_change & rx.ts.rate.gen2 & rx.consecutive):
+						m.d.rx += status.directed_speed_change.eq(1)
+
 				# If a TS is received with the link and lane numbers matching the configured ones and 8 such have been received, go to Recovery.RcvrCfg
 				with m.If(rx.ts_received & rx.ts.valid & rx.ts.link.valid & rx.ts.lane.valid & rx.consecutive &
 					(rx.ts.link.number == tx.ts.link.number) &
@@ -636,10 +725,13 @@ class PCIeLTSSM(Elaboratable): # Based on Yumewatary phy.py
 						# TODO: Add "| 5 GT/s DRI in TX TS1 & in 8x RX TS2"
 				
 				with m.Elif(timer >= 24 * clocks_per_ms):
+					# The link doesn't work at the new speed, revert to the speed before the speed change
 					with m.If(status.link.changed_speed_recovery):
+						m.d.rx += status.link.successful_speed_negotiation.eq(0)
 						reset_ts_count_and_jump(State.Recovery_Speed)
 					
 					with m.Elif(~status.link.changed_speed_recovery & status.link.speed):
+						m.d.rx += status.link.successful_speed_negotiation.eq(0)
 						reset_ts_count_and_jump(State.Recovery_Speed)
 
 					# TODO: Add jump to Configuration.Linkwidth.Start
@@ -649,12 +741,29 @@ class PCIeLTSSM(Elaboratable): # Based on Yumewatary phy.py
 			
 
 			with m.State(State.Recovery_Speed):
-				stimer = Signal(range(int(16000 / ui_per_clock) + 1))
+				m.d.rx += debug_state.eq(State.Recovery_Speed)
+
+				# Transmitter is in electrical idle while the speed is changed
+				m.d.rx += lane.tx_e_idle.eq(Repl(1, len(lane.tx_e_idle)))
+				m.d.rx += tx.ts.valid.eq(0)
+
+				# Wait for 16000 UI in electrical idle before changing the speed, the SERDES relocks when the speed
+				# changes. Then wait the same time again before leaving electrical idle.
+				idle_time = int(16000 / ui_per_clock)
+				stimer = Signal(range(2 * idle_time + 1))
 				m.d.rx += stimer.eq(stimer + 1)
-				
-				with m.If(status.link.successful_speed_negotiation):
-					with m.If(rx.ts_received):
-						m.d.rx += stimer.eq(0)
+
+				with m.If(stimer == idle_time):
+					# Change to the highest common speed if the speed negotiation was successful, otherwise go back to
+					# the previous speed. Only 2.5 and 5 GT/s are supported, so the previous speed is always 2.5 GT/s.
+					m.d.rx += status.link.speed.eq(status.link.successful_speed_negotiation)
+
+				with m.If(stimer == 2 * idle_time):
+					m.d.rx += stimer.eq(0)
+					m.d.rx += lane.tx_e_idle.eq(0)
+					m.d.rx += status.link.changed_speed_recovery.eq(status.link.successful_speed_negotiation)
+					m.d.rx += status.directed_speed_change.eq(0)
+					reset_ts_count_and_jump(State.Recovery_RcvrLock)
 
 
 			with m.State(State.Recovery_RcvrCfg): # Revise when implementing 5 GT/s, page 290
@@ -665,7 +774,8 @@ class PCIeLTSSM(Elaboratable): # Based on Yumewatary phy.py
 				# Send TS2 ordered sets with same Link and Lane as configured
 				m.d.rx += [
 					tx.ts.valid.eq(1),
-					tx.ts.ts_id.eq(1)
+					tx.ts.ts_id.eq(1),
+					tx.ts.rate.speed_change.eq(status.directed_speed_change),
 				]
 
 				last_ts = Signal()
@@ -687,8 +797,10 @@ class PCIeLTSSM(Elaboratable): # Based on Yumewatary phy.py
 				#	m.d.rx += rx_ts_count.eq(rx_ts_count + 1)
 
 				with m.If(rx.ts_received):
-					with m.If(rx.consecutive & (rx_ts_count < 8)):
-						m.d.rx += rx_ts_count.eq(rx_ts_count + 1)
+					with m.If(rx.consecutive):
+						# Prevent overflows
+						with m.If(rx_ts_count < 8):
+							m.d.rx += rx_ts_count.eq(rx_ts_count + 1)
 
 					with m.Else():
 						m.d.rx += rx_ts_count.eq(0)
@@ -699,7 +811,16 @@ class PCIeLTSSM(Elaboratable): # Based on Yumewatary phy.py
 					(rx.ts.link.number == tx.ts.link.number) &
 					(rx.ts.lane.number == tx.ts.lane.number)):
 					m.d.rx += last_ts.eq(0)
+					m.d.rx += status.link.changed_speed_recovery.eq(0)
 					reset_ts_count_and_jump(State.Recovery_Idle)
+
+				# If 8 TS2s requesting a speed change have been received and a speed change is directed, change the speed.
+				# Both sides advertise 5 GT/s, otherwise the speed change wouldn't have been directed.
+				with m.If((rx_ts_count == 8) & (rx.ts.ts_id == 1) & status.directed_speed_change &
+					rx.ts.valid & rx.ts.rate.speed_change & rx.ts.rate.gen2):
+					m.d.rx += last_ts.eq(0)
+					m.d.rx += status.link.successful_speed_negotiation.eq(1)
+					reset_ts_count_and_jump(State.Recovery_Speed)
 				
 				# If 8 TS1s have been received and 16 TS2s sent, go back to Configuration
 				with m.If((rx_ts_count == 8) & (rx.ts.ts_id == 0) & (tx_ts_count == 16) & (rx.ts.rate.speed_change == 0)):
@@ -711,6 +832,7 @@ class PCIeLTSSM(Elaboratable): # Based on Yumewatary phy.py
 				
 				# Set the transmitter to send IDL symbols
 				m.d.rx += tx.idle.eq(1)
+				m.d.rx += tx.ts.valid.eq(0)
 
 				# TODO: Add Hot Reset state
 				if(upstream):
@@ -772,12 +894,32 @@ class PCIeLTSSM(Elaboratable): # Based on Yumewatary phy.py
 				with m.If(rx.ts_received):
 					# TODO: Record speed here for Recovery
 					reset_ts_count_and_jump(State.Recovery)
+
+				# Change to 5 GT/s if both sides support it
+				if self.support_5GTps:
+					with m.Elif(~status.link.speed & status.link.rate.gen2 & ~speed_change_attempted):
+						m.d.rx += status.directed_speed_change.eq(1)
+						m.d.rx += speed_change_attempted.eq(1)
+						reset_ts_count_and_jump(State.Recovery)
+
+				# Retrain the link if the Data Link Layer requests it
+				with m.Elif(self.retrain):
+					reset_ts_count_and_jump(State.Recovery)
+
+				# Go to L1 once the Data Link Layer has negotiated it
+				with m.Elif(self.enter_l1):
+					reset_ts_count_and_jump(State.L1_Entry)
+
+				# The receiver didn't leave L0s in time
+				with m.Elif(rx_l0s_timeout):
+					reset_ts_count_and_jump(State.Recovery)
 				
 
 				error_count = Signal(range(64))
 
-				# When more than 1/9 of cycles have errors, reset
-				with m.If(rx.has_symbol(Ctrl.Error)):
+				# When more than 1/9 of cycles have errors, reset. The receiver isn't locked while the other side is in
+				# electrical idle, so errors and the lock are ignored in L0s.
+				with m.If(rx.has_symbol(Ctrl.Error) & ~status.rx_l0s):
 					m.d.rx += error_count.eq(error_count + 8)
 
 					with m.If(error_count > 50):
@@ -786,12 +928,173 @@ class PCIeLTSSM(Elaboratable): # Based on Yumewatary phy.py
 				with m.Elif(error_count != 0):
 					m.d.rx += error_count.eq(error_count - 1)
 				
-				with m.If(~lane.rx_locked):
+				with m.If(~lane.rx_locked & ~status.rx_l0s):
 					reset_ts_count_and_jump(State.Detect)
+
+
+			# L1, Page 224 in PCIe 1.1. The link stays up, the Data Link Layer only negotiates L1 once all TLPs have been
+			# acknowledged.
+			with m.State(State.L1_Entry):
+				m.d.rx += debug_state.eq(State.L1_Entry)
+				m.d.rx += status.l1.eq(1)
+
+				# Send an EIOS once the packet in progress is done
+				m.d.comb += tx.eios.eq(1)
+				with m.If(tx.eios_sent):
+					m.d.rx += rx.ready.eq(0)
+					m.d.rx += tx.ready.eq(0)
+					reset_ts_count_and_jump(State.L1_Idle)
+
+
+			with m.State(State.L1_Idle):
+				m.d.rx += debug_state.eq(State.L1_Idle)
+
+				# Go to electrical idle once the EIOS has left the transmitter
+				with m.If(timer < 4):
+					m.d.rx += timer.eq(timer + 1)
+				with m.Else():
+					m.d.rx += lane.tx_e_idle.eq(Repl(1, len(lane.tx_e_idle)))
+
+				# Leave L1 when the Data Link Layer has something to send or the other side leaves it, it sends TS1s in
+				# Recovery.RcvrLock
+				with m.If((timer == 4) & (self.exit_l1 | self.retrain | rx.ts_received)):
+					m.d.rx += lane.tx_e_idle.eq(0)
+					m.d.rx += status.l1.eq(0)
+					m.d.rx += l1_exiting.eq(1)
+					m.d.rx += l1_exit_timer.eq(0)
+					reset_ts_count_and_jump(State.Recovery)
 			
 
 			with m.State(State.Disabled):
-				pass
+				m.d.rx += status.link.up.eq(0)
+
+		in_l0 = fsm.ongoing(State.L0)
+
+		# The link is being trained outside of L0 and L1, it stays up in Recovery
+		m.d.comb += status.link.training.eq(~in_l0 & ~fsm.ongoing(State.L1_Entry) & ~fsm.ongoing(State.L1_Idle))
+
+		# Number of FTSs in a word
+		quads = lane.ratio // lane.lanes // 4
+
+		# Transmitter L0s, Page 221 in PCIe 1.1
+		tx_idle_timer = Signal(range(self.l0s_entry_clocks + 1))
+		l0s_entry_clocks = Mux(self.lane.speed == LinkSpeed.S2_5, self.l0s_entry_clocks // 2, self.l0s_entry_clocks) if lane.use_speed else self.l0s_entry_clocks
+		tx_l0s_timer = Signal(range(4 + 1))
+		fts_count = Signal(range(0xFF + quads + 1))
+
+		with m.FSM(domain="rx", name="tx_l0s"):
+			with m.State("L0"):
+				with m.If(tx.sink.all_valid | ~in_l0):
+					m.d.rx += tx_idle_timer.eq(0)
+				with m.Elif(tx_idle_timer < l0s_entry_clocks):
+					m.d.rx += tx_idle_timer.eq(tx_idle_timer + 1)
+
+				with m.If(in_l0 & self.aspm_control[0] & (tx_idle_timer >= l0s_entry_clocks)):
+					m.next = "Entry"
+
+			# Send an EIOS, a packet which has started in the meantime is sent first
+			with m.State("Entry"):
+				with m.If(~in_l0):
+					m.next = "L0"
+
+				with m.Else():
+					m.d.comb += tx.eios.eq(1)
+					with m.If(tx.eios_sent):
+						m.d.rx += tx.ready.eq(0)
+						m.d.rx += status.tx_l0s.eq(1)
+						m.d.rx += tx_l0s_timer.eq(0)
+						m.next = "Idle"
+
+			# Stay in electrical idle until there is a packet to send, the minimum time in L0s is a few clock cycles
+			with m.State("Idle"):
+				with m.If(~in_l0):
+					m.d.rx += lane.tx_e_idle.eq(0)
+					m.d.rx += status.tx_l0s.eq(0)
+					m.next = "L0"
+
+				with m.Else():
+					m.d.rx += tx.ready.eq(0)
+					m.d.rx += tx.ltssm_L0.eq(0)
+
+					with m.If(tx_l0s_timer < 4):
+						m.d.rx += tx_l0s_timer.eq(tx_l0s_timer + 1)
+					with m.Else():
+						m.d.rx += lane.tx_e_idle.eq(Repl(1, len(lane.tx_e_idle)))
+
+					with m.If((tx_l0s_timer == 4) & tx.sink.all_valid):
+						m.d.rx += lane.tx_e_idle.eq(0)
+						m.d.rx += fts_count.eq(0)
+						m.next = "FTS"
+
+			# Send the number of FTSs the other side requested, PCIePhyTX sends a SKP ordered set after them
+			with m.State("FTS"):
+				with m.If(~in_l0):
+					m.d.rx += status.tx_l0s.eq(0)
+					m.next = "L0"
+
+				with m.Else():
+					m.d.rx += tx.ready.eq(0)
+					m.d.rx += tx.ltssm_L0.eq(0)
+					m.d.comb += tx.fts.eq(1)
+
+					m.d.rx += fts_count.eq(fts_count + quads)
+					with m.If(fts_count + quads >= status.link.n_fts):
+						m.d.rx += status.tx_l0s.eq(0)
+						m.d.rx += tx_idle_timer.eq(0)
+						m.next = "L0"
+
+		# Receiver L0s, Page 220 in PCIe 1.1. Received data isn't forwarded until the receiver is back in L0. If the SKP
+		# ordered set doesn't arrive in twice the time of the requested FTSs, the link is retrained.
+		rx_l0s_timer = Signal(16)
+		rx_l0s_timeout_words = 2 * ((self.n_fts + quads - 1) // quads) + 16
+
+		with m.FSM(domain="rx", name="rx_l0s"):
+			with m.State("L0"):
+				with m.If(in_l0 & rx.has_symbol(Ctrl.IDL)):
+					m.d.rx += rx.ready.eq(0)
+					m.d.rx += status.rx_l0s.eq(1)
+					m.next = "Idle"
+
+			with m.State("Idle"):
+				with m.If(~in_l0):
+					m.d.rx += status.rx_l0s.eq(0)
+					m.next = "L0"
+
+				with m.Else():
+					m.d.rx += rx.ready.eq(0)
+					with m.If(rx.has_symbol(Ctrl.FTS)):
+						m.d.rx += rx_l0s_timer.eq(1)
+						m.next = "FTS"
+
+			# The exit latency is measured from the first FTS until the SKP ordered set
+			with m.State("FTS"):
+				with m.If(~in_l0):
+					m.d.rx += status.rx_l0s.eq(0)
+					m.next = "L0"
+
+				with m.Else():
+					m.d.rx += rx.ready.eq(0)
+					m.d.rx += rx_l0s_timer.eq(rx_l0s_timer + 1)
+
+					with m.If(rx.has_symbol(Ctrl.SKP)):
+						m.d.rx += rx.ready.eq(1)
+						m.d.rx += status.rx_l0s.eq(0)
+						with m.If(rx_l0s_timer > status.l0s_exit_latency):
+							m.d.rx += status.l0s_exit_latency.eq(rx_l0s_timer)
+						m.next = "L0"
+
+					with m.Elif(rx_l0s_timer >= rx_l0s_timeout_words):
+						m.d.comb += rx_l0s_timeout.eq(1)
+
+		# L1 exit latency, from leaving L1.Idle until L0
+		with m.If(l1_exiting):
+			with m.If(~l1_exit_timer.all()):
+				m.d.rx += l1_exit_timer.eq(l1_exit_timer + 1)
+
+			with m.If(in_l0):
+				m.d.rx += l1_exiting.eq(0)
+				with m.If(l1_exit_timer > status.l1_exit_latency):
+					m.d.rx += status.l1_exit_latency.eq(l1_exit_timer)
 
 
 		return m
\ No newline at end of file
@@ -1,12 +1,42 @@
 from amaranth import *
 from amaranth.build import *
+from amaranth.lib.coding import PriorityEncoder
+from amaranth.lib.fifo import SyncFIFOBuffered
 import math
 
 from .stream import StreamInterface
 
+def _or_tree(terms):
+	"""
+	ORs the terms together in a balanced tree, the logic depth grows with log2(len(terms))
+	"""
+	if len(terms) == 1:
+		return terms[0]
+	return _or_tree(terms[:len(terms) // 2]) | _or_tree(terms[len(terms) // 2:])
+
+def _one_hot_select(one_hot, values):
+	"""
+	Selects values[i] for the bit i set in one_hot, at most one bit may be set. Returns 0 if no bit is set.
+	"""
+	return _or_tree([Mux(one_hot[i], value, 0) for i, value in enumerate(values)])
+
 class TLPBuffer(Elaboratable):
 	"""
-	Stores TLPs. They need to be at least 2 clock cycles long. At a ratio of 4 that should be no problem since all TLPs are at least 3 DW long (1 DW = 4 Bytes / Symbols)
+	Stores TLPs. The start and end of a TLP are marked with first and last in the sink and source, so TLPs can be stored back to back.
+	TLPs longer than tlp_bytes are dropped, the words which fit are written but the TLP doesn't get a slot.
+
+	The valid bits and the last marker are stored with the symbols, so the last word of a TLP can be partially valid.
+
+	By default every TLP gets a slot of tlp_depth words. With ring_words set, TLPs are packed back to back into a ring buffer instead
+	and every slot gets a descriptor with the start address and length of the TLP. Storing a TLP starts if there is space for a TLP of
+	the maximum length, the space of deleted TLPs is freed in the order they were stored.
+
+	TLPs are sent through a pipeline which starts a requested TLP right after the last word of the previous one, the source can
+	stall at any word.
+
+	TLPs are looked up by their ID in all slots in parallel, every slot compares its ID and the matching slot is selected with an OR tree.
+	Besides deleting single TLPs, a range of IDs can be deleted at once, for example for acknowledging several TLPs at once.
+	Both deletes can be used in the same cycle.
 	
 	Parameters
 	----------
@@ -21,12 +51,15 @@ class TLPBuffer(Elaboratable):
 
 	delete_on_send : bool
 		Whether to delete the TLP once it is sent
+
+	ring_words : int
+		Size of the ring buffer in words, 0 to use fixed slots instead
 	"""
-	def __init__(self, ratio: int = 4, max_tlps: int = 4, tlp_bytes: int = 512, delete_on_send: bool = False):
+	def __init__(self, ratio: int = 4, max_tlps: int = 4, tlp_bytes: int = 512, delete_on_send: bool = False, ring_words: int = 0):
 		self.ratio = ratio
 
 		self.tlp_sink = StreamInterface(8, ratio, name="TLP_Sink")
-		"""Connect this to the TLP source, when all_valid goes low it marks the end of a TLP"""
+		"""Connect this to the TLP source, first and last mark the start and end of a TLP"""
 		self.tlp_source = StreamInterface(8, ratio, name="TLP_Source")
 		"""Connect this to the TLP sink"""
 
@@ -36,28 +69,53 @@ class TLPBuffer(Elaboratable):
 		"""log2(TLP memory depth)"""
 		self.tlp_depth = 2 ** self.tlp_bit_depth
 		"""TLP memory depth"""
+
+		self.ring_words = ring_words
+		"""Size of the ring buffer in words, 0 if fixed slots are used"""
+		if ring_words:
+			assert ring_words >= self.tlp_depth and 2 ** int(math.log2(ring_words)) == ring_words
+			assert 2 ** int(math.log2(max_tlps)) == max_tlps
+			self.depth = ring_words
+		else:
+			self.depth = self.tlp_depth * max_tlps
+		"""Memory depth"""
 		
 		self.slots = [[Signal(name=f"Slot_{i}_valid"), Signal(12, name=f"Slot_{i}_ID")] for i in range(max_tlps)] # First signal indicates whether the slot is full
 		"""TLP slots, this is a pointer table, first element is whether the pointer is valid and second element is the TLP ID, this is managed by this class, should not be set externally"""
+		for i, slot in enumerate(self.slots):
+			slot += [Signal(range(self.depth), name=f"Slot_{i}_start", reset = 0 if ring_words else i * self.tlp_depth),
+				Signal(range(self.tlp_depth + 1), name=f"Slot_{i}_length")]
+		"""The third and fourth elements are the start address and the length in words, the start address of fixed slots is constant"""
 
 		self.send_tlp_id = Signal(12)
-		"""The ID of the TLP to be sent, can be set 1 cycle later than send_tlp"""
+		"""The ID of the TLP to be sent, needs to be valid from the cycle after send_tlp until the next request"""
 		self.send_tlp = Signal()
-		"""Set to 1 for 1 cycle to start sending a TLP"""
+		"""Set to 1 for 1 cycle to request sending a TLP, it follows the TLP being sent without a gap. Only one request can wait, see send_ready"""
+		self.send_ready = Signal()
+		"""Whether a TLP can be requested, comb domain"""
 		self.sending_tlp = Signal()
-		"""Is 1 while TLP is being sent"""
+		"""Is 1 while a TLP is requested or being sent, comb domain"""
 
 		self.delete_tlp_id = Signal(12)
 		"""The ID of the TLP to be deleted, should be set in the same cycle as delete_tlp"""
 		self.delete_tlp = Signal()
 		"""Set to 1 for 1 cycle to delete TLP"""
 
+		self.delete_range_first = Signal(12)
+		"""The ID of the first TLP of the range to be deleted, should be set in the same cycle as delete_range"""
+		self.delete_range_last = Signal(12)
+		"""The ID of the last TLP of the range to be deleted, should be set in the same cycle as delete_range"""
+		self.delete_range = Signal()
+		"""Set to 1 for 1 cycle to delete all TLPs with IDs from delete_range_first to delete_range_last (modulo 4096)"""
+
 		self.store_tlp_id = Signal(12)
-		"""The ID of the TLP to be stored, can be set 1 cycle later than store_tlp"""
+		"""The ID of the TLP to be stored, needs to be valid when the first word is taken"""
 		self.store_tlp = Signal()
-		"""Set to 1 for 1 cycle to start storing a TLP"""
+		"""Set to 1 to store TLPs, a TLP is stored if this is 1 when its first word is taken"""
 		self.storing_tlp = Signal()
-		"""Is 1 while TLP is being stored"""
+		"""Is 1 while TLP is being stored, comb domain"""
+		self.store_tlp_good = Signal(reset = 1)
+		"""Valid with the last word of a TLP, the TLP is dropped if this is 0, for TLPs which are checked while they are stored"""
 
 		self.slots_full = Signal(reset = 0)
 		"""Whether all TLP slots are full, check for free space with ~slots_full"""
@@ -77,165 +135,256 @@ class TLPBuffer(Elaboratable):
 	def elaborate(self, platform: Platform) -> Module:
 		m = Module()
 
-		storage = Memory(width = self.ratio * 8 + 1, depth = self.tlp_depth * self.max_tlps)
+		storage = Memory(width = self.ratio * 9 + 1, depth = self.depth)
 
 		read_port  = m.submodules.read_port  = storage.read_port(domain = "rx", transparent = False)
 		write_port = m.submodules.write_port = storage.write_port(domain = "rx")
 
-		slots_empty_statement = 1
-		for i in range(self.max_tlps):
-			slots_empty_statement = slots_empty_statement & ~self.slots[i][0]
-
-		m.d.comb += self.slots_empty.eq(slots_empty_statement)
-
-		slots_full_statement = 1
-		for i in range(self.max_tlps):
-			slots_full_statement = slots_full_statement & self.slots[i][0]
-
-		m.d.comb += self.slots_full.eq(slots_full_statement) # TODO: Maybe replace with Cat([i[0] for i in self.slots]).all()? (~….any() for slots_empty)
-
-		read_address_base = Signal(range(self.max_tlps))
-		read_address_counter = Signal(range(self.tlp_depth))
-		m.d.comb += read_port.addr.eq(Cat(read_address_counter, read_address_base))
-		m.d.rx += Cat(self.tlp_source.symbol).eq(read_port.data[:-1])
-
-		tlp_source_valid = Signal(2)
-		m.d.rx += tlp_source_valid.eq(tlp_source_valid << 1)
-		m.d.rx += tlp_source_valid[0].eq(0)
-		m.d.rx += [self.tlp_source.valid[i].eq(tlp_source_valid[-1]) for i in range(self.ratio)]
-		m.d.rx += read_port.en.eq(1)
-
-
-		valid_id_check = 0
+		def match(id):
+			"""Bitmask of the valid slots storing TLP id"""
+			return Cat(slot[0] & (slot[1] == id) for slot in self.slots)
+
+		slots_valid = Cat(slot[0] for slot in self.slots)
+
+		m.d.comb += self.slots_empty.eq(~slots_valid.any())
+		m.d.comb += self.slots_occupied.eq(sum(slot[0] for slot in self.slots))
+
+		if not self.ring_words:
+			m.d.comb += self.slots_full.eq(slots_valid.all())
+
+		# TLPs are read through a 2 stage pipeline, the address stage issues the addresses of a TLP and the word read from the memory is
+		# registered into the source. The end of a TLP is known from its length, so the next requested TLP is started right after the
+		# last address of the current one and consecutive TLPs leave the buffer without idle cycles. The pipeline advances while the
+		# source is ready or empty.
+		advance = Signal()
+		m.d.comb += advance.eq(self.tlp_source.ready | ~self.tlp_source.valid[0])
+
+		send_pending = Signal()
+		reading = Signal()
+		read_first = Signal()
+		read_slot = Signal(range(self.max_tlps))
+		read_address = Signal(range(self.depth))
+		read_remaining = Signal(range(self.tlp_depth + 1))
+		data_valid = Signal()
+		data_first = Signal()
+		data_slot = Signal(range(self.max_tlps))
+
+		m.d.comb += read_port.addr.eq(read_address)
+		m.d.comb += read_port.en.eq(advance)
+		m.d.comb += self.sending_tlp.eq(send_pending | reading | data_valid)
+		# A request can be made while the waiting one is being started
+		load = Signal()
+		m.d.comb += load.eq(advance & (~reading | (read_remaining == 1)))
+		m.d.comb += self.send_ready.eq(~send_pending | load)
+
+		# A TLP has been sent once its last word has been read from the memory
+		sent = Signal()
+		m.d.comb += sent.eq(advance & data_valid & read_port.data[-1])
+
+		m.d.comb += self.in_buffer.eq(match(self.in_buffer_id).any())
+
+		with m.If(advance):
+			m.d.rx += [
+				data_valid.eq(reading),
+				data_first.eq(read_first),
+				data_slot.eq(read_slot),
+				Cat(self.tlp_source.symbol).eq(read_port.data[:self.ratio * 8]),
+				self.tlp_source.first.eq(data_valid & data_first),
+				self.tlp_source.last.eq(data_valid & read_port.data[-1]),
+			]
+			m.d.rx += [self.tlp_source.valid[i].eq(data_valid & read_port.data[self.ratio * 8 + i]) for i in range(self.ratio)]
+
+			with m.If(reading):
+				m.d.rx += read_address.eq(read_address + 1)
+				m.d.rx += read_remaining.eq(read_remaining - 1)
+				m.d.rx += read_first.eq(0)
+
+			# The requested TLP is looked up once send_tlp_id is valid, IDs which aren't stored are ignored
+			with m.If(load):
+				m.d.rx += reading.eq(0)
+
+				with m.If(send_pending):
+					send_match = Signal(self.max_tlps)
+					m.d.comb += send_match.eq(match(self.send_tlp_id))
+
+					m.d.rx += send_pending.eq(0)
+					with m.If(send_match.any()):
+						m.d.rx += [
+							reading.eq(1),
+							read_first.eq(1),
+							read_slot.eq(_one_hot_select(send_match, range(self.max_tlps))),
+							read_address.eq(_one_hot_select(send_match, [slot[2] for slot in self.slots])),
+							read_remaining.eq(_one_hot_select(send_match, [slot[3] for slot in self.slots])),
+						]
+
+		with m.If(self.send_tlp):
+			m.d.rx += send_pending.eq(1)
+
+		# Dereference pointers, a slot is in the range if its distance to the first ID is at most the length of the range
+		delete_match = Signal(self.max_tlps)
+		m.d.comb += delete_match.eq(match(self.delete_tlp_id))
+		delete_range_length = Signal(12)
+		m.d.comb += delete_range_length.eq(self.delete_range_last - self.delete_range_first)
+
+		for i, slot in enumerate(self.slots):
+			slot_distance = (slot[1] - self.delete_range_first)[:12]
+			deleted = (self.delete_tlp & delete_match[i]) | (self.delete_range & (slot_distance <= delete_range_length))
+			if self.delete_on_send:
+				deleted = deleted | (sent & (data_slot == i))
+			with m.If(deleted):
+				m.d.rx += slot[0].eq(0)
 
-		for i in range(self.max_tlps):
-			valid_id_check = valid_id_check | self.slots[i][0] & (self.slots[i][1] == self.in_buffer_id)
-		
-		m.d.comb += self.in_buffer.eq(valid_id_check)
-
-		with m.If(self.slots_empty):
-			m.d.rx += self.slots_occupied.eq(0)
-
-		with m.FSM(name = "send_fsm", domain = "rx"):
-			with m.State("Idle"):
-				m.d.rx += tlp_source_valid[0].eq(0)
-				m.d.rx += tlp_source_valid[1].eq(0)
-				with m.If(self.send_tlp):
-					m.d.rx += self.sending_tlp.eq(1)
-					m.next = "Set offset"
-					
-				with m.Else():
-					m.d.rx += self.sending_tlp.eq(0)
-
-			with m.State("Set offset"):
-				offset = 0
-				valid_id = 0
-
-				for i in range(self.max_tlps):
-					offset = Mux(self.slots[i][0] & (self.slots[i][1] == self.send_tlp_id), i, offset)
-					valid_id = valid_id | self.slots[i][0] & (self.slots[i][1] == self.send_tlp_id)
-
-				m.d.rx += read_address_base.eq(offset)
-
-				with m.If(valid_id & self.tlp_source.ready):
-					m.next = "Transmit"
-					
-				with m.Elif(~valid_id):
-					m.d.rx += self.sending_tlp.eq(0)
-					m.next = "Idle"
-			
-			with m.State("Transmit"):
-				m.d.rx += tlp_source_valid[0].eq(1)
-				with m.If(tlp_source_valid[0]):
-					m.d.rx += read_address_counter.eq(read_address_counter + 1)
-
-				with m.If((read_address_counter == self.tlp_depth - 1) | read_port.data[-1]):
-					m.d.rx += read_address_counter.eq(0)
-					m.d.rx += tlp_source_valid[0].eq(~read_port.data[-1])
-					m.d.rx += tlp_source_valid[1].eq(~read_port.data[-1])
-
-					m.d.rx += self.sending_tlp.eq(0)
-					m.next = "Idle"
-
-					if self.delete_on_send:
-						m.d.comb += self.delete_tlp.eq(1)
-						m.d.comb += self.delete_tlp_id.eq(self.send_tlp_id)
-		
-
-		# Dereference pointer
-		with m.If(self.delete_tlp):
-			for i in range(self.max_tlps):
-				with m.If(self.slots[i][0] & (self.delete_tlp_id == self.slots[i][1])):
-					m.d.rx += self.slots[i][0].eq(0)
-					m.d.rx += self.slots_occupied.eq(self.slots_occupied - 1)
-
-
-		end_tlp = Signal()
 
 		write_address_base = Signal(range(self.max_tlps))
 		write_address_counter = Signal(range(self.tlp_depth), reset = 0)
-		m.d.comb += write_port.addr.eq(Cat(write_address_counter, write_address_base))
-		m.d.rx += write_port.data.eq(Cat(self.tlp_sink.symbol))
-
-		m.d.rx += self.tlp_sink.ready.eq(0)
-		m.d.rx += write_port.en.eq(0)
-
-		tlp_sink_last_valid = Signal(2)
-		m.d.rx += tlp_sink_last_valid.eq(tlp_sink_last_valid << 1)
-		m.d.rx += tlp_sink_last_valid[0].eq(self.tlp_sink.all_valid)
-
-		with m.FSM(name = "store_fsm", domain = "rx"):
-			offset = 0
-			slot_exists = 0
-
-			with m.State("Idle"):
-				with m.If(self.store_tlp & ~self.slots_full):
-					m.next = "Set offset"
-					m.d.rx += self.storing_tlp.eq(1)
-					
-				with m.Else():
-					m.d.rx += self.storing_tlp.eq(0)
-
-			with m.State("Set offset"):
-
+		# The ID is taken when storing starts, store_tlp_id may change while the TLP is being received
+		store_id = Signal(12)
+
+		if self.ring_words:
+			# Descriptors are used in the order the TLPs are stored, the pointers have an additional bit to tell full from empty
+			head = Signal(range(2 * self.depth))
+			tail = Signal(range(2 * self.depth))
+			head_slot = Signal(range(2 * self.max_tlps))
+			tail_slot = Signal(range(2 * self.max_tlps))
+
+			# Free the space of the oldest TLP once it has been deleted
+			with m.If(tail_slot != head_slot):
 				for i in range(self.max_tlps):
-					slot_exists = slot_exists | ((self.slots[i][1] == self.store_tlp_id) & self.slots[i][0])
-					offset = Mux(~self.slots[i][0], i, offset)
+					with m.If((tail_slot[:-1] == i) & ~self.slots[i][0]):
+						m.d.rx += tail.eq(tail + self.slots[i][3])
+						m.d.rx += tail_slot.eq(tail_slot + 1)
+
+			# There needs to be space for a TLP of maximal length
+			m.d.comb += self.slots_full.eq(((head_slot - tail_slot)[:len(head_slot)] == self.max_tlps) |
+				((head - tail)[:len(head)] > self.depth - self.tlp_depth))
+
+
+		if not self.ring_words:
+			# Lowest free slot
+			m.submodules.free_slot = free_slot = PriorityEncoder(self.max_tlps)
+			m.d.comb += free_slot.i.eq(~slots_valid)
+
+		# Words are written as they are taken, the first word goes to a free slot and decides whether the TLP is stored.
+		# Since the next TLP can follow right after the last word, the slot is taken combinatorially for the first word.
+		receiving = Signal()
+		discarding = Signal()
+		m.d.comb += self.storing_tlp.eq(receiving)
+		m.d.comb += self.tlp_sink.ready.eq(receiving | discarding | (self.store_tlp & ~self.slots_full))
+
+		take = self.tlp_sink.ready & self.tlp_sink.all_valid
+		first = ~receiving & ~discarding & self.tlp_sink.first
+		# A TLP which has already been stored isn't stored again
+		store_first = first & self.store_tlp & ~self.slots_full & ~match(self.store_tlp_id).any()
+
+		slot = Mux(first, head_slot[:-1] if self.ring_words else free_slot.o, write_address_base)
+		counter = Mux(first, 0, write_address_counter)
+		id = Mux(first, self.store_tlp_id, store_id)
+		# Writing stops after tlp_depth words, a longer TLP is discarded until its last word
+		end = self.tlp_sink.last | (counter == self.tlp_depth - 1)
+
+		if self.ring_words:
+			m.d.comb += write_port.addr.eq(head[:-1] + counter)
+		else:
+			m.d.comb += write_port.addr.eq(Cat(counter, slot))
+		m.d.comb += write_port.data.eq(Cat(*self.tlp_sink.symbol, *self.tlp_sink.valid, end))
+
+		with m.If(take & (store_first | receiving)):
+			m.d.comb += write_port.en.eq(1)
+			m.d.rx += [
+				receiving.eq(~end),
+				discarding.eq(end & ~self.tlp_sink.last),
+				write_address_base.eq(slot),
+				write_address_counter.eq(Mux(end, 0, counter + 1)),
+				store_id.eq(id),
+			]
+
+			with m.If(end & self.tlp_sink.last & self.store_tlp_good):
+				for i in range(self.max_tlps):
+					with m.If(slot == i):
+						m.d.rx += self.slots[i][0].eq(1)
+						m.d.rx += self.slots[i][1].eq(id)
+						m.d.rx += self.slots[i][3].eq(counter + 1)
+						if self.ring_words:
+							m.d.rx += self.slots[i][2].eq(head[:-1])
 
-				with m.If(slot_exists):
-					m.next = "Idle"
+				if self.ring_words:
+					m.d.rx += head.eq(head + counter + 1)
+					m.d.rx += head_slot.eq(head_slot + 1)
 
-				with m.Else():
-					m.d.rx += write_address_base.eq(offset)
-					m.d.rx += self.tlp_sink.ready.eq(1)
+		# Words of TLPs which aren't stored are dropped until the last one
+		with m.Elif(take & (first | discarding)):
+			m.d.rx += discarding.eq(~self.tlp_sink.last)
 
-					m.next = "Receive"
-			
-			with m.State("Receive"):
-				m.d.rx += self.tlp_sink.ready.eq(1)
+		return m
 
-				with m.If(self.tlp_sink.all_valid):
-					with m.If(tlp_sink_last_valid[0]):
-						m.d.rx += write_address_counter.eq(write_address_counter + 1)
-					m.d.rx += write_port.en.eq(1)
-				
-				with m.Elif(tlp_sink_last_valid[0]):
-					m.d.rx += write_port.en.eq(1)
-					m.d.rx += write_port.data.eq(Cat(write_port.data[:-1], 1))
+class InterleavedFIFO(Elaboratable):
+	"""
+	FIFO which takes up to ports words per clock cycle and puts out one. The words are interleaved over ports FIFOs which are
+	written and read in turn, so every FIFO takes at most one word per clock cycle and the levels of the FIFOs differ by at most 1.
 
+	Parameters
+	----------
+	width : int
+		Word width
+	depth : int
+		Depth of every FIFO
+	ports : int
+		Maximum number of words written per clock cycle
+	"""
+	def __init__(self, width: int, depth: int, ports: int):
+		self.width = width
+		self.depth = depth
+		self.ports = ports
 
-				with m.If((write_address_counter == self.tlp_depth - 1) | (~self.tlp_sink.all_valid & ~tlp_sink_last_valid[0] & tlp_sink_last_valid[1])):
-					m.d.rx += self.tlp_sink.ready.eq(0)
-					m.d.rx += write_address_counter.eq(0)
-					m.d.rx += write_port.en.eq(0)
-					m.d.rx += self.slots_occupied.eq(self.slots_occupied + 1)
+		self.w_data = [Signal(width, name=f"w_data_{i}") for i in range(ports)]
+		"""Words to write, w_data[0] is the first"""
+		self.w_count = Signal(range(ports + 1))
+		"""Number of words of w_data to write"""
+		self.w_rdy = Signal()
+		"""Whether ports words can be written"""
 
-					for i in range(self.max_tlps): # TODO: This can also be solved with amaranth.lib.coding.PriorityEncoder
-						with m.If((offset == i) & ~slot_exists & ~self.slots_full):
-							m.d.rx += self.slots[i][0].eq(1) # TODO: Should this be moved down to Receive to the transition to Idle in case a TLP is being stored incompletely?
-							m.d.rx += self.slots[i][1].eq(self.store_tlp_id)
+		self.r_data = Signal(width)
+		self.r_rdy = Signal()
+		self.r_en = Signal()
 
-					m.next = "Idle"
+		self.level = Signal(range(ports * depth + 1))
+		"""Number of words in all FIFOs"""
 
+	def elaborate(self, platform: Platform) -> Module:
+		m = Module()
 
-		return m
\ No newline at end of file
+		fifos = [SyncFIFOBuffered(width = self.width, depth = self.depth) for _ in range(self.ports)]
+		for i, fifo in enumerate(fifos):
+			m.submodules[f"fifo_{i}"] = fifo
+
+		if self.ports == 1:
+			write_fifo = Signal(1)
+			read_fifo = Signal(1)
+		else:
+			write_fifo = Signal(range(self.ports)) # FIFO which takes w_data[0]
+			read_fifo = Signal(range(self.ports))
+
+		# Word i goes to FIFO (write_fifo + i) % ports, so FIFO j takes word (j - write_fifo) % ports
+		for j, fifo in enumerate(fifos):
+			index = Signal(range(self.ports), name=f"index_{j}")
+			m.d.comb += index.eq(Mux(write_fifo <= j, j - write_fifo, j + self.ports - write_fifo))
+			m.d.comb += fifo.w_data.eq(Array(self.w_data)[index])
+			m.d.comb += fifo.w_en.eq(index < self.w_count)
+
+		if self.ports > 1:
+			next_write_fifo = write_fifo + self.w_count
+			m.d.sync += write_fifo.eq(Mux(next_write_fifo >= self.ports, next_write_fifo - self.ports, next_write_fifo))
+
+		m.d.comb += self.w_rdy.eq(Cat(fifo.w_rdy for fifo in fifos).all())
+		m.d.comb += self.level.eq(sum(fifo.level for fifo in fifos))
+
+		m.d.comb += self.r_data.eq(Array(fifo.r_data for fifo in fifos)[read_fifo])
+		m.d.comb += self.r_rdy.eq(Array(fifo.r_rdy for fifo in fifos)[read_fifo])
+		for j, fifo in enumerate(fifos):
+			m.d.comb += fifo.r_en.eq(self.r_en & (read_fifo == j))
+
+		if self.ports > 1:
+			with m.If(self.r_en & self.r_rdy):
+				m.d.sync += read_fifo.eq(Mux(read_fifo == self.ports - 1, 0, read_fifo + 1))
+
+		return m
@@ -9,38 +9,59 @@ from .dllp import PCIeDLLPTransmitter, PCIeDLLPReceiver
 from .dll import PCIeDLL
 from .virtual_tlp_gen import PCIeVirtualTLPGenerator
 from .tlp import TLP
+from .dma import DMAEngine
+from .interrupts import InterruptController
 
 class PCIePhy(Elaboratable): # Phy might not be the right name for this
 	"""
 	A PCIe Phy
+
+	With aspm the configuration space advertises L0s and L1 with the exit latencies of the LTSSM, they are enabled by the
+	ASPM Control field of the Link Control register. n_fts is the number of FTSs requested for leaving L0s.
+
+	max_payload_size is advertised in the Device Capabilities register, the DMA engine and the memory endpoint use it for the
+	TLPs they send and the buffers of the Data Link Layer are sized for TLPs with that payload.
 	"""
-	def __init__(self, lane, upstream = True, support_5GTps = True, disable_scrambling = False):
+	def __init__(self, lane, upstream = True, support_5GTps = True, disable_scrambling = False, cut_through = False, bar_sizes = [], dma = False, interrupt_vectors = 0, scrambler_pipeline = False,
+		aspm = False, n_fts = 0xFF, max_payload_size = 128):
 		self.upstream = upstream
+		self.lane = lane
 		
 		# PHY
-		self.descrambled_lane = PCIeScrambler(lane)#, Signal())
+		self.descrambled_lane = PCIeScrambler(lane, scrambler_pipeline)
 		self.rx = PCIePhyRX(lane, self.descrambled_lane)
 		self.tx = PCIePhyTX(self.descrambled_lane)
-		self.ltssm = PCIeLTSSM(self.descrambled_lane, self.tx, self.rx, upstream=upstream, support_5GTps=support_5GTps, disable_scrambling=disable_scrambling) # It doesn't care whether the lane is scrambled or not, since it only uses it for RX detection in Detect
+		self.ltssm = PCIeLTSSM(self.descrambled_lane, self.tx, self.rx, upstream=upstream, support_5GTps=support_5GTps, disable_scrambling=disable_scrambling, n_fts=n_fts) # It doesn't care whether the lane is scrambled or not, since it only uses it for RX detection in Detect
 		
 		# DLL
-		self.dllp_rx = PCIeDLLPReceiver()
-		self.dllp_tx = PCIeDLLPTransmitter()
+		ratio = lane.ratio
+
+		self.dllp_rx = PCIeDLLPReceiver(ratio)
+		self.dllp_tx = PCIeDLLPTransmitter(ratio)
 
 		self.dll = PCIeDLL(self.ltssm, self.dllp_tx, self.dllp_rx, lane.frequency, use_speed = self.descrambled_lane.use_speed)
 
-		self.dll_tlp_rx = (ResetInserter(~self.dll.up))(PCIeDLLTLPReceiver(self.dll))
-		self.dll_tlp_tx = (ResetInserter(~self.dll.up))(PCIeDLLTLPTransmitter(self.dll))
+		# The receive buffer keeps room for the completions of the reads of the DMA engine
+		dma_engine = DMAEngine(ratio, max_payload_size = max_payload_size, frequency = lane.frequency, use_speed = self.descrambled_lane.use_speed) if dma and upstream else None
+		self.dma_engine = dma_engine
+		completion_blocks = dma_engine.completion_blocks if dma_engine is not None else 0
+
+		# The TLP Data Link Layer is reset on DL_Down, the link stays up while it is retrained in Recovery
+		self.dll_tlp_rx = (ResetInserter({"rx": ~self.dll.up}))(PCIeDLLTLPReceiver(self.dll, ratio, lane.lanes, cut_through = cut_through,
+			max_payload_size = max_payload_size, completion_blocks = completion_blocks))
+		self.dll_tlp_tx = (ResetInserter({"rx": ~self.dll.up}))(PCIeDLLTLPTransmitter(self.dll, ratio, max_payload_size))
 
 		self.debug = Signal(32)
 		self.debug2 = Signal(8)
 
 		# TL
 		if self.upstream:
-			self.tlp = TLP()
+			link_capabilities = dict(aspm_support = 0b11, l0s_exit_latency = self.ltssm.l0s_exit_latency(), l1_exit_latency = self.ltssm.l1_exit_latency()) if aspm else {}
+			self.tlp = TLP(ratio, bar_sizes, max_payload_size, dma = dma_engine, flow_control = self.dll_tlp_tx.flow_control, cut_through = cut_through,
+				interrupts = InterruptController(ratio, interrupt_vectors) if interrupt_vectors else None, **link_capabilities)
 		
 		else:
-			self.tlp = PCIeVirtualTLPGenerator()
+			self.tlp = PCIeVirtualTLPGenerator(ratio)
 		
 		# Debug
 		self.submodules = [
@@ -88,6 +109,17 @@ class PCIePhy(Elaboratable): # Phy might not be the right name for this
 			m.submodules.tlp = self.tlp
 
 		m.d.comb += self.dll.speed.eq(self.descrambled_lane.speed)
+		if self.dma_engine is not None:
+			m.d.comb += self.dma_engine.speed.eq(self.descrambled_lane.speed)
+		m.d.comb += self.dll.skp_pending.eq(self.tx.skp_pending)
+		m.d.comb += self.tx.skp_request.eq(self.lane.tx_skp_request)
+		m.d.comb += self.ltssm.retrain.eq(self.dll_tlp_tx.retrain)
+		m.d.comb += self.ltssm.enter_l1.eq(self.dll.enter_l1)
+		m.d.comb += self.ltssm.exit_l1.eq(self.dll.exit_l1)
+
+		# A downstream port has no configuration space, its ASPM Control is set directly
+		if self.upstream:
+			m.d.comb += self.ltssm.aspm_control.eq(self.tlp.aspm_control)
 
 		self.dllp_tx.phy_source.connect(self.tx.sink, m.d.comb)
 		self.rx.source.connect(self.dllp_rx.phy_sink, m.d.comb)
@@ -98,9 +130,12 @@ class PCIePhy(Elaboratable): # Phy might not be the right name for this
 		if self.upstream:
 			self.tlp.tlp_source.connect(self.dll_tlp_tx.tlp_sink, m.d.comb)
 			self.dll_tlp_rx.tlp_source.connect(self.tlp.tlp_sink, m.d.comb)
+			m.d.comb += self.tlp.tlp_sink_good.eq(self.dll_tlp_rx.tlp_good)
 		
 		else:
 			self.tlp.tlp_source.connect(self.dll_tlp_tx.tlp_sink, m.d.comb)
+			# The TLP generator doesn't take TLPs, received TLPs are discarded such that they are still acknowledged
+			m.d.comb += self.dll_tlp_rx.tlp_source.ready.eq(1)
 		
 		m.d.comb += self.debug.eq(Cat(self.dll_tlp_tx.tlp_sink.symbol))
 		m.d.comb += self.debug2.eq(Cat(self.dll_tlp_tx.tlp_sink.valid))
@@ -128,6 +163,10 @@ class PCIePhy(Elaboratable): # Phy might not be the right name for this
 
 		m.d.rx += self.descrambled_lane.rx_align.eq(1)
 
+		# Bonded lanes are deskewed on ordered sets while the link is being trained
+		if self.lane.lanes > 1:
+			m.d.rx += self.lane.enable.eq(self.ltssm.status.link.training)
+
 		m.d.rx += self.descrambled_lane.enable.eq(self.ltssm.status.link.scrambling & ~self.tx.sending_ts)
 
 		return m
\ No newline at end of file
@@ -1,38 +1,50 @@
 from amaranth import *
 from amaranth.build import *
 from amaranth.lib.fifo import SyncFIFOBuffered
-from .serdes import K, D, compose, Ctrl, PCIeSERDESInterface, PCIeScrambler
+from .serdes import K, D, compose, lane_symbols, Ctrl, PCIeSERDESInterface, PCIeScrambler
 from .layouts import ts_layout
 from .stream import StreamInterface
 
 class PCIePhyRX(Elaboratable):
 	"""
-	PCIe Receiver for 1:4 gearing
+	PCIe Receiver for 1:4 or wider gearing per lane, the gearing needs to be a multiple of 4
+
+	Ordered sets and packets start at a multiple of 4 symbols, so ordered sets are detected in a window of the
+	last received symbols, at any multiple of 4 symbols within a word.
 
 	Parameters
 	----------
 	lane : PCIeSERDESInterface
 		PCIe lane
 	ts : Record(ts_layout)
-		Data from received training sequence
+		Data from received training sequence on lane 0
 	vlink : Signal
 		Last valid link # received
 	vlane : Signal
 		Last valid lane # received
+	lane_link_valid : Signal(lanes)
+		Per lane, whether the last TS received on lane 0 was also received on that lane with a valid link #
+	lane_lane_valid : Signal(lanes)
+		Per lane, whether the last TS received on lane 0 was also received on that lane with a valid lane #
+	lane_numbers : [Signal(5)] * lanes
+		Per lane, lane # of the last TS
 	ready : Signal()
 		Asserted by LTSSM to enable data reception
 	fifo : SyncFIFOBuffered()
 		Received data gets stored in here
 	"""
 	def __init__(self, raw_lane : PCIeSERDESInterface, decoded_lane : PCIeScrambler):
-		assert raw_lane.ratio == 4
+		assert raw_lane.ratio % (4 * raw_lane.lanes) == 0
 		self.raw_lane = raw_lane
 		self.decoded_lane = decoded_lane
 		self.ts = Record(ts_layout)
 		self.vlink = Signal(8)
 		self.vlane = Signal(5)
+		self.lane_link_valid = Signal(raw_lane.lanes)
+		self.lane_lane_valid = Signal(raw_lane.lanes)
+		self.lane_numbers = [Signal(5, name=f"lane_number_{i}") for i in range(raw_lane.lanes)]
 		self.consecutive = Signal()
-		self.inverted = Signal()
+		self.inverted = Signal(raw_lane.lanes)
 		self.ready = Signal()
 		self.source = StreamInterface(9, raw_lane.ratio, name="PHY_Source")
 
@@ -59,22 +71,36 @@ class PCIePhyRX(Elaboratable):
 		vlane = self.vlane
 		ts_last = Record(ts_layout)
 		ts_current = Record(ts_layout)
-		ratio = raw_lane.ratio
-
-		# Idle signal for when the idle symbol or SKP ordered sets are received
-		self.idle = (decoded_lane.rx_symbol == 0) | (decoded_lane.rx_symbol == compose([Ctrl.COM, Ctrl.SKP, Ctrl.SKP, Ctrl.SKP]))
+		lanes = raw_lane.lanes
+		ratio = raw_lane.ratio // lanes
+		quads = ratio // 4
 
-		# The received symbols
-		symbols = [raw_lane.rx_symbol[i * 9 : i * 9 + 9] for i in range(ratio)]
-		decoded_symbols = [decoded_lane.rx_symbol[i * 9 : i * 9 + 9] for i in range(ratio)]
+		skp = [Ctrl.COM, Ctrl.SKP, Ctrl.SKP, Ctrl.SKP]
 
-		def compare(*csymbols):
-			statement = True
-			
-			for i in range(ratio):
-				statement &= csymbols[i] == symbols[i]
+		def quad(symbols, i):
+			return Cat(symbols[4 * i : 4 * i + 4])
 
-			return statement
+		# Idle signal for when the idle symbol or SKP ordered sets are received
+		self.idle = Cat((quad(decoded_symbols, i) == 0) | (quad(decoded_symbols, i) == compose(skp))
+			for decoded_symbols in [[lane_symbols(decoded_lane.rx_symbol, lanes, lane).word_select(i, 9) for i in range(ratio)] for lane in range(lanes)]
+			for i in range(quads)).all()
+
+		# The received symbols of every lane, ordered sets are sent on all lanes at the same time.
+		# The TS contents are taken from lane 0, other lanes only contribute their link and lane numbers.
+		all_symbols = [[lane_symbols(raw_lane.rx_symbol, lanes, lane).word_select(i, 9) for i in range(ratio)] for lane in range(lanes)]
+		symbols = all_symbols[0]
+
+		# Window of the last received symbols of every lane, oldest symbol first. It contains every TS which ends in
+		# the current word.
+		window_words = 1 + (16 - 4 + ratio - 1) // ratio
+		windows = []
+		for lane in range(lanes):
+			words = [all_symbols[lane]]
+			for i in range(window_words - 1):
+				word = [Signal(9, name=f"window_{lane}_{i}_{j}") for j in range(ratio)]
+				m.d.rx += Cat(word).eq(Cat(words[-1]))
+				words.append(word)
+			windows.append([symbol for word in reversed(words) for symbol in word])
 
 		# Whether a TS is being received
 		self.recv_tsn = recv_tsn = Signal()
@@ -88,9 +114,6 @@ class PCIePhyRX(Elaboratable):
 		# Whether the TS is inverted
 		inverted = self.inverted # Signal()
 
-		# Whether currently a DLLP or TLP is being received
-		receiving_data = Signal()
-
 		# Limit inversion rate, because inverting takes a while to propagate.
 		# Otherwise it will oscillate and return garbage.
 		# (And the moment when the inversion happens, the symbol will be garbled, since it isn't aligned to symbol boundaries.)
@@ -98,7 +121,9 @@ class PCIePhyRX(Elaboratable):
 		with m.If(last_invert != 0):
 			m.d.rx += last_invert.eq(last_invert - 1)
 
-		m.d.comb += Cat(self.source.valid).eq(0) # TODO: Is this necessary?
+		m.d.rx += self.ts_received.eq(0)
+		m.d.rx += self.start_receive_ts.eq(0)
+		m.d.rx += inverted.eq(0)
 
 		# Structure of a TS:
 		# COM Link Lane n_FTS Rate Ctrl ID ID ID ID ID ID ID ID ID ID
@@ -106,96 +131,74 @@ class PCIePhyRX(Elaboratable):
 		# In that case, the 9th bit is true.
 		# Otherwise its valid and the link number gets stored.
 		# There is also a SKP ordered set composed of COM SKP SKP SKP
-		# A comma aligner before the RX causes the comma to be aligned to symbol1.
-		with m.FSM(domain="rx"):
-			with m.State("IDLE"):
-				m.d.rx += self.ts_received.eq(0)
-				with m.If(compare(Ctrl.COM, Ctrl.SKP, Ctrl.SKP, Ctrl.SKP)):
-					m.d.comb += Cat(self.source.valid).eq(0)
-
-				with m.Elif(symbols[0] == Ctrl.COM):
-					# Ignore the comma otherwise, could be a different ordered set
-					with m.If((symbols[1] == Ctrl.PAD) | (symbols[1][8] == 0)):
-						with m.If(symbols[1] == Ctrl.PAD):
-							m.d.rx += ts_current.link.valid.eq(0)
-							m.d.rx += recv_tsn.eq(1)
-						with m.Elif(symbols[1][8] == 0):
-							m.d.rx += ts_current.link.number.eq(symbols[1][:8])
-							m.d.rx += ts_current.link.valid.eq(1)
-							m.d.rx += recv_tsn.eq(1)
-						
-						m.d.rx += ts_current.valid.eq(1)
-						m.d.rx += self.start_receive_ts.eq(1)
-
-						# Lane and Fast Training Sequence count
-						
-						with m.If(symbols[2] == Ctrl.PAD):
-							m.d.rx += ts_current.lane.valid.eq(0)
-						with m.Elif(symbols[2][8] == 0):
-							m.d.rx += ts_current.lane.valid.eq(1)
-							m.d.rx += ts_current.lane.number.eq(symbols[2][:5])
-						with m.If(symbols[3][8] == 0):
-							m.d.rx += ts_current.n_fts.eq(symbols[3][:8])
-						
-						m.next = "TSn-DATA"
-
-				with m.Elif(self.ready): # Might overflow
-					m.d.comb += Cat(self.source.valid).eq(decoded_lane.rx_valid)
-					m.d.comb += Cat(self.source.symbol).eq(decoded_lane.rx_symbol)
-
-				#with m.Else():
-				#    m.d.rx += recv_tsn.eq(0)
-
-			# OLD: From when the bus was 2 symbols wide
-			# SKP ordered set, in COMMA there is 'COM SKP' and here is 'SKP SKP' in rx_symbol, after which it goes back to COMMA.
-			#with m.State("SKP"):
-			#	m.next = "IDLE"
-			
-			# Rate and Ctrl bytes
-			with m.State("TSn-DATA"):
-				m.next = "TSn-ID1"
-				m.d.rx += self.start_receive_ts.eq(0)
-				with m.If(symbols[0][8] == 0):
-					m.d.rx += Cat(ts_current.rate).eq(symbols[0][:8])
-
-				with m.If(symbols[1][8] == 0):
-					m.d.rx += Cat(ts_current.ctrl).eq(symbols[1][:5])
-
-				m.d.rx += ts_current.valid.eq(1)
-
-
-				with m.If(symbols[2] == D(10,2)):
-					m.d.rx += ts_current.ts_id.eq(0)
-
-				with m.If(symbols[2] == D(5,2)):
-					m.d.rx += ts_current.ts_id.eq(1)
-					
-				with m.If(symbols[2] == D(21,5)):
-					m.d.rx += ts_current.ts_id.eq(0)
-					m.d.rx += inverted.eq(1)
-
-				with m.If(symbols[2] == D(26,5)):
-					m.d.rx += ts_current.ts_id.eq(1)
-					m.d.rx += inverted.eq(1)
-
-			# Find out whether its a TS1, a TS2 or inverted, called ID1 because some ID bits are already gotten before
-			with m.State("TSn-ID1"):
-				m.next = "TSn-ID2"
-
-			# When its not inverted, accept it.
-			# Additionally it can be checked whether two consecutive TSs are valid by uncommenting the if statement
-			with m.State("TSn-ID2"):
-				m.next = "IDLE"
-				with m.If(inverted):
-					m.d.rx += ts.valid.eq(0)
-					m.d.rx += inverted.eq(0)
+		# A comma aligner before the RX causes the comma to be aligned to a multiple of 4 symbols.
+		for i in range(quads):
+			with m.If((symbols[4 * i] == Ctrl.COM) & ((symbols[4 * i + 1] == Ctrl.PAD) | (symbols[4 * i + 1][8] == 0))):
+				m.d.rx += self.start_receive_ts.eq(1)
+
+		# A TS ending at quad i of the current word
+		for i in range(quads):
+			end = len(windows[0]) - ratio + 4 * i + 4
+			received = [window[end - 16 : end] for window in windows]
+			ts_symbols = received[0]
+
+			ts_id_valid = False
+			for id_symbol in [D(10, 2), D(5, 2), D(21, 5), D(26, 5)]:
+				ts_id_valid |= ts_symbols[6] == id_symbol
+
+			with m.If((ts_symbols[0] == Ctrl.COM) & ((ts_symbols[1] == Ctrl.PAD) | (ts_symbols[1][8] == 0)) & ts_id_valid):
+				# Fields which are not valid keep their last value
+				m.d.comb += ts_current.eq(ts_last)
+				m.d.comb += ts_current.valid.eq(1)
+
+				with m.If(ts_symbols[1] == Ctrl.PAD):
+					m.d.comb += ts_current.link.valid.eq(0)
+				with m.Else():
+					m.d.comb += ts_current.link.number.eq(ts_symbols[1][:8])
+					m.d.comb += ts_current.link.valid.eq(1)
+
+				# Lane and Fast Training Sequence count
+				with m.If(ts_symbols[2] == Ctrl.PAD):
+					m.d.comb += ts_current.lane.valid.eq(0)
+				with m.Elif(ts_symbols[2][8] == 0):
+					m.d.comb += ts_current.lane.valid.eq(1)
+					m.d.comb += ts_current.lane.number.eq(ts_symbols[2][:5])
+				with m.If(ts_symbols[3][8] == 0):
+					m.d.comb += ts_current.n_fts.eq(ts_symbols[3][:8])
+
+				# Rate and Ctrl bytes
+				with m.If(ts_symbols[4][8] == 0):
+					m.d.comb += Cat(ts_current.rate).eq(ts_symbols[4][:8])
+				with m.If(ts_symbols[5][8] == 0):
+					m.d.comb += Cat(ts_current.ctrl).eq(ts_symbols[5][:5])
+
+				# Find out whether its a TS1, a TS2 or inverted
+				m.d.comb += ts_current.ts_id.eq((ts_symbols[6] == D(5, 2)) | (ts_symbols[6] == D(26, 5)))
+
+				# Every lane can be inverted on its own
+				lane_com = Cat(lane_symbol[0] == Ctrl.COM for lane_symbol in received)
+				lane_inverted = Cat((lane_symbol[0] == Ctrl.COM) & ((lane_symbol[6] == D(21, 5)) | (lane_symbol[6] == D(26, 5))) for lane_symbol in received)
+				lane_link_valid = Cat(lane_symbol[1][8] == 0 for lane_symbol in received) & lane_com
+				lane_lane_valid = Cat(lane_symbol[2][8] == 0 for lane_symbol in received) & lane_com
+
+				m.d.rx += recv_tsn.eq(1)
+				m.d.rx += inverted.eq(lane_inverted)
+
+				with m.If(lane_inverted.any()):
 					with m.If(last_invert == 0): # Should this be moved into the If(inverted) statement?
-						m.d.rx += raw_lane.rx_invert.eq(~raw_lane.rx_invert) # Maybe it should change the disparity instead?
+						m.d.rx += raw_lane.rx_invert.eq(raw_lane.rx_invert ^ lane_inverted) # Maybe it should change the disparity instead?
 						m.d.rx += last_invert.eq(200)
+
+				with m.If(lane_inverted[0]):
+					m.d.rx += ts.valid.eq(0)
 				
-				# If its not inverted, then a valid TS was received.
+				# When its not inverted, accept it.
 				with m.Else():
-					#with m.If((ts_last == ts_current)):
+					m.d.rx += self.lane_link_valid.eq(lane_link_valid & ~lane_inverted)
+					m.d.rx += self.lane_lane_valid.eq(lane_lane_valid & ~lane_inverted)
+					for lane in range(lanes):
+						m.d.rx += self.lane_numbers[lane].eq(received[lane][2][:5])
+
 					m.d.rx += ts.eq(ts_current)
 					m.d.rx += ts_last.eq(ts_current)
 					m.d.rx += self.ts_received.eq(1)
@@ -203,10 +206,27 @@ class PCIePhyRX(Elaboratable):
 
 					# Consecutive TS sensing
 					m.d.rx += self.consecutive.eq(ts_last == ts_current)
+
+		# Symbols which belong to ordered sets are not forwarded to higher layers. Since the descrambler takes a
+		# clock cycle, the mask is delayed by one clock cycle. A TS is 4 quads long, SKP, FTS and EIOS are 1 quad.
+		os_remaining = Signal(2)
+		os_mask = Signal(quads)
+		remaining = os_remaining
+		for i in range(quads):
+			com = symbols[4 * i] == Ctrl.COM
+			short = (symbols[4 * i + 1] == Ctrl.SKP) | (symbols[4 * i + 1] == Ctrl.FTS) | (symbols[4 * i + 1] == Ctrl.IDL)
+			m.d.rx += os_mask[i].eq(com | (remaining != 0))
+			remaining = Mux(com, Mux(short, 0, 3), Mux(remaining != 0, remaining - 1, 0))
+		m.d.rx += os_remaining.eq(remaining)
+
+		with m.If(self.ready): # Might overflow
+			m.d.comb += Cat(self.source.symbol).eq(decoded_lane.rx_symbol)
+			for i in range(len(self.source.valid)):
+				m.d.comb += self.source.valid[i].eq(decoded_lane.rx_valid[i] & ~os_mask[i // lanes // 4])
 		
 		with m.If(ts.link.valid):
 			m.d.rx += vlink.eq(ts.link.number)
 		with m.If(ts.lane.valid):
 			m.d.rx += vlane.eq(ts.lane.number)
 
-		return m
\ No newline at end of file
+		return m
@@ -1,6 +1,7 @@
 from amaranth import *
 from amaranth.build import *
 from amaranth.lib.fifo import SyncFIFOBuffered
+import math
 from .serdes import K, D, Ctrl, PCIeSERDESInterface
 from .layouts import ts_layout
 from .stream import StreamInterface
@@ -8,25 +9,60 @@ from .stream import StreamInterface
 # TODO: When TS data changes during TS sending, the sent TS changes. For example when it changes from TS1 to TS2, itll send ...D10.2 D10.2 D5.2 D5.2 which is kinda suboptimal. TS should be buffered.
 class PCIePhyTX(Elaboratable):
 	"""
-	PCIe Transmitter for 1:4 gearing
+	PCIe Transmitter for 1:4 or wider gearing per lane, the gearing needs to be a multiple of 4
+
+	Ordered sets are always sent at the start of a word, SKP ordered sets are repeated to fill the word.
+
+	SKP ordered sets are scheduled every skp_interval symbol times, see section 4.2.7.3 on page 196 in PCIe 1.1. The interval
+	is the same at both speeds and the word clock is proportional to the speed, so it is a fixed number of clock cycles.
+	Scheduled SKP ordered sets are only sent between packets, they are counted in skp_pending until then. The DLL doesn't
+	start new packets while SKP ordered sets are pending, so at most the longest packet delays them and the count is bounded.
+	If skp_request is asserted when one is scheduled, another one is scheduled with it, so both are sent back to back.
+
+	Electrical Idle ordered sets (EIOS) and Fast Training Sequences (FTS) are sent while eios or fts is asserted, between
+	packets like SKP ordered sets. A SKP ordered set always follows the last FTS, see section 4.2.4.5 on page 186 in PCIe 1.1.
 
 	Parameters
 	----------
 	lane : PCIeSERDESInterface
 		PCIe lane
 	ts : Record(ts_layout)
-		Data to send
+		Data to send, the lane # is the one of lane 0 and increases for the other lanes
+	lane_reversal : Signal()
+		Assert to decrease the lane # for the other lanes instead
 	ready : Signal()
 		Asserted by LTSSM to enable data transmission
 	in_symbols : Signal(18)
 		Symbols to send from higher layers
 	fifo : SyncFIFOBuffered()
 		Data to transmit goes in here
+	skp_pending : Signal(range(max_skp_pending + 1))
+		Number of scheduled SKP ordered sets which haven't been sent, each takes one word
+	skp_request : Signal()
+		Assert to schedule an additional SKP ordered set, for an elastic buffer to remove
+	eios : Signal()
+		Assert to send Electrical Idle ordered sets, COM IDL IDL IDL
+	eios_sent : Signal()
+		Is 1 while an EIOS is being sent, it can't start while a packet is in progress
+	fts : Signal()
+		Assert to send Fast Training Sequences, COM FTS FTS FTS, each word holds ratio / 4 of them
 	"""
-	def __init__(self, lane : PCIeSERDESInterface):
-		assert lane.ratio == 4
+	def __init__(self, lane : PCIeSERDESInterface, skp_interval : int = 1300):
+		assert lane.ratio % (4 * lane.lanes) == 0
+		assert 1180 <= skp_interval <= 1538
 		self.lane = lane
+		self.skp_interval = skp_interval
+
+		# A TLP with 4 KB of payload, a 4 DW header, ECRC and framing is 4124 symbols long, SKP ordered sets scheduled while it
+		# and the packet before it are sent are pending
+		self.max_skp_pending = math.ceil(4124 / lane.lanes / skp_interval) + 1
+		self.skp_pending = Signal(range(self.max_skp_pending + 1))
+		self.skp_request = Signal()
+		self.eios = Signal()
+		self.eios_sent = Signal()
+		self.fts = Signal()
 		self.ts = Record(ts_layout)
+		self.lane_reversal = Signal()
 		self.idle = Signal()
 		self.sending_ts = Signal()
 		self.ready = Signal()
@@ -44,16 +80,23 @@ class PCIePhyTX(Elaboratable):
 
 		lane = self.lane
 		ts = self.ts # ts to transmit
-		ratio = lane.ratio
+		lanes = lane.lanes
+		ratio = lane.ratio // lanes
+		quads = ratio // 4
 
 		self.start_send_ts = Signal()
 		self.idle = Signal()
-		self.eidle = Signal(ratio)
-		symbols = [lane.tx_symbol[i * 9 : i * 9 + 9] for i in range(ratio)]
+		self.eidle = Signal(lane.ratio)
+		all_symbols = [lane.tx_symbol[i * 9 : i * 9 + 9] for i in range(lane.ratio)]
+		symbols = [[all_symbols[i * lanes + lane] for i in range(ratio)] for lane in range(lanes)]
 
 		def send(*ssymbols):
-			for i in range(ratio):
-				m.d.comb += symbols[i].eq(ssymbols[i])
+			"""
+			Sends the same symbols on all lanes, a symbol can also be a function of the lane number
+			"""
+			for lane in range(lanes):
+				for i in range(ratio):
+					m.d.comb += symbols[lane][i].eq(ssymbols[i](lane) if callable(ssymbols[i]) else ssymbols[i])
 		
 
 
@@ -63,21 +106,34 @@ class PCIePhyTX(Elaboratable):
 
 		m.d.rx += self.start_send_ts.eq(0)
 
-		skp_counter = Signal(range(int(1538)))
-		skp_accumulator = Signal(4)
-		
-		# Increase SKP accumulator once counter reaches 325 (SKP between 1180 and 1538 symbol times, here 1300)
+		# Schedule a SKP ordered set every skp_interval symbol times, a word has ratio symbols per lane
+		skp_counter = Signal(range(self.skp_interval // ratio + 1))
+		skp_accumulator = self.skp_pending
+
 		m.d.rx += skp_counter.eq(skp_counter + 1)
-		#with m.If((skp_counter << lane.speed) == 650):
-		with m.If(skp_counter == 325):
+		with m.If(skp_counter == self.skp_interval // ratio - 1):
 			m.d.rx += skp_counter.eq(0)
-			with m.If(skp_accumulator < 15):
+			with m.If(skp_accumulator < self.max_skp_pending):
 				m.d.rx += skp_accumulator.eq(skp_accumulator + 1)
+				with m.If(self.skp_request & (skp_accumulator + 1 < self.max_skp_pending)):
+					m.d.rx += skp_accumulator.eq(skp_accumulator + 2)
 
 		m.d.comb += self.sink.ready.eq(0) # TODO: Is this necessary?
 
 		# Structure of a TS:
 		# COM Link Lane n_FTS Rate Ctrl ID ID ID ID ID ID ID ID ID ID
+		# Send PAD symbols if the link/lane is invalid, otherwise send the link/lane number.
+		ts_symbol = Mux(ts.ts_id, D(5, 2), D(10, 2))
+		ts_symbols = [
+			Ctrl.COM,
+			Mux(ts.link.valid, ts.link.number, Ctrl.PAD),
+			lambda lane: Mux(ts.lane.valid, Mux(self.lane_reversal, ts.lane.number - lane, ts.lane.number + lane)[:5], Ctrl.PAD),
+			ts.n_fts,
+			ts.rate,
+			ts.ctrl,
+		] + [ts_symbol] * 10
+		ts_words = [ts_symbols[i : i + ratio] for i in range(0, 16, ratio)]
+
 		with m.FSM(domain="rx"):
 
 			with m.State("IDLE"):
@@ -87,9 +143,13 @@ class PCIePhyTX(Elaboratable):
 				# Whether higher levels are sending DLLPs or TLPs
 				sending_old = Signal()
 				# When a TLP starts, set sending_data to 1 and reset it when it ends.
-				# (self.in_symbols[0:9] == Ctrl.SDP) | 
-				sending_data = ((self.sink.symbol[0] == Ctrl.STP) | (self.sink.symbol[0] == Ctrl.SDP) # TODO: This might insert SKP sets in the beginning of a TLP since the pipeline takes a while and the ready signal might be buggy
-				| sending_old) & ~((self.sink.symbol[3] == Ctrl.END) | (self.sink.symbol[3] == Ctrl.EDB))
+				# Packets start and end at a multiple of 4 symbols, so the word is checked in groups of 4 symbols.
+				# Only valid symbols count, the sink keeps the symbols of the last word while it isn't valid.
+				sending_data = sending_old
+				for i in range(len(self.sink.symbol) // 4):
+					start = self.sink.valid[4 * i] & ((self.sink.symbol[4 * i] == Ctrl.STP) | (self.sink.symbol[4 * i] == Ctrl.SDP))
+					end = self.sink.valid[4 * i + 3] & ((self.sink.symbol[4 * i + 3] == Ctrl.END) | (self.sink.symbol[4 * i + 3] == Ctrl.EDB))
+					sending_data = (sending_data | start) & ~end
 
 				m.d.rx += sending_old.eq(sending_data)
 				m.d.rx += self.enable_higher_layers.eq(1)
@@ -97,67 +157,73 @@ class PCIePhyTX(Elaboratable):
 				m.d.comb += self.sink.ready.eq(self.ltssm_L0)
 
 
-				last_symbols = [Signal(9) for _ in range(ratio)]
+				last_symbols = [Signal(9) for _ in range(lane.ratio)]
 
 				with m.If(self.sink.all_valid):
-					for i in range(ratio):
+					for i in range(lane.ratio):
 						m.d.rx += last_symbols[i].eq(self.sink.symbol[i])
 
-				# Send SKP ordered sets when the accumulator is above 0
-				#with m.If(skp_accumulator > 0):
-				#    m.d.comb += self.sink.ready.eq(0)
+				# Electrical Idle ordered sets and FTSs have priority over SKP ordered sets, the word in the sink waits. FTSs are
+				# only requested in L0s, where no packet is in progress, and the SKP ordered set after them is sent in the following
+				# word, even if a packet is waiting.
+				fts_sent = Signal()
+
+				with m.If(self.eios & ~sending_old & ~sending_data):
+					m.d.comb += self.sink.ready.eq(0)
+					m.d.comb += self.eios_sent.eq(1)
+					send(*[Ctrl.COM, Ctrl.IDL, Ctrl.IDL, Ctrl.IDL] * quads)
+					m.d.rx += self.enable_higher_layers.eq(0)
 
-				with m.If((skp_accumulator > 0) & ~sending_old & ~sending_data):#(~sending_data | ((last_symbols[3] == Ctrl.END) | (last_symbols[3] == Ctrl.EDB)))):
+				with m.Elif(self.fts):
 					m.d.comb += self.sink.ready.eq(0)
-					send(Ctrl.COM, Ctrl.SKP, Ctrl.SKP, Ctrl.SKP)
+					send(*[Ctrl.COM, Ctrl.FTS, Ctrl.FTS, Ctrl.FTS] * quads)
+					m.d.rx += self.enable_higher_layers.eq(0)
+					m.d.rx += fts_sent.eq(1)
+
+				with m.Elif(fts_sent):
+					m.d.comb += self.sink.ready.eq(0)
+					send(*[Ctrl.COM, Ctrl.SKP, Ctrl.SKP, Ctrl.SKP] * quads)
+					m.d.rx += self.enable_higher_layers.eq(0)
+					m.d.rx += fts_sent.eq(0)
+
+				# Send SKP ordered sets when the accumulator is above 0 and no packet is in progress, the word in the sink waits
+				# SKP ordered sets only consist of K symbols, which aren't scrambled, so scrambling stays enabled for the other words
+				with m.Elif((skp_accumulator > 0) & ~sending_old & ~sending_data):
+					m.d.comb += self.sink.ready.eq(0)
+					send(*[Ctrl.COM, Ctrl.SKP, Ctrl.SKP, Ctrl.SKP] * quads)
 					m.d.rx += [
 						self.enable_higher_layers.eq(0),
 						skp_accumulator.eq(skp_accumulator - 1),
-						self.sending_ts.eq(1),
 					]
 
 				with m.Elif(ts.valid):
 					m.d.rx += self.sending_ts.eq(1)
 					#m.d.comb += lane.tx_e_idle.eq(0b0)
-					m.next = "TSn-DATA"
+					if len(ts_words) > 1:
+						m.next = "TSn-1"
 					m.d.rx += [
 						self.start_send_ts.eq(1)
 					]
 
-					# Send PAD symbols if the link/lane is invalid, otherwise send the link/lane number.
-					send(
-						Ctrl.COM,
-						Mux(ts.link.valid, ts.link.number, Ctrl.PAD),
-						Mux(ts.lane.valid, ts.lane.number, Ctrl.PAD),
-						ts.n_fts
-						)
+					send(*ts_words[0])
 
 				# Transmit data from higher layers
 				with m.Elif(self.ready):
 					m.d.comb += self.sink.ready.eq(1)
-					for i in range(ratio):
-						m.d.comb += symbols[i].eq(Mux(self.sink.valid[i], self.sink.symbol[i], 0))
+					for i in range(lane.ratio):
+						m.d.comb += all_symbols[i].eq(Mux(self.sink.valid[i], self.sink.symbol[i], 0))
 
 				# Transmit idle data
 				with m.Elif(self.idle):
-					send(self.idle_symbol, self.idle_symbol, self.idle_symbol, self.idle_symbol)
+					send(*[self.idle_symbol] * ratio)
 
 				# Otherwise go to electrical idle, if told so
 				#with m.Else():
 				#	m.d.comb += lane.tx_e_idle.eq(self.eidle)
 
-			ts_symbol = Mux(ts.ts_id, D(5, 2), D(10, 2))
-
-			with m.State("TSn-DATA"):
-				send(ts.rate, ts.ctrl, ts_symbol, ts_symbol)
-				m.next = "TSn-ID0"
-
-			with m.State("TSn-ID0"):
-				send(ts_symbol, ts_symbol, ts_symbol, ts_symbol)
-				m.next = "TSn-ID1"
-
-			with m.State("TSn-ID1"):
-				send(ts_symbol, ts_symbol, ts_symbol, ts_symbol)
-				m.next = "IDLE"
+			for i in range(1, len(ts_words)):
+				with m.State(f"TSn-{i}"):
+					send(*ts_words[i])
+					m.next = f"TSn-{i + 1}" if i + 1 < len(ts_words) else "IDLE"
 
 		return m
\ No newline at end of file
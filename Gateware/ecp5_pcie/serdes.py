@@ -3,6 +3,7 @@ from amaranth.build import *
 from amaranth.hdl.ast import Part
 from amaranth.lib.fifo import AsyncFIFOBuffered
 from amaranth.lib.cdc import FFSynchronizer
+from amaranth.lib.coding import GrayEncoder, GrayDecoder
 
 from enum import IntEnum
 
@@ -10,7 +11,7 @@ from .align import SymbolSlip
 from .lfsr import PCIeLFSR
 
 
-__all__ = ["PCIeSERDESInterface", "PCIeSERDESAligner", "PCIeScrambler"]
+__all__ = ["PCIeSERDESInterface", "PCIeElasticBuffer", "PCIeSERDESAligner", "PCIeSERDESDeskew", "PCIeScrambler"]
 
 
 def K(x, y):
@@ -38,6 +39,14 @@ def compose(symbols: list[int], symbol_size : int = 9):
 	
 	return result
 
+def lane_symbols(symbols, lanes : int, lane : int, symbol_size : int = 9):
+	"""
+	Returns the symbols of one lane out of symbols striped across lanes, symbol i is on lane i % lanes.
+	The result is assignable if symbols is.
+	"""
+	assert len(symbols) % (symbol_size * lanes) == 0
+	return Cat(symbols.word_select(i, symbol_size) for i in range(lane, len(symbols) // symbol_size, lanes))
+
 
 
 class Ctrl(IntEnum):
@@ -81,8 +90,11 @@ class PCIeSERDESInterface(Elaboratable): # From Yumewatari
 	----------
 	ratio : int
 		Gearbox ratio.
+	lanes : int
+		Number of bonded lanes. Symbols are striped across lanes, symbol i is on lane i % lanes, so each lane
+		transmits ratio / lanes symbols per clock cycle.
 
-	rx_invert : Signal
+	rx_invert : Signal(lanes)
 		Assert to invert the received bits before 8b10b decoder.
 	rx_align : Signal
 		Assert to enable comma alignment state machine, deassert to lock alignment.
@@ -113,6 +125,9 @@ class PCIeSERDESInterface(Elaboratable): # From Yumewatari
 		running disparity.
 	tx_e_idle : Signal(ratio)
 		Assert to transmit Electrical Idle for that symbol.
+	tx_skp_request : Signal
+		Asserted by an elastic buffer in the transmit path to request an additional SKP ordered set right after the
+		next scheduled one, which it removes again.
 
 	det_enable : Signal
 		Rising edge starts the Receiver Detection test. Transmitter must be in Electrical Idle
@@ -129,10 +144,12 @@ class PCIeSERDESInterface(Elaboratable): # From Yumewatari
 	speed : Signal()
 		LinkSpeed enum value, indicates current speed
 	"""
-	def __init__(self, ratio=1):
+	def __init__(self, ratio=1, lanes=1):
+		assert ratio % lanes == 0
 		self.ratio        = ratio
+		self.lanes        = lanes
 
-		self.rx_invert    = Signal()
+		self.rx_invert    = Signal(lanes)
 		self.rx_align     = Signal()
 		self.rx_present   = Signal()
 		self.rx_locked    = Signal()
@@ -159,6 +176,7 @@ class PCIeSERDESInterface(Elaboratable): # From Yumewatari
 		self.tx_disp      = Signal(ratio)
 		self.tx_e_idle    = Signal(ratio)
 		self.tx_locked    = Signal()
+		self.tx_skp_request = Signal()
 
 		self.det_enable   = Signal()
 		self.det_valid    = Signal()
@@ -172,7 +190,7 @@ class PCIeSERDESInterface(Elaboratable): # From Yumewatari
 		self.reset_done   = Signal()
 
 		# Idle signal for when the idle symbol or SKP ordered sets are received
-		self.idle = (self.rx_symbol == 0) | (self.rx_symbol == compose([Ctrl.COM, Ctrl.SKP, Ctrl.SKP, Ctrl.SKP]))
+		self.idle = (self.rx_symbol == 0) | (self.rx_symbol == compose([symbol for symbol in [Ctrl.COM, Ctrl.SKP, Ctrl.SKP, Ctrl.SKP] for _ in range(lanes)]))
 
 		self.state = [
 			self.speed
@@ -193,13 +211,171 @@ class PCIeSERDESInterface(Elaboratable): # From Yumewatari
 		return m
 
 
+class PCIeElasticBuffer(Elaboratable):
+	"""
+	Elastic buffer for transmitted words, from the "rx" domain to the "tx" domain, which compensates a frequency offset
+	between the clocks by adding and removing SKP ordered sets, see section 4.2.7 on page 195 in PCIe 1.1. The "rx" domain
+	runs on the recovered clock, so with a separate reference clock it is up to 600 ppm off the transmit clock.
+
+	The occupancy is kept between depth / 4 and 3 * depth / 4 words. Each side sees the pointer of the other side a few
+	cycles late, which the margins of depth / 4 cover. Below the range, a SKP word is read twice. Above it, skp_request
+	is asserted to get an additional SKP word after a scheduled one and a SKP word which follows a SKP word isn't written,
+	so the receiver still gets a COM to reset its descrambler on. A SKP word consists of SKP ordered sets only.
+
+	Parameters
+	----------
+	ratio : int
+		Symbols per word, a multiple of 4
+	depth : int
+		Number of words, a power of 2 of at least 16
+	leader : PCIeElasticBuffer
+		Buffer whose writes and reads are followed, for the other lanes of a link, such that all lanes add and remove the
+		same words. It needs to be written and read in the same cycles.
+
+	w_data : Signal(12 * ratio)
+		Cat(tx_symbol, tx_set_disp, tx_disp, tx_e_idle) to write, a word is written every cycle
+	w_en : Signal()
+		Asserted if w_data is written, deasserted if it is removed
+	w_level : Signal(range(depth + 1))
+		Occupancy as seen by the write side
+	skp_request : Signal()
+		Asserted to request an additional SKP ordered set
+
+	r_data : Signal(12 * ratio)
+		Word read, registered in the "tx" domain
+	r_en : Signal()
+		Asserted if the read pointer advances, deasserted while the buffer fills after reset and if a SKP word is repeated
+	r_level : Signal(range(depth + 1))
+		Occupancy as seen by the read side
+	"""
+	def __init__(self, ratio : int, depth : int = 16, leader = None):
+		assert ratio % 4 == 0
+		assert depth >= 16 and depth & (depth - 1) == 0
+		self.ratio = ratio
+		self.depth = depth
+		self.leader = leader
+
+		self.w_data = Signal(12 * ratio)
+		self.w_en = Signal()
+		self.w_level = Signal(range(depth + 1))
+		self.skp_request = Signal()
+
+		self.r_data = Signal(12 * ratio)
+		self.r_en = Signal()
+		self.r_level = Signal(range(depth + 1))
+
+	def elaborate(self, platform: Platform) -> Module:
+		m = Module()
+
+		ratio = self.ratio
+		depth = self.depth
+		bits = depth.bit_length()
+
+		def is_skp(data):
+			return data[:9 * ratio] == compose([Ctrl.COM, Ctrl.SKP, Ctrl.SKP, Ctrl.SKP] * (ratio // 4))
+
+		storage = Memory(width=12 * ratio, depth=depth)
+		w_port = m.submodules.w_port = storage.write_port(domain="rx")
+		r_port = m.submodules.r_port = storage.read_port(domain="comb")
+
+		# Pointers are exchanged in Gray code
+		w_ptr = Signal(bits)
+		r_ptr = Signal(bits)
+		w_ptr_gray = Signal(bits)
+		r_ptr_gray = Signal(bits)
+
+		m.submodules.w_encoder = w_encoder = GrayEncoder(bits)
+		m.submodules.r_encoder = r_encoder = GrayEncoder(bits)
+		m.d.comb += w_encoder.i.eq(w_ptr + self.w_en)
+		m.d.comb += r_encoder.i.eq(r_ptr + self.r_en)
+		m.d.rx += w_ptr_gray.eq(w_encoder.o)
+		m.d.tx += r_ptr_gray.eq(r_encoder.o)
+
+		w_ptr_tx = Signal(bits)
+		r_ptr_rx = Signal(bits)
+		m.submodules.w_decoder = w_decoder = GrayDecoder(bits)
+		m.submodules.r_decoder = r_decoder = GrayDecoder(bits)
+		m.submodules.w_ptr_sync = FFSynchronizer(w_ptr_gray, w_decoder.i, o_domain="tx")
+		m.submodules.r_ptr_sync = FFSynchronizer(r_ptr_gray, r_decoder.i, o_domain="rx")
+		m.d.comb += w_ptr_tx.eq(w_decoder.o)
+		m.d.comb += r_ptr_rx.eq(r_decoder.o)
+
+		m.d.comb += self.w_level.eq((w_ptr - r_ptr_rx)[:bits])
+		m.d.comb += self.r_level.eq((w_ptr_tx - r_ptr)[:bits])
+
+		# Write side
+		m.d.comb += [
+			w_port.addr.eq(w_ptr[:bits - 1]),
+			w_port.data.eq(self.w_data),
+			w_port.en.eq(self.w_en),
+		]
+		m.d.rx += w_ptr.eq(w_ptr + self.w_en)
+
+		# Read side, the output is registered
+		m.d.comb += r_port.addr.eq(r_ptr[:bits - 1])
+		m.d.tx += self.r_data.eq(r_port.data)
+		m.d.tx += r_ptr.eq(r_ptr + self.r_en)
+
+		if self.leader is not None:
+			m.d.comb += self.w_en.eq(self.leader.w_en)
+			m.d.comb += self.r_en.eq(self.leader.r_en)
+
+		else:
+			high = Signal()
+			m.d.comb += high.eq(self.w_level > 3 * depth // 4)
+			m.d.comb += self.skp_request.eq(high)
+
+			last_skp = Signal()
+			m.d.rx += last_skp.eq(is_skp(self.w_data))
+			m.d.comb += self.w_en.eq(~(high & last_skp & is_skp(self.w_data)) & (self.w_level < depth))
+
+			# Reading starts once the buffer is filled to the middle, a SKP word is repeated at most once
+			started = Signal()
+			repeated = Signal()
+			repeat = Signal()
+			with m.If(self.r_level >= depth // 2):
+				m.d.tx += started.eq(1)
+
+			m.d.comb += repeat.eq((self.r_level < depth // 4) & is_skp(r_port.data) & ~repeated)
+			m.d.tx += repeated.eq(started & repeat)
+			m.d.comb += self.r_en.eq(started & ~repeat & (self.r_level != 0))
+
+		return m
+
+
 class PCIeSERDESAligner(PCIeSERDESInterface):
 	"""
 	A multiplexer that aligns commas to the first symbol of the word, for SERDESes that only
-	perform bit alignment and not symbol alignment.
+	perform bit alignment and not symbol alignment. Words wider than 4 symbols are aligned to a multiple of
+	4 symbols instead, since ordered sets and packets can start at any multiple of 4 symbols.
+
+	Transmitted words cross from the "rx" domain, which runs on the recovered clock, to the "tx" domain. The clock
+	domain crossing is chosen with cdc:
+
+	- "fifo": An asynchronous FIFO. The "tx" clock needs to have the same frequency as the recovered clock, which is
+	  the case with a common reference clock.
+	- "register": One register in the "tx" domain, the lowest latency. The "tx" clock needs to be phase locked to the
+	  recovered clock, for example the same clock.
+	- "elastic": A PCIeElasticBuffer, which also works with a separate reference clock.
+
+	Parameters
+	----------
+	lane : PCIeSERDESInterface
+		Lane to align
+	cdc : str
+		Clock domain crossing of the transmitted words, "fifo", "register" or "elastic"
+	depth : int
+		Depth of the elastic buffer
+	leader : PCIeSERDESAligner
+		Aligner of lane 0, whose elastic buffer is followed with "elastic"
 	"""
-	def __init__(self, lane : PCIeSERDESInterface):
+	def __init__(self, lane : PCIeSERDESInterface, cdc : str = "fifo", depth : int = 16, leader = None):
+		assert cdc in ["fifo", "register", "elastic"]
 		super().__init__(lane.ratio)
+		self.cdc = cdc
+
+		if cdc == "elastic":
+			self.elastic_buffer = PCIeElasticBuffer(lane.ratio, depth, leader.elastic_buffer if leader is not None else None)
 
 		#self.ratio        = lane.ratio
 #
@@ -236,31 +412,28 @@ class PCIeSERDESAligner(PCIeSERDESInterface):
 	def elaborate(self, platform: Platform) -> Module:
 		m = Module()
 
-		# Do TX CDC
-		# FFSynchronizer
-		if False:
-			m.submodules.tx_ff = FFSynchronizer(Cat(self.tx_symbol, self.tx_set_disp, self.tx_disp, self.tx_e_idle), Cat(self.__lane.tx_symbol, self.__lane.tx_set_disp, self.__lane.tx_disp, self.__lane.tx_e_idle), o_domain="tx", stages=4)
-		
-		# No CDC
-		# TODO: Check if this actually works
-		if False:
-			m.d.comb += Cat(self.__lane.tx_symbol, self.__lane.tx_set_disp, self.__lane.tx_disp, self.__lane.tx_e_idle).eq(
-				Cat(self.tx_symbol, self.tx_set_disp, self.tx_disp, self.tx_e_idle))
-
-		# AsyncFIFOBuffered
-		if True:
+		# TX CDC
+		tx_data = Cat(self.tx_symbol, self.tx_set_disp, self.tx_disp, self.tx_e_idle)
+		lane_tx_data = Cat(self.__lane.tx_symbol, self.__lane.tx_set_disp, self.__lane.tx_disp, self.__lane.tx_e_idle)
+
+		if self.cdc == "fifo":
 			tx_fifo = m.submodules.tx_fifo = AsyncFIFOBuffered(width=self.ratio * 12, depth=8, r_domain="tx", w_domain="rx")
-			m.d.comb += tx_fifo.w_data.eq(Cat(self.tx_symbol, self.tx_set_disp, self.tx_disp, self.tx_e_idle))
-			m.d.comb += Cat(self.__lane.tx_symbol, self.__lane.tx_set_disp, self.__lane.tx_disp, self.__lane.tx_e_idle).eq(tx_fifo.r_data)
+			m.d.comb += tx_fifo.w_data.eq(tx_data)
+			m.d.comb += lane_tx_data.eq(tx_fifo.r_data)
 			m.d.comb += tx_fifo.r_en.eq(1)
 			m.d.comb += tx_fifo.w_en.eq(1)
 
-		# Testing symbols
-		if False:
-			m.d.comb += self.__lane.tx_symbol.eq(Cat(Ctrl.COM, D(10, 2)))
+		elif self.cdc == "register":
+			m.d.tx += lane_tx_data.eq(tx_data)
+
+		elif self.cdc == "elastic":
+			elastic_buffer = m.submodules.elastic_buffer = self.elastic_buffer
+			m.d.comb += elastic_buffer.w_data.eq(tx_data)
+			m.d.comb += lane_tx_data.eq(elastic_buffer.r_data)
+			m.d.comb += self.tx_skp_request.eq(elastic_buffer.skp_request)
 
 
-		self.slip = SymbolSlip(symbol_size=10, word_size=self.__lane.ratio, comma=Cat(Const(Ctrl.COM, 9), 1))
+		self.slip = SymbolSlip(symbol_size=10, word_size=self.__lane.ratio, comma=Cat(Const(Ctrl.COM, 9), 1), alignment=min(self.__lane.ratio, 4))
 		m.submodules.slip = self.slip
 
 		m.d.comb += self.debug.eq(self.slip.debug)
@@ -283,12 +456,187 @@ class PCIeSERDESAligner(PCIeSERDESInterface):
 		return m
 
 
+class PCIeSERDESDeskew(PCIeSERDESInterface):
+	"""
+	Bonds several aligned lanes into one wide lane and removes the skew between them. Symbols are striped across
+	the lanes, symbol i of the wide lane is on lane i % lanes.
+
+	While enabled, the arrival times of COM symbols on all lanes are compared and every lane is delayed such that
+	the COM symbols leave the deskew buffer at the same position. Needs to be after the aligners, which place
+	COM symbols at a multiple of 4 symbols. Skew is compensated in steps of 4 symbols.
+
+	Parameters
+	----------
+	lanes : [PCIeSERDESInterface]
+		Aligned lanes, lane 0 first
+	max_skew : int
+		Maximum compensated skew in clock cycles
+	enable : Signal()
+		Assert to update the lane delays from received ordered sets, deassert to lock them
+	deskewed : Signal()
+		Asserted when COM symbols arrived on all lanes within max_skew cycles of each other
+	"""
+	def __init__(self, lanes : list, max_skew = 2):
+		gearing = lanes[0].ratio
+		assert all(lane.ratio == gearing and lane.lanes == 1 for lane in lanes)
+		super().__init__(gearing * len(lanes), len(lanes))
+
+		self.frequency    = lanes[0].frequency
+		self.speed        = lanes[0].speed
+		self.use_speed    = lanes[0].use_speed
+
+		self.enable       = Signal(reset=1)
+		self.deskewed     = Signal()
+		self.max_skew     = max_skew
+
+		self.__lanes = lanes
+
+	def elaborate(self, platform: Platform) -> Module:
+		m = Module()
+
+		lanes = self.__lanes
+		count = len(lanes)
+		gearing = lanes[0].ratio
+		max_skew = self.max_skew
+
+		# Control and status signals are shared by all lanes
+		for i, lane in enumerate(lanes):
+			m.d.comb += [
+				lane.rx_invert.eq(self.rx_invert[i]),
+				lane.rx_align.eq(self.rx_align),
+				lane.det_enable.eq(self.det_enable),
+				lane.reset.eq(self.reset),
+			]
+
+		m.d.comb += [
+			self.rx_present.eq(Cat(lane.rx_present for lane in lanes).all()),
+			self.rx_locked.eq(Cat(lane.rx_locked for lane in lanes).all()),
+			self.rx_aligned.eq(Cat(lane.rx_aligned for lane in lanes).all()),
+			self.tx_locked.eq(Cat(lane.tx_locked for lane in lanes).all()),
+			self.det_valid.eq(Cat(lane.det_valid for lane in lanes).all()),
+			self.det_status.eq(Cat(lane.det_status for lane in lanes).all()),
+			self.reset_done.eq(Cat(lane.reset_done for lane in lanes).all()),
+			self.tx_skp_request.eq(lanes[0].tx_skp_request),
+		]
+
+		# Stripe the transmitted symbols across the lanes
+		for i, lane in enumerate(lanes):
+			m.d.comb += [
+				lane.tx_symbol.eq(lane_symbols(self.tx_symbol, count, i)),
+				lane.tx_set_disp.eq(lane_symbols(self.tx_set_disp, count, i, 1)),
+				lane.tx_disp.eq(lane_symbols(self.tx_disp, count, i, 1)),
+				lane.tx_e_idle.eq(lane_symbols(self.tx_e_idle, count, i, 1)),
+			]
+
+		# Lanes are delayed in units of 4 symbols, since ordered sets start at a multiple of 4 symbols.
+		# With 1:4 gearing this is one word per unit.
+		unit = min(gearing, 4)
+		units = gearing // unit
+		max_delay = max_skew * units + units - 1
+
+		# Delay line for every lane, index 0 is the current input
+		delays = [Signal(range(max_delay + 1), name=f"delay_{i}") for i in range(count)]
+		history = []
+		for i, lane in enumerate(lanes):
+			words = [Cat(lane.rx_symbol, lane.rx_valid)]
+			for j in range((max_delay * unit + gearing - 1) // gearing):
+				word = Signal(len(words[0]), name=f"history_{i}_{j}")
+				m.d.rx += word.eq(words[-1])
+				words.append(word)
+			# Oldest symbol first
+			symbols = [word[:9 * gearing].word_select(k, 9) for word in reversed(words) for k in range(gearing)]
+			valid = [word[9 * gearing + k] for word in reversed(words) for k in range(gearing)]
+			history.append((symbols, valid))
+
+		for i in range(count):
+			symbols, valid = history[i]
+			word = Signal(10 * gearing, name=f"deskewed_{i}")
+			with m.Switch(delays[i]):
+				for j in range(max_delay + 1):
+					end = len(symbols) - j * unit
+					with m.Case(j):
+						m.d.rx += word.eq(Cat(*symbols[end - gearing : end], *valid[end - gearing : end]))
+
+			m.d.comb += [
+				lane_symbols(self.rx_symbol, count, i).eq(word[:9 * gearing]),
+				lane_symbols(self.rx_valid, count, i, 1).eq(word[9 * gearing:]),
+			]
+
+		# Measure when COM symbols arrive on each lane. The measurement window opens with the first COM and closes
+		# after max_skew cycles, lanes which received a COM later get less delay.
+		com = Cat((Cat(lane.rx_symbol.word_select(k * unit, 9) == Ctrl.COM for k in range(units))).any() for lane in lanes)
+		window = Signal(range(max_skew + 1))
+		window_open = Signal()
+		seen = Signal(count)
+		arrival = [Signal(range(max_delay + 1), name=f"arrival_{i}") for i in range(count)]
+
+		# Arrival time in units, the first COM of the word counts
+		arrival_now = []
+		for i, lane in enumerate(lanes):
+			position = Signal(range(units), name=f"com_position_{i}")
+			for k in reversed(range(units)):
+				with m.If(lane.rx_symbol.word_select(k * unit, 9) == Ctrl.COM):
+					m.d.comb += position.eq(k)
+			time = Signal(range(max_delay + 1), name=f"arrival_now_{i}")
+			m.d.comb += time.eq(Mux(window_open, window * units, 0) + position)
+			arrival_now.append(Mux(window_open & seen[i], arrival[i], time))
+
+		latest = arrival_now[0]
+		for time in arrival_now[1:]:
+			latest = Mux(time > latest, time, latest)
+
+		with m.If(~window_open):
+			with m.If(self.enable & com.any()):
+				m.d.rx += window_open.eq(1)
+				m.d.rx += window.eq(1)
+				m.d.rx += seen.eq(com)
+				for i in range(count):
+					m.d.rx += arrival[i].eq(arrival_now[i])
+
+				with m.If(com.all()):
+					m.d.rx += window_open.eq(0)
+					m.d.rx += self.deskewed.eq(1)
+					for i in range(count):
+						m.d.rx += delays[i].eq(latest - arrival_now[i])
+
+		with m.Else():
+			m.d.rx += window.eq(window + 1)
+			m.d.rx += seen.eq(seen | com)
+			for i in range(count):
+				with m.If(com[i] & ~seen[i]):
+					m.d.rx += arrival[i].eq(arrival_now[i])
+
+			with m.If((seen | com).all()):
+				m.d.rx += window_open.eq(0)
+				m.d.rx += self.deskewed.eq(1)
+				for i in range(count):
+					m.d.rx += delays[i].eq(latest - arrival_now[i])
+
+			with m.Elif(window == max_skew):
+				m.d.rx += window_open.eq(0)
+				m.d.rx += self.deskewed.eq(0)
+
+		return m
+
+
 class PCIeScrambler(PCIeSERDESInterface):
 	"""
-	Scrambler and Descrambler for PCIe, needs to be after an aligner
+	Scrambler and Descrambler for PCIe, needs to be after an aligner. Every lane has its own LFSR, which is reset after
+	a COM and not advanced by a SKP, see section 4.2.3 on page 188 in PCIe 1.1. Only data symbols are scrambled.
+
+	Parameters
+	----------
+	lane : PCIeSERDESInterface
+		Lane to scramble and descramble
+	pipeline : bool
+		Adds a register stage in front of the LFSRs in both directions, for wide words at high clock frequencies. It
+		adds one cycle of latency, enable is delayed with the symbols.
+
+	enable : Signal()
+		Assert to scramble and descramble data symbols
 	"""
-	def __init__(self, lane : PCIeSERDESInterface):#, enable : Signal):
-		super().__init__(lane.ratio)
+	def __init__(self, lane : PCIeSERDESInterface, pipeline : bool = False):#, enable : Signal):
+		super().__init__(lane.ratio, lane.lanes)
 		#self.ratio        = lane.ratio
 #
 		self.rx_invert    = lane.rx_invert
@@ -311,6 +659,7 @@ class PCIeScrambler(PCIeSERDESInterface):
 		self.det_status   = lane.det_status
 #
 		self.enable        = Signal()
+		self.pipeline      = pipeline
 #
 		self.frequency    = lane.frequency
 		self.speed        = lane.speed
@@ -324,72 +673,42 @@ class PCIeScrambler(PCIeSERDESInterface):
 	def elaborate(self, platform: Platform) -> Module:
 		m = Module()
 
-		# Scramble transmitted and received data, skip on SKP, reset on COM
-		# TODO: Add case for when only one SKP character is received
-
-		def scramble(input, output, enable):
-			lfsr = PCIeLFSR(self.ratio, input[0:9] == Ctrl.COM, input[9:18] != Ctrl.SKP)
-			m.submodules += lfsr 
-			with m.If(enable & (input[8] == 0)):
-				m.d.rx += output[0:9].eq(lfsr.output[0:9] ^ input[0:9])
-
-			with m.Else():
-				m.d.rx += output[0:9].eq(input[0:9])
-				
-				
-			with m.If(enable & (input[17] == 0)):
-				with m.If(input[0:9] == Ctrl.COM): # TODO: This is a hack. Please fix.
-					m.d.rx += output[9:18].eq(0xFF ^ input[9:18])
-
-				with m.Else():
-					m.d.rx += output[9:18].eq(lfsr.output[9:18] ^ input[9:18])
-
-				if (self.ratio > 2):
-					for i in range(2, self.ratio):
-						m.d.rx += output[9 * i : 9 * i + 9].eq(Mux(input[9 * i : 9 * i + 9][8], 0, lfsr.output[9 * i : 9 * i + 9]) ^ input[9 * i : 9 * i + 9])
-
-			with m.Else():
-				for i in range(1, self.ratio):
-					m.d.rx += output[9 * i : 9 * i + 9].eq(input[9 * i : 9 * i + 9])
-			
+		def delay(value, name):
+			"""
+			Delays value by the pipeline stage
+			"""
+			if not self.pipeline:
+				return value
+			delayed = Signal.like(value, name=name)
+			m.d.rx += delayed.eq(value)
+			return delayed
 
-		#with m.If(self.enable & (self.__lane.rx_symbol[8] == 0)):
-		#    with m.If(self.__lane.rx_symbol[0:9] == Ctrl.COM):
-		#        m.d.rx += self.rx_symbol.eq(0x1FE00 ^ self.__lane.rx_symbol)
-		#    with m.Else():
-		#        m.d.rx += self.rx_symbol.eq(rx_lfsr.output ^ self.__lane.rx_symbol)
-		#with m.Else():
-		#    m.d.rx += self.rx_symbol.eq(self.__lane.rx_symbol)
+		enable = delay(self.enable, "enable_delayed")
 
-		scramble(self.__lane.rx_symbol, self.rx_symbol, self.enable)
-		scramble(self.tx_symbol, self.__lane.tx_symbol, self.enable)
+		# Scramble transmitted and received data, skip on SKP, reset on COM
+		def scramble(input, output, name):
+			ratio = len(input) // 9
+			symbols = [input.word_select(i, 9) for i in range(ratio)]
+			lfsr = PCIeLFSR(ratio, Cat(symbol == Ctrl.COM for symbol in symbols), Cat(symbol != Ctrl.SKP for symbol in symbols), self.pipeline)
+			m.submodules[f"{name}_lfsr"] = lfsr
+
+			# Only data symbols are scrambled
+			symbols = [delay(symbol, f"{name}_symbol_{i}") for i, symbol in enumerate(symbols)]
+			for i in range(ratio):
+				with m.If(enable & (symbols[i][8] == 0)):
+					m.d.rx += output.word_select(i, 9).eq(lfsr.output.word_select(i, 9) ^ symbols[i])
 
-		i1 = Signal(len(self.__lane.rx_symbol)) # TODO: This is for debug, remove
-		o1 = Signal(len(self.rx_symbol))
-		i2 = Signal(len(self.tx_symbol))
-		o2 = Signal(len(self.__lane.tx_symbol))
+				with m.Else():
+					m.d.rx += output.word_select(i, 9).eq(symbols[i])
 
-		m.d.rx += i1.eq(self.__lane.rx_symbol)
-		m.d.rx += o1.eq(self.rx_symbol)
-		m.d.rx += i2.eq(self.tx_symbol)
-		m.d.rx += o2.eq(self.__lane.tx_symbol)
+		for lane in range(self.lanes):
+			scramble(lane_symbols(self.__lane.rx_symbol, self.lanes, lane), lane_symbols(self.rx_symbol, self.lanes, lane), f"rx_{lane}")
+			scramble(lane_symbols(self.tx_symbol, self.lanes, lane), lane_symbols(self.__lane.tx_symbol, self.lanes, lane), f"tx_{lane}")
 
 		# This is necessary because the scrambling already takes one clock cycle
-		m.d.rx += self.rx_valid.eq(self.__lane.rx_valid)
-
-		#with m.If(self.enable & (self.tx_symbol[8] == 0)):
-		#    with m.If(self.tx_symbol[0:9] == Ctrl.COM):
-		#        m.d.rx += self.__lane.tx_symbol.eq(0x1FE00 ^ self.tx_symbol)
-		#    with m.Else():
-		#        m.d.rx += self.__lane.tx_symbol.eq(tx_lfsr.output ^ self.tx_symbol)
-		#with m.Else():
-		#    m.d.rx += self.__lane.tx_symbol.eq(self.tx_symbol)
+		m.d.rx += self.rx_valid.eq(delay(self.__lane.rx_valid, "rx_valid_delayed"))
 
-		m.d.rx += self.__lane.tx_set_disp.eq(self.tx_set_disp)
-		m.d.rx += self.__lane.tx_disp    .eq(self.tx_disp)
-		#m.d.rx += self.__lane.tx_e_idle  .eq(self.tx_e_idle)
+		m.d.rx += self.__lane.tx_set_disp.eq(delay(self.tx_set_disp, "tx_set_disp_delayed"))
+		m.d.rx += self.__lane.tx_disp    .eq(delay(self.tx_disp, "tx_disp_delayed"))
 
-		#m.d.comb += self.__lane.reset.eq(self.reset)
-		#m.d.comb += self.reset_done.eq(self.__lane.reset_done)
-
-		return m
\ No newline at end of file
+		return m
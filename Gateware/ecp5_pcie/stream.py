@@ -18,6 +18,10 @@ class StreamInterface(): # From Yumewatari
         Asserted if the symbol is valid and should be processed.
     ready : Signal()
         Asserted when the receiver is ready´
+    first : Signal()
+        Asserted on the first word of a packet, for streams carrying TLPs
+    last : Signal()
+        Asserted on the last word of a packet, for streams carrying TLPs
     """
     def __init__(self, symbol_size, word_size, name="", decode_9b_symbols=True):
         def stream_decoder(value : int):
@@ -41,6 +45,8 @@ class StreamInterface(): # From Yumewatari
 
         self.all_valid = sigs
         self.ready = Signal(name=f"{name}_ready")
+        self.first = Signal(name=f"{name}_first")
+        self.last = Signal(name=f"{name}_last")
     
     """
     Connects a source to a sink.
@@ -60,6 +66,8 @@ class StreamInterface(): # From Yumewatari
             domain += sink.symbol[i].eq(self.symbol[i])
             domain += sink.valid[i].eq(self.valid[i])
 
+        domain += sink.first.eq(self.first)
+        domain += sink.last.eq(self.last)
         domain += self.ready.eq(sink.ready)
 
         #domain += self.debug.eq(Cat(self.symbol, self.valid)) TODO: This doesn't show up in GTKWave
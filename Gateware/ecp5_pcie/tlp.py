@@ -1,8 +1,12 @@
 from amaranth import *
 from amaranth.build import *
+from amaranth.lib.fifo import SyncFIFOBuffered
 from enum import IntEnum
 import math
 from .stream import StreamInterface
+from .tlp_dispatch import TLPCategory, TLPDispatcher, UnsupportedRequestCompleter
+from .tlp_arbiter import TLPTransmitArbiter
+from .flow_control import FCClass
 
 class TLPType(IntEnum): # PCIe Base 1.1 Page 49
 	# Value equals to Cat(type, fmt)
@@ -80,10 +84,11 @@ class MemoryIORequest(TLPBase):
 			self.first_dw_be.eq(data[7][0:4]),
 		]
 
+		# The address is big endian, its lowest 2 bits are reserved
 		with m.If(self.fmt[0]):
-			m.d.comb += self.address[2:].eq(Cat(data[8:16][::-1]))
+			m.d.comb += self.address[2:].eq(Cat(data[8:16][::-1])[2:])
 		with m.Else():
-			m.d.comb += self.address[2:].eq(Cat(data[8:12][::-1]))
+			m.d.comb += self.address[2:].eq(Cat(data[8:12][::-1])[2:])
 
 		return m
 
@@ -217,8 +222,8 @@ class ConfigurationCompletion(TLPBase):
 
 			self.length[0:8],
 
+			self.completer_id[8:16], # Bus number first
 			self.completer_id[0:8],
-			self.completer_id[8:16],
 
 			self.byte_count[8:12],
 			self.bcm,
@@ -245,7 +250,8 @@ class ConfigurationCompletion(TLPBase):
 
 class ConfigurationMemory(Elaboratable):
 	"""
-	Configuration memory
+	Configuration space, read only fields are decoded from the init values and writable fields are kept in registers, everything else
+	reads as zero. A request is completed in the cycle after new_request.
 	
 	Parameters
 	----------
@@ -256,90 +262,173 @@ class ConfigurationMemory(Elaboratable):
 		Configuration Request to take data from
 
 	new_request : Signal
-		Toggle to process configuration request
+		Set to 1 for 1 cycle to process the configuration request
 
 	ratio : int
 		Gearbox ratio
+
+	bar_sizes : [int]
+		Size of every implemented BAR in bytes, a power of 2 and at least 128 bytes. The other BARs are read only zero.
+
+	command : Value(16)
+		Command register
+	device_control : Value(16)
+		Device Control register in the PCI Express capability
+	link_control : Value(16)
+		Link Control register in the PCI Express capability
+	bars : [Signal(32)]
+		Base address registers
+	msi_control : Value(16)
+		MSI Message Control register, None if there is no MSI capability
+	msi_address : Value(64)
+		MSI Message Address and Message Upper Address registers
+	msi_data : Value(16)
+		MSI Message Data register
+	msi_mask : Signal(32)
+		MSI Mask Bits register
+	msi_pending : Signal(32)
+		MSI Pending Bits register, an input
+	msix_control : Value(16)
+		MSI-X Message Control register, None if there is no MSI-X capability
 	"""
-	def __init__(self, init: list[int], configuration_request: ConfigurationRequest, new_request: Signal, ratio = 4):
+	# The PCI Express capability is the first one, see make_init
+	DEVICE_CONTROL = 0x48
+	LINK_CONTROL = 0x50
+
+	def __init__(self, init: list[int], configuration_request: ConfigurationRequest, new_request: Signal, ratio = 4, bar_sizes: list[int] = []):
 		self.ratio = ratio
-		assert 4096 // ratio == 4096 / ratio # Ratio needs to be 2 ** n
-		assert ratio >= 4 # And at least 4
+		assert len(bar_sizes) <= 6
+		for size in bar_sizes:
+			assert size >= 128 and size & (size - 1) == 0
 		self.init = init
+		self.bar_sizes = bar_sizes
 		self.configuration_request = configuration_request
 		self.configuration_completion = ConfigurationCompletion()
 		self.new_request = new_request
 		self.done = Signal() # Is high for 1 cycle
 
-	def elaborate(self, platform: Platform) -> Module:
-		m = Module()
+		# Writable bits of every DW with writable fields, status bits which are cleared by writing 1 aren't implemented
+		self.write_masks = {
+			0x04: 0x00000547, # Command: I/O Space, Memory Space, Bus Master, Parity Error Response, SERR# and Interrupt Disable
+			0x0C: 0x000000FF, # Cache Line Size
+			0x3C: 0x000000FF, # Interrupt Line
+			self.DEVICE_CONTROL: 0x00007FFF,
+			self.LINK_CONTROL: 0x000000CB, # ASPM Control, Read Completion Boundary, Common Clock Configuration and Extended Synch
+		}
+		# Bits of a BAR below its size are read only zero, so the size can be read back after writing all ones to it
+		for i, size in enumerate(bar_sizes):
+			self.write_masks[0x10 + 4 * i] = ~(size - 1) & 0xFFFFFFFF
+
+		def init_value(address, size):
+			return int.from_bytes(bytes(init[address : address + size]), byteorder = "little")
+
+		self.msi_offset = self.find_capability(init, 0x05)
+		self.msix_offset = self.find_capability(init, 0x11)
+
+		if self.msi_offset is not None:
+			msi_vectors = 1 << ((init_value(self.msi_offset + 2, 2) >> 1) & 0b111) # Multiple Message Capable
+			self.write_masks[self.msi_offset] = 0x00710000 # MSI Enable and Multiple Message Enable
+			self.write_masks[self.msi_offset + 0x04] = 0xFFFFFFFC # Message Address
+			self.write_masks[self.msi_offset + 0x08] = 0xFFFFFFFF # Message Upper Address
+			self.write_masks[self.msi_offset + 0x0C] = 0x0000FFFF # Message Data
+			self.write_masks[self.msi_offset + 0x10] = (1 << msi_vectors) - 1 # Mask Bits
+
+		if self.msix_offset is not None:
+			self.write_masks[self.msix_offset] = 0xC0000000 # Function Mask and MSI-X Enable
+
+		self.registers = {address: Signal(32, name = f"Configuration_{address:03X}", reset = init_value(address, 4)) for address in self.write_masks}
+		"""DWs with writable fields by address"""
+
+		self.command = self.registers[0x04][0:16]
+		self.device_control = self.registers[self.DEVICE_CONTROL][0:16]
+		self.link_control = self.registers[self.LINK_CONTROL][0:16]
+		self.bars = [self.registers[0x10 + 4 * i] for i in range(len(bar_sizes))]
+
+		if self.msi_offset is not None:
+			self.msi_control = self.registers[self.msi_offset][16:32]
+			self.msi_address = Cat(self.registers[self.msi_offset + 0x04], self.registers[self.msi_offset + 0x08])
+			self.msi_data = self.registers[self.msi_offset + 0x0C][0:16]
+			self.msi_mask = self.registers[self.msi_offset + 0x10]
+			self.msi_pending = Signal(32)
+		else:
+			self.msi_control = self.msi_address = self.msi_data = self.msi_mask = self.msi_pending = None
+
+		self.msix_control = self.registers[self.msix_offset][16:32] if self.msix_offset is not None else None
 
-		ratio = self.ratio
+	@staticmethod
+	def find_capability(init: list[int], capability_id: int):
+		"""
+		Offset of a capability in the capability list of init values, None if it isn't in the list
+		"""
+		pointer = init[0x34]
+		while pointer != 0:
+			if init[pointer] == capability_id:
+				return pointer
+			pointer = init[pointer + 1]
+		return None
 
-		memory_init = [int.from_bytes(self.init[i : i + ratio], byteorder = "little") for i in range(0, len(self.init), self.ratio)]
-		assert len(memory_init) == len(self.init) / ratio
+	def elaborate(self, platform: Platform) -> Module:
+		m = Module()
 
-		# TODO: Considering that always 4 bytes are processed having a variable width memory is nonsense
-		memory = Memory(width = 8 * self.ratio, depth = 4096 // self.ratio, init = memory_init, name = "Configuration_Memory")
-		m.submodules.read_port = read_port = memory.read_port(domain = "rx", transparent = False)
-		m.submodules.write_port = write_port = memory.write_port(domain = "rx", granularity = 8)
 		m.submodules.configuration_completion = self.configuration_completion
 
-		m.d.rx += read_port.en.eq(1)
-		m.d.rx += write_port.en.eq(0)
+		request = self.configuration_request
+		completion = self.configuration_completion
+
+		# DWs with read only fields which aren't zero
+		rom = {}
+		for address in range(0, len(self.init), 4):
+			value = int.from_bytes(bytes(self.init[address : address + 4]), byteorder = "little")
+			if value != 0 and address not in self.registers:
+				rom[address] = value
+
+		read_data = Signal(32)
+		with m.Switch(request.register):
+			for address, value in rom.items():
+				with m.Case(address // 4):
+					m.d.comb += read_data.eq(value)
+			for address, register in self.registers.items():
+				with m.Case(address // 4):
+					m.d.comb += read_data.eq(register)
+			if self.msi_pending is not None:
+				with m.Case((self.msi_offset + 0x14) // 4):
+					m.d.comb += read_data.eq(self.msi_pending)
+
 		m.d.rx += self.done.eq(0)
 
-		# TODO: Make an LTSSM which processes any pending TLPs and refreshes status registers as required
-		debug_tlp = Signal()
-		tlp_type = Signal(len(self.configuration_request.tlp_type))
-		tlp_type2 = Signal(len(self.configuration_request.tlp_type))
-		with m.FSM(name = "Configuration_FSM", domain = "rx"):
-			with m.State("Idle"):
-				with m.If(self.new_request):
-					m.d.comb += read_port.addr.eq(self.configuration_request.register.shift_right(self.ratio // 4 - 1))
-					m.next = "Process"
-			
-			with m.State("Process"):
-				m.d.comb += tlp_type.eq(self.configuration_request.tlp_type)
-				m.d.comb += tlp_type2.eq(TLPType.CfgRd0)
-				with m.If(self.configuration_request.tlp_type == TLPType.CfgRd0):
-					m.d.comb += debug_tlp.eq(1)
-					m.d.rx += [ # TODO: Is this the right amount of delay?
-						self.configuration_completion.configuration_data[i].eq(
-							read_port.data.word_select(i | (self.configuration_request.register & int(math.log2(ratio // 4))).shift_left(2), 8)
-							)
-						for i in range(4)]
-					
-					m.d.rx += [
-						self.configuration_completion.completer_id.eq(self.configuration_request.completer_id),
-						self.configuration_completion.requester_id.eq(self.configuration_request.requester_id),
-						self.configuration_completion.tag.eq(self.configuration_request.tag),
-						self.configuration_completion.byte_count.eq(4), # TODO: Eh, this might cause errors when byte enables are set
-						self.configuration_completion.tlp_type.eq(TLPType.CplD),
-						self.configuration_completion.length.eq(self.configuration_request.first_dw_be.any()),
-					]
+		with m.If(self.new_request):
+			m.d.rx += [
+				completion.completer_id.eq(request.completer_id),
+				completion.requester_id.eq(request.requester_id),
+				completion.tag.eq(request.tag),
+				completion.byte_count.eq(4), # Always 4 for configuration requests, see section 2.2.9 in PCIe 1.1
+			]
 
-				with m.Elif(self.configuration_request.tlp_type == TLPType.CfgWr0):
-					m.d.rx += write_port.addr.eq(self.configuration_request.register.shift_right(self.ratio // 4 - 1))
-					m.d.rx += write_port.en.eq(self.configuration_request.first_dw_be | (self.configuration_request.register & int(math.log2(ratio // 4))).shift_left(2))
-					m.d.rx += write_port.data.eq(Repl(Cat(self.configuration_request.configuration_data), self.ratio // 4))
-					
-					m.d.rx += [
-						self.configuration_completion.completer_id.eq(self.configuration_request.completer_id),
-						self.configuration_completion.requester_id.eq(self.configuration_request.requester_id),
-						self.configuration_completion.tag.eq(self.configuration_request.tag),
-						self.configuration_completion.byte_count.eq(4),
-						self.configuration_completion.tlp_type.eq(TLPType.Cpl),
-						self.configuration_completion.length.eq(0),
-					]
-				
-				m.d.rx += self.done.eq(1)
-				m.next = "Idle"
+			# Bytes which aren't enabled read as zero, a read without enabled bytes is completed with 1 DW as well
+			with m.If(request.tlp_type == TLPType.CfgRd0):
+				m.d.rx += [completion.configuration_data[i].eq(Mux(request.first_dw_be[i], read_data.word_select(i, 8), 0)) for i in range(4)]
+				m.d.rx += completion.tlp_type.eq(TLPType.CplD)
+				m.d.rx += completion.length.eq(1)
+
+			with m.Elif(request.tlp_type == TLPType.CfgWr0):
+				write_data = Cat(request.configuration_data)
+				for address, register in self.registers.items():
+					mask = self.write_masks[address]
+					with m.If(request.register == address // 4):
+						for i in range(4):
+							with m.If(request.first_dw_be[i]):
+								m.d.rx += register.word_select(i, 8).eq(((register & (~mask & 0xFFFFFFFF)) | (write_data & mask)).word_select(i, 8))
+
+				m.d.rx += completion.tlp_type.eq(TLPType.Cpl)
+				m.d.rx += completion.length.eq(0)
+
+			m.d.rx += self.done.eq(1)
 
 		return m
 
 	@staticmethod
-	def make_init(vendor_id: int, device_id: int, subsystem_vendor_id: int = 0, subsystem_device_id: int = 0, command: int = 0, status: int = 0x0010, max_payload_size = 128):
+	def make_init(vendor_id: int, device_id: int, subsystem_vendor_id: int = 0, subsystem_device_id: int = 0, command: int = 0, status: int = 0x0010, max_payload_size = 128,
+		msi_vectors: int = 0, msix_vectors: int = 0, msix_bar: int = 0, aspm_support: int = 0b00, l0s_exit_latency: int = None, l1_exit_latency: int = None):
 		"""
 		Make init values
 		
@@ -356,10 +445,36 @@ class ConfigurationMemory(Elaboratable):
 
 		subsystem_device_id : int
 			Device ID, 16 bits
+
+		msi_vectors : int
+			Number of MSI vectors, a power of 2 up to 32, there is no MSI capability if 0
+
+		msix_vectors : int
+			Number of MSI-X vectors up to 2048, there is no MSI-X capability if 0
+
+		msix_bar : int
+			BAR with the MSI-X table at offset 0, it is followed by the Pending Bit Array
+
+		aspm_support : int
+			Active State Power Management support, 0b01 for L0s, 0b10 for L1 and 0b11 for both
+
+		l0s_exit_latency : int
+			L0s exit latency in ns, more than 4 µs if None
+
+		l1_exit_latency : int
+			L1 exit latency in ns, more than 64 µs if None
 		"""
 		def get_bytes(val, n):
 			return val.to_bytes(n, byteorder = "little")
 
+		def exit_latency(latency, unit):
+			"""
+			Encodes an exit latency for the Link Capabilities register, the ranges double from below unit up to 64 times unit
+			"""
+			if latency is None:
+				return 0b111
+			return next((i for i in range(7) if latency < unit << i), 0b111)
+
 		init = [
 			*get_bytes(vendor_id, 2),		   # 00
 			*get_bytes(device_id, 2),		   # 02
@@ -414,9 +529,9 @@ class ConfigurationMemory(Elaboratable):
 		link_capabilities = 0
 		link_capabilities |= 0b0001 << 0 # Max Link Speed, 2.5 GT/s is 0001 and 5 GT/s is 0010
 		link_capabilities |= 0b000001 << 4 # Maximum Link Width, x1
-		link_capabilities |= 0b00 << 10 # Active State Power Management (ASPM) Support, whether L0s and L1 is supported (0b01 = L0s, 0b10 = L1, 0b11 = 0b01 | 0b10)
-		link_capabilities |= 0b111 << 12 # L0s Exit Latency
-		link_capabilities |= 0b111 << 15 # L1 Exit Latency
+		link_capabilities |= aspm_support << 10 # Active State Power Management (ASPM) Support, whether L0s and L1 is supported (0b01 = L0s, 0b10 = L1, 0b11 = 0b01 | 0b10)
+		link_capabilities |= exit_latency(l0s_exit_latency, 64) << 12 # L0s Exit Latency, 0b000 is less than 64 ns
+		link_capabilities |= exit_latency(l1_exit_latency, 1000) << 15 # L1 Exit Latency, 0b000 is less than 1 µs
 		link_capabilities |= 0b1 << 22 # ASPM Optionality Compliance, must be set to 0b1
 		link_capabilities |= 0b00000000 << 24 # Port Number, TODO: Does this need to be set in the LTSSM when the port is negotiated?
 
@@ -470,6 +585,43 @@ class ConfigurationMemory(Elaboratable):
 			]
 		]
 
+		if msi_vectors:
+			assert msi_vectors in [1, 2, 4, 8, 16, 32]
+
+			msi_control = 0
+			msi_control |= 0b0 << 0 # MSI Enable
+			msi_control |= int(math.log2(msi_vectors)) << 1 # Multiple Message Capable
+			msi_control |= 0b000 << 4 # Multiple Message Enable, number of allocated vectors
+			msi_control |= 0b1 << 7 # 64 bit address capable
+			msi_control |= 0b1 << 8 # Per-vector masking capable
+
+			capabilities.append([
+				0x05,								 # 00 MSI Capability
+				0x00,								 # 01 Next Capability Pointer
+				*get_bytes(msi_control, 2),		   # 02 Message Control
+				0x00, 0x00, 0x00, 0x00,			   # 04 Message Address
+				0x00, 0x00, 0x00, 0x00,			   # 08 Message Upper Address
+				0x00, 0x00, 0x00, 0x00,			   # 0C Message Data
+				0x00, 0x00, 0x00, 0x00,			   # 10 Mask Bits
+				0x00, 0x00, 0x00, 0x00,			   # 14 Pending Bits
+			])
+
+		if msix_vectors:
+			assert msix_vectors <= 2048 and msix_bar < 6
+
+			msix_control = 0
+			msix_control |= (msix_vectors - 1) << 0 # Table Size
+			msix_control |= 0b0 << 14 # Function Mask
+			msix_control |= 0b0 << 15 # MSI-X Enable
+
+			capabilities.append([
+				0x11,								 # 00 MSI-X Capability
+				0x00,								 # 01 Next Capability Pointer
+				*get_bytes(msix_control, 2),		  # 02 Message Control
+				*get_bytes(0 | msix_bar, 4),		  # 04 Table Offset and BIR
+				*get_bytes(16 * msix_vectors | msix_bar, 4), # 08 PBA Offset and BIR
+			])
+
 		current_pointer = 0x40 # Start at 0x40
 
 		init[0x34] = current_pointer # Set first capability pointer
@@ -492,6 +644,499 @@ class ConfigurationMemory(Elaboratable):
 		return init
 
 
+class DWSplitter(Elaboratable):
+	"""
+	Takes a TLP stream apart into one DW per cycle
+
+	Parameters
+	----------
+	ratio : int
+		Gearbox ratio
+	tlp_sink : StreamInterface
+		TLPs, every valid DW is taken
+	dw : Signal(32)
+		Current DW, byte 0 of the TLP is dw[0:8]
+	valid : Signal()
+		dw is valid
+	first : Signal()
+		dw is the first DW of a TLP
+	last : Signal()
+		dw is the last DW of a TLP
+	ready : Signal()
+		Take dw
+	"""
+	def __init__(self, ratio: int):
+		assert ratio % 4 == 0
+		self.ratio = ratio
+		self.tlp_sink = StreamInterface(8, ratio, name="DW_Splitter_Sink")
+		self.dw = Signal(32)
+		self.valid = Signal()
+		self.first = Signal()
+		self.last = Signal()
+		self.ready = Signal()
+
+	def elaborate(self, platform: Platform) -> Module:
+		m = Module()
+
+		lanes = self.ratio // 4
+		sink = self.tlp_sink
+
+		index = Signal(range(lanes))
+		word_end = Signal()
+		m.d.comb += self.dw.eq(Array(Cat(sink.symbol[4 * i : 4 * i + 4]) for i in range(lanes))[index])
+		m.d.comb += self.valid.eq(Array(sink.valid[4 * i] for i in range(lanes))[index])
+		m.d.comb += word_end.eq(Array(Const(1) if i == lanes - 1 else ~sink.valid[4 * i + 4] for i in range(lanes))[index])
+		m.d.comb += self.first.eq(sink.first & (index == 0))
+		m.d.comb += self.last.eq(sink.last & word_end)
+
+		take = self.valid & self.ready
+		m.d.comb += sink.ready.eq(take & word_end)
+
+		with m.If(take):
+			m.d.rx += index.eq(Mux(word_end, 0, index + 1))
+
+		return m
+
+
+class DWPacker(Elaboratable):
+	"""
+	Packs DWs into a TLP stream, a word is sent once it is full or has the last DW of a TLP.
+	The DWs are queued in a FIFO of depth DWs.
+
+	Parameters
+	----------
+	ratio : int
+		Gearbox ratio
+	depth : int
+		Number of DWs which can be queued
+	w_en : Signal()
+		Queue w_data
+	w_data : Signal(32)
+		DW to queue, byte 0 of the TLP is w_data[0:8]
+	w_first : Signal()
+		w_data is the first DW of a TLP
+	w_last : Signal()
+		w_data is the last DW of a TLP
+	room : Signal()
+		There is room for 2 more DWs, so a DW can be queued in the cycle after deciding to queue it
+	tlp_source : StreamInterface
+		TLPs
+	"""
+	def __init__(self, ratio: int, depth: int = 8):
+		assert ratio % 4 == 0
+		self.ratio = ratio
+		self.depth = depth
+		self.w_en = Signal()
+		self.w_data = Signal(32)
+		self.w_first = Signal()
+		self.w_last = Signal()
+		self.room = Signal()
+		self.tlp_source = StreamInterface(8, ratio, name="DW_Packer_Source")
+
+	def elaborate(self, platform: Platform) -> Module:
+		m = Module()
+
+		lanes = self.ratio // 4
+		source = self.tlp_source
+
+		m.submodules.fifo = fifo = SyncFIFOBuffered(width = 32 + 2, depth = self.depth)
+		m.d.comb += fifo.w_en.eq(self.w_en)
+		m.d.comb += fifo.w_data.eq(Cat(self.w_data, self.w_first, self.w_last))
+		m.d.comb += self.room.eq(fifo.level < self.depth - 1)
+
+		packed = [Signal(32, name = f"Packed_{i}") for i in range(lanes)]
+		packed_first = Signal()
+		lane = Signal(range(lanes))
+
+		fifo_dw = fifo.r_data[0:32]
+		fifo_first = fifo.r_data[32]
+		fifo_last = fifo.r_data[33]
+		flush = (lane == lanes - 1) | fifo_last
+		next_word = source.ready | ~source.valid[0]
+
+		m.d.comb += fifo.r_en.eq(~flush | next_word)
+
+		with m.If(fifo.r_rdy & ~flush):
+			m.d.rx += Array(packed)[lane].eq(fifo_dw)
+			m.d.rx += lane.eq(lane + 1)
+			with m.If(lane == 0):
+				m.d.rx += packed_first.eq(fifo_first)
+
+		with m.If(next_word):
+			with m.If(fifo.r_rdy & flush):
+				for i in range(lanes):
+					for j in range(4):
+						m.d.rx += source.symbol[4 * i + j].eq(Mux(lane == i, fifo_dw, packed[i]).word_select(j, 8))
+						m.d.rx += source.valid[4 * i + j].eq(lane >= i)
+				m.d.rx += source.first.eq(Mux(lane == 0, fifo_first, packed_first))
+				m.d.rx += source.last.eq(fifo_last)
+				m.d.rx += lane.eq(0)
+
+			with m.Else():
+				m.d.rx += [valid.eq(0) for valid in source.valid]
+				m.d.rx += source.first.eq(0)
+				m.d.rx += source.last.eq(0)
+
+		return m
+
+
+class MemoryEndpoint(Elaboratable):
+	"""
+	Memory mapped endpoint, memory writes and reads which hit a BAR are passed on to a write and read port.
+
+	Memory reads are answered with completions of at most Max_Payload_Size, every completion but the last ends at a
+	Read Completion Boundary, see section 2.3.1.1 on page 77 in PCIe 1.1. Reads which don't hit a BAR and locked reads are
+	answered with an Unsupported Request completion, writes which don't hit a BAR are dropped.
+
+	TLPs are processed one DW per cycle. Writes are done as the data is received unless hold_writes is set. Then the data of
+	a write is kept in a buffer of max_payload_size and only written once the TLP is known to be good (tlp_sink_good), the
+	sink is stalled while it is written. This is needed in cut-through mode, where bad TLPs are only dropped at their end.
+
+	Parameters
+	----------
+	ratio : int
+		Gearbox ratio
+	bar_sizes : [int]
+		Size of every BAR in bytes
+	completer_id : Value
+		Bus, device and function number of this function, Cat(function, device, bus)
+	max_payload_size : int
+		Largest payload in bytes, the payload size set in the Device Control register is limited to it
+	internal_bar : int
+		BAR which is accessed through the internal ports instead of the write and read ports, optional
+	hold_writes : bool
+		Write the data of a write only once the TLP is known to be good
+	tlp_sink : StreamInterface
+		Memory requests
+	tlp_sink_good : Signal()
+		Valid with the last word, reads are dropped if 0, and writes too with hold_writes
+	tlp_source : StreamInterface
+		Completions
+	bars : [Signal(32)]
+		Base addresses, from the configuration space
+	memory_space_enable : Signal()
+		Memory Space Enable bit of the Command register
+	payload_size : Signal(3)
+		Max_Payload_Size field of the Device Control register
+	read_completion_boundary : Signal()
+		Read Completion Boundary bit of the Link Control register, 0 is 64 bytes and 1 is 128 bytes
+	write_bar : Signal(range(len(bar_sizes)))
+		BAR which is written to
+	write_address : Signal()
+		DW address in the BAR
+	write_data : Signal(32)
+		Data to write, little endian
+	write_enable : Signal(4)
+		Byte enables, nothing is written if 0
+	read_bar : Signal(range(len(bar_sizes)))
+		BAR which is read from
+	read_address : Signal()
+		DW address in the BAR
+	read_enable : Signal()
+		Read read_address
+	read_data : Signal(32)
+		Data read, needs to be valid in the cycle after read_enable
+	internal_write_enable : Signal(4)
+		Byte enables of a write to the internal BAR, with write_address and write_data
+	internal_read_enable : Signal()
+		Read read_address of the internal BAR
+	internal_read_data : Signal(32)
+		Data read from the internal BAR, needs to be valid in the cycle after internal_read_enable
+	"""
+	def __init__(self, ratio: int, bar_sizes: list[int], completer_id: Value, max_payload_size: int = 128, internal_bar: int = None,
+		hold_writes: bool = False):
+		assert ratio % 4 == 0
+		assert len(bar_sizes) > 0
+		assert max_payload_size in [128, 256, 512, 1024, 2048, 4096]
+		self.ratio = ratio
+		self.bar_sizes = bar_sizes
+		self.completer_id = completer_id
+		self.max_payload_size = max_payload_size
+		self.internal_bar = internal_bar
+		self.hold_writes = hold_writes
+
+		self.tlp_sink = StreamInterface(8, ratio, name="Memory_Sink")
+		self.tlp_sink_good = Signal(reset = 1)
+		self.tlp_source = StreamInterface(8, ratio, name="Memory_Source")
+
+		self.bars = [Signal(32, name = f"Endpoint_BAR{i}") for i in range(len(bar_sizes))]
+		self.memory_space_enable = Signal()
+		self.payload_size = Signal(3)
+		self.read_completion_boundary = Signal()
+
+		address_width = int(math.log2(max(bar_sizes))) - 2
+		self.write_bar = Signal(range(len(bar_sizes)))
+		self.write_address = Signal(address_width)
+		self.write_data = Signal(32)
+		self.write_enable = Signal(4)
+		self.read_bar = Signal(range(len(bar_sizes)))
+		self.read_address = Signal(address_width)
+		self.read_enable = Signal()
+		self.read_data = Signal(32)
+		self.internal_write_enable = Signal(4)
+		self.internal_read_enable = Signal()
+		self.internal_read_data = Signal(32)
+
+	def elaborate(self, platform: Platform) -> Module:
+		m = Module()
+
+		ratio = self.ratio
+		sink = self.tlp_sink
+		source = self.tlp_source
+
+		# Byte enables to the index of the first and last enabled byte, see Table 2-21 on page 89 in PCIe 1.1 for the byte count
+		def lowest(be):
+			return Array(Const((be & -be).bit_length() - 1 if be else 0, 2) for be in range(16))[be]
+
+		def highest(be):
+			return Array(Const(be.bit_length() - 1 if be else 0, 2) for be in range(16))[be]
+
+		# The sink is taken apart into DWs
+		m.submodules.splitter = splitter = DWSplitter(ratio)
+		sink.connect(splitter.tlp_sink, m.d.comb)
+		dw = splitter.dw
+		dw_last = splitter.last
+
+		stall = Signal()
+		take = splitter.valid & ~stall
+		m.d.comb += splitter.ready.eq(~stall)
+
+		# The header is collected and decoded by a MemoryIORequest, which is valid from the cycle after its last DW
+		header_data = [Signal(8, name = f"Memory_Header_{i}") for i in range(4 * 4)]
+		m.submodules.request = request = MemoryIORequest(header_data)
+
+		dw_count = Signal(range(5))
+		with m.If(take):
+			m.d.rx += dw_count.eq(Mux(dw_last, 0, Mux(dw_count == 4, 4, dw_count + 1)))
+			with m.Switch(dw_count):
+				for i in range(4):
+					with m.Case(i):
+						m.d.rx += Cat(header_data[4 * i : 4 * i + 4]).eq(dw)
+
+		header_dws = Mux(request.fmt[0], 4, 3)
+		header_end = (dw_count != 0) & (dw_count == header_dws - 1)
+		write = request.fmt[1]
+
+		# BAR decoding, the upper 32 bits of a 64 bit address need to be 0
+		hit = Signal()
+		hit_bar = Signal(range(len(self.bar_sizes)))
+		for i, size in reversed(list(enumerate(self.bar_sizes))):
+			bits = int(math.log2(size))
+			with m.If(self.memory_space_enable & (request.address[bits:] == self.bars[i][bits:32])):
+				m.d.comb += hit.eq(1)
+				m.d.comb += hit_bar.eq(i)
+
+		# Memory writes
+		data_dw = Signal(10)
+		in_data = Signal()
+		with m.If(take):
+			with m.If(header_end & ~dw_last):
+				m.d.rx += in_data.eq(1)
+				m.d.rx += data_dw.eq(0)
+			with m.If(in_data):
+				m.d.rx += data_dw.eq(data_dw + 1)
+			with m.If(dw_last):
+				m.d.rx += in_data.eq(0)
+
+		# The write and read enables of the internal BAR are separate
+		def internal(bar, enable, internal_enable, value):
+			if self.internal_bar is None:
+				m.d.comb += enable.eq(value)
+			else:
+				with m.If(bar == self.internal_bar):
+					m.d.comb += internal_enable.eq(value)
+				with m.Else():
+					m.d.comb += enable.eq(value)
+
+		write_be = Mux(data_dw == 0, request.first_dw_be, Mux(dw_last, request.last_dw_be, 0b1111))
+
+		committing = Signal()
+		if not self.hold_writes:
+			with m.If(take & in_data & write & hit):
+				m.d.comb += self.write_bar.eq(hit_bar)
+				m.d.comb += self.write_address.eq(request.address[2:] + data_dw)
+				m.d.comb += self.write_data.eq(dw)
+				internal(hit_bar, self.write_enable, self.internal_write_enable, write_be)
+
+		else:
+			# The data and byte enables are buffered, once the last DW of a good write has been taken they are read back and
+			# written one DW per cycle, the read takes 1 cycle
+			write_buffer = Memory(width = 32 + 4, depth = self.max_payload_size // 4, name = "Write_Buffer")
+			m.submodules.write_buffer_write = buffer_write = write_buffer.write_port(domain = "rx")
+			m.submodules.write_buffer_read = buffer_read = write_buffer.read_port(domain = "rx", transparent = False)
+
+			commit_bar = Signal.like(hit_bar)
+			commit_address = Signal(len(self.write_address))
+			commit_dw = Signal(10)
+			commit_last = Signal(10)
+			commit_write = Signal()
+			commit_write_dw = Signal(10)
+
+			with m.If(take & in_data & write & hit):
+				m.d.comb += buffer_write.en.eq(1)
+				m.d.comb += buffer_write.addr.eq(data_dw)
+				m.d.comb += buffer_write.data.eq(Cat(dw, write_be))
+
+				with m.If(dw_last & self.tlp_sink_good):
+					m.d.rx += [
+						committing.eq(1),
+						commit_bar.eq(hit_bar),
+						commit_address.eq(request.address[2:]),
+						commit_dw.eq(0),
+						commit_last.eq(data_dw),
+					]
+
+			m.d.comb += buffer_read.addr.eq(commit_dw)
+			m.d.comb += buffer_read.en.eq(committing)
+			m.d.rx += commit_write.eq(committing)
+			m.d.rx += commit_write_dw.eq(commit_dw)
+			with m.If(committing):
+				m.d.rx += commit_dw.eq(commit_dw + 1)
+				with m.If(commit_dw == commit_last):
+					m.d.rx += committing.eq(0)
+
+			with m.If(commit_write):
+				m.d.comb += self.write_bar.eq(commit_bar)
+				m.d.comb += self.write_address.eq(commit_address + commit_write_dw)
+				m.d.comb += self.write_data.eq(buffer_read.data[0:32])
+				internal(commit_bar, self.write_enable, self.internal_write_enable, buffer_read.data[32:36])
+
+		# Memory reads are passed to the completion FSM in the cycle after their last DW
+		read_load = Signal()
+		completion_busy = Signal()
+		m.d.comb += stall.eq((header_end & ~write & (read_load | completion_busy)) | committing)
+		m.d.rx += read_load.eq(take & header_end & dw_last & ~write & self.tlp_sink_good)
+
+		# Completions are packed one DW per cycle, memory reads take 1 cycle
+		m.submodules.packer = packer = DWPacker(ratio)
+		packer.tlp_source.connect(source, m.d.comb)
+		room = packer.room
+
+		push = Signal()
+		push_read = Signal()
+		push_internal = Signal()
+		push_dw = Signal(32)
+		push_first = Signal()
+		push_last = Signal()
+		m.d.rx += push.eq(0)
+		m.d.comb += packer.w_en.eq(push)
+		m.d.comb += packer.w_data.eq(Mux(push_read, Mux(push_internal, self.internal_read_data, self.read_data), push_dw))
+		m.d.comb += packer.w_first.eq(push_first)
+		m.d.comb += packer.w_last.eq(push_last)
+
+		def push_header(value, first = False, last = False):
+			m.d.rx += [
+				push.eq(1),
+				push_read.eq(0),
+				push_dw.eq(value),
+				push_first.eq(first),
+				push_last.eq(last),
+			]
+
+		bar = Signal.like(hit_bar)
+		address = Signal(len(self.read_address)) # DW address of the next completion
+		lower_address = Signal(2) # Address of the first enabled byte in the first DW
+		remaining = Signal(11) # DWs left to complete
+		byte_count = Signal(13) # Bytes left to complete
+		unsupported = Signal()
+		locked = Signal()
+		tc = Signal(3)
+		attr = Signal(2)
+		requester_id = Signal(16)
+		tag = Signal(8)
+
+		# Payload of the completion being sent
+		payload = Signal(11)
+		payload_left = Signal(11)
+
+		length = Mux(request.length == 0, 1024, request.length)
+		locked_request = request.type == 0b00001
+
+		payload_size = Mux(self.payload_size > int(math.log2(self.max_payload_size // 128)), int(math.log2(self.max_payload_size // 128)), self.payload_size)
+		max_payload = Signal(11)
+		m.d.comb += max_payload.eq(Const(32, 6) << payload_size)
+		rcb_mask = Mux(self.read_completion_boundary, 31, 15)
+		to_boundary = max_payload - (address & rcb_mask)
+
+		fmt_type = Signal(7)
+		m.d.comb += fmt_type.eq(Mux(unsupported, Mux(locked, TLPType.CplLk, TLPType.Cpl), TLPType.CplD))
+		header = [
+			Cat(fmt_type, Const(0, 1), Const(0, 4), tc, Const(0, 1), payload[8:10], Const(0, 2), attr, Const(0, 2), payload[0:8]),
+			Cat(self.completer_id[8:16], self.completer_id[0:8], byte_count[8:12], Const(0, 1), Mux(unsupported, Const(0b001, 3), Const(0b000, 3)), byte_count[0:8]),
+			Cat(requester_id[8:16], requester_id[0:8], tag, lower_address, address[0:5], Const(0, 1)),
+		]
+
+		with m.FSM(name = "Completion_FSM", domain = "rx"):
+			with m.State("Idle"):
+				with m.If(read_load):
+					m.d.comb += completion_busy.eq(1)
+					m.d.rx += [
+						bar.eq(hit_bar),
+						address.eq(request.address[2:]),
+						lower_address.eq(lowest(request.first_dw_be)),
+						remaining.eq(length),
+						unsupported.eq(~hit | locked_request),
+						locked.eq(locked_request),
+						tc.eq(request.tc),
+						attr.eq(request.attr),
+						requester_id.eq(request.requester_id),
+						tag.eq(request.tag),
+					]
+
+					with m.If(length == 1):
+						m.d.rx += byte_count.eq(Mux(request.first_dw_be == 0, 1, highest(request.first_dw_be) - lowest(request.first_dw_be) + 1))
+					with m.Else():
+						m.d.rx += byte_count.eq((length << 2) - lowest(request.first_dw_be) - (3 - highest(request.last_dw_be)))
+
+					m.next = "Start"
+
+			with m.State("Start"):
+				m.d.comb += completion_busy.eq(1)
+				with m.If(unsupported):
+					m.d.rx += payload.eq(0)
+				with m.Else():
+					m.d.rx += payload.eq(Mux(remaining <= to_boundary, remaining, to_boundary))
+					m.d.rx += payload_left.eq(Mux(remaining <= to_boundary, remaining, to_boundary))
+				m.next = "Header0"
+
+			for i in range(3):
+				with m.State(f"Header{i}"):
+					m.d.comb += completion_busy.eq(1)
+					with m.If(room):
+						push_header(header[i], first = i == 0, last = (i == 2) & unsupported)
+						m.next = f"Header{i + 1}" if i < 2 else "Data"
+						if i == 2:
+							with m.If(unsupported):
+								m.next = "Idle"
+
+			with m.State("Data"):
+				m.d.comb += completion_busy.eq(1)
+				with m.If(room):
+					internal(bar, self.read_enable, self.internal_read_enable, 1)
+					m.d.comb += self.read_bar.eq(bar)
+					m.d.comb += self.read_address.eq(address)
+					m.d.rx += [
+						push.eq(1),
+						push_read.eq(1),
+						push_internal.eq(bar == self.internal_bar if self.internal_bar is not None else 0),
+						push_first.eq(0),
+						push_last.eq(payload_left == 1),
+						address.eq(address + 1),
+						payload_left.eq(payload_left - 1),
+					]
+
+					with m.If(payload_left == 1):
+						m.d.rx += remaining.eq(remaining - payload)
+						m.d.rx += byte_count.eq(byte_count - (payload << 2) + lower_address)
+						m.d.rx += lower_address.eq(0)
+						with m.If(remaining == payload):
+							m.next = "Idle"
+						with m.Else():
+							m.next = "Start"
+
+		return m
+
+
 class TLPTransmitter(Elaboratable): # Unused
 	def __init__(self, ratio = 4):
 		self.tlp_source = StreamInterface(8, ratio, name="TLP_Gen_Source")
@@ -507,6 +1152,8 @@ class TLPTransmitter(Elaboratable): # Unused
 		with m.If(self.tlp_source.ready):
 			m.d.rx += timer.eq(timer + 1)
 			with m.If(timer < 128): # TODO: If this value is 64 it goes to Recovery
+				m.d.rx += self.tlp_source.first.eq(timer == 0)
+				m.d.rx += self.tlp_source.last.eq(timer == 127)
 				for i in range(ratio):
 					m.d.rx += self.tlp_source.symbol[i].eq(timer * ratio + i)
 					m.d.rx += self.tlp_source.valid[i].eq(1)
@@ -519,9 +1166,81 @@ class TLPTransmitter(Elaboratable): # Unused
 
 
 class TLP(Elaboratable):
-	def __init__(self, ratio = 4):
-		self.tlp_sink = StreamInterface(8, ratio, name="TLP_Gen_Sink")
-		self.tlp_source = StreamInterface(8, ratio, name="TLP_Gen_Source")
+	"""
+	Transaction layer, received TLPs are dispatched by category, configuration requests of type 0 are handled by the
+	configuration memory, memory requests by a MemoryEndpoint if there are BARs, completions by the DMA engine if there is
+	one and other non-posted requests are answered with an Unsupported Request completion.
+
+	With an interrupt controller the configuration space has MSI and MSI-X capabilities, the MSI-X table is in a BAR after
+	the ones in bar_sizes.
+
+	Parameters
+	----------
+	ratio : int
+		Gearbox ratio
+	bar_sizes : [int]
+		Size of every BAR in bytes, see ConfigurationMemory
+	max_payload_size : int
+		Largest payload supported in bytes
+	dma : DMAEngine
+		Bus master DMA engine, optional
+	interrupts : InterruptController
+		MSI and MSI-X interrupts, optional
+	flow_control : PCIeFlowControl
+		Credits of the other side, TLPs of a class without enough credits don't block the others, see TLPTransmitArbiter
+	cut_through : bool
+		Whether the Data Link Layer passes TLPs on before they are checked, writes to the BARs are held until they are good
+	aspm_support : int
+		Active State Power Management support and exit latencies in ns for the Link Capabilities register, see make_init
+	aspm_control : Signal(2)
+		ASPM Control field of the Link Control register
+	memory_endpoint : MemoryEndpoint
+		Memory ports of the BARs, None if there are no BARs
+	tlp_sink : StreamInterface
+		Received TLPs
+	tlp_sink_good : Signal()
+		Valid with the last word, the TLP is discarded if 0 (see cut-through in PCIeDLLTLPReceiver)
+	tlp_source : StreamInterface
+		TLPs to send
+	"""
+	def __init__(self, ratio = 4, bar_sizes: list[int] = [], max_payload_size: int = 128, dma = None, flow_control = None, interrupts = None,
+		cut_through: bool = False, aspm_support: int = 0b00, l0s_exit_latency: int = None, l1_exit_latency: int = None):
+		self.completer_id = Signal(16)
+		"""Bus, device and function number, captured from configuration requests of type 0"""
+		self.aspm_control = Signal(2)
+		self.link_capabilities = dict(aspm_support = aspm_support, l0s_exit_latency = l0s_exit_latency, l1_exit_latency = l1_exit_latency)
+		self.max_payload_size = max_payload_size
+		self.dma = dma
+		self.interrupts = interrupts
+		# The buffers of the Data Link Layer are sized for the advertised Max_Payload_Size
+		assert dma is None or dma.max_payload_size <= max_payload_size
+
+		# The MSI-X table is accessed through the internal BAR of the memory endpoint
+		internal_bar = None
+		if interrupts is not None and interrupts.msix:
+			internal_bar = len(bar_sizes)
+			bar_sizes = bar_sizes + [interrupts.table_size]
+		self.bar_sizes = bar_sizes
+		self.internal_bar = internal_bar
+
+		categories = [TLPCategory.Config0]
+		classes = [FCClass.Completion, FCClass.Completion] # Configuration and Unsupported Request completions
+		if bar_sizes:
+			self.memory_endpoint = MemoryEndpoint(ratio, bar_sizes, self.completer_id, max_payload_size, internal_bar, hold_writes = cut_through)
+			categories.append(TLPCategory.Memory)
+			classes.append(FCClass.Completion)
+		else:
+			self.memory_endpoint = None
+		if dma is not None:
+			categories.append(TLPCategory.Completion)
+			classes += [FCClass.NonPosted, FCClass.Posted]
+		if interrupts is not None:
+			classes.append(FCClass.Posted)
+		self.dispatcher = TLPDispatcher(ratio, categories)
+		self.arbiter = TLPTransmitArbiter(ratio, classes, max_payload_size, flow_control)
+		self.tlp_sink = self.dispatcher.tlp_sink
+		self.tlp_sink_good = self.dispatcher.tlp_sink_good
+		self.tlp_source = self.arbiter.tlp_source
 		self.ratio = ratio
 		self.debug = Signal(8)
 		self.debug_state = self.debug #Signal(4)
@@ -537,94 +1256,175 @@ class TLP(Elaboratable):
 
 		ratio = self.ratio
 
-		assert ratio == 4
+		assert ratio % 4 == 0
+
+		m.submodules.dispatcher = dispatcher = self.dispatcher
+		m.submodules.arbiter = arbiter = self.arbiter
+		m.submodules.unsupported = unsupported = UnsupportedRequestCompleter(ratio, self.completer_id)
+
+		# Arbiter sinks in the order of the classes, see __init__
+		arbiter_sinks = iter(arbiter.tlp_sinks)
+
+		config_sink = dispatcher.sources[TLPCategory.Config0]
+		config_source = StreamInterface(8, ratio, name="Cfg_Cpl_Source")
+		config_source.connect(next(arbiter_sinks), m.d.comb)
+
+		dispatcher.sources[TLPCategory.Unsupported].connect(unsupported.tlp_sink, m.d.comb)
+		m.d.comb += unsupported.tlp_sink_good.eq(dispatcher.sources_good[TLPCategory.Unsupported])
+		unsupported.tlp_source.connect(next(arbiter_sinks), m.d.comb)
 
 		self.header_data = [Signal(8) for i in range(4 * 4)] # 16 bytes buffer for the header (they're either 3 DW or 4 DW)
 
-		# All the requests it can receive
-		m.submodules.memory_io_request = memory_io_request = MemoryIORequest(self.header_data)
 		m.submodules.configuration_request = configuration_request = ConfigurationRequest(self.header_data)
-		m.submodules.message_request = message_request = MessageRequest(self.header_data)
 
 		new_configuration_request = Signal()
 
-		m.submodules.configuration_memory = configuration_memory = ConfigurationMemory(ConfigurationMemory.make_init(0x1234, 0x5678), configuration_request, new_configuration_request)
+		interrupt_capabilities = {}
+		if self.interrupts is not None:
+			interrupt_capabilities = {
+				"msi_vectors": self.interrupts.msi_vectors,
+				"msix_vectors": self.interrupts.vectors if self.interrupts.msix else 0,
+				"msix_bar": self.internal_bar or 0,
+			}
+		init = ConfigurationMemory.make_init(0x1234, 0x5678, max_payload_size = self.max_payload_size, **interrupt_capabilities, **self.link_capabilities)
+		m.submodules.configuration_memory = configuration_memory = ConfigurationMemory(init, configuration_request, new_configuration_request, ratio, self.bar_sizes)
+		m.d.comb += self.aspm_control.eq(configuration_memory.link_control[0:2])
+
+		if self.memory_endpoint is not None:
+			m.submodules.memory_endpoint = endpoint = self.memory_endpoint
+			dispatcher.sources[TLPCategory.Memory].connect(endpoint.tlp_sink, m.d.comb)
+			m.d.comb += endpoint.tlp_sink_good.eq(dispatcher.sources_good[TLPCategory.Memory])
+			endpoint.tlp_source.connect(next(arbiter_sinks), m.d.comb)
+
+			m.d.comb += [bar.eq(configuration_memory.bars[i]) for i, bar in enumerate(endpoint.bars)]
+			m.d.comb += endpoint.memory_space_enable.eq(configuration_memory.command[1])
+			m.d.comb += endpoint.payload_size.eq(configuration_memory.device_control[5:8])
+			m.d.comb += endpoint.read_completion_boundary.eq(configuration_memory.link_control[3])
+
+		if self.dma is not None:
+			m.submodules.dma = dma = self.dma
+			dispatcher.sources[TLPCategory.Completion].connect(dma.completion_sink, m.d.comb)
+			m.d.comb += dma.completion_sink_good.eq(dispatcher.sources_good[TLPCategory.Completion])
+			dma.read_source.connect(next(arbiter_sinks), m.d.comb)
+			dma.write_source.connect(next(arbiter_sinks), m.d.comb)
+
+			m.d.comb += dma.requester_id.eq(self.completer_id)
+			m.d.comb += dma.bus_master_enable.eq(configuration_memory.command[2])
+			m.d.comb += dma.payload_size.eq(configuration_memory.device_control[5:8])
+			m.d.comb += dma.read_request_size.eq(configuration_memory.device_control[12:15])
+
+		if self.interrupts is not None:
+			m.submodules.interrupts = interrupts = self.interrupts
+			interrupts.tlp_source.connect(next(arbiter_sinks), m.d.comb)
+
+			m.d.comb += interrupts.requester_id.eq(self.completer_id)
+			m.d.comb += interrupts.bus_master_enable.eq(configuration_memory.command[2])
+			m.d.comb += [
+				interrupts.msi_control.eq(configuration_memory.msi_control),
+				interrupts.msi_address.eq(configuration_memory.msi_address),
+				interrupts.msi_data.eq(configuration_memory.msi_data),
+				interrupts.msi_mask.eq(configuration_memory.msi_mask),
+				configuration_memory.msi_pending.eq(interrupts.msi_pending),
+			]
 
-		last_valid = Signal()
-		m.d.rx += last_valid.eq(self.tlp_sink.valid[0])
+			if interrupts.msix:
+				m.d.comb += [
+					interrupts.msix_control.eq(configuration_memory.msix_control),
+					interrupts.table_write_address.eq(endpoint.write_address),
+					interrupts.table_write_data.eq(endpoint.write_data),
+					interrupts.table_write_enable.eq(endpoint.internal_write_enable),
+					interrupts.table_read_address.eq(endpoint.read_address),
+					interrupts.table_read_enable.eq(endpoint.internal_read_enable),
+					endpoint.internal_read_data.eq(interrupts.table_read_data),
+				]
+
+		# A request is processed in the cycle after its last word has been received if it is good, while the next request is being
+		# received, and its completion is queued. The header can be overwritten by the next request once the request is processed.
+		take = config_sink.ready & config_sink.valid[0]
+		request_received = Signal()
+		tlp_good = Signal()
+		m.d.rx += request_received.eq(take & config_sink.last)
+		with m.If(take & config_sink.last):
+			m.d.rx += tlp_good.eq(dispatcher.sources_good[TLPCategory.Config0])
+
+		m.d.comb += new_configuration_request.eq(request_received & tlp_good)
+		with m.If(new_configuration_request):
+			m.d.rx += self.completer_id.eq(configuration_request.completer_id)
+
+		# Completions with a flag whether they have data, there is room for the requests which are being processed
+		completion = configuration_memory.configuration_completion
+		completion_queue_depth = 8
+		m.submodules.completion_queue = completion_queue = SyncFIFOBuffered(width = len(completion.data) * 8 + 1, depth = completion_queue_depth)
+		m.d.comb += completion_queue.w_data.eq(Cat(*completion.data, completion.has_data))
+		m.d.comb += completion_queue.w_en.eq(configuration_memory.done)
+		m.d.comb += config_sink.ready.eq(completion_queue.level < completion_queue_depth - 3)
+
+		# Number of words in the header of a configuration write, the header is 3 DW and a write has 1 DW of data
+		write_words = (4 * 4 + ratio - 1) // ratio
+
+		def store_header(word):
+			for i in range(ratio):
+				if i + word * ratio < len(self.header_data):
+					m.d.rx += self.header_data[i + word * ratio].eq(config_sink.symbol[i])
 
 		with m.FSM(name = "TLP_rx_FSM", domain = "rx") as fsm:
 			m.d.comb += Cat(self.debug[0:4]).eq(fsm.state)
 
 			with m.State("Wait"):
-				m.d.rx += self.tlp_sink.ready.eq(1)
-				with m.If(~last_valid & self.tlp_sink.valid[0]):
-					for i in range(4):
-						# Assign header_data one by one
-						m.d.rx += self.header_data[i + 0].eq(self.tlp_sink.symbol[i])
-						m.d.rx += self.debug_header.eq(Cat(self.tlp_sink.symbol))
-
-					#with m.If(configuration_request.fmt_type_match()):
-					with m.If((self.tlp_sink.symbol[0] == TLPType.CfgRd0) | (self.tlp_sink.symbol[0] == TLPType.CfgWr0)):
-						m.next = "CfgRq1"
-
-			with m.State("CfgRq1"):
-				for i in range(4):
-					m.d.rx += self.header_data[i + 4].eq(self.tlp_sink.symbol[i])
-
-				m.next = "CfgRq2"
-
-			with m.State("CfgRq2"):
-				for i in range(4):
-					m.d.rx += self.header_data[i + 8].eq(self.tlp_sink.symbol[i])
-
-				m.d.rx += self.tlp_sink.ready.eq(0)
-				
-				# CfgWr0 has 1 data, process it as it is 4 DW long
-				with m.If(self.header_data[0] == TLPType.CfgWr0):
-					m.next = "CfgRq3"
-				
-				with m.Else():
-					m.next = "CfgRq4"
-
-			with m.State("CfgRq3"):
-				for i in range(4):
-					m.d.rx += self.header_data[i + 12].eq(self.tlp_sink.symbol[i])
+				with m.If(take & config_sink.first):
+					# Assign header_data one by one
+					store_header(0)
+					m.d.rx += self.debug_header.eq(Cat(config_sink.symbol[0:4]))
+					with m.If(~config_sink.last):
+						m.next = "CfgRqDrop" if write_words == 1 else "CfgRq1"
+
+			for i in range(1, write_words):
+				with m.State(f"CfgRq{i}"):
+					with m.If(take):
+						store_header(i)
+						m.next = f"CfgRq{i + 1}" if i + 1 < write_words else "CfgRqDrop"
+						with m.If(config_sink.last):
+							m.next = "Wait"
+
+			# Words after the header and the data of a configuration write are dropped
+			with m.State("CfgRqDrop"):
+				with m.If(take & config_sink.last):
+					m.next = "Wait"
+
+		# A completion without data is 3 DW long, the data is the 4th DW
+		# The next word is only put into the source once the current one has been taken
+		completion_data = completion_queue.r_data[:-1]
+		completion_has_data = completion_queue.r_data[-1]
+		completion_words = (len(completion.data) + ratio - 1) // ratio
+		completion_word = Signal(range(completion_words))
+		next_word = config_source.ready | ~config_source.valid[0]
+
+		with m.If(next_word):
+			with m.If(completion_queue.r_rdy):
+				m.d.rx += config_source.first.eq(completion_word == 0)
+				m.d.rx += config_source.last.eq(0)
+				m.d.rx += completion_word.eq(completion_word + 1)
+
+				for i in range(completion_words):
+					with m.If(completion_word == i):
+						# The word with the end of the header is the last one of a completion without data
+						if i == completion_words - 1 or (i + 1) * ratio >= 3 * 4:
+							end = Const(1) if i == completion_words - 1 else ~completion_has_data
+							with m.If(end):
+								m.d.rx += config_source.last.eq(1)
+								m.d.rx += completion_word.eq(0)
+								m.d.comb += completion_queue.r_en.eq(1)
+
+						for j in range(ratio):
+							if j + i * ratio < len(completion.data):
+								m.d.rx += config_source.symbol[j].eq(completion_data.word_select(j + i * ratio, 8))
+								m.d.rx += config_source.valid[j].eq(completion_has_data if j + i * ratio >= 3 * 4 else 1)
+							else:
+								m.d.rx += config_source.valid[j].eq(0)
 
-				m.d.rx += self.tlp_sink.ready.eq(0)
-				m.next = "CfgRq4"
-
-			with m.State("CfgRq4"):
-				# Signal that there is a new configuration request to process
-				m.d.comb += new_configuration_request.eq(1)
-				m.next = "Wait"
-
-		with m.FSM(name = "TLP_tx_FSM", domain = "rx") as fsm:
-			m.d.comb += Cat(self.debug[4:8]).eq(fsm.state)
-			with m.State("Wait"):
-				with m.If(configuration_memory.done):
-					m.next = "CfgCpl0"
-		
-			for i in range(len(configuration_memory.configuration_completion.data) // ratio):
-				with m.State(f"CfgCpl{i}"):
-					for j in range(4):
-						m.d.rx += self.tlp_source.symbol[j].eq(configuration_memory.configuration_completion.data[j + i * ratio])
-						m.d.rx += self.tlp_source.valid[j].eq(1)
-
-					if i < len(configuration_memory.configuration_completion.data) // ratio - 1:
-						m.next = f"CfgCpl{i + 1}"
-					
-					else:
-						m.next = "CfgCplEnd"
-					
-					if i == len(configuration_memory.configuration_completion.data) // ratio - 2:
-						with m.If(~configuration_memory.configuration_completion.has_data):
-							m.next = "CfgCplEnd"
-			
-			with m.State("CfgCplEnd"):
-				for j in range(4):
-					m.d.rx += self.tlp_source.valid[j].eq(0)
-
-				m.next = "Wait"
+			with m.Else():
+				m.d.rx += config_source.first.eq(0)
+				m.d.rx += config_source.last.eq(0)
+				m.d.rx += [valid.eq(0) for valid in config_source.valid]
 
 		return m
\ No newline at end of file
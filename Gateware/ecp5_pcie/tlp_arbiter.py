@@ -0,0 +1,224 @@
+from amaranth import *
+from amaranth.build import *
+from amaranth.lib.fifo import SyncFIFOBuffered
+
+from .stream import StreamInterface
+from .flow_control import FCClass
+
+class TLPArbiter(Elaboratable):
+	"""
+	Merges several TLP streams into one, switching between them round-robin at TLP boundaries.
+
+	A source is chosen combinatorially when its first word is valid, so TLPs from different sources can follow each other
+	without an idle cycle. Once the first word has been taken the source is kept until its last word has been taken.
+
+	Parameters
+	----------
+	ratio : int
+		Gearbox ratio
+	count : int
+		Number of sinks
+	tlp_sinks : [StreamInterface]
+		TLPs to send, valid must not depend on ready
+	tlp_source : StreamInterface
+		Merged TLPs
+	"""
+	def __init__(self, ratio: int = 4, count: int = 2):
+		self.ratio = ratio
+		self.count = count
+
+		self.tlp_sinks = [StreamInterface(8, ratio, name=f"Arbiter_Sink_{i}") for i in range(count)]
+		self.tlp_source = StreamInterface(8, ratio, name="Arbiter_Source")
+
+	def elaborate(self, platform: Platform) -> Module:
+		m = Module()
+
+		count = self.count
+		sinks = self.tlp_sinks
+		source = self.tlp_source
+
+		# Sink which sent the last TLP, or which is sending the current one if active
+		current = Signal(range(count))
+		active = Signal()
+
+		# The next sink after the current one which has a TLP to send wins
+		choice = Signal(range(count))
+		m.d.comb += choice.eq(current)
+		with m.Switch(current):
+			for c in range(count):
+				with m.Case(c):
+					for k in reversed(range(1, count + 1)):
+						i = (c + k) % count
+						with m.If(sinks[i].valid[0] & sinks[i].first):
+							m.d.comb += choice.eq(i)
+
+		grant = Signal(range(count))
+		m.d.comb += grant.eq(Mux(active, current, choice))
+
+		for i, sink in enumerate(sinks):
+			with m.If(grant == i):
+				for j in range(self.ratio):
+					m.d.comb += source.symbol[j].eq(sink.symbol[j])
+					m.d.comb += source.valid[j].eq(sink.valid[j] & (active | sink.first))
+				m.d.comb += source.first.eq(sink.first & ~active)
+				m.d.comb += source.last.eq(sink.last)
+				m.d.comb += sink.ready.eq(source.ready)
+
+		with m.If(source.ready & source.valid[0]):
+			m.d.rx += current.eq(grant)
+			m.d.rx += active.eq(~source.last)
+
+		return m
+
+class TLPTransmitArbiter(Elaboratable):
+	"""
+	Merges the TLP streams of the transaction layer into one, with separate queues for posted requests, non-posted requests and
+	completions, see the ordering rules in section 2.4.1 in PCIe 1.1.
+
+	The sinks of every flow control class are merged by a TLPArbiter into the queue of that class. A TLP is only sent from a queue
+	once it has been queued completely, so the source has no gaps within TLPs, and once the other side has advertised enough credits
+	for it, so a class which is out of credits doesn't block the others. The queues take turns round-robin within the ordering rules:
+	posted requests can pass non-posted requests and completions, completions can pass non-posted requests, and neither can pass a
+	posted request which was queued before them.
+
+	Parameters
+	----------
+	ratio : int
+		Gearbox ratio
+	classes : [FCClass]
+		Flow control class of the TLPs of every sink
+	max_payload_size : int
+		Largest payload of the TLPs in bytes, the queues of posted requests and completions hold 2 TLPs of that size
+	flow_control : PCIeFlowControl
+		Credits of the other side, credits aren't checked if None
+	tlp_sinks : [StreamInterface]
+		TLPs to send, one stream for every entry in classes
+	tlp_source : StreamInterface
+		Merged TLPs
+	"""
+	def __init__(self, ratio: int = 4, classes: list = [], max_payload_size: int = 128, flow_control = None):
+		assert ratio % 4 == 0
+		self.ratio = ratio
+		self.classes = classes
+		self.max_payload_size = max_payload_size
+		self.flow_control = flow_control
+
+		self.tlp_sinks = [StreamInterface(8, ratio, name=f"Transmit_Sink_{i}") for i in range(len(classes))]
+		self.tlp_source = StreamInterface(8, ratio, name="Transmit_Source")
+
+	def elaborate(self, platform: Platform) -> Module:
+		m = Module()
+
+		ratio = self.ratio
+		source = self.tlp_source
+
+		def words(size):
+			return (size + ratio - 1) // ratio
+
+		depths = {
+			FCClass.Posted: 2 * words(16 + self.max_payload_size),
+			FCClass.NonPosted: 4 * words(16),
+			FCClass.Completion: 2 * words(12 + self.max_payload_size),
+		}
+
+		# Posted TLPs which have been started to be queued and which have been sent. Other TLPs are stamped with the number of posted
+		# TLPs queued before them and wait until those have been sent. The counters wrap, a stamp which lies within the posted TLPs
+		# which haven't been sent yet blocks the TLP. A stale stamp can block a TLP until newer posted TLPs have been sent, which is
+		# allowed, but a TLP is never sent before the posted TLPs queued before it.
+		stamp_bits = 8
+		assert depths[FCClass.Posted] // words(16) < 2 ** stamp_bits
+		posted_queued = Signal(stamp_bits)
+		posted_sent = Signal(stamp_bits)
+		unsent = Signal(stamp_bits)
+		m.d.comb += unsent.eq(posted_queued - posted_sent)
+
+		queues = []
+		for fc_class in FCClass:
+			sinks = [sink for sink, sink_class in zip(self.tlp_sinks, self.classes) if sink_class == fc_class]
+			if not sinks:
+				continue
+
+			if len(sinks) == 1:
+				class_sink = sinks[0]
+			else:
+				arbiter = TLPArbiter(ratio, len(sinks))
+				m.submodules[f"arbiter_{fc_class.name}"] = arbiter
+				for sink, arbiter_sink in zip(sinks, arbiter.tlp_sinks):
+					sink.connect(arbiter_sink, m.d.comb)
+				class_sink = arbiter.tlp_source
+
+			# The symbols, valid bits, first, last and the stamp are queued
+			depth = depths[fc_class]
+			queue = SyncFIFOBuffered(width = ratio * 9 + 2 + stamp_bits, depth = depth)
+			m.submodules[f"queue_{fc_class.name}"] = queue
+
+			m.d.comb += queue.w_data.eq(Cat(*class_sink.symbol, *class_sink.valid, class_sink.first, class_sink.last, posted_queued))
+			m.d.comb += queue.w_en.eq(class_sink.all_valid)
+			m.d.comb += class_sink.ready.eq(queue.w_rdy)
+
+			if fc_class == FCClass.Posted:
+				with m.If(queue.w_en & queue.w_rdy & class_sink.first):
+					m.d.rx += posted_queued.eq(posted_queued + 1)
+
+			# Number of TLPs which have been queued completely
+			complete = Signal(range(depth + 1), name=f"complete_{fc_class.name}")
+			queued = queue.w_en & queue.w_rdy & class_sink.last
+			dequeued = queue.r_en & queue.r_rdy & queue.r_data[ratio * 9 + 1]
+			m.d.rx += complete.eq(complete + queued - dequeued)
+
+			queues.append((fc_class, queue, complete))
+
+		count = len(queues)
+
+		# Whether the TLP at the head of a queue can be sent
+		eligible = Signal(count)
+		for i, (fc_class, queue, complete) in enumerate(queues):
+			header = [queue.r_data[j * 8 : j * 8 + 8] for j in range(4)]
+			stamp = queue.r_data[ratio * 9 + 2:]
+			# Set if all posted TLPs queued before this one have been sent
+			distance = (stamp - posted_sent)[:stamp_bits]
+			in_order = Const(1) if fc_class == FCClass.Posted else (distance == 0) | (distance > unsent)
+			credits = Const(1) if self.flow_control is None else self.flow_control.credits_available(header)
+			m.d.comb += eligible[i].eq((complete != 0) & queue.r_rdy & in_order & credits)
+
+		# Queue which sent the last TLP, or which is sending the current one if active
+		current = Signal(range(count))
+		active = Signal()
+
+		# The next eligible queue after the current one wins
+		choice = Signal(range(count))
+		m.d.comb += choice.eq(current)
+		with m.Switch(current):
+			for c in range(count):
+				with m.Case(c):
+					for k in reversed(range(1, count + 1)):
+						i = (c + k) % count
+						with m.If(eligible[i]):
+							m.d.comb += choice.eq(i)
+
+		grant = Signal(range(count))
+		m.d.comb += grant.eq(Mux(active, current, choice))
+
+		symbol = Signal(ratio * 8)
+		valid = Signal(ratio)
+		first = Signal()
+		last = Signal()
+
+		for i, (fc_class, queue, complete) in enumerate(queues):
+			with m.If(grant == i):
+				m.d.comb += Cat(symbol, valid, first, last).eq(queue.r_data)
+				m.d.comb += [source.valid[j].eq(valid[j] & queue.r_rdy & (active | eligible[i])) for j in range(ratio)]
+				m.d.comb += queue.r_en.eq(source.ready & (active | eligible[i]))
+				if fc_class == FCClass.Posted:
+					with m.If(queue.r_en & queue.r_rdy & last):
+						m.d.rx += posted_sent.eq(posted_sent + 1)
+
+		m.d.comb += [source.symbol[j].eq(symbol[j * 8 : j * 8 + 8]) for j in range(ratio)]
+		m.d.comb += source.first.eq(first & source.valid[0])
+		m.d.comb += source.last.eq(last & source.valid[0])
+
+		with m.If(source.ready & source.valid[0]):
+			m.d.rx += current.eq(grant)
+			m.d.rx += active.eq(~source.last)
+
+		return m
@@ -0,0 +1,246 @@
+from amaranth import *
+from amaranth.build import *
+from amaranth.lib.fifo import SyncFIFOBuffered
+from enum import IntEnum
+
+from .stream import StreamInterface
+from .flow_control import FCClass, tlp_fc_class
+
+class TLPCategory(IntEnum):
+	Memory      = 0 # MRd, MRdLk, MWr
+	IO          = 1 # IORd, IOWr
+	Config0     = 2 # CfgRd0, CfgWr0
+	Config1     = 3 # CfgRd1, CfgWr1
+	Message     = 4 # Msg, MsgD
+	Completion  = 5 # Cpl, CplD, CplLk, CplDLk
+	Unsupported = 6 # Everything else
+
+def tlp_category(fmt_type: Value) -> Value:
+	"""
+	Category of a TLP, see Table 2-3 on page 49 in PCIe 1.1
+
+	Parameters
+	----------
+	fmt_type : Value
+		First byte of the TLP header, Cat(type, fmt)
+	"""
+	type = fmt_type[0:5]
+	return Mux((type == 0b00000) | (type == 0b00001), TLPCategory.Memory,
+		Mux(type == 0b00010, TLPCategory.IO,
+		Mux(type == 0b00100, TLPCategory.Config0,
+		Mux(type == 0b00101, TLPCategory.Config1,
+		Mux(type[3:5] == 0b10, TLPCategory.Message,
+		Mux((type == 0b01010) | (type == 0b01011), TLPCategory.Completion,
+		TLPCategory.Unsupported))))))
+
+class TLPDispatcher(Elaboratable):
+	"""
+	Passes received TLPs on to one stream per category, the category is decoded from the first byte of the first word.
+
+	Every stream has its own queue of queue_depth words, so a handler which is slow to take TLPs only stalls the sink once its
+	queue is full and the others keep receiving TLPs. TLPs of categories without a handler are passed on to the Unsupported stream,
+	which should be connected to an UnsupportedRequestCompleter.
+
+	Parameters
+	----------
+	ratio : int
+		Gearbox ratio
+	categories : [TLPCategory]
+		Categories with a handler
+	queue_depth : int
+		Number of words every queue can hold
+	tlp_sink : StreamInterface
+		Received TLPs
+	tlp_sink_good : Signal()
+		Valid with the last word, whether the TLP is good, see cut-through in PCIeDLLTLPReceiver
+	sources : {TLPCategory: StreamInterface}
+		TLPs of every handled category and the Unsupported category
+	sources_good : {TLPCategory: Signal()}
+		tlp_sink_good for the TLPs in sources, valid with the last word
+	"""
+	def __init__(self, ratio: int = 4, categories: list = [], queue_depth: int = 8):
+		self.ratio = ratio
+		self.categories = [category for category in categories if category != TLPCategory.Unsupported] + [TLPCategory.Unsupported]
+		self.queue_depth = queue_depth
+
+		self.tlp_sink = StreamInterface(8, ratio, name="Dispatch_Sink")
+		self.tlp_sink_good = Signal(reset = 1)
+		self.sources = {category: StreamInterface(8, ratio, name=f"Dispatch_{category.name}") for category in self.categories}
+		self.sources_good = {category: Signal(name=f"Dispatch_{category.name}_good") for category in self.categories}
+
+	def elaborate(self, platform: Platform) -> Module:
+		m = Module()
+
+		ratio = self.ratio
+		sink = self.tlp_sink
+
+		# The symbols, valid bits, first, last and good are queued
+		queues = []
+		for category in self.categories:
+			queue = SyncFIFOBuffered(width = ratio * 9 + 3, depth = self.queue_depth)
+			m.submodules[f"queue_{category.name}"] = queue
+			queues.append(queue)
+
+			source = self.sources[category]
+			m.d.comb += Cat(*source.symbol, *source.valid, source.first, source.last, self.sources_good[category]).eq(queue.r_data)
+			with m.If(~queue.r_rdy):
+				m.d.comb += [valid.eq(0) for valid in source.valid]
+				m.d.comb += source.first.eq(0)
+				m.d.comb += source.last.eq(0)
+			m.d.comb += queue.r_en.eq(source.ready)
+
+		# The queue is chosen on the first word and kept for the rest of the TLP
+		category = Signal(range(len(TLPCategory)))
+		m.d.comb += category.eq(tlp_category(sink.symbol[0]))
+
+		port = Signal(range(len(queues)))
+		m.d.comb += port.eq(len(queues) - 1)
+		with m.Switch(category):
+			for i, handled in enumerate(self.categories[:-1]):
+				with m.Case(handled):
+					m.d.comb += port.eq(i)
+
+		current_port = Signal(range(len(queues)))
+		target = Mux(sink.first, port, current_port)
+		m.d.comb += sink.ready.eq(Array(queue.w_rdy for queue in queues)[target])
+
+		for i, queue in enumerate(queues):
+			m.d.comb += queue.w_data.eq(Cat(*sink.symbol, *sink.valid, sink.first, sink.last, self.tlp_sink_good))
+			m.d.comb += queue.w_en.eq(sink.ready & sink.all_valid & (target == i))
+
+		with m.If(sink.ready & sink.all_valid & sink.first):
+			m.d.rx += current_port.eq(port)
+
+		return m
+
+class UnsupportedRequestCompleter(Elaboratable):
+	"""
+	Answers non-posted requests with an Unsupported Request completion, see section 2.3.1 on page 75 in PCIe 1.1.
+	Posted requests and TLPs which aren't good are dropped.
+
+	The header of the next request is taken while the completion of the previous one is being sent, so requests are answered
+	at the rate they are received.
+
+	The Byte Count of a memory read completion is the number of bytes of the request from its byte enables and its Lower
+	Address is the address of the first enabled byte, see section 2.3.1.1 on page 77 in PCIe 1.1. Other completions have a
+	Byte Count of 4 and a Lower Address of 0.
+
+	Parameters
+	----------
+	ratio : int
+		Gearbox ratio
+	completer_id : Value
+		Bus, device and function number of this function, Cat(function, device, bus)
+	tlp_sink : StreamInterface
+		Requests
+	tlp_sink_good : Signal()
+		Valid with the last word, the request is dropped if 0
+	tlp_source : StreamInterface
+		Completions
+	"""
+	def __init__(self, ratio: int, completer_id: Value):
+		self.ratio = ratio
+		self.completer_id = completer_id
+
+		self.tlp_sink = StreamInterface(8, ratio, name="UR_Sink")
+		self.tlp_sink_good = Signal(reset = 1)
+		self.tlp_source = StreamInterface(8, ratio, name="UR_Source")
+
+	def elaborate(self, platform: Platform) -> Module:
+		m = Module()
+
+		ratio = self.ratio
+		sink = self.tlp_sink
+		source = self.tlp_source
+
+		# The header contains the fields needed for the completion, the lowest address byte is in its last DW
+		header_bytes = 16
+		header = [Signal(8, name=f"header_{i}") for i in range(header_bytes)]
+		word = Signal(range(header_bytes // ratio + 2))
+
+		# Header bytes of the word being taken are used right away, since a TLP can end in the word with the header
+		current = [Mux(word == i // ratio, sink.symbol[i % ratio], header[i]) for i in range(header_bytes)]
+
+		# The completion waiting to be sent, the sink stalls on the last word of a request while it is occupied
+		cpl_pending = Signal()
+		cpl_header = [Signal(8, name=f"cpl_header_{i}") for i in range(12)]
+
+		# The completion is 3 DW long, its last word can be partially valid
+		cpl_words = (12 + ratio - 1) // ratio
+		cpl_word = Signal(range(cpl_words))
+		next_word = source.ready | ~source.valid[0]
+		cpl_sent = next_word & cpl_pending & (cpl_word == cpl_words - 1)
+
+		take = sink.ready & sink.all_valid
+		m.d.comb += sink.ready.eq(~cpl_pending | cpl_sent | ~sink.last)
+
+		with m.If(take):
+			m.d.rx += word.eq(Mux(sink.last, 0, Mux(word < header_bytes // ratio, word + 1, word)))
+			for i in range(header_bytes):
+				with m.If(word == i // ratio):
+					m.d.rx += header[i].eq(sink.symbol[i % ratio])
+
+		fmt_type = current[0]
+		non_posted = tlp_fc_class(fmt_type) == FCClass.NonPosted
+		memory = (fmt_type[0:5] == 0b00000) | (fmt_type[0:5] == 0b00001)
+		length = Cat(current[3], current[2][0:2])
+		first_dw_be = current[7][0:4]
+		last_dw_be = current[7][4:8]
+		address = Mux(fmt_type[5], current[15], current[11]) # Lowest byte of the address of a 3 or 4 DW header
+
+		# Byte enables to the index of the first and last enabled byte, see Table 2-21 on page 89 in PCIe 1.1 for the byte count
+		def lowest(be):
+			return Array(Const((be & -be).bit_length() - 1 if be else 0, 2) for be in range(16))[be]
+
+		def highest(be):
+			return Array(Const(be.bit_length() - 1 if be else 0, 2) for be in range(16))[be]
+
+		# A length of 0 is 1024 DW, which is a byte count of 0 if all bytes are enabled
+		byte_count = Signal(12)
+		lower_address = Signal(7)
+		with m.If(memory & (length == 1)):
+			m.d.comb += byte_count.eq(Mux(first_dw_be == 0, 1, highest(first_dw_be) - lowest(first_dw_be) + 1))
+		with m.Elif(memory):
+			m.d.comb += byte_count.eq((length << 2) - lowest(first_dw_be) - (3 - highest(last_dw_be)))
+		with m.Else():
+			m.d.comb += byte_count.eq(4)
+		with m.If(memory):
+			m.d.comb += lower_address.eq(Cat(lowest(first_dw_be), address[2:7]))
+
+		with m.If(cpl_sent):
+			m.d.rx += cpl_pending.eq(0)
+
+		with m.If(take & sink.last & self.tlp_sink_good & non_posted):
+			m.d.rx += cpl_pending.eq(1)
+			m.d.rx += Cat(cpl_header).eq(Cat(
+				Mux(fmt_type[0:5] == 0b00001, Const(0b01011, 5), Const(0b01010, 5)), # CplLk for MRdLk, Cpl otherwise
+				Const(0b000, 3),
+				current[1], # Traffic class
+				Const(0, 4), current[2][4:6], Const(0, 2), # Attributes, no digest and not poisoned
+				Const(0, 8), # Length
+				self.completer_id[8:16],
+				self.completer_id[0:8],
+				byte_count[8:12], Const(0, 1), Const(0b001, 3), # Completion status UR
+				byte_count[0:8],
+				current[4], # Requester ID
+				current[5],
+				current[6], # Tag
+				lower_address, Const(0, 1),
+			))
+
+		with m.If(next_word):
+			with m.If(cpl_pending):
+				for i in range(ratio):
+					m.d.rx += source.symbol[i].eq(Array(cpl_header[j * ratio + i] if j * ratio + i < 12 else 0 for j in range(cpl_words))[cpl_word])
+					m.d.rx += source.valid[i].eq(Array(Const(int(j * ratio + i < 12), 1) for j in range(cpl_words))[cpl_word])
+				m.d.rx += source.first.eq(cpl_word == 0)
+				m.d.rx += source.last.eq(cpl_word == cpl_words - 1)
+
+				m.d.rx += cpl_word.eq(Mux(cpl_word == cpl_words - 1, 0, cpl_word + 1))
+
+			with m.Else():
+				m.d.rx += [valid.eq(0) for valid in source.valid]
+				m.d.rx += source.first.eq(0)
+				m.d.rx += source.last.eq(0)
+
+		return m
@@ -0,0 +1,85 @@
+from amaranth import *
+from amaranth.build import *
+from .virtual_serdes import VirtualPCIeSERDESx4
+from .serdes import PCIeSERDESAligner, LinkSpeed
+from .phy import PCIePhy
+from .stream import StreamInterface
+
+class VirtualTransactionLayer(Elaboratable):
+	"""
+	Transaction layer of a PCIePhy whose streams are driven by the simulation
+
+	Parameters
+	----------
+	ratio : int
+		Gearbox ratio
+	"""
+	def __init__(self, ratio: int = 4):
+		self.tlp_source = StreamInterface(8, ratio, name="TL_Source")
+		"""TLPs to send"""
+		self.tlp_sink = StreamInterface(8, ratio, name="TL_Sink")
+		"""Received TLPs, only connected in an upstream port"""
+		self.tlp_sink_good = Signal()
+		self.aspm_control = Signal(2)
+
+	def elaborate(self, platform: Platform) -> Module:
+		return Module()
+
+class VirtualPCIeLink(Elaboratable):
+	"""
+	Two PHYs on virtual SERDES connected to each other, the upstream port phy_u and the downstream port phy_d.
+	Like in VirtualPCIePhy everything runs in the sync domain. The lane speed follows the LTSSM like in LatticeECP5PCIePhy.
+
+	Parameters
+	----------
+	ratio : int
+		Gearbox ratio of both SERDES
+	support_5GTps_u : bool
+		Whether the upstream port supports 5 GT/s
+	support_5GTps_d : bool
+		Whether the downstream port supports 5 GT/s
+	virtual_tl_u : bool
+		Replace the transaction layer of the upstream port with a VirtualTransactionLayer
+	virtual_tl_d : bool
+		Replace the transaction layer of the downstream port with a VirtualTransactionLayer
+	cut_through : bool
+		Cut-through mode of the upstream port, see PCIeDLLTLPReceiver
+	aspm : bool
+		ASPM support of the upstream port, see PCIePhy
+	"""
+	def __init__(self, ratio: int = 4, support_5GTps_u: bool = False, support_5GTps_d: bool = False, virtual_tl_u: bool = True,
+		virtual_tl_d: bool = True, cut_through: bool = False, aspm: bool = False):
+		self.serdes_u = VirtualPCIeSERDESx4(speed_5GTps=support_5GTps_u, gearing=ratio)
+		self.serdes_d = VirtualPCIeSERDESx4(speed_5GTps=support_5GTps_d, gearing=ratio)
+		self.aligner_u = DomainRenamer({"rx": "sync", "tx": "sync"})(PCIeSERDESAligner(self.serdes_u.lane))
+		self.aligner_d = DomainRenamer({"rx": "sync", "tx": "sync"})(PCIeSERDESAligner(self.serdes_d.lane))
+
+		phy_u = PCIePhy(self.aligner_u, upstream=True, support_5GTps=support_5GTps_u, cut_through=cut_through, aspm=aspm)
+		phy_d = PCIePhy(self.aligner_d, upstream=False, support_5GTps=support_5GTps_d)
+		if virtual_tl_u:
+			phy_u.tlp = VirtualTransactionLayer(ratio)
+		if virtual_tl_d:
+			phy_d.tlp = VirtualTransactionLayer(ratio)
+		self.phy_u = DomainRenamer({"rx": "sync", "tx": "sync"})(phy_u)
+		self.phy_d = DomainRenamer({"rx": "sync", "tx": "sync"})(phy_d)
+		self.phy_u.ltssm.simulate = True
+		self.phy_d.ltssm.simulate = True
+
+	def elaborate(self, platform: Platform) -> Module:
+		m = Module()
+
+		m.submodules.serdes_u = self.serdes_u
+		m.submodules.serdes_d = self.serdes_d
+		m.submodules.aligner_u = self.aligner_u
+		m.submodules.aligner_d = self.aligner_d
+		m.submodules.phy_u = self.phy_u
+		m.submodules.phy_d = self.phy_d
+
+		# The speed is changed by the LTSSM in Recovery.Speed
+		for serdes, phy in [(self.serdes_u, self.phy_u), (self.serdes_d, self.phy_d)]:
+			m.d.comb += serdes.lane.speed.eq(Mux(phy.ltssm.status.link.speed, LinkSpeed.S5_0, LinkSpeed.S2_5))
+
+		m.d.comb += self.serdes_u.lane.rx_symbol.eq(self.serdes_d.lane.tx_symbol)
+		m.d.comb += self.serdes_d.lane.rx_symbol.eq(self.serdes_u.lane.tx_symbol)
+
+		return m
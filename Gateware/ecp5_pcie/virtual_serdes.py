@@ -9,7 +9,7 @@ __all__ = ["VirtualPCIeSERDESx4"]
 class VirtualPCIeSERDESx4(Elaboratable): # Based on Yumewatari
     """
     Lattice ECP5 DCU configured in PCIe mode, 2.5 or 5 GT/s. Assumes 100 MHz reference clock on SERDES clock input pair. Only provides a single lane.
-    Uses 1:4 gearing.
+    Uses 1:4 gearing by default.
 
     Clock frequencies are 125 MHz for 5 GT/s and 62.5 MHz for 2.5 GT/s.
 
@@ -21,6 +21,8 @@ class VirtualPCIeSERDESx4(Elaboratable): # Based on Yumewatari
         Which DCU to use
     CH : int
         Which channel within the DCU to use
+    gearing : int
+        Symbols per clock cycle, 4 or 8
 
     Attributes
     ----------
@@ -35,16 +37,17 @@ class VirtualPCIeSERDESx4(Elaboratable): # Based on Yumewatari
     tx_clk_i : Signal
         Clock for the transmit FIFO.
     """
-    def __init__(self, speed_5GTps=True, DCU=0, CH=0):
+    def __init__(self, speed_5GTps=True, DCU=0, CH=0, gearing=4):
+        assert gearing == 4 or gearing == 8
 
         self.rx_clk = Signal()  # recovered word clock
 
         self.tx_clk = Signal()  # generated word clock
 
         # The PCIe lane with all signals necessary to control it
-        self.lane = PCIeSERDESInterface(4)
+        self.lane = PCIeSERDESInterface(gearing)
 
-        self.gearing = 4
+        self.gearing = gearing
 
         self.DCU = DCU
         self.CH = CH
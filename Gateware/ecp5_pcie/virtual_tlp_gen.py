@@ -37,19 +37,23 @@ class PCIeVirtualTLPGenerator(Elaboratable):
 			with m.If(timer == 2):
 				pass
 
-			for j in range(len(test_tlp_1) // 4):
-				with m.Elif(timer == 10 + j):
-					for i in range(ratio):
-						m.d.rx += self.tlp_source.symbol[i].eq(test_tlp_1[i + j * 4])
-						m.d.rx += self.tlp_source.valid[i].eq(1)
-
-			for j in range(len(test_tlp_2) // 4):
-				with m.Elif(timer == 300 + j):
-					for i in range(ratio):
-						m.d.rx += self.tlp_source.symbol[i].eq(test_tlp_2[i + j * 4])
-						m.d.rx += self.tlp_source.valid[i].eq(1)
+			# The last word is partially valid if the TLP isn't a multiple of the ratio long
+			for start, test_tlp in [(10, test_tlp_1), (300, test_tlp_2)]:
+				words = (len(test_tlp) + ratio - 1) // ratio
+				for j in range(words):
+					with m.Elif(timer == start + j):
+						m.d.rx += self.tlp_source.first.eq(j == 0)
+						m.d.rx += self.tlp_source.last.eq(j == words - 1)
+						for i in range(ratio):
+							if i + j * ratio < len(test_tlp):
+								m.d.rx += self.tlp_source.symbol[i].eq(test_tlp[i + j * ratio])
+								m.d.rx += self.tlp_source.valid[i].eq(1)
+							else:
+								m.d.rx += self.tlp_source.valid[i].eq(0)
 
 			with m.Else():
+				m.d.rx += self.tlp_source.first.eq(0)
+				m.d.rx += self.tlp_source.last.eq(0)
 				for i in range(ratio):
 					m.d.rx += self.tlp_source.valid[i].eq(0)
 
@@ -1,32 +1,89 @@
 from amaranth import *
-from amaranth.back.pysim import Simulator, Delay, Settle
+from amaranth.sim import Simulator, Settle
 from ecp5_pcie.lfsr import PCIeLFSR
 import random
 
-if __name__ == "__main__":
+# Compares the scrambling data of PCIeLFSR with a bit serial model of the LFSR from section 4.2.3 of PCIe 1.1 for random
+# positions of COM, which resets the LFSR, and SKP, which doesn't advance it, with and without the pipeline stage.
+
+
+class SerialLFSR:
+    """
+    Bit serial LFSR with G(X) = X^16 + X^5 + X^4 + X^3 + 1, the first bit out is the LSB of the scrambling byte
+    """
+    def __init__(self):
+        self.state = 0xFFFF
+
+    def byte(self):
+        state = self.state
+        value = 0
+        for i in range(8):
+            out = state >> 15
+            value |= out << i
+            state = (state << 1) & 0xFFFF
+            if out:
+                state ^= 0x0039
+        return value, state
+
+    def symbol(self, reset, advance):
+        value, state = self.byte()
+        if reset:
+            self.state = 0xFFFF
+        elif advance:
+            self.state = state
+        return value
+
+
+def test(ratio, pipeline, words = 200):
     m = Module()
 
-    m.submodules.lfsr = lfsr = PCIeLFSR(4, Signal(), 1)
+    reset = Signal(ratio)
+    advance = Signal(ratio)
+    m.submodules.lfsr = lfsr = PCIeLFSR(ratio, reset, advance, pipeline)
 
     sim = Simulator(m)
     sim.add_clock(1/125e6, domain="rx")
-    
+
     def process():
-        for _ in range(20):
-            print(hex((yield lfsr.output)))
-            yield
-        
-        print()
+        model = SerialLFSR()
+        expected = []
+        outputs = []
 
-        yield lfsr.reset.eq(1)
-        yield
-        yield lfsr.reset.eq(0)
+        for _ in range(words):
+            resets = [random.random() < 0.1 for _ in range(ratio)]
+            advances = [not reset and random.random() > 0.2 for reset in resets]
+            expected.append([model.symbol(resets[i], advances[i]) for i in range(ratio)])
 
-        for _ in range(20):
-            print(bin((yield lfsr.output + 0x100000000000000000)))
+            yield reset.eq(sum(bit << i for i, bit in enumerate(resets)))
+            yield advance.eq(sum(bit << i for i, bit in enumerate(advances)))
+            yield Settle()
+            outputs.append((yield lfsr.output))
             yield
 
-    sim.add_sync_process(process, domain="rx") # or sim.add_sync_process(process), see below
+        yield Settle()
+        outputs.append((yield lfsr.output))
+
+        # The pipeline stage delays the output by a word
+        delay = 1 if pipeline else 0
+        for n, symbols in enumerate(expected):
+            output = [(outputs[n + delay] >> (9 * i)) & 0x1FF for i in range(ratio)]
+            assert output == symbols, f"Word {n}: {[hex(x) for x in output]}, expected {[hex(x) for x in symbols]}"
+
+        print(f"{ratio} bytes{' with pipeline' if pipeline else ''}: {words} words match the serial LFSR")
+
+    sim.add_sync_process(process, domain="rx")
 
     with sim.write_vcd("test.vcd", "test.gtkw"):
-        sim.run()
\ No newline at end of file
+        sim.run()
+
+
+if __name__ == "__main__":
+    random.seed(0)
+
+    # Scrambling data after a reset from Appendix C of PCIe 1.1
+    model = SerialLFSR()
+    assert [model.symbol(False, True) for _ in range(8)] == [0xFF, 0x17, 0xC0, 0x14, 0xB2, 0xE7, 0x02, 0x82]
+
+    for ratio in [4, 8, 16]:
+        for pipeline in [False, True]:
+            test(ratio, pipeline)